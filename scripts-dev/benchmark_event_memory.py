@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the memory used by the different event classes.
+
+Builds a set of synthetic room events from JSON, in the same way as they are
+loaded from the database, and reports the memory held per event by each class.
+Needs python 3 (for tracemalloc).
+"""
+
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from synapse import events
+from synapse.events import (
+    CompactFrozenEvent,
+    CompactFrozenEventV2,
+    FrozenEvent,
+    FrozenEventV2,
+)
+
+
+def make_event_json(i, v2):
+    room = "!room%i:example.com" % (i % 50,)
+    sender = "@user%i:example.com" % (i % 1000,)
+
+    if v2:
+        prev_events = ["$%043i" % (i - 1,)]
+        auth_events = ["$%043i" % (j,) for j in range(3)]
+    else:
+        prev_events = [["$%i:example.com" % (i - 1,), {"sha256": "a" * 43}]]
+        auth_events = [
+            ["$%i:example.com" % (j,), {"sha256": "b" * 43}] for j in range(3)
+        ]
+
+    event = {
+        "room_id": room,
+        "sender": sender,
+        "origin": "example.com",
+        "origin_server_ts": 1550000000000 + i,
+        "depth": i,
+        "prev_events": prev_events,
+        "auth_events": auth_events,
+        "hashes": {"sha256": "c" * 43},
+        "signatures": {"example.com": {"ed25519:a_abcd": "d" * 86}},
+        "unsigned": {"age_ts": 1550000000000 + i},
+    }
+    if not v2:
+        event["event_id"] = "$%i:example.com" % (i,)
+
+    if i % 5 == 0:
+        event["type"] = "m.room.member"
+        event["state_key"] = sender
+        event["content"] = {
+            "membership": "join",
+            "displayname": "User %i" % (i % 1000,),
+            "avatar_url": "mxc://example.com/%032i" % (i,),
+        }
+    else:
+        event["type"] = "m.room.message"
+        event["content"] = {
+            "msgtype": "m.text",
+            "body": "This is message number %i in the room" % (i,),
+        }
+
+    return json.dumps(event)
+
+
+def measure(cls, rows, read_content):
+    gc.collect()
+    tracemalloc.start()
+    start = time.time()
+
+    evs = [cls(json.loads(js), {"stream_ordering": i}) for i, js in enumerate(rows)]
+    if read_content:
+        for ev in evs:
+            ev.content
+
+    duration = time.time() - start
+    gc.collect()
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return used, duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-n", "--events", type=int, default=100000,
+        help="number of events to build (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--frozen-dicts", action="store_true",
+        help="build the non-compact events with frozen dicts",
+    )
+    args = parser.parse_args()
+
+    events.USE_FROZEN_DICTS = args.frozen_dicts
+
+    for v2, classes in (
+        (False, (FrozenEvent, CompactFrozenEvent)),
+        (True, (FrozenEventV2, CompactFrozenEventV2)),
+    ):
+        rows = [make_event_json(i, v2) for i in range(args.events)]
+        for cls in classes:
+            for read_content in (False, True):
+                used, duration = measure(cls, rows, read_content)
+                print(
+                    "%-22s content %-8s %7.0f bytes/event  %6.2f us/event" % (
+                        cls.__name__,
+                        "read" if read_content else "unread",
+                        used / args.events,
+                        duration * 1e6 / args.events,
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
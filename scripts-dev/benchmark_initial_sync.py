@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reports how long an initial sync takes against the number of rooms the user
+is in, loading the rooms' recent events in bulk and a room at a time.
+
+Uses an in-memory SQLite homeserver from the test utilities, so must be run
+from the root of the source tree.
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import time
+
+from twisted.internet import defer, task
+
+from synapse.api.filtering import DEFAULT_FILTER_COLLECTION
+from synapse.handlers.sync import SyncConfig
+from synapse.types import UserID, create_requester
+
+from tests.utils import setup_test_homeserver
+
+USER_ID = "@user:test"
+
+
+@defer.inlineCallbacks
+def add_rooms(hs, count, messages):
+    requester = create_requester(USER_ID)
+    room_creation_handler = hs.get_room_creation_handler()
+    event_creation_handler = hs.get_event_creation_handler()
+
+    for _ in range(count):
+        info = yield room_creation_handler.create_room(
+            requester, {}, ratelimit=False,
+        )
+        for i in range(messages):
+            yield event_creation_handler.create_and_send_nonmember_event(
+                requester, {
+                    "type": "m.room.message",
+                    "room_id": info["room_id"],
+                    "sender": USER_ID,
+                    "content": {"msgtype": "m.text", "body": "message %i" % (i,)},
+                }, ratelimit=False,
+            )
+
+
+@defer.inlineCallbacks
+def measure(hs, repeats):
+    sync_handler = hs.get_sync_handler()
+    sync_config = SyncConfig(
+        user=UserID.from_string(USER_ID),
+        filter_collection=DEFAULT_FILTER_COLLECTION,
+        is_guest=False,
+        request_key=None,
+        device_id=None,
+    )
+
+    start = time.time()
+    for _ in range(repeats):
+        yield sync_handler.generate_sync_result(sync_config)
+    defer.returnValue((time.time() - start) / repeats)
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    hs = yield setup_test_homeserver(lambda f: None, "test")
+    yield hs.get_datastore().register(USER_ID, None, None)
+
+    sync_handler = hs.get_sync_handler()
+    prefetch_recents = sync_handler._prefetch_recents
+
+    def no_prefetch(*args, **kwargs):
+        return defer.succeed(None)
+
+    print("%8s %12s %12s" % ("rooms", "bulk", "per room"))
+
+    rooms = 0
+    for count in args.rooms:
+        yield add_rooms(hs, count - rooms, args.messages)
+        rooms = count
+
+        # Fill the caches, as a server that has been running a while would
+        # have them.
+        yield measure(hs, 1)
+
+        sync_handler._prefetch_recents = prefetch_recents
+        bulk = yield measure(hs, args.repeats)
+
+        sync_handler._prefetch_recents = no_prefetch
+        per_room = yield measure(hs, args.repeats)
+
+        print("%8i %10.1fms %10.1fms" % (count, bulk * 1000, per_room * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-r", "--rooms", type=int, nargs="+", default=[10, 100, 500],
+        help="numbers of rooms to measure (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-m", "--messages", type=int, default=5,
+        help="number of messages in each room (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-n", "--repeats", type=int, default=3,
+        help="number of syncs to time at each size (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    task.react(run, (args,))
+
+
+if __name__ == "__main__":
+    main()
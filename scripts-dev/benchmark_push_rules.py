@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the time taken to evaluate push rules for every member of a large
+room, using the compiled rules against checking each user's rules in turn.
+
+Most of the synthetic users have the default rules, and a few have a keyword
+rule of their own or have disabled a default rule.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import time
+
+from synapse.events import FrozenEvent
+from synapse.push.bulk_push_rule_evaluator import _actions_for_users
+from synapse.push.push_rule_evaluator import PushRuleEvaluatorForEvent
+from synapse.storage.push_rule import _load_rules
+from synapse.storage.roommember import ProfileInfo
+
+BODIES = [
+    "Has anyone got the notes from yesterday's meeting?",
+    "user42: could you have a look at this when you get a chance",
+    "Thanks Person 7, that fixed it!",
+    "@room the server will be restarted in 5 minutes",
+]
+
+
+def make_room(members):
+    room_members = {}
+    rules_by_user = {}
+    for i in range(members):
+        user_id = "@user%i:example.com" % (i,)
+        room_members[user_id] = ProfileInfo(
+            avatar_url=None, display_name="Person %i" % (i,),
+        )
+
+        raw_rules = []
+        enabled = {}
+        if i % 50 == 0:
+            raw_rules.append({
+                "rule_id": "keyword%i" % (i,),
+                "priority_class": 4,
+                "priority": 0,
+                "conditions": json.dumps([{
+                    "kind": "event_match",
+                    "key": "content.body",
+                    "pattern": "meeting",
+                }]),
+                "actions": json.dumps(["notify", {"set_tweak": "highlight"}]),
+            })
+        if i % 70 == 0:
+            enabled["global/underride/.m.rule.message"] = False
+
+        rules_by_user[user_id] = _load_rules(raw_rules, enabled)
+
+    return room_members, rules_by_user
+
+
+def make_event(i, body):
+    return FrozenEvent({
+        "event_id": "$%i:example.com" % (i,),
+        "room_id": "!room:example.com",
+        "type": "m.room.message",
+        "sender": "@user0:example.com",
+        "content": {"msgtype": "m.text", "body": body},
+    })
+
+
+def per_user_actions(evaluator, event, rules_by_user, room_members):
+    """Evaluate each user's rules in turn, as BulkPushRuleEvaluator used to."""
+    actions_by_user = {}
+    condition_cache = {}
+
+    for uid, rules in rules_by_user.items():
+        if event.sender == uid:
+            continue
+
+        display_name = None
+        profile_info = room_members.get(uid)
+        if profile_info:
+            display_name = profile_info.display_name
+
+        for rule in rules:
+            if 'enabled' in rule and not rule['enabled']:
+                continue
+
+            matches = True
+            for cond in rule['conditions']:
+                _id = cond.get("_id", None)
+                res = condition_cache.get(_id, None) if _id else None
+                if res is None:
+                    res = bool(evaluator.matches(cond, uid, display_name))
+                    if _id:
+                        condition_cache[_id] = res
+                if not res:
+                    matches = False
+                    break
+
+            if matches:
+                actions = [x for x in rule['actions'] if x != 'dont_notify']
+                if actions and 'notify' in actions:
+                    actions_by_user[uid] = actions
+                break
+
+    return actions_by_user
+
+
+def measure(fn, events, room_members, rules_by_user):
+    results = []
+    start = time.time()
+    for event in events:
+        evaluator = PushRuleEvaluatorForEvent(
+            event, len(room_members), 100, {},
+        )
+        results.append(fn(evaluator, event, rules_by_user, room_members))
+    return time.time() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-m", "--members", type=int, default=10000,
+        help="number of users in the room (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-n", "--events", type=int, default=20,
+        help="number of events to evaluate (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    room_members, rules_by_user = make_room(args.members)
+    events = [
+        make_event(i, BODIES[i % len(BODIES)]) for i in range(args.events)
+    ]
+
+    # the first run compiles the rules, which only happens when they change
+    measure(_actions_for_users, events[:1], room_members, rules_by_user)
+
+    old_duration, old_results = measure(
+        per_user_actions, events, room_members, rules_by_user,
+    )
+    new_duration, new_results = measure(
+        _actions_for_users, events, room_members, rules_by_user,
+    )
+
+    if old_results != new_results:
+        raise Exception("Compiled rules gave different actions")
+
+    for name, duration in (("per user", old_duration), ("compiled", new_duration)):
+        print("%-10s %8.2f ms/event" % (name, duration * 1000 / args.events))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the throughput of the TCP replication line protocol (one RDATA per
+row) against sending the rows as RDATA_BATCH commands.
+
+Events stream rows are sent from a master protocol to a number of workers, a
+batch at a time as the master's notifier loop would. Reports the time the
+master spends encoding and writing the rows, and the time a worker spends
+parsing and handling them.
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from twisted.internet import reactor
+from twisted.test.proto_helpers import StringTransport
+
+from synapse.replication.tcp.protocol import (
+    ClientReplicationStreamProtocol,
+    ServerReplicationStreamProtocol,
+    rdata_batch_commands,
+)
+from synapse.util import Clock
+
+READ_SIZE = 64 * 1024
+
+
+class Streamer(object):
+    def new_connection(self, connection):
+        pass
+
+    def lost_connection(self, connection):
+        pass
+
+
+class Handler(object):
+    def __init__(self):
+        self.rows = 0
+
+    def get_streams_to_replicate(self):
+        return {}
+
+    def get_currently_syncing_users(self):
+        return []
+
+    def update_connection(self, connection):
+        pass
+
+    def finished_connecting(self):
+        pass
+
+    def on_rdata(self, stream_name, token, rows):
+        self.rows += len(rows)
+
+
+def make_updates(count):
+    return [
+        (i, (
+            "$%i:example.com" % (i,),
+            "!room%i:example.com" % (i % 100,),
+            "m.room.message",
+            None,
+            None,
+        ))
+        for i in range(count)
+    ]
+
+
+def make_server(clock, use_rdata_batch):
+    server = ServerReplicationStreamProtocol("example.com", clock, Streamer())
+    server.makeConnection(StringTransport())
+    server.replication_streams.add("events")
+    server.use_rdata_batch = use_rdata_batch
+    return server
+
+
+def run(clock, updates, workers, batch_size, use_rdata_batch):
+    servers = [make_server(clock, use_rdata_batch) for _ in range(workers)]
+
+    start = time.time()
+    for i in range(0, len(updates), batch_size):
+        batches = rdata_batch_commands("events", updates[i:i + batch_size])
+        for server in servers:
+            server.stream_updates("events", batches)
+    send_duration = time.time() - start
+
+    # every worker receives the same data, so we only need to time one
+    data = servers[0].transport.value()
+
+    handler = Handler()
+    client = ClientReplicationStreamProtocol("worker", "example.com", clock, handler)
+    client.makeConnection(StringTransport())
+
+    # feed the data to the worker as it would be read from the socket
+    start = time.time()
+    for i in range(0, len(data), READ_SIZE):
+        client.dataReceived(data[i:i + READ_SIZE])
+    receive_duration = time.time() - start
+
+    if handler.rows != len(updates):
+        raise Exception("Received %i of %i rows" % (handler.rows, len(updates)))
+
+    return send_duration, receive_duration, len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-r", "--rows", type=int, default=100000,
+        help="number of rows to send (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=10,
+        help="number of connected workers (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-b", "--batch-size", type=int, default=50,
+        help="number of rows sent per notifier loop (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    clock = Clock(reactor)
+    updates = make_updates(args.rows)
+
+    print("%-12s %14s %14s %10s" % ("", "master rows/s", "worker rows/s", "bytes"))
+    for name, use_rdata_batch in (("RDATA", False), ("RDATA_BATCH", True)):
+        send_duration, receive_duration, length = run(
+            clock, updates, args.workers, args.batch_size, use_rdata_batch,
+        )
+        print("%-12s %14i %14i %10i" % (
+            name,
+            args.rows * args.workers / send_duration,
+            args.rows / receive_duration,
+            length,
+        ))
+
+
+if __name__ == "__main__":
+    main()
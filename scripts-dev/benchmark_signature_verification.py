@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Reports how many event signatures per second the Keyring verifies, and the
+longest time the reactor was blocked while doing so.
+
+Compares checking the signatures on the reactor thread with checking them in
+batches in the threadpool. Uses an in-memory SQLite homeserver from the test utilities, so
+must be run from the root of the source tree.
+"""
+
+from __future__ import print_function
+
+import argparse
+import logging
+import time
+
+from signedjson.key import generate_signing_key, get_verify_key
+from signedjson.sign import sign_json
+
+from twisted.internet import defer, task
+
+from synapse.util import Clock
+
+from tests.utils import setup_test_homeserver
+
+SERVER_NAMES = ["server%i.example.com" % (i,) for i in range(5)]
+
+
+def make_events(count):
+    """Makes signed PDU-like objects from a few servers"""
+    keys = {name: generate_signing_key("a_%i" % (i,)) for i, name in enumerate(
+        SERVER_NAMES,
+    )}
+
+    events = []
+    for i in range(count):
+        origin = SERVER_NAMES[i % len(SERVER_NAMES)]
+        event = {
+            "type": "m.room.message",
+            "room_id": "!room:example.com",
+            "sender": "@user%i:%s" % (i, origin),
+            "origin": origin,
+            "origin_server_ts": 1550000000000 + i,
+            "depth": i,
+            "prev_events": [["$prev%i:%s" % (i, origin), {"sha256": "abc"}]],
+            "auth_events": [["$auth%i:%s" % (j, origin), {"sha256": "abc"}]
+                            for j in range(3)],
+            "hashes": {"sha256": "d7tD5iK1zOSaNpNa7sq9zmVqzBp4HbWAtXlbs4F4cvg"},
+            "content": {"msgtype": "m.text", "body": "message %i" % (i,)},
+            "unsigned": {"age_ts": 1550000000000 + i},
+        }
+        sign_json(event, origin, keys[origin])
+        events.append((origin, event))
+
+    return keys, events
+
+
+class StallMonitor(object):
+    """Measures the longest gap between reactor ticks"""
+    def __init__(self, reactor):
+        self.longest = 0
+        self._last = time.time()
+        self._loop = task.LoopingCall(self._tick)
+        self._loop.clock = reactor
+
+    def _tick(self):
+        now = time.time()
+        self.longest = max(self.longest, now - self._last)
+        self._last = now
+
+    def start(self):
+        self._last = time.time()
+        self.longest = 0
+        self._loop.start(0.001)
+
+    def stop(self):
+        self._loop.stop()
+        self._tick()
+
+
+def verify(reactor, hs, keys, events):
+    return defer.gatherResults(
+        hs.get_keyring().verify_json_objects_for_server(events),
+    )
+
+
+@defer.inlineCallbacks
+def measure(reactor, hs, fn, keys, events, repeats):
+    monitor = StallMonitor(reactor)
+    monitor.start()
+
+    start = time.time()
+    for _ in range(repeats):
+        yield fn(reactor, hs, keys, events)
+    duration = time.time() - start
+
+    monitor.stop()
+    defer.returnValue((len(events) * repeats / duration, monitor.longest))
+
+
+@defer.inlineCallbacks
+def run(reactor, args):
+    reactor.suggestThreadPoolSize(args.threads)
+
+    hs = yield setup_test_homeserver(
+        lambda f: None, "test", reactor=reactor, clock=Clock(reactor),
+    )
+    keys, events = make_events(args.events)
+
+    now = time.time() * 1000
+    for server_name, key in keys.items():
+        yield hs.get_datastore().store_server_verify_key(
+            server_name, "", now, get_verify_key(key),
+        )
+
+    # warm the key caches
+    yield verify(reactor, hs, keys, events[:len(SERVER_NAMES)])
+
+    print("%-26s %14s %14s" % ("", "signatures/s", "longest block"))
+    for name, fn, in_threadpool in (
+        ("reactor thread", verify, False),
+        ("threadpool", verify, True),
+    ):
+        hs.config.verify_signatures_in_threadpool = in_threadpool
+        rate, longest = yield measure(reactor, hs, fn, keys, events, args.repeats)
+        print("%-26s %14i %12.1fms" % (name, rate, longest * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-e", "--events", type=int, default=1000,
+        help="number of signed events to verify (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-n", "--repeats", type=int, default=5,
+        help="number of times to verify the events (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-t", "--threads", type=int, default=4,
+        help="size of the reactor's threadpool (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    task.react(run, (args,))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares encoding a large /sync response in one go against streaming it.
+
+Builds a synthetic initial sync result, and reports the extra memory used
+while encoding it and the longest time the reactor would be blocked for.
+Needs python 3 (for tracemalloc).
+"""
+
+import argparse
+import time
+import tracemalloc
+
+from canonicaljson import json
+
+from synapse.events import FrozenEvent
+from synapse.handlers.sync import (
+    DeviceLists,
+    GroupsSyncResult,
+    JoinedSyncResult,
+    SyncResult,
+    TimelineBatch,
+)
+from synapse.http.server import JSON_STREAM_BUFFER_SIZE, LazyJsonObject, _iterencode_json
+from synapse.rest.client.v2_alpha.sync import SyncRestServlet
+from synapse.types import StreamToken
+
+
+class Filter(object):
+    event_format = "client"
+    event_fields = []
+
+
+def make_event(room_id, i, state_key=None):
+    event = {
+        "event_id": "$%i:example.com" % (i,),
+        "room_id": room_id,
+        "sender": "@user%i:example.com" % (i % 100,),
+        "origin_server_ts": 1550000000000 + i,
+        "type": "m.room.message",
+        "content": {"msgtype": "m.text", "body": "message %i " % (i,) * 5},
+        "unsigned": {"age_ts": 1550000000000 + i},
+    }
+    if state_key is not None:
+        event["type"] = "m.room.member"
+        event["state_key"] = state_key
+        event["content"] = {
+            "membership": "join",
+            "displayname": "User %i" % (i,),
+            "avatar_url": "mxc://example.com/%i" % (i,),
+        }
+    return FrozenEvent(event)
+
+
+def make_sync_result(rooms, state, timeline):
+    joined = []
+    i = 0
+    for r in range(rooms):
+        room_id = "!room%i:example.com" % (r,)
+
+        state_events = {}
+        for s in range(state):
+            state_key = "@user%i:example.com" % (s,)
+            state_events[("m.room.member", state_key)] = make_event(
+                room_id, i, state_key,
+            )
+            i += 1
+
+        timeline_events = []
+        for _ in range(timeline):
+            timeline_events.append(make_event(room_id, i))
+            i += 1
+
+        joined.append(JoinedSyncResult(
+            room_id=room_id,
+            timeline=TimelineBatch(
+                prev_batch=StreamToken.START,
+                events=timeline_events,
+                limited=True,
+            ),
+            state=state_events,
+            ephemeral=[],
+            account_data=[],
+            unread_notifications={"notification_count": 0},
+            summary={},
+        ))
+
+    return SyncResult(
+        next_batch=StreamToken.START,
+        presence=[],
+        account_data=[],
+        joined=joined,
+        invited=[],
+        archived=[],
+        to_device=[],
+        device_lists=DeviceLists(changed=[], left=[]),
+        device_one_time_keys_count={},
+        groups=GroupsSyncResult(join={}, invite={}, leave={}),
+    )
+
+
+def encode(json_object):
+    return json.dumps(json_object).encode("utf-8")
+
+
+def materialise(json_object):
+    """Build the whole response in memory, as the servlet used to."""
+    if isinstance(json_object, LazyJsonObject):
+        return {k: materialise(v) for k, v in json_object.items}
+    return json_object
+
+
+def all_at_once(sync_result):
+    start = time.time()
+    response = materialise(
+        SyncRestServlet.encode_response(1, sync_result, None, Filter()),
+    )
+    body = encode(response)
+    return len(body), time.time() - start
+
+
+def streamed(sync_result):
+    response = SyncRestServlet.encode_response(1, sync_result, None, Filter())
+
+    # As in _JsonStreamProducer, we encode a buffer's worth at a time, giving
+    # the reactor a chance to run in between.
+    length = 0
+    longest = 0
+    buf = []
+    size = 0
+    start = time.time()
+    for fragment in _iterencode_json(response, encode):
+        buf.append(fragment)
+        size += len(fragment)
+        if size >= JSON_STREAM_BUFFER_SIZE:
+            length += len(b"".join(buf))
+            longest = max(longest, time.time() - start)
+            buf = []
+            size = 0
+            start = time.time()
+
+    length += len(b"".join(buf))
+    longest = max(longest, time.time() - start)
+    return length, longest
+
+
+def measure(fn, sync_result):
+    tracemalloc.start()
+    length, blocked = fn(sync_result)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return length, blocked, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-r", "--rooms", type=int, default=2000,
+        help="number of joined rooms (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-s", "--state", type=int, default=20,
+        help="number of state events per room (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-t", "--timeline", type=int, default=10,
+        help="number of timeline events per room (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    sync_result = make_sync_result(args.rooms, args.state, args.timeline)
+
+    print("%-14s %10s %16s %14s" % ("", "body", "longest block", "peak memory"))
+    for name, fn in (("all at once", all_at_once), ("streamed", streamed)):
+        length, blocked, peak = measure(fn, sync_result)
+        print("%-14s %8.1fMB %14.1fms %12.1fMB" % (
+            name, length / 1024. / 1024, blocked * 1000, peak / 1024. / 1024,
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -29,6 +29,7 @@ import synapse
 from synapse.app import check_bind_error
 from synapse.crypto import context_factory
 from synapse.util import PreserveLoggingContext
+from synapse.util.caches.lrucache import setup_expire_lru_cache_entries
 from synapse.util.rlimit import change_resource_limit
 from synapse.util.versionstring import get_version_string
 
@@ -279,6 +280,8 @@ def start(hs, listeners=None):
         hs.start_listening(listeners)
         hs.get_datastore().start_profiling()
 
+        setup_expire_lru_cache_entries(hs)
+
         setup_sentry(hs)
     except Exception:
         traceback.print_exc(file=sys.stderr)
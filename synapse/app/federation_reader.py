@@ -145,6 +145,7 @@ class FederationReaderServer(HomeServer):
                 logger.warn("Unrecognized listener type: %s", listener["type"])
 
         self.get_tcp_replication().start_replication(self)
+        self.get_keyring().start()
 
     def build_tcp_replication(self):
         return ReplicationClientHandler(self.get_datastore())
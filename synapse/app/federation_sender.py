@@ -40,6 +40,7 @@ from synapse.replication.slave.storage.transactions import SlavedTransactionStor
 from synapse.replication.tcp.client import ReplicationClientHandler
 from synapse.replication.tcp.streams import ReceiptsStream
 from synapse.server import HomeServer
+from synapse.storage._base import LoggingTransaction
 from synapse.storage.engines import create_engine
 from synapse.types import ReadReceipt
 from synapse.util.async_helpers import Linearizer
@@ -62,21 +63,36 @@ class FederationSenderSlaveStore(
         # always have a known value for the federation position in memory so
         # that we don't have to bounce via a deferred once when we start the
         # replication streams.
-        self.federation_out_pos_startup = self._get_federation_out_pos(db_conn)
+        instance_name = "master"
+        if hs.config.federation_sender_instances:
+            instance_name = hs.config.worker_name
+        self.federation_out_pos_startup = self._get_federation_out_pos(
+            db_conn, instance_name,
+        )
+
+    def _get_federation_out_pos(self, db_conn, instance_name):
+        txn = LoggingTransaction(
+            db_conn.cursor(),
+            name="_get_federation_out_pos",
+            database_engine=self.database_engine,
+            after_callbacks=[],
+            exception_callbacks=[],
+        )
 
-    def _get_federation_out_pos(self, db_conn):
-        sql = (
-            "SELECT stream_id FROM federation_stream_position"
-            " WHERE type = ?"
+        # If the set of senders has changed, this resets every sender's
+        # position to that of the furthest behind.
+        self.reconcile_federation_out_pos_txn(
+            txn, self.hs.config.federation_sender_instances,
+        )
+        self._federation_out_pos_reconciled = True
+        stream_id = self._get_federation_out_pos_txn(
+            txn, "federation", instance_name,
         )
-        sql = self.database_engine.convert_param_style(sql)
 
-        txn = db_conn.cursor()
-        txn.execute(sql, ("federation",))
-        rows = txn.fetchall()
         txn.close()
+        db_conn.commit()
 
-        return rows[0][0] if rows else -1
+        return stream_id if stream_id is not None else -1
 
 
 class FederationSenderServer(HomeServer):
@@ -182,6 +198,17 @@ def start(config_options):
         )
         sys.exit(1)
 
+    if (
+        config.federation_sender_instances
+        and config.worker_name not in config.federation_sender_instances
+    ):
+        sys.stderr.write(
+            "\nThe worker_name of each federation sender must be listed in"
+            "\nfederation_sender_instances when sending is sharded, but %r isn't."
+            "\n" % (config.worker_name,)
+        )
+        sys.exit(1)
+
     # Force the pushers to start since they will be disabled in the main config
     config.send_federation = True
 
@@ -273,7 +300,8 @@ class FederationSenderHandler(object):
             with (yield self._fed_position_linearizer.queue(None)):
                 if self._last_ack < self.federation_position:
                     yield self.store.update_federation_out_pos(
-                        "federation", self.federation_position
+                        "federation", self.federation_position,
+                        self.federation_sender.instance_name,
                     )
 
                     # We ACK this token over replication so that the master can drop
@@ -439,6 +439,7 @@ def setup(config_options):
             _base.start(hs, config.listeners)
 
             hs.get_pusherpool().start()
+            hs.get_keyring().start()
             hs.get_datastore().start_doing_background_updates()
         except Exception:
             # Print the exception and bail out.
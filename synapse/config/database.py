@@ -24,6 +24,22 @@ class DatabaseConfig(Config):
             config.get("event_cache_size", "10K")
         )
 
+        self.compact_event_cache = config.get("compact_event_cache", False)
+
+        self.max_state_delta_hops = config.get("max_state_delta_hops", 100)
+
+        shared_event_cache = config.get("shared_event_cache") or {}
+        self.shared_event_cache_path = shared_event_cache.get("path")
+        self.shared_event_cache_size = self.parse_size(
+            shared_event_cache.get("size", "256M")
+        )
+
+        state_snapshot_cache = config.get("state_snapshot_cache") or {}
+        self.state_snapshot_cache_path = state_snapshot_cache.get("path")
+        self.state_snapshot_cache_size = self.parse_size(
+            state_snapshot_cache.get("size", "1024M")
+        )
+
         self.database_config = config.get("database")
 
         if self.database_config is None:
@@ -62,6 +78,44 @@ class DatabaseConfig(Config):
         # Number of events to cache in memory.
         #
         #event_cache_size: 10K
+
+        # Whether to hold the events loaded from the database in a more compact
+        # form, which uses less memory per cached event at the cost of some CPU
+        # when their content is first read.
+        #
+        #compact_event_cache: false
+
+        # A cache of events which is shared between all of the synapse
+        # processes on this host (the main process and any workers), held in
+        # a memory-mapped file. Events are looked for here before going to the
+        # database, so they only need to be loaded once per host, and workers
+        # which are restarted don't start with a cold cache.
+        #
+        # When enabled, event_cache_size can usually be reduced. The file
+        # should be on a tmpfs, such as /dev/shm. Disabled by default.
+        #
+        #shared_event_cache:
+        #  path: /dev/shm/synapse_event_cache
+        #  size: 256M
+
+        # A cache of the full state at each state group, held in a memory-mapped
+        # file in a compact form. Like shared_event_cache, it is shared between
+        # all of the synapse processes on this host, and survives restarts.
+        # State is looked for here before going to the database.
+        #
+        # The file can be on a tmpfs or on local disk. Disabled by default.
+        #
+        #state_snapshot_cache:
+        #  path: /var/cache/synapse/state_snapshots
+        #  size: 1024M
+
+        # State groups are stored as a chain of deltas against earlier state
+        # groups. This is the longest that chain is allowed to get before a
+        # state group is stored in full instead. Shorter chains make state
+        # lookups quicker but take more space in the database. A background
+        # job rewrites existing chains which are longer than this.
+        #
+        #max_state_delta_hops: 100
         """ % locals()
 
     def read_arguments(self, args):
@@ -50,6 +50,9 @@ class KeyConfig(Config):
         self.key_refresh_interval = self.parse_duration(
             config.get("key_refresh_interval", "1d"),
         )
+        self.verify_signatures_in_threadpool = config.get(
+            "verify_signatures_in_threadpool", False,
+        )
         self.perspectives = self.read_perspectives(
             config.get("perspectives", {}).get("servers", {
                 "matrix.org": {"verify_keys": {
@@ -130,6 +133,13 @@ class KeyConfig(Config):
         #
         #key_refresh_interval: 1d
 
+        # Whether to check the signatures on events and requests from other
+        # servers in a threadpool, rather than on the main thread. This keeps
+        # the server responsive while checking the signatures in large
+        # transactions and room joins.
+        #
+        #verify_signatures_in_threadpool: False
+
         # The trusted servers to download signing keys from.
         #
         #perspectives:
@@ -121,6 +121,19 @@ class ServerConfig(Config):
             for domain in federation_domain_whitelist:
                 self.federation_domain_whitelist[domain] = True
 
+        self.stage_incoming_federation_events = config.get(
+            "stage_incoming_federation_events", False,
+        )
+
+        self.federation_compression = config.get("federation_compression", True)
+
+        self.federation_max_idle_connections_per_server = config.get(
+            "federation_max_idle_connections_per_server", 5,
+        )
+        self.federation_max_idle_connections = config.get(
+            "federation_max_idle_connections", 1000,
+        )
+
         if self.public_baseurl is not None:
             if self.public_baseurl[-1] != '/':
                 self.public_baseurl += '/'
@@ -350,6 +363,37 @@ class ServerConfig(Config):
         #  - nyc.example.com
         #  - syd.example.com
 
+        # Whether to store the events in incoming federation transactions and
+        # acknowledge the transaction straight away, rather than processing the
+        # events before responding. The stored events are then processed in the
+        # background, several rooms at a time, so that a room which is slow to
+        # process doesn't hold up the sending server's other rooms. Events
+        # which were sent a while ago (eg, by a server catching up after an
+        # outage) are processed after recent ones. Once a server has 1000
+        # events waiting, its transactions are rejected until we catch up.
+        #
+        # Each process only processes the events it received itself, so when
+        # using federation_reader workers each must have a distinct worker_name,
+        # and their events are left waiting while they are not running.
+        #
+        #stage_incoming_federation_events: true
+
+        # Whether to gzip the bodies of federation requests and responses, when
+        # the other server supports it. This greatly reduces the size of large
+        # responses, such as those for joining big rooms, at the cost of some
+        # CPU. Defaults to true.
+        #
+        #federation_compression: false
+
+        # The most idle connections to keep open for sending federation
+        # requests, to each server and in total. Keeping connections open saves
+        # setting up new ones for later requests; when there are too many, the
+        # connections which have been idle longest are closed. The defaults are
+        # 5 and 1000.
+        #
+        #federation_max_idle_connections_per_server: 2
+        #federation_max_idle_connections: 5000
+
         # List of ports that Synapse should listen on, their purpose and their
         # configuration.
         #
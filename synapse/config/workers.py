@@ -45,6 +45,12 @@ class WorkerConfig(Config):
 
         self.worker_name = config.get("worker_name", self.worker_app)
 
+        # The worker_names of the federation senders, if sending federation
+        # traffic is sharded between several of them by destination.
+        self.federation_sender_instances = config.get(
+            "federation_sender_instances",
+        ) or []
+
         self.worker_main_http_uri = config.get("worker_main_http_uri", None)
         self.worker_cpu_affinity = config.get("worker_cpu_affinity")
 
@@ -14,7 +14,9 @@
 # limitations under the License.
 
 import logging
+import time
 
+from prometheus_client import Histogram
 from zope.interface import implementer
 
 from OpenSSL import SSL, crypto
@@ -24,8 +26,29 @@ from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
 from twisted.internet.ssl import CertificateOptions, ContextFactory
 from twisted.python.failure import Failure
 
+from synapse.util.caches.lrucache import LruCache
+
+try:
+    # pyOpenSSL doesn't expose whether a session was resumed, so we have to ask
+    # OpenSSL directly.
+    from OpenSSL._util import lib as _openssl_lib
+    _session_reused = _openssl_lib.SSL_session_reused
+except (ImportError, AttributeError):
+    _session_reused = None
+
 logger = logging.getLogger(__name__)
 
+# The number of servers to remember a TLS session for, so that we can resume it
+# rather than doing a full handshake when we next connect.
+TLS_SESSION_CACHE_SIZE = 5000
+
+# How long the TLS handshakes for our outbound federation connections take, by
+# whether they resumed a previous session ("resumed"), did a full handshake
+# ("full"), or we can't tell ("unknown").
+tls_handshake_histogram = Histogram(
+    "synapse_http_federation_client_tls_handshake_seconds", "", ["session"],
+)
+
 
 class ServerContextFactory(ContextFactory):
     """Factory for PyOpenSSL SSL contexts that are used to handle incoming
@@ -89,16 +112,29 @@ def _tolerateErrors(wrapped):
     return infoCallback
 
 
+class _ClientConnection(SSL.Connection):
+    """An SSL.Connection which remembers the server it is to, and when its
+    handshake started.
+    """
+    hostname = None
+    handshake_start = None
+    handshake_done = False
+
+
 @implementer(IOpenSSLClientConnectionCreator)
 class ClientTLSOptions(object):
     """
     Client creator for TLS without certificate identity verification. This is a
     copy of twisted.internet._sslverify.ClientTLSOptions with the identity
     verification left out. For documentation, see the twisted documentation.
+
+    Connections share the factory's context, and resume the last TLS session we
+    had with the server if we have one.
     """
 
-    def __init__(self, hostname, ctx):
+    def __init__(self, hostname, ctx, session_cache):
         self._ctx = ctx
+        self._session_cache = session_cache
 
         if isIPAddress(hostname) or isIPv6Address(hostname):
             self._hostnameBytes = hostname.encode('ascii')
@@ -107,29 +143,68 @@ class ClientTLSOptions(object):
             self._hostnameBytes = _idnaBytes(hostname)
             self._sendSNI = True
 
-        ctx.set_info_callback(_tolerateErrors(self._identityVerifyingInfoCallback))
-
     def clientConnectionForTLS(self, tlsProtocol):
-        context = self._ctx
-        connection = SSL.Connection(context, None)
+        connection = _ClientConnection(self._ctx, None)
         connection.set_app_data(tlsProtocol)
-        return connection
+        connection.hostname = self._hostnameBytes
 
-    def _identityVerifyingInfoCallback(self, connection, where, ret):
         # Literal IPv4 and IPv6 addresses are not permitted
         # as host names according to the RFCs
-        if where & SSL.SSL_CB_HANDSHAKE_START and self._sendSNI:
+        if self._sendSNI:
             connection.set_tlsext_host_name(self._hostnameBytes)
 
+        session = self._session_cache.get(self._hostnameBytes)
+        if session is not None:
+            connection.set_session(session)
+
+        return connection
+
 
 class ClientTLSOptionsFactory(object):
     """Factory for Twisted ClientTLSOptions that are used to make connections
-    to remote servers for federation."""
+    to remote servers for federation.
+
+    All of the connections share an OpenSSL context, and we remember the last
+    TLS session we had with each server so that new connections to it can
+    resume the session instead of doing a full handshake.
+    """
 
     def __init__(self, config):
         # We don't use config options yet
         self._options = CertificateOptions(verify=False)
 
+        self._context = self._options._makeContext()
+        self._context.set_info_callback(_tolerateErrors(self._info_callback))
+
+        # map from server name to the last SSL.Session we had with it
+        self._session_cache = LruCache(TLS_SESSION_CACHE_SIZE)
+
     def get_options(self, host):
-        # Use _makeContext so that we get a fresh OpenSSL CTX each time.
-        return ClientTLSOptions(host, self._options._makeContext())
+        return ClientTLSOptions(host, self._context, self._session_cache)
+
+    def _info_callback(self, connection, where, ret):
+        if where & SSL.SSL_CB_HANDSHAKE_START:
+            if connection.handshake_start is None:
+                connection.handshake_start = time.time()
+
+        if where & SSL.SSL_CB_HANDSHAKE_DONE:
+            # With TLS 1.3, the server sends us session tickets after the
+            # handshake, which also triggers this callback; so we update the
+            # cached session each time.
+            session = connection.get_session()
+            if session is not None:
+                self._session_cache[connection.hostname] = session
+
+            if not connection.handshake_done and connection.handshake_start:
+                connection.handshake_done = True
+
+                if _session_reused is None:
+                    handshake_type = "unknown"
+                elif _session_reused(connection._ssl):
+                    handshake_type = "resumed"
+                else:
+                    handshake_type = "full"
+
+                tls_handshake_histogram.labels(handshake_type).observe(
+                    time.time() - connection.handshake_start,
+                )
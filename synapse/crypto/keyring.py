@@ -17,9 +17,10 @@
 import logging
 from collections import namedtuple
 
-from six import raise_from
+from six import iteritems, raise_from
 from six.moves import urllib
 
+from canonicaljson import json
 from signedjson.key import (
     decode_verify_key_bytes,
     encode_verify_key_base64,
@@ -42,10 +43,14 @@ from synapse.api.errors import (
     RequestSendFailed,
     SynapseError,
 )
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.util import logcontext, unwrapFirstError
+from synapse.util.caches import CACHE_SIZE_FACTOR
+from synapse.util.caches.lrucache import LruCache
 from synapse.util.logcontext import (
     LoggingContext,
     PreserveLoggingContext,
+    defer_to_thread,
     preserve_fn,
     run_in_background,
 )
@@ -54,6 +59,21 @@ from synapse.util.retryutils import NotRetryingDestination
 
 logger = logging.getLogger(__name__)
 
+# The most signatures we check in one go when verifying them in the threadpool
+SIGNATURE_VERIFY_BATCH_SIZE = 100
+
+# How often we check for cached verify keys which are about to expire
+KEY_REFRESH_INTERVAL_MS = 10 * 60 * 1000
+
+# How long before a server's keys expire we start trying to refresh them
+KEY_REFRESH_AHEAD_MS = 60 * 60 * 1000
+
+# We only refresh the keys of servers we've used a key for this recently
+KEY_REFRESH_IDLE_MS = 24 * 60 * 60 * 1000
+
+# The most servers we keep verify keys for in memory
+VERIFY_KEY_CACHE_SIZE = 10000 * CACHE_SIZE_FACTOR
+
 
 VerifyKeyRequest = namedtuple("VerifyRequest", (
     "server_name", "key_ids", "json_object", "deferred"
@@ -77,6 +97,22 @@ class KeyLookupError(ValueError):
     pass
 
 
+class _CachedServerKeys(object):
+    """The verify keys we have in memory for a server"""
+    __slots__ = ["verify_keys", "valid_until_ms", "last_used_ms"]
+
+    def __init__(self):
+        # map from key_id -> VerifyKey
+        self.verify_keys = {}
+
+        # the time until which the keys are valid, or 0 if we don't know (eg,
+        # because we found the keys in server_signature_keys).
+        self.valid_until_ms = 0
+
+        # the last time one of the server's signatures checked out.
+        self.last_used_ms = 0
+
+
 class Keyring(object):
     def __init__(self, hs):
         self.store = hs.get_datastore()
@@ -93,6 +129,29 @@ class Keyring(object):
         # These are regular, logcontext-agnostic Deferreds.
         self.key_downloads = {}
 
+        # Signatures waiting to be checked, and whether we've scheduled a call
+        # to _verify_pending_signatures to check them. See _verify_signature.
+        self._pending_verifies = []
+        self._verify_scheduled = False
+
+        # In-memory cache of the keys we have for other servers, so that
+        # checking a signature with a key we've seen before doesn't need to
+        # wait on the database or on other lookups for that server. Servers
+        # whose keys have expired are dropped by _refresh_expiring_keys.
+        #
+        # map from server_name -> _CachedServerKeys
+        self._verify_key_cache = LruCache(VERIFY_KEY_CACHE_SIZE)
+
+    def start(self):
+        """Warms the cache of verify keys from the database, and starts
+        refreshing the keys of the servers we've heard from recently before
+        they expire.
+        """
+        run_as_background_process("warm_verify_key_cache", self._warm_key_cache)
+        self.clock.looping_call(
+            self._start_refresh_expiring_keys, KEY_REFRESH_INTERVAL_MS,
+        )
+
     def verify_json_for_server(self, server_name, json_object):
         return logcontext.make_deferred_yieldable(
             self.verify_json_objects_for_server(
@@ -138,11 +197,31 @@ class Keyring(object):
 
             verify_requests.append(verify_request)
 
-        run_in_background(self._start_key_lookups, verify_requests)
+        # Resolve the requests we have a cached key for straight away, rather
+        # than waiting for any outstanding lookups for the server.
+        to_lookup = []
+        for verify_request in verify_requests:
+            if verify_request.deferred.called:
+                continue
+
+            server_name = verify_request.server_name
+            cached = self._verify_key_cache.get(server_name)
+            cached_keys = cached.verify_keys if cached else {}
+            for key_id in verify_request.key_ids:
+                if key_id in cached_keys:
+                    verify_request.deferred.callback((
+                        server_name, key_id, cached_keys[key_id],
+                    ))
+                    break
+            else:
+                to_lookup.append(verify_request)
+
+        if to_lookup:
+            run_in_background(self._start_key_lookups, to_lookup)
 
         # Pass those keys to handle_key_deferred so that the json object
         # signatures can be verified
-        handle = preserve_fn(_handle_key_deferred)
+        handle = preserve_fn(self._handle_key_deferred)
         return [
             handle(rq) for rq in verify_requests
         ]
@@ -289,6 +368,9 @@ class Keyring(object):
                     results = yield fn(missing_keys.items())
                     merged_results.update(results)
 
+                    for server_name, verify_keys in iteritems(results):
+                        self._cache_verify_keys(server_name, verify_keys)
+
                     # We now need to figure out which verify requests we have keys
                     # for and which we don't
                     missing_keys = {}
@@ -644,9 +726,265 @@ class Keyring(object):
         ).addErrback(unwrapFirstError))
 
         results[server_name] = response_keys
+        self._cache_verify_keys(server_name, response_keys, ts_valid_until_ms)
 
         defer.returnValue(results)
 
+    def _cache_verify_keys(self, server_name, verify_keys, valid_until_ms=None):
+        """Adds some keys to the in-memory cache of verify keys
+
+        Args:
+            server_name (str): The server the keys belong to.
+            verify_keys (dict[str, VerifyKey]): map from key_id to key.
+            valid_until_ms (int|None): The time until which the server's keys
+                are valid, if known.
+        """
+        if not verify_keys:
+            return
+
+        cached = self._verify_key_cache.setdefault(server_name, _CachedServerKeys())
+        cached.verify_keys.update(verify_keys)
+        if valid_until_ms is not None:
+            cached.valid_until_ms = valid_until_ms
+
+    @defer.inlineCallbacks
+    def _warm_key_cache(self):
+        """Loads the keys which are still valid from server_keys_json into the
+        in-memory cache.
+        """
+        rows = yield self.store.get_valid_server_keys_json(self.clock.time_msec())
+
+        for row in rows:
+            server_name = row["server_name"]
+            key_id = row["key_id"]
+            if not is_signing_algorithm_supported(key_id):
+                continue
+
+            try:
+                key_json = json.loads(bytes(row["key_json"]).decode("utf-8"))
+                key_data = (
+                    key_json.get("verify_keys", {}).get(key_id)
+                    or key_json.get("old_verify_keys", {}).get(key_id)
+                )
+                if not key_data:
+                    continue
+                verify_key = decode_verify_key_bytes(
+                    key_id, decode_base64(key_data["key"]),
+                )
+            except Exception as e:
+                logger.warn(
+                    "Ignoring invalid key json for %s %s: %s", server_name, key_id, e,
+                )
+                continue
+
+            # don't replace any keys we've looked up in the meantime
+            cached = self._verify_key_cache.setdefault(
+                server_name, _CachedServerKeys(),
+            )
+            cached.verify_keys.setdefault(key_id, verify_key)
+            cached.valid_until_ms = max(
+                cached.valid_until_ms, row["ts_valid_until_ms"],
+            )
+
+        logger.info(
+            "Loaded %i verify keys for %i servers",
+            len(rows), self._verify_key_cache.len(),
+        )
+
+    def _start_refresh_expiring_keys(self):
+        return run_as_background_process(
+            "refresh_verify_keys", self._refresh_expiring_keys,
+        )
+
+    @defer.inlineCallbacks
+    def _refresh_expiring_keys(self):
+        """Fetches new copies of the keys of the servers we've heard from
+        recently whose keys are about to expire, and drops the servers whose
+        keys have expired from the cache.
+        """
+        now = self.clock.time_msec()
+
+        to_refresh = {}
+        for server_name, cached in self._verify_key_cache.items():
+            if cached.valid_until_ms > now + KEY_REFRESH_AHEAD_MS:
+                continue
+            if 0 < cached.valid_until_ms < now:
+                self._verify_key_cache.pop(server_name)
+            if cached.last_used_ms < now - KEY_REFRESH_IDLE_MS:
+                continue
+            to_refresh[server_name] = set(cached.verify_keys)
+
+        if not to_refresh:
+            return
+
+        logger.info("Refreshing verify keys for %i servers", len(to_refresh))
+
+        with Measure(self.clock, "refresh_verify_keys"):
+            # We ask each perspective server for all of the keys in one request,
+            # and then ask any servers the perspectives couldn't tell us about
+            # directly. Both store the new keys, and update the cache, as they
+            # go.
+            results = yield self.get_keys_from_perspectives(to_refresh.items())
+
+            @defer.inlineCallbacks
+            def refresh_direct(server_name, key_ids):
+                try:
+                    yield self.get_server_verify_key_v2_direct(server_name, key_ids)
+                except Exception as e:
+                    logger.info(
+                        "Failed to refresh keys for %s: %s %s",
+                        server_name, type(e).__name__, str(e),
+                    )
+
+            yield logcontext.make_deferred_yieldable(defer.gatherResults(
+                [
+                    run_in_background(refresh_direct, server_name, key_ids)
+                    for server_name, key_ids in iteritems(to_refresh)
+                    if server_name not in results
+                ],
+                consumeErrors=True,
+            ).addErrback(unwrapFirstError))
+
+    @defer.inlineCallbacks
+    def _handle_key_deferred(self, verify_request):
+        """Waits for the key to become available, and then performs a verification
+
+        Args:
+            verify_request (VerifyKeyRequest):
+
+        Returns:
+            Deferred[None]
+
+        Raises:
+            SynapseError if there was a problem performing the verification
+        """
+        server_name = verify_request.server_name
+        try:
+            with PreserveLoggingContext():
+                _, key_id, verify_key = yield verify_request.deferred
+        except KeyLookupError as e:
+            logger.warn(
+                "Failed to download keys for %s: %s %s",
+                server_name, type(e).__name__, str(e),
+            )
+            raise SynapseError(
+                502,
+                "Error downloading keys for %s" % (server_name,),
+                Codes.UNAUTHORIZED,
+            )
+        except Exception as e:
+            logger.exception(
+                "Got Exception when downloading keys for %s: %s %s",
+                server_name, type(e).__name__, str(e),
+            )
+            raise SynapseError(
+                401,
+                "No key for %s with id %s" % (server_name, verify_request.key_ids),
+                Codes.UNAUTHORIZED,
+            )
+
+        json_object = verify_request.json_object
+
+        logger.debug("Got key %s %s:%s for server %s, verifying" % (
+            key_id, verify_key.alg, verify_key.version, server_name,
+        ))
+        try:
+            yield self._verify_signature(server_name, verify_key, json_object)
+        except SignatureVerifyException as e:
+            logger.debug(
+                "Error verifying signature for %s:%s:%s with key %s: %s",
+                server_name, verify_key.alg, verify_key.version,
+                encode_verify_key_base64(verify_key),
+                str(e),
+            )
+            raise SynapseError(
+                401,
+                "Invalid signature for server %s with key %s:%s: %s" % (
+                    server_name, verify_key.alg, verify_key.version, str(e),
+                ),
+                Codes.UNAUTHORIZED,
+            )
+
+        # Now that we know the signature really came from the server, note that
+        # its keys are in use so that we keep them fresh.
+        cached = self._verify_key_cache.get(server_name)
+        if cached is not None:
+            cached.last_used_ms = self.clock.time_msec()
+
+    def _verify_signature(self, server_name, verify_key, json_object):
+        """Checks a signature.
+
+        If verify_signatures_in_threadpool is set, the signature is queued to
+        be checked in the threadpool along with any others which are ready
+        during this reactor tick. Otherwise it is checked straight away, as
+        waiting for the rest of the batch would only add latency.
+
+        Args:
+            server_name (str): The name of the server to verify against.
+            verify_key (nacl.signing.VerifyKey): The key to verify with.
+            json_object (dict): The signed JSON object.
+
+        Returns:
+            Deferred[None]: resolves once the signature has been checked, or
+                fails with SignatureVerifyException if it isn't valid. Follows
+                the synapse rules of logcontext preservation.
+        """
+        if not self.config.verify_signatures_in_threadpool:
+            verify_signed_json(json_object, server_name, verify_key)
+            return defer.succeed(None)
+
+        d = defer.Deferred()
+        self._pending_verifies.append((server_name, verify_key, json_object, d))
+
+        if not self._verify_scheduled:
+            self._verify_scheduled = True
+            self.clock.call_later(
+                0, run_as_background_process,
+                "verify_signatures", self._verify_pending_signatures,
+            )
+
+        return logcontext.make_deferred_yieldable(d)
+
+    @defer.inlineCallbacks
+    def _verify_pending_signatures(self):
+        """Checks the signatures queued by _verify_signature in the threadpool,
+        and resolves their deferreds.
+        """
+        pending = self._pending_verifies
+        self._pending_verifies = []
+        self._verify_scheduled = False
+
+        # Check the signatures made with the same key together
+        pending.sort(key=lambda p: (p[0], p[1].version))
+        batch = [p[:3] for p in pending]
+
+        try:
+            # Split the batch up so that several threads can work on it
+            chunks = [
+                batch[i:i + SIGNATURE_VERIFY_BATCH_SIZE]
+                for i in range(0, len(batch), SIGNATURE_VERIFY_BATCH_SIZE)
+            ]
+            results = yield logcontext.make_deferred_yieldable(
+                defer.gatherResults([
+                    run_in_background(
+                        defer_to_thread, self.hs.get_reactor(),
+                        _verify_signatures, chunk,
+                    )
+                    for chunk in chunks
+                ], consumeErrors=True).addErrback(unwrapFirstError)
+            )
+            results = [r for chunk in results for r in chunk]
+        except Exception as e:
+            logger.exception("Error verifying signatures")
+            results = [e] * len(pending)
+
+        with PreserveLoggingContext():
+            for (_, _, _, d), error in zip(pending, results):
+                if error is None:
+                    d.callback(None)
+                else:
+                    d.errback(error)
+
     def store_keys(self, server_name, from_server, verify_keys):
         """Store a collection of verify keys for a given server
         Args:
@@ -669,62 +1007,22 @@ class Keyring(object):
         ).addErrback(unwrapFirstError))
 
 
-@defer.inlineCallbacks
-def _handle_key_deferred(verify_request):
-    """Waits for the key to become available, and then performs a verification
+def _verify_signatures(batch):
+    """Checks a batch of signatures. May be run in a thread.
 
     Args:
-        verify_request (VerifyKeyRequest):
+        batch (list[tuple[str, nacl.signing.VerifyKey, dict]]): the
+            (server_name, verify_key, json_object) to check.
 
     Returns:
-        Deferred[None]
-
-    Raises:
-        SynapseError if there was a problem performing the verification
+        list[Exception|None]: for each signature, None if it is valid or the
+            exception raised when checking it otherwise.
     """
-    server_name = verify_request.server_name
-    try:
-        with PreserveLoggingContext():
-            _, key_id, verify_key = yield verify_request.deferred
-    except KeyLookupError as e:
-        logger.warn(
-            "Failed to download keys for %s: %s %s",
-            server_name, type(e).__name__, str(e),
-        )
-        raise SynapseError(
-            502,
-            "Error downloading keys for %s" % (server_name,),
-            Codes.UNAUTHORIZED,
-        )
-    except Exception as e:
-        logger.exception(
-            "Got Exception when downloading keys for %s: %s %s",
-            server_name, type(e).__name__, str(e),
-        )
-        raise SynapseError(
-            401,
-            "No key for %s with id %s" % (server_name, verify_request.key_ids),
-            Codes.UNAUTHORIZED,
-        )
-
-    json_object = verify_request.json_object
-
-    logger.debug("Got key %s %s:%s for server %s, verifying" % (
-        key_id, verify_key.alg, verify_key.version, server_name,
-    ))
-    try:
-        verify_signed_json(json_object, server_name, verify_key)
-    except SignatureVerifyException as e:
-        logger.debug(
-            "Error verifying signature for %s:%s:%s with key %s: %s",
-            server_name, verify_key.alg, verify_key.version,
-            encode_verify_key_base64(verify_key),
-            str(e),
-        )
-        raise SynapseError(
-            401,
-            "Invalid signature for server %s with key %s:%s: %s" % (
-                server_name, verify_key.alg, verify_key.version, str(e),
-            ),
-            Codes.UNAUTHORIZED,
-        )
+    results = []
+    for server_name, verify_key, json_object in batch:
+        try:
+            verify_signed_json(json_object, server_name, verify_key)
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+    return results
@@ -19,11 +19,12 @@ from distutils.util import strtobool
 
 import six
 
+from canonicaljson import json
 from unpaddedbase64 import encode_base64
 
 from synapse.api.constants import KNOWN_ROOM_VERSIONS, EventFormatVersions, RoomVersions
-from synapse.util.caches import intern_dict
-from synapse.util.frozenutils import freeze
+from synapse.util.caches import intern_dict, intern_string
+from synapse.util.frozenutils import freeze, frozendict_json_encoder
 
 # Whether we should use frozen_dict in FrozenEvent. Using frozen_dicts prevents
 # bugs where we accidentally share e.g. signature dicts. However, converting a
@@ -122,6 +123,10 @@ def _event_dict_property(key):
 
 
 class EventBase(object):
+    # Subclasses which don't define __slots__ get a __dict__ as usual, but this
+    # lets the compact event classes below avoid one.
+    __slots__ = ()
+
     def __init__(self, event_dict, signatures={}, unsigned={},
                  internal_metadata_dict={}, rejected_reason=None):
         self.signatures = signatures
@@ -342,6 +347,239 @@ class FrozenEventV2(EventBase):
         )
 
 
+def _extra_field_property(key):
+    def getter(self):
+        try:
+            return self._extra[key]
+        except (KeyError, TypeError):
+            raise AttributeError(key)
+
+    def setter(self, v):
+        if self._extra is None:
+            self._extra = {}
+        self._extra[key] = v
+
+    return property(getter, setter)
+
+
+class _CompactEventBase(EventBase):
+    """Base class for the compact event representations.
+
+    Rather than keeping the whole event dict around, the compact classes hold
+    the commonly used fields in slots, intern the strings which repeat across
+    events, keep prev_events and auth_events as tuples, and hold the content as
+    JSON until it is first accessed. Anything else in the event ends up in
+    `_extra`.
+
+    They are otherwise interchangeable with FrozenEvent and FrozenEventV2.
+    """
+
+    __slots__ = (
+        "type",
+        "state_key",
+        "room_id",
+        "sender",
+        "depth",
+        "origin_server_ts",
+        "prev_events",
+        "auth_events",
+        "signatures",
+        "unsigned",
+        "rejected_reason",
+        "internal_metadata",
+        "_content",
+        "_content_json",
+        "_extra",
+    )
+
+    def _init_fields(self, event_dict, internal_metadata_dict, rejected_reason):
+        event_dict = dict(event_dict)
+
+        # Signatures is a dict of dicts, and this is faster than doing a
+        # copy.deepcopy
+        self.signatures = {
+            name: {sig_id: sig for sig_id, sig in sigs.items()}
+            for name, sigs in event_dict.pop("signatures", {}).items()
+        }
+        self.unsigned = dict(event_dict.pop("unsigned", {}))
+        self.rejected_reason = rejected_reason
+        self.internal_metadata = _EventInternalMetadata(internal_metadata_dict)
+
+        self.type = intern_string(event_dict.pop("type"))
+        for key in ("state_key", "room_id", "sender"):
+            if key in event_dict:
+                setattr(self, key, intern_string(event_dict.pop(key)))
+
+        for key in ("depth", "origin_server_ts"):
+            if key in event_dict:
+                setattr(self, key, event_dict.pop(key))
+
+        for key in ("prev_events", "auth_events"):
+            if key in event_dict:
+                setattr(self, key, tuple(
+                    tuple(e) if isinstance(e, (list, tuple)) else intern_string(e)
+                    for e in event_dict.pop(key)
+                ))
+
+        self._content = None
+        self._content_json = frozendict_json_encoder.encode(
+            event_dict.pop("content", {})
+        ).encode("utf8")
+
+        self._extra = event_dict or None
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = json.loads(self._content_json.decode("utf8"))
+            self._content_json = None
+        return self._content
+
+    @content.setter
+    def content(self, v):
+        self._content = v
+        self._content_json = None
+
+    hashes = _extra_field_property("hashes")
+    origin = _extra_field_property("origin")
+    redacts = _extra_field_property("redacts")
+
+    @property
+    def user_id(self):
+        return self.sender
+
+    @property
+    def _event_dict(self):
+        d = dict(self._extra or {})
+        d["type"] = self.type
+        d["content"] = self.content
+
+        for key in (
+            "state_key", "room_id", "sender", "depth", "origin_server_ts",
+        ):
+            try:
+                d[key] = getattr(self, key)
+            except AttributeError:
+                pass
+
+        for key in ("prev_events", "auth_events"):
+            try:
+                d[key] = [
+                    list(e) if isinstance(e, tuple) else e
+                    for e in getattr(self, key)
+                ]
+            except AttributeError:
+                pass
+
+        return d
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __getitem__(self, field):
+        if field in ("type", "room_id", "sender", "state_key", "depth"):
+            try:
+                return getattr(self, field)
+            except AttributeError:
+                raise KeyError(field)
+        return self._event_dict[field]
+
+    def __contains__(self, field):
+        return field in self._event_dict
+
+
+class CompactFrozenEvent(_CompactEventBase):
+    """A more compact equivalent of FrozenEvent
+    """
+    format_version = EventFormatVersions.V1  # All events of this type are V1
+
+    __slots__ = ("event_id",)
+
+    def __init__(self, event_dict, internal_metadata_dict={}, rejected_reason=None):
+        self.event_id = intern_string(event_dict["event_id"])
+
+        event_dict = dict(event_dict)
+        del event_dict["event_id"]
+        self._init_fields(event_dict, internal_metadata_dict, rejected_reason)
+
+    @property
+    def _event_dict(self):
+        d = super(CompactFrozenEvent, self)._event_dict
+        d["event_id"] = self.event_id
+        return d
+
+    def __getitem__(self, field):
+        if field == "event_id":
+            return self.event_id
+        return super(CompactFrozenEvent, self).__getitem__(field)
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return "<CompactFrozenEvent event_id='%s', type='%s', state_key='%s'>" % (
+            self.event_id,
+            self.type,
+            self.get("state_key", None),
+        )
+
+
+class CompactFrozenEventV2(_CompactEventBase):
+    """A more compact equivalent of FrozenEventV2
+    """
+    format_version = EventFormatVersions.V2  # All events of this type are V2
+
+    __slots__ = ("_event_id",)
+
+    def __init__(self, event_dict, internal_metadata_dict={}, rejected_reason=None):
+        assert "event_id" not in event_dict
+
+        self._event_id = None
+        self._init_fields(event_dict, internal_metadata_dict, rejected_reason)
+
+    @property
+    def event_id(self):
+        # We have to import this here as otherwise we get an import loop which
+        # is hard to break.
+        from synapse.crypto.event_signing import compute_event_reference_hash
+
+        if self._event_id:
+            return self._event_id
+        self._event_id = "$" + encode_base64(compute_event_reference_hash(self)[1])
+        return self._event_id
+
+    def prev_event_ids(self):
+        """Returns the list of prev event IDs. The order matches the order
+        specified in the event, though there is no meaning to it.
+
+        Returns:
+            list[str]: The list of event IDs of this event's prev_events
+        """
+        return list(self.prev_events)
+
+    def auth_event_ids(self):
+        """Returns the list of auth event IDs. The order matches the order
+        specified in the event, though there is no meaning to it.
+
+        Returns:
+            list[str]: The list of event IDs of this event's auth_events
+        """
+        return list(self.auth_events)
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return "<CompactFrozenEventV2 event_id='%s', type='%s', state_key='%s'>" % (
+            self.event_id,
+            self.type,
+            self.get("state_key", None),
+        )
+
+
 def room_version_to_event_format(room_version):
     """Converts a room version string to the event format
 
@@ -365,12 +603,15 @@ def room_version_to_event_format(room_version):
         raise RuntimeError("Unrecognized room version %s" % (room_version,))
 
 
-def event_type_from_format_version(format_version):
+def event_type_from_format_version(format_version, compact=False):
     """Returns the python type to use to construct an Event object for the
     given event format version.
 
     Args:
         format_version (int): The event format version
+        compact (bool): Whether to return the compact equivalent of the type,
+            which uses less memory at the cost of more work when accessing the
+            content or the event as a dict.
 
     Returns:
         type: A type that can be initialized as per the initializer of
@@ -378,9 +619,9 @@ def event_type_from_format_version(format_version):
     """
 
     if format_version == EventFormatVersions.V1:
-        return FrozenEvent
+        return CompactFrozenEvent if compact else FrozenEvent
     elif format_version == EventFormatVersions.V2:
-        return FrozenEventV2
+        return CompactFrozenEventV2 if compact else FrozenEventV2
     else:
         raise Exception(
             "No event format %r" % (format_version,)
@@ -40,7 +40,7 @@ from synapse.api.errors import (
 )
 from synapse.events import builder, room_version_to_event_format
 from synapse.federation.federation_base import FederationBase, event_from_pdu_json
-from synapse.util import logcontext, unwrapFirstError
+from synapse.util import batch_iter, logcontext, unwrapFirstError
 from synapse.util.caches.expiringcache import ExpiringCache
 from synapse.util.logcontext import make_deferred_yieldable, run_in_background
 from synapse.util.logutils import log_function
@@ -53,6 +53,11 @@ sent_queries_counter = Counter("synapse_federation_client_sent_queries", "", ["t
 
 PDU_RETRY_TIME_MS = 1 * 60 * 1000
 
+# How many of the events in a send_join response we check the signatures of at
+# once. Bounds the memory used for the (redacted) copies of the events which
+# are checked, and the number of outstanding key lookups.
+SEND_JOIN_SIG_CHECK_BATCH_SIZE = 1000
+
 
 class InvalidResponseError(RuntimeError):
     """Helper for _try_destination_list: indicates that the server returned a response
@@ -668,24 +673,23 @@ class FederationClient(FederationBase):
         @defer.inlineCallbacks
         def send_request(destination):
             time_now = self._clock.time_msec()
-            _, content = yield self.transport_layer.send_join(
+
+            # the events are built as the response arrives
+            content = yield self.transport_layer.send_join(
                 destination=destination,
                 room_id=pdu.room_id,
                 event_id=pdu.event_id,
                 content=pdu.get_pdu_json(time_now),
+                event_format_version=event_format_version,
             )
 
-            logger.debug("Got content: %s", content)
+            state = content["state"]
+            auth_chain = content["auth_chain"]
 
-            state = [
-                event_from_pdu_json(p, event_format_version, outlier=True)
-                for p in content.get("state", [])
-            ]
-
-            auth_chain = [
-                event_from_pdu_json(p, event_format_version, outlier=True)
-                for p in content.get("auth_chain", [])
-            ]
+            logger.debug(
+                "Got %i state and %i auth_chain events from %s",
+                len(state), len(auth_chain), destination,
+            )
 
             pdus = {
                 p.event_id: p
@@ -703,16 +707,14 @@ class FederationClient(FederationBase):
                 # invalid, and it would fail auth checks anyway.
                 raise SynapseError(400, "No create event in state")
 
-            valid_pdus = yield self._check_sigs_and_hash_and_fetch(
-                destination, list(pdus.values()),
-                outlier=True,
-                room_version=room_version,
-            )
-
-            valid_pdus_map = {
-                p.event_id: p
-                for p in valid_pdus
-            }
+            valid_pdus_map = {}
+            for batch in batch_iter(pdus.values(), SEND_JOIN_SIG_CHECK_BATCH_SIZE):
+                valid_pdus = yield self._check_sigs_and_hash_and_fetch(
+                    destination, list(batch),
+                    outlier=True,
+                    room_version=room_version,
+                )
+                valid_pdus_map.update((p.event_id, p) for p in valid_pdus)
 
             # NB: We *need* to copy to ensure that we don't have multiple
             # references being passed on, as that causes... issues.
@@ -14,9 +14,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import logging
+from collections import OrderedDict
 
 import six
-from six import iteritems
+from six import iteritems, itervalues
 
 from canonicaljson import json
 from prometheus_client import Counter
@@ -31,6 +32,7 @@ from synapse.api.errors import (
     Codes,
     FederationError,
     IncompatibleRoomVersionError,
+    LimitExceededError,
     NotFoundError,
     SynapseError,
 )
@@ -40,6 +42,8 @@ from synapse.federation.federation_base import FederationBase, event_from_pdu_js
 from synapse.federation.persistence import TransactionActions
 from synapse.federation.units import Edu, Transaction
 from synapse.http.endpoint import parse_server_name
+from synapse.metrics import LaterGauge
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.replication.http.federation import (
     ReplicationFederationSendEduRestServlet,
     ReplicationGetQueryRestServlet,
@@ -55,6 +59,23 @@ from synapse.util.logutils import log_function
 # parallel, up to this limit.
 TRANSACTION_CONCURRENCY_LIMIT = 10
 
+# Priorities for processing staged PDUs: rooms with PDUs of a lower value are
+# processed first.
+PDU_PRIORITY_LIVE = 0
+PDU_PRIORITY_BACKFILL = 1
+
+# PDUs which were sent more than this long before we received them are treated
+# as backfill traffic (eg, from a server catching up after an outage).
+BACKFILL_PDU_AGE_MS = 5 * 60 * 1000
+
+# how many staged PDUs for a room we load from the database at a time
+STAGED_PDU_BATCH_SIZE = 50
+
+# the most PDUs from one server we stage before we start rejecting its
+# transactions, and how long we ask it to wait before retrying
+MAX_STAGED_PDUS_PER_ORIGIN = 1000
+STAGED_PDUS_RETRY_AFTER_MS = 10 * 1000
+
 logger = logging.getLogger(__name__)
 
 received_pdus_counter = Counter("synapse_federation_server_received_pdus", "")
@@ -85,6 +106,37 @@ class FederationServer(FederationBase):
         # come in waves.
         self._state_resp_cache = ResponseCache(hs, "state_resp", timeout_ms=30000)
 
+        self._stage_incoming_pdus = hs.config.stage_incoming_federation_events
+
+        # Staged PDUs are only processed by the process which received them.
+        self._instance_name = hs.config.worker_name or "master"
+
+        # Rooms with staged PDUs to process, by priority. Each room is queued
+        # at most once, at the highest priority of its staged PDUs.
+        self._staged_rooms = OrderedDict(
+            (priority, OrderedDict())
+            for priority in (PDU_PRIORITY_LIVE, PDU_PRIORITY_BACKFILL)
+        )
+
+        # The rooms we're currently processing staged PDUs for. We process the
+        # PDUs for each room in series.
+        self._processing_staged_rooms = set()
+
+        if self._stage_incoming_pdus:
+            LaterGauge(
+                "synapse_federation_server_staged_rooms", "", ["priority"],
+                lambda: {
+                    (str(priority),): len(rooms)
+                    for priority, rooms in self._staged_rooms.items()
+                },
+            )
+
+            # Carry on with any PDUs we didn't get round to before restarting
+            self._clock.call_later(
+                0, run_as_background_process,
+                "resume_staged_pdus", self._resume_staged_pdus,
+            )
+
     @defer.inlineCallbacks
     @log_function
     def on_backfill_request(self, origin, room_id, versions, limit):
@@ -167,8 +219,6 @@ class FederationServer(FederationBase):
 
         received_pdus_counter.inc(len(transaction.pdus))
 
-        origin_host, _ = parse_server_name(origin)
-
         pdus_by_room = {}
 
         for p in transaction.pdus:
@@ -207,48 +257,35 @@ class FederationServer(FederationBase):
 
         pdu_results = {}
 
-        # we can process different rooms in parallel (which is useful if they
-        # require callouts to other servers to fetch missing events), but
-        # impose a limit to avoid going too crazy with ram/cpu.
-
-        @defer.inlineCallbacks
-        def process_pdus_for_room(room_id):
-            logger.debug("Processing PDUs for %s", room_id)
+        if self._stage_incoming_pdus:
             try:
-                yield self.check_server_matches_acl(origin_host, room_id)
-            except AuthError as e:
-                logger.warn(
-                    "Ignoring PDUs for room %s from banned server", room_id,
+                pdu_results = yield self._stage_pdus(
+                    origin, pdus_by_room, request_time,
                 )
-                for pdu in pdus_by_room[room_id]:
-                    event_id = pdu.event_id
-                    pdu_results[event_id] = e.error_dict()
-                return
+            except LimitExceededError as e:
+                # We don't record this response, so the server can try the
+                # same transaction again once we've caught up.
+                logger.info(
+                    "[%s] Too many staged PDUs from %s, rejecting transaction",
+                    transaction.transaction_id, origin,
+                )
+                defer.returnValue((e.code, e.error_dict()))
+        else:
+            # we can process different rooms in parallel (which is useful if
+            # they require callouts to other servers to fetch missing events),
+            # but impose a limit to avoid going too crazy with ram/cpu.
+
+            @defer.inlineCallbacks
+            def process_pdus_for_room(room_id):
+                results = yield self._process_pdus_for_room(
+                    origin, room_id, pdus_by_room[room_id],
+                )
+                pdu_results.update(results)
 
-            for pdu in pdus_by_room[room_id]:
-                event_id = pdu.event_id
-                with nested_logging_context(event_id):
-                    try:
-                        yield self._handle_received_pdu(
-                            origin, pdu
-                        )
-                        pdu_results[event_id] = {}
-                    except FederationError as e:
-                        logger.warn("Error handling PDU %s: %s", event_id, e)
-                        pdu_results[event_id] = {"error": str(e)}
-                    except Exception as e:
-                        f = failure.Failure()
-                        pdu_results[event_id] = {"error": str(e)}
-                        logger.error(
-                            "Failed to handle PDU %s",
-                            event_id,
-                            exc_info=(f.type, f.value, f.getTracebackObject()),
-                        )
-
-        yield concurrently_execute(
-            process_pdus_for_room, pdus_by_room.keys(),
-            TRANSACTION_CONCURRENCY_LIMIT,
-        )
+            yield concurrently_execute(
+                process_pdus_for_room, pdus_by_room.keys(),
+                TRANSACTION_CONCURRENCY_LIMIT,
+            )
 
         if hasattr(transaction, "edus"):
             for edu in (Edu(**x) for x in transaction.edus):
@@ -271,6 +308,206 @@ class FederationServer(FederationBase):
         )
         defer.returnValue((200, response))
 
+    @defer.inlineCallbacks
+    def _process_pdus_for_room(self, origin, room_id, pdus):
+        """Handles some PDUs for a room from a server, one at a time.
+
+        Args:
+            origin (str): the server which sent the PDUs
+            room_id (str)
+            pdus (list[FrozenEvent])
+
+        Returns:
+            Deferred[dict[str, dict]]: map from event_id to the result of
+                handling the PDU, for the transaction response.
+        """
+        logger.debug("Processing PDUs for %s", room_id)
+
+        pdu_results = {}
+
+        origin_host, _ = parse_server_name(origin)
+        try:
+            yield self.check_server_matches_acl(origin_host, room_id)
+        except AuthError as e:
+            logger.warn(
+                "Ignoring PDUs for room %s from banned server", room_id,
+            )
+            for pdu in pdus:
+                pdu_results[pdu.event_id] = e.error_dict()
+            defer.returnValue(pdu_results)
+
+        for pdu in pdus:
+            event_id = pdu.event_id
+            with nested_logging_context(event_id):
+                try:
+                    yield self._handle_received_pdu(
+                        origin, pdu
+                    )
+                    pdu_results[event_id] = {}
+                except FederationError as e:
+                    logger.warn("Error handling PDU %s: %s", event_id, e)
+                    pdu_results[event_id] = {"error": str(e)}
+                except Exception as e:
+                    f = failure.Failure()
+                    pdu_results[event_id] = {"error": str(e)}
+                    logger.error(
+                        "Failed to handle PDU %s",
+                        event_id,
+                        exc_info=(f.type, f.value, f.getTracebackObject()),
+                    )
+
+        defer.returnValue(pdu_results)
+
+    @defer.inlineCallbacks
+    def _stage_pdus(self, origin, pdus_by_room, request_time):
+        """Stores the PDUs from a transaction to be processed in the
+        background, and starts processing them.
+
+        Args:
+            origin (str): the server which sent the PDUs
+            pdus_by_room (dict[str, list[FrozenEvent]]): the PDUs, by room
+            request_time (int): when we received the transaction
+
+        Returns:
+            Deferred[dict[str, dict]]: map from event_id to the result for the
+                transaction response.
+
+        Raises:
+            LimitExceededError: if the server already has too many PDUs waiting
+                to be processed.
+        """
+        pdu_count = sum(len(pdus) for pdus in itervalues(pdus_by_room))
+        staged_count = yield self.store.count_received_events_in_staging(origin)
+        if staged_count + pdu_count > MAX_STAGED_PDUS_PER_ORIGIN:
+            raise LimitExceededError(retry_after_ms=STAGED_PDUS_RETRY_AFTER_MS)
+
+        pdu_results = {}
+        to_stage = []
+        room_priorities = {}
+
+        origin_host, _ = parse_server_name(origin)
+        for room_id, pdus in iteritems(pdus_by_room):
+            # we check the ACLs now, so that we can tell the server if we're
+            # ignoring it.
+            try:
+                yield self.check_server_matches_acl(origin_host, room_id)
+            except AuthError as e:
+                logger.warn(
+                    "Ignoring PDUs for room %s from banned server", room_id,
+                )
+                for pdu in pdus:
+                    pdu_results[pdu.event_id] = e.error_dict()
+                continue
+
+            for pdu in pdus:
+                if request_time - pdu.origin_server_ts > BACKFILL_PDU_AGE_MS:
+                    priority = PDU_PRIORITY_BACKFILL
+                else:
+                    priority = PDU_PRIORITY_LIVE
+
+                to_stage.append((pdu, priority))
+                room_priorities[room_id] = min(
+                    priority, room_priorities.get(room_id, priority),
+                )
+                pdu_results[pdu.event_id] = {}
+
+        yield self.store.insert_received_events_to_staging(
+            self._instance_name, origin, request_time, to_stage,
+        )
+
+        for room_id, priority in iteritems(room_priorities):
+            self._queue_staged_room(room_id, priority)
+
+        defer.returnValue(pdu_results)
+
+    @defer.inlineCallbacks
+    def _resume_staged_pdus(self):
+        rooms = yield self.store.get_rooms_with_staged_events(self._instance_name)
+        if rooms:
+            logger.info("Resuming processing of staged PDUs for %i rooms", len(rooms))
+
+        for room_id, priority in iteritems(rooms):
+            self._queue_staged_room(room_id, priority)
+
+    def _queue_staged_room(self, room_id, priority):
+        """Queues a room with staged PDUs to be processed, and starts
+        processing if we're not too busy.
+
+        Args:
+            room_id (str)
+            priority (int): the highest priority of the room's new PDUs.
+        """
+        for queued_priority, rooms in iteritems(self._staged_rooms):
+            if room_id not in rooms:
+                continue
+            if queued_priority <= priority:
+                # it's already queued at the same or a higher priority
+                return
+            del rooms[room_id]
+
+        self._staged_rooms[priority][room_id] = None
+        self._start_processing_staged_rooms()
+
+    def _start_processing_staged_rooms(self):
+        """Starts processing the highest priority queued rooms, up to
+        TRANSACTION_CONCURRENCY_LIMIT rooms at a time.
+        """
+        while len(self._processing_staged_rooms) < TRANSACTION_CONCURRENCY_LIMIT:
+            room_id = self._pop_staged_room()
+            if room_id is None:
+                return
+
+            self._processing_staged_rooms.add(room_id)
+            run_as_background_process(
+                "process_staged_pdus", self._process_staged_room, room_id,
+            )
+
+    def _pop_staged_room(self):
+        """Takes the highest priority room off the queue which we're not
+        already processing.
+
+        Returns:
+            str|None: the room, or None if there are none
+        """
+        for rooms in itervalues(self._staged_rooms):
+            for room_id in rooms:
+                if room_id not in self._processing_staged_rooms:
+                    del rooms[room_id]
+                    return room_id
+        return None
+
+    @defer.inlineCallbacks
+    def _process_staged_room(self, room_id):
+        """Processes the staged PDUs for a room, oldest first, until there are
+        none left.
+        """
+        try:
+            while True:
+                staged = yield self.store.get_next_staged_events_for_room(
+                    self._instance_name, room_id, STAGED_PDU_BATCH_SIZE,
+                )
+                if not staged:
+                    break
+
+                room_version = yield self.store.get_room_version(room_id)
+                format_ver = room_version_to_event_format(room_version)
+
+                for origin, event_id, pdu_json in staged:
+                    try:
+                        pdu = event_from_pdu_json(pdu_json, format_ver)
+                        yield self._process_pdus_for_room(origin, room_id, [pdu])
+                    except Exception:
+                        logger.exception("Failed to handle staged PDU %s", event_id)
+
+                    yield self.store.remove_received_event_from_staging(
+                        origin, event_id,
+                    )
+        except Exception:
+            logger.exception("Error processing staged PDUs for %s", room_id)
+        finally:
+            self._processing_staged_rooms.discard(room_id)
+            self._start_processing_staged_rooms()
+
     @defer.inlineCallbacks
     def received_edu(self, origin, edu_type, content):
         received_edus_counter.inc()
@@ -14,6 +14,7 @@
 # limitations under the License.
 
 import logging
+import zlib
 
 from six import itervalues
 
@@ -48,6 +49,20 @@ sent_pdus_destination_dist_total = Counter(
     "Total number of PDUs queued for sending across all destinations",
 )
 
+# How we worked out which servers to send each PDU to: from the joined hosts
+# index ("index"), or by calculating the state before the PDU ("state").
+pdu_destination_lookups_counter = Counter(
+    "synapse_federation_client_pdu_destination_lookups", "", ["method"],
+)
+
+# How long after starting up we start waking destinations which need catching
+# up, and how long we wait between waking each batch of them.
+CATCH_UP_STARTUP_DELAY_SEC = 15
+CATCH_UP_STARTUP_INTERVAL_SEC = 5
+
+# How many destinations needing catching up we wake at once.
+CATCH_UP_STARTUP_BATCH_SIZE = 25
+
 
 class FederationSender(object):
     def __init__(self, hs):
@@ -62,6 +77,19 @@ class FederationSender(object):
 
         self._transaction_manager = TransactionManager(hs)
 
+        # If sending is sharded between several federation sender workers,
+        # which of them we are. Each shard tracks its own position in the
+        # streams.
+        instances = hs.config.federation_sender_instances
+        if hs.config.worker_app and instances:
+            self.instance_name = hs.config.worker_name
+            self._shard_index = instances.index(self.instance_name)
+            self._shard_count = len(instances)
+        else:
+            self.instance_name = "master"
+            self._shard_index = 0
+            self._shard_count = 1
+
         # map from destination to PerDestinationQueue
         self._per_destination_queues = {}   # type: dict[str, PerDestinationQueue]
 
@@ -115,6 +143,16 @@ class FederationSender(object):
             1000.0 / hs.get_config().federation_rr_transactions_per_room_per_second
         )
 
+        # Destinations we failed to send to before we last stopped won't be
+        # sent anything until there is new traffic for them, so wake them
+        # (gradually) once we've started up.
+        self.clock.call_later(
+            CATCH_UP_STARTUP_DELAY_SEC,
+            run_as_background_process,
+            "wake_destinations_needing_catchup",
+            self._wake_destinations_needing_catchup,
+        )
+
     def _get_per_destination_queue(self, destination):
         """Get or create a PerDestinationQueue for the given destination
 
@@ -130,6 +168,22 @@ class FederationSender(object):
             self._per_destination_queues[destination] = queue
         return queue
 
+    def should_send_to(self, destination):
+        """Whether we are the federation sender responsible for sending to the
+        destination.
+
+        Args:
+            destination (str): server_name of remote server
+
+        Returns:
+            bool
+        """
+        if self._shard_count == 1:
+            return True
+        return get_shard_for_destination(destination, self._shard_count) == (
+            self._shard_index
+        )
+
     def notify_new_events(self, current_id):
         """This gets called when we have some new events we might want to
         send out to other servers.
@@ -150,7 +204,9 @@ class FederationSender(object):
         try:
             self._is_processing = True
             while True:
-                last_token = yield self.store.get_federation_out_pos("events")
+                last_token = yield self.store.get_federation_out_pos(
+                    "events", self.instance_name,
+                )
                 next_token, events = yield self.store.get_all_new_events_stream(
                     last_token, self._last_poked_id, limit=100,
                 )
@@ -169,15 +225,7 @@ class FederationSender(object):
                         return
 
                     try:
-                        # Get the state from before the event.
-                        # We need to make sure that this is the state from before
-                        # the event and not from after it.
-                        # Otherwise if the last member on a server in a room is
-                        # banned then it won't receive the event because it won't
-                        # be in the room after the ban.
-                        destinations = yield self.state.get_current_hosts_in_room(
-                            event.room_id, latest_event_ids=event.prev_event_ids(),
-                        )
+                        destinations = yield self._get_hosts_before_event(event)
                     except Exception:
                         logger.exception(
                             "Failed to calculate hosts in room for event: %s",
@@ -195,7 +243,7 @@ class FederationSender(object):
 
                     logger.debug("Sending %s to %r", event, destinations)
 
-                    self._send_pdu(event, destinations)
+                    yield self._send_pdu(event, destinations)
 
                 @defer.inlineCallbacks
                 def handle_room_events(events):
@@ -215,7 +263,7 @@ class FederationSender(object):
                 ))
 
                 yield self.store.update_federation_out_pos(
-                    "events", next_token
+                    "events", next_token, self.instance_name,
                 )
 
                 if events:
@@ -241,6 +289,43 @@ class FederationSender(object):
         finally:
             self._is_processing = False
 
+    @defer.inlineCallbacks
+    def _get_hosts_before_event(self, event):
+        """Works out which servers were in the room before an event.
+
+        We need to make sure that this is the state from before the event and
+        not from after it. Otherwise if the last member on a server in a room is
+        banned then it won't receive the event because it won't be in the room
+        after the ban.
+
+        Args:
+            event (FrozenEvent): the event, which must have its stream ordering
+                set.
+
+        Returns:
+            Deferred[iterable[str]]: the server names
+        """
+        # If the current state hasn't changed since this event was persisted
+        # (including by the batch of events it was persisted with), then the
+        # current state is the state before the event, and we can look the
+        # hosts up in the joined hosts index rather than resolving the state
+        # and counting up the members. We don't use the cached
+        # get_joined_host_counts, as on a worker it may not have been
+        # invalidated for the latest changes yet.
+        host_counts = yield self.store.get_joined_host_counts_before(
+            event.room_id, event.internal_metadata.stream_ordering,
+        )
+        if host_counts is not None:
+            pdu_destination_lookups_counter.labels("index").inc()
+            defer.returnValue(host_counts.keys())
+
+        pdu_destination_lookups_counter.labels("state").inc()
+        destinations = yield self.state.get_current_hosts_in_room(
+            event.room_id, latest_event_ids=event.prev_event_ids(),
+        )
+        defer.returnValue(destinations)
+
+    @defer.inlineCallbacks
     def _send_pdu(self, pdu, destinations):
         # We loop through all destinations to see whether we already have
         # a transaction in progress. If we do, stick it in the pending_pdus
@@ -249,13 +334,21 @@ class FederationSender(object):
         order = self._order
         self._order += 1
 
-        destinations = set(destinations)
-        destinations.discard(self.server_name)
+        destinations = set(
+            d for d in destinations
+            if d != self.server_name and self.should_send_to(d)
+        )
         logger.debug("Sending to: %s", str(destinations))
 
         if not destinations:
             return
 
+        # Record that we're sending the event before queuing it, so that we can
+        # catch up any destinations which miss it.
+        yield self.store.store_destination_rooms_entries(
+            destinations, pdu.room_id, pdu.internal_metadata.stream_ordering,
+        )
+
         sent_pdus_destination_dist_total.inc(len(destinations))
         sent_pdus_destination_dist_count.inc()
 
@@ -305,7 +398,9 @@ class FederationSender(object):
 
         # Work out which remote servers should be poked and poke them.
         domains = yield self.state.get_current_hosts_in_room(room_id)
-        domains = [d for d in domains if d != self.server_name]
+        domains = [
+            d for d in domains if d != self.server_name and self.should_send_to(d)
+        ]
         if not domains:
             return
 
@@ -417,6 +512,8 @@ class FederationSender(object):
             for destination in destinations:
                 if destination == self.server_name:
                     continue
+                if not self.should_send_to(destination):
+                    continue
                 self._get_per_destination_queue(destination).send_presence(states)
 
     def build_and_send_edu(self, destination, edu_type, content, key=None):
@@ -448,6 +545,9 @@ class FederationSender(object):
             edu (Edu): edu to send
             key (Any|None): clobbering key for this edu
         """
+        if not self.should_send_to(edu.destination):
+            return
+
         queue = self._get_per_destination_queue(edu.destination)
         if key:
             queue.send_keyed_edu(edu, key)
@@ -459,7 +559,49 @@ class FederationSender(object):
             logger.info("Not sending device update to ourselves")
             return
 
+        if not self.should_send_to(destination):
+            return
+
         self._get_per_destination_queue(destination).attempt_new_transaction()
 
     def get_current_token(self):
         return 0
+
+    @defer.inlineCallbacks
+    def _wake_destinations_needing_catchup(self):
+        """Starts sending to the destinations which have missed PDUs, a batch
+        at a time.
+        """
+        last_destination = ""
+        while True:
+            destinations = yield self.store.get_catch_up_outstanding_destinations(
+                last_destination, CATCH_UP_STARTUP_BATCH_SIZE,
+            )
+            if not destinations:
+                return
+
+            last_destination = destinations[-1]
+
+            for destination in destinations:
+                if self.should_send_to(destination):
+                    logger.info("Waking %s to catch it up", destination)
+                    self._get_per_destination_queue(
+                        destination,
+                    ).attempt_new_transaction()
+
+            yield self.clock.sleep(CATCH_UP_STARTUP_INTERVAL_SEC)
+
+
+def get_shard_for_destination(destination, shard_count):
+    """Get which of the federation sender shards sends to a destination.
+
+    This must give the same answer in every process, so can't use `hash`.
+
+    Args:
+        destination (str): server_name of remote server
+        shard_count (int): the number of federation senders
+
+    Returns:
+        int: the index of the shard, between 0 and shard_count - 1
+    """
+    return (zlib.crc32(destination.encode("utf-8")) & 0xffffffff) % shard_count
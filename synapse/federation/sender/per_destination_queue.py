@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import datetime
+import itertools
 import logging
 
 from prometheus_client import Counter
@@ -47,6 +48,10 @@ sent_edus_by_type = Counter(
     ["type"],
 )
 
+# The most PDUs we can send in a transaction, which is also how many rooms we
+# catch a destination up on at a time.
+MAX_PDUS_PER_TRANSACTION = 50
+
 
 class PerDestinationQueue(object):
     """
@@ -91,6 +96,24 @@ class PerDestinationQueue(object):
         # stream_id of last successfully sent device list update.
         self._last_device_list_stream_id = 0
 
+        # Whether the destination may have missed PDUs which we aren't holding
+        # in memory. While we are catching up, new PDUs aren't queued: instead
+        # we send the most recent event in each room the destination is behind
+        # in, as recorded in the destination_rooms table. We don't know whether
+        # the destination missed anything before we started, so we start off
+        # catching up.
+        self._catching_up = True
+
+        # The stream_ordering of the most recent PDU the destination has
+        # successfully received, or None if we haven't looked it up yet, or have
+        # never sent it one. Until we know it, we can't catch up from the
+        # database, so queue PDUs in memory as normal.
+        self._last_successful_stream_ordering = None
+
+        # The stream_ordering of the most recent PDU we didn't queue because we
+        # were catching up.
+        self._catch_up_last_skipped = 0
+
     def __str__(self):
         return "PerDestinationQueue[%s]" % self._destination
 
@@ -107,11 +130,18 @@ class PerDestinationQueue(object):
     def send_pdu(self, pdu, order):
         """Add a PDU to the queue, and start the transmission loop if neccessary
 
+        The caller must have recorded the PDU in the destination_rooms table, so
+        that it can be sent later if we are catching up.
+
         Args:
             pdu (EventBase): pdu to send
             order (int):
         """
-        self._pending_pdus.append((pdu, order))
+        if self._catching_up and self._last_successful_stream_ordering is not None:
+            # it will be picked up from the database
+            self._catch_up_last_skipped = pdu.internal_metadata.stream_ordering
+        else:
+            self._pending_pdus.append((pdu, order))
         self.attempt_new_transaction()
 
     def send_presence(self, states):
@@ -194,6 +224,9 @@ class PerDestinationQueue(object):
             # hence why we throw the result away.
             yield get_retry_limiter(self._destination, self._clock, self._store)
 
+            if self._catching_up:
+                yield self._catch_up_transmission_loop()
+
             pending_pdus = []
             while True:
                 device_message_edus, device_stream_id, dev_list_id = (
@@ -212,7 +245,10 @@ class PerDestinationQueue(object):
                 pending_pdus = self._pending_pdus
 
                 # We can only include at most 50 PDUs per transactions
-                pending_pdus, self._pending_pdus = pending_pdus[:50], pending_pdus[50:]
+                pending_pdus, self._pending_pdus = (
+                    pending_pdus[:MAX_PDUS_PER_TRANSACTION],
+                    pending_pdus[MAX_PDUS_PER_TRANSACTION:],
+                )
 
                 pending_edus = []
 
@@ -287,6 +323,12 @@ class PerDestinationQueue(object):
 
                     self._last_device_stream_id = device_stream_id
                     self._last_device_list_stream_id = dev_list_id
+
+                    if pending_pdus:
+                        yield self._set_last_successful_stream_ordering(max(
+                            p.internal_metadata.stream_ordering
+                            for p, _ in pending_pdus
+                        ))
                 else:
                     break
         except NotRetryingDestination as e:
@@ -298,19 +340,23 @@ class PerDestinationQueue(object):
                     (e.retry_last_ts + e.retry_interval) / 1000.0
                 ),
             )
+            yield self._start_catching_up(pending_pdus)
         except FederationDeniedError as e:
             logger.info(e)
+            yield self._start_catching_up(pending_pdus)
         except HttpResponseException as e:
             logger.warning(
                 "TX [%s] Received %d response to transaction: %s",
                 self._destination, e.code, e,
             )
+            yield self._start_catching_up(pending_pdus)
         except RequestSendFailed as e:
             logger.warning("TX [%s] Failed to send transaction: %s", self._destination, e)
 
             for p, _ in pending_pdus:
                 logger.info("Failed to send event %s to %s", p.event_id,
                             self._destination)
+            yield self._start_catching_up(pending_pdus)
         except Exception:
             logger.exception(
                 "TX [%s] Failed to send transaction",
@@ -319,10 +365,124 @@ class PerDestinationQueue(object):
             for p, _ in pending_pdus:
                 logger.info("Failed to send event %s to %s", p.event_id,
                             self._destination)
+            yield self._start_catching_up(pending_pdus)
         finally:
             # We want to be *very* sure we clear this after we stop processing
             self.transmission_loop_running = False
 
+    @defer.inlineCallbacks
+    def _start_catching_up(self, failed_pdus):
+        """Stops holding PDUs in memory for the destination, which we have
+        failed to send to, and catches it up from the database instead once it
+        is reachable again.
+
+        Args:
+            failed_pdus (list[tuple[EventBase, int]]): the PDUs we failed to
+                send, and their order
+        """
+        self._catching_up = True
+
+        if self._last_successful_stream_ordering is None:
+            self._last_successful_stream_ordering = (
+                yield self._store.get_destination_last_successful_stream_ordering(
+                    self._destination,
+                )
+            )
+
+        if self._last_successful_stream_ordering is None:
+            # We've never successfully sent the destination a PDU. Catch it up
+            # from just before the earliest PDU it has missed.
+            stream_orderings = [
+                p.internal_metadata.stream_ordering
+                for p, _ in itertools.chain(failed_pdus, self._pending_pdus)
+            ]
+            if stream_orderings:
+                yield self._set_last_successful_stream_ordering(
+                    min(stream_orderings) - 1,
+                )
+
+        if self._last_successful_stream_ordering is not None:
+            # the PDUs will be picked up from the database
+            self._pending_pdus = []
+
+        # Also drop the EDUs which would otherwise pile up while the destination
+        # is unreachable. They are ephemeral (to-device messages and device list
+        # updates, which aren't, are sent from the database). Presence and read
+        # receipts are kept, as there is at most one per user.
+        self._pending_edus = []
+        self._pending_edus_keyed = {}
+
+    @defer.inlineCallbacks
+    def _catch_up_transmission_loop(self):
+        """Sends the destination the most recent event in each room where it
+        has missed PDUs, oldest first.
+
+        Once it is up to date, stops catching up, so that new PDUs are queued
+        in memory again. Raises if sending a transaction fails.
+        """
+        if self._last_successful_stream_ordering is None:
+            self._last_successful_stream_ordering = (
+                yield self._store.get_destination_last_successful_stream_ordering(
+                    self._destination,
+                )
+            )
+
+        if self._last_successful_stream_ordering is None:
+            # We've never successfully sent the destination a PDU, so have no
+            # idea where to catch up from.
+            self._catching_up = False
+            return
+
+        # Any PDUs we queued before we knew that will be picked up from the
+        # database.
+        self._pending_pdus = []
+
+        while True:
+            rows = yield self._store.get_catch_up_room_events(
+                self._destination,
+                self._last_successful_stream_ordering,
+                MAX_PDUS_PER_TRANSACTION,
+            )
+
+            if not rows:
+                if self._catch_up_last_skipped > self._last_successful_stream_ordering:
+                    # We skipped a PDU after looking for events to send. It
+                    # will have been recorded in the database by now, so look
+                    # again.
+                    self._catch_up_last_skipped = 0
+                    continue
+
+                self._catching_up = False
+                logger.info("TX [%s] Caught up", self._destination)
+                return
+
+            stream_orderings = dict(rows)
+            events = yield self._store.get_events(list(stream_orderings))
+            events = list(events.values())
+
+            logger.info(
+                "TX [%s] Catching up on %i rooms", self._destination, len(events),
+            )
+
+            if events:
+                success = yield self._transaction_manager.send_new_transaction(
+                    self._destination,
+                    [(event, stream_orderings[event.event_id]) for event in events],
+                    [],
+                )
+                if success:
+                    sent_transactions_counter.inc()
+
+            # If the destination rejected the transaction, we give up on these
+            # events, as we would if we had been sending them from memory.
+            yield self._set_last_successful_stream_ordering(rows[-1][1])
+
+    def _set_last_successful_stream_ordering(self, stream_ordering):
+        self._last_successful_stream_ordering = stream_ordering
+        return self._store.set_destination_last_successful_stream_ordering(
+            self._destination, stream_ordering,
+        )
+
     def _get_rr_edus(self, force_flush):
         if not self._pending_rrs:
             return
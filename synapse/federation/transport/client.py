@@ -14,18 +14,34 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import codecs
 import logging
+import re
 
 from six.moves import urllib
 
+from canonicaljson import json
+
 from twisted.internet import defer
 
 from synapse.api.constants import Membership
 from synapse.api.urls import FEDERATION_V1_PREFIX, FEDERATION_V2_PREFIX
+from synapse.federation.federation_base import event_from_pdu_json
 from synapse.util.logutils import log_function
 
 logger = logging.getLogger(__name__)
 
+# Matches either a complete JSON string, or one of the characters which change
+# the nesting depth. A lone quote is the start of a string which hasn't all
+# arrived yet.
+_JSON_TOKEN_RE = re.compile(u'"[^"\\\\]*(?:\\\\.[^"\\\\]*)*"|"|[\\[\\]{}]', re.DOTALL)
+
+_json_decoder = json.JSONDecoder()
+
+# The most of a send_join response we will hold on to at once while parsing it:
+# in practice, the longest PDU (PDUs are limited to 64KiB).
+MAX_SEND_JOIN_BUFFER_LENGTH = 1024 * 1024
+
 
 class TransportLayerClient(object):
     """Sends federation HTTP requests to other servers"""
@@ -264,13 +280,31 @@ class TransportLayerClient(object):
 
     @defer.inlineCallbacks
     @log_function
-    def send_join(self, destination, room_id, event_id, content):
+    def send_join(self, destination, room_id, event_id, content,
+                  event_format_version):
+        """Sends a signed join event to a server in the room.
+
+        The response, which can be huge for a large room, is parsed as it
+        arrives by a SendJoinParser.
+
+        Args:
+            destination (str): the server to send the event to
+            room_id (str)
+            event_id (str)
+            content (dict): the PDU json of the join event
+            event_format_version (int): the format of the events in the room
+
+        Returns:
+            Deferred[dict[str, list[FrozenEvent]]]: the "state" and "auth_chain"
+                events in the response.
+        """
         path = _create_v1_path("/send_join/%s/%s", room_id, event_id)
 
         response = yield self.client.put_json(
             destination=destination,
             path=path,
             data=content,
+            parser=SendJoinParser(event_format_version),
         )
 
         defer.returnValue(response)
@@ -960,6 +994,122 @@ class TransportLayerClient(object):
         )
 
 
+class SendJoinParser(object):
+    """Parses the response to a v1 /send_join request as it arrives, building
+    the events in its "state" and "auth_chain" lists.
+
+    The response looks like `[200, {"state": [...], "auth_chain": [...]}]`.
+    Rather than waiting for all of it and then decoding it in one go, which for
+    a large room means holding the whole body and its decoded form alongside
+    the events built from it, and blocking the reactor while decoding, each PDU
+    is decoded and turned into an event as soon as it has arrived. Anything
+    else in the response is skipped over.
+
+    Args:
+        event_format_version (int): the format of the events in the response
+    """
+
+    # how deep the object containing the lists is within the response
+    _OBJECT_DEPTH = 2
+
+    def __init__(self, event_format_version):
+        self._event_format_version = event_format_version
+        self._events = {"state": [], "auth_chain": []}
+
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+
+        # what we've received but not yet dealt with: a PDU or a string which
+        # hasn't all arrived yet
+        self._buffer = u""
+
+        self._depth = 0
+        self._started = False
+
+        # the most recent key we've seen in the object containing the lists
+        self._key = None
+
+        # the list of events we're adding to, if we're in one
+        self._list = None
+
+    def write(self, data):
+        """Parses the next part of the response
+
+        Args:
+            data (bytes)
+
+        Raises:
+            ValueError: if the response is malformed
+        """
+        buf = self._buffer + self._decoder.decode(data)
+        pos = 0
+
+        while True:
+            m = _JSON_TOKEN_RE.search(buf, pos)
+            if not m:
+                pos = len(buf)
+                break
+
+            token = m.group()
+            if token == u'"':
+                # wait for the rest of the string
+                pos = m.start()
+                break
+
+            if token == u"{" and self._list is not None and (
+                self._depth == self._OBJECT_DEPTH + 1
+            ):
+                # a PDU: let the json module find the end of it.
+                try:
+                    pdu, pos = _json_decoder.raw_decode(buf, m.start())
+                except ValueError:
+                    # wait for the rest of the PDU
+                    pos = m.start()
+                    break
+
+                self._list.append(event_from_pdu_json(
+                    pdu, self._event_format_version, outlier=True,
+                ))
+                continue
+
+            pos = m.end()
+
+            if token in (u"[", u"{"):
+                self._started = True
+                self._depth += 1
+                if self._depth == self._OBJECT_DEPTH + 1 and token == u"[":
+                    self._list = self._events.get(self._key)
+
+            elif token in (u"]", u"}"):
+                if self._depth == self._OBJECT_DEPTH + 1:
+                    self._list = None
+
+                self._depth -= 1
+                if self._depth < 0:
+                    raise ValueError("Unbalanced brackets in send_join response")
+
+            elif self._depth == self._OBJECT_DEPTH:
+                self._key = json.loads(token)
+
+        self._buffer = buf[pos:]
+        if len(self._buffer) > MAX_SEND_JOIN_BUFFER_LENGTH:
+            raise ValueError("Invalid or over-long PDU in send_join response")
+
+    def finish(self):
+        """Checks that we received the whole response.
+
+        Returns:
+            dict[str, list[FrozenEvent]]: the "state" and "auth_chain" events
+
+        Raises:
+            ValueError: if the response was truncated
+        """
+        self._decoder.decode(b"", final=True)
+        if not self._started or self._depth or self._buffer:
+            raise ValueError("Incomplete send_join response")
+
+        return self._events
+
+
 def _create_v1_path(path, *args):
     """Creates a path against V1 federation API from the path template and
     args. Ensures that all args are url encoded.
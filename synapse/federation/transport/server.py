@@ -17,6 +17,7 @@
 import functools
 import logging
 import re
+from io import BytesIO
 
 from twisted.internet import defer
 
@@ -24,8 +25,20 @@ import synapse
 from synapse.api.constants import RoomVersions
 from synapse.api.errors import Codes, FederationDeniedError, SynapseError
 from synapse.api.urls import FEDERATION_V1_PREFIX, FEDERATION_V2_PREFIX
+from synapse.http.compression import (
+    MIN_COMPRESS_LENGTH,
+    GzipDecoder,
+    accepts_gzip,
+    gzip_compress,
+    record_uncompressed_body,
+)
 from synapse.http.endpoint import parse_and_validate_server_name
-from synapse.http.server import JsonResource
+from synapse.http.server import (
+    JsonResource,
+    LazyJsonObject,
+    encode_json_response,
+    respond_with_json_bytes,
+)
 from synapse.http.servlet import (
     parse_boolean_from_args,
     parse_integer_from_args,
@@ -33,12 +46,18 @@ from synapse.http.servlet import (
     parse_string_from_args,
 )
 from synapse.types import ThirdPartyInstanceID, get_domain_from_id
-from synapse.util.logcontext import run_in_background
+from synapse.util.logcontext import defer_to_thread, run_in_background
 from synapse.util.ratelimitutils import FederationRateLimiter
 from synapse.util.versionstring import get_version_string
 
 logger = logging.getLogger(__name__)
 
+# We compress response bodies larger than this in the threadpool
+COMPRESS_IN_THREAD_LENGTH = 1024 * 1024
+
+# The largest request body we'll accept once it has been decompressed
+MAX_DECOMPRESSED_REQUEST_LENGTH = 50 * 1024 * 1024
+
 
 class TransportLayerServer(JsonResource):
     """Handles incoming federation HTTP requests"""
@@ -60,6 +79,8 @@ class TransportLayerServer(JsonResource):
 
         super(TransportLayerServer, self).__init__(hs, canonical_json=False)
 
+        self._compress = hs.config.federation_compression
+
         self.authenticator = Authenticator(hs)
         self.ratelimiter = FederationRateLimiter(
             self.clock,
@@ -81,6 +102,57 @@ class TransportLayerServer(JsonResource):
             servlet_groups=self.servlet_groups,
         )
 
+    @defer.inlineCallbacks
+    def _send_response(self, request, code, response_json_object,
+                       response_code_message=None):
+        """Sends a JSON response, gzipping it if the other server accepts gzip.
+        """
+        if self._compress:
+            # Let the other server know that it may gzip its request bodies
+            # (RFC 7694)
+            request.setHeader(b"Accept-Encoding", b"gzip")
+            request.setHeader(b"Vary", b"Accept-Encoding")
+
+        if (
+            not self._compress
+            or isinstance(response_json_object, LazyJsonObject)
+            or not accepts_gzip(request.requestHeaders)
+        ):
+            super(TransportLayerServer, self)._send_response(
+                request, code, response_json_object, response_code_message,
+            )
+            return
+
+        json_bytes = encode_json_response(
+            response_json_object, canonical_json=self.canonical_json,
+        )
+        destination = request.authenticated_entity or "unknown"
+
+        if len(json_bytes) >= MIN_COMPRESS_LENGTH:
+            if len(json_bytes) >= COMPRESS_IN_THREAD_LENGTH:
+                json_bytes = yield defer_to_thread(
+                    self.hs.get_reactor(), gzip_compress, json_bytes, destination,
+                )
+            else:
+                json_bytes = gzip_compress(json_bytes, destination)
+
+            request.setHeader(b"Content-Encoding", b"gzip")
+        else:
+            record_uncompressed_body("sent", destination, len(json_bytes))
+
+        if request._disconnected:
+            logger.warn(
+                "Not sending response to request %s, already disconnected.",
+                request,
+            )
+            return
+
+        respond_with_json_bytes(
+            request, code, json_bytes,
+            send_cors=True,
+            response_code_message=response_code_message,
+        )
+
 
 class AuthenticationError(SynapseError):
     """There was a problem authenticating the request"""
@@ -202,6 +274,42 @@ def _parse_auth_header(header_bytes):
         )
 
 
+def _decode_request_body(request):
+    """Decompresses the body of a request in place, if it is gzipped.
+
+    Args:
+        request (twisted.web.http.Request)
+
+    Returns:
+        GzipDecoder|None: the decoder used to decompress the body, if any.
+
+    Raises:
+        SynapseError: if the body is compressed in a way we don't support, or
+            can't be decompressed.
+    """
+    content_encoding = request.requestHeaders.getRawHeaders(
+        b"Content-Encoding", [b"identity"],
+    )[-1].strip().lower()
+
+    if content_encoding == b"identity":
+        return None
+
+    if content_encoding != b"gzip":
+        raise SynapseError(
+            415, "Unsupported Content-Encoding", Codes.UNRECOGNIZED,
+        )
+
+    decoder = GzipDecoder(max_length=MAX_DECOMPRESSED_REQUEST_LENGTH)
+    try:
+        body = decoder.decode(request.content.read())
+        decoder.finish()
+    except ValueError as e:
+        raise SynapseError(400, str(e), Codes.NOT_JSON)
+
+    request.content = BytesIO(body)
+    return decoder
+
+
 class BaseFederationServlet(object):
     """Abstract base class for federation servlet classes.
 
@@ -267,7 +375,9 @@ class BaseFederationServlet(object):
                     by the callback method. None if the request has already been handled.
             """
             content = None
+            decoder = None
             if request.method in [b"PUT", b"POST"]:
+                decoder = _decode_request_body(request)
                 # TODO: Handle other method types? other content types?
                 content = parse_json_object_from_request(request)
 
@@ -282,6 +392,9 @@ class BaseFederationServlet(object):
                 logger.warn("authenticate_request failed: %s", e)
                 raise
 
+            if decoder and origin:
+                decoder.record_metrics(origin)
+
             if origin:
                 with ratelimiter.ratelimit(origin) as d:
                     yield d
@@ -23,6 +23,7 @@ import six
 from six import iteritems, itervalues
 from six.moves import http_client, zip
 
+from prometheus_client import Counter
 from signedjson.key import decode_verify_key_bytes
 from signedjson.sign import verify_signed_json
 from unpaddedbase64 import decode_base64
@@ -55,7 +56,7 @@ from synapse.replication.http.membership import ReplicationUserJoinedLeftRoomRes
 from synapse.state import StateResolutionStore, resolve_events_with_store
 from synapse.types import UserID, get_domain_from_id
 from synapse.util import logcontext, unwrapFirstError
-from synapse.util.async_helpers import Linearizer
+from synapse.util.async_helpers import Linearizer, ObservableDeferred
 from synapse.util.distributor import user_joined_room
 from synapse.util.logutils import log_function
 from synapse.util.retryutils import NotRetryingDestination
@@ -65,6 +66,17 @@ from ._base import BaseHandler
 
 logger = logging.getLogger(__name__)
 
+# When a user paginates to within this depth of a gap in a room's history, we
+# start backfilling the history beyond the gap in the background. We keep going
+# until the gap is this far behind the user.
+BACKFILL_PREFETCH_DEPTH = 250
+
+# The most backfill requests we make each time we prefetch a room's history.
+BACKFILL_PREFETCH_MAX_REQUESTS = 5
+
+# Number of backfill requests we've made to prefetch history
+backfill_prefetch_counter = Counter("synapse_handlers_federation_backfill_prefetches", "")
+
 
 def shortstr(iterable, maxitems=5):
     """If iterable has maxitems or fewer, return the stringification of a list
@@ -131,6 +143,10 @@ class FederationHandler(BaseHandler):
         self.room_queues = {}
         self._room_pdu_linearizer = Linearizer("fed_room_pdu")
 
+        # map from room_id to ObservableDeferred for the backfill prefetch in
+        # progress for that room
+        self._backfill_prefetches = {}
+
     @defer.inlineCallbacks
     def on_receive_pdu(
             self, origin, pdu, sent_to_us_directly=False,
@@ -637,7 +653,7 @@ class FederationHandler(BaseHandler):
 
     @log_function
     @defer.inlineCallbacks
-    def backfill(self, dest, room_id, limit, extremities):
+    def backfill(self, dest, room_id, limit, extremities, persist_lock=None):
         """ Trigger a backfill request to `dest` for the given `room_id`
 
         This will attempt to get more events from the remote. If the other side
@@ -650,6 +666,15 @@ class FederationHandler(BaseHandler):
         TODO: make this more useful to distinguish failures of the remote
         server from invalid events (there is probably no point in trying to
         re-fetch invalid events from every other HS in the room.)
+
+        Args:
+            dest (str)
+            room_id (str)
+            limit (int)
+            extremities (list[str])
+            persist_lock (callable|None): if given, a function returning a
+                Deferred[context manager] which is held while the fetched
+                events are persisted, but not while they are fetched.
         """
         if dest == self.server_name:
             raise SynapseError(400, "Can't backfill from self.")
@@ -821,28 +846,36 @@ class FederationHandler(BaseHandler):
                 }
             })
 
-        yield self._handle_new_events(
-            dest, ev_infos,
-            backfilled=True,
-        )
+        @defer.inlineCallbacks
+        def persist():
+            yield self._handle_new_events(
+                dest, ev_infos,
+                backfilled=True,
+            )
 
-        # Step 2: Persist the rest of the events in the chunk one by one
-        events.sort(key=lambda e: e.depth)
+            # Step 2: Persist the rest of the events in the chunk one by one
+            events.sort(key=lambda e: e.depth)
 
-        for event in events:
-            if event in events_to_state:
-                continue
+            for event in events:
+                if event in events_to_state:
+                    continue
 
-            # For paranoia we ensure that these events are marked as
-            # non-outliers
-            assert(not event.internal_metadata.is_outlier())
+                # For paranoia we ensure that these events are marked as
+                # non-outliers
+                assert(not event.internal_metadata.is_outlier())
 
-            # We store these one at a time since each event depends on the
-            # previous to work out the state.
-            # TODO: We can probably do something more clever here.
-            yield self._handle_new_event(
-                dest, event, backfilled=True,
-            )
+                # We store these one at a time since each event depends on the
+                # previous to work out the state.
+                # TODO: We can probably do something more clever here.
+                yield self._handle_new_event(
+                    dest, event, backfilled=True,
+                )
+
+        if persist_lock is None:
+            yield persist()
+        else:
+            with (yield persist_lock()):
+                yield persist()
 
         defer.returnValue(events)
 
@@ -851,6 +884,86 @@ class FederationHandler(BaseHandler):
         """Checks the database to see if we should backfill before paginating,
         and if so do.
         """
+        # if we're already backfilling this room in the background, and this page
+        # needs backfilling, wait for that rather than asking for the same events
+        # again.
+        prefetch = self._backfill_prefetches.get(room_id)
+        if prefetch is not None:
+            extremities = yield self._get_backfill_extremities(
+                room_id, current_depth,
+            )
+            if extremities:
+                yield logcontext.make_deferred_yieldable(prefetch.observe())
+
+        result = yield self._maybe_backfill(room_id, current_depth)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def prefetch_backfill(self, room_id, current_depth, persist_lock=None):
+        """Backfills the history of a room ahead of a user who is paginating
+        through it, so that their later pages can be read from the database.
+
+        Does nothing unless the user is close to a gap in the history, or if we
+        are already doing this for the room.
+
+        Args:
+            room_id (str)
+            current_depth (int): the depth the user has paginated back to
+            persist_lock (callable|None): if given, a function returning a
+                Deferred[context manager] to hold while persisting the events.
+                See backfill.
+
+        Returns:
+            Deferred
+        """
+        if room_id in self._backfill_prefetches:
+            return
+
+        prefetch = ObservableDeferred(
+            logcontext.run_in_background(
+                self._prefetch_backfill, room_id, current_depth, persist_lock,
+            ),
+            consumeErrors=True,
+        )
+        self._backfill_prefetches[room_id] = prefetch
+        try:
+            yield logcontext.make_deferred_yieldable(prefetch.observe())
+        finally:
+            self._backfill_prefetches.pop(room_id, None)
+
+    @defer.inlineCallbacks
+    def _prefetch_backfill(self, room_id, current_depth, persist_lock):
+        for _ in range(BACKFILL_PREFETCH_MAX_REQUESTS):
+            try:
+                success = yield self._maybe_backfill(
+                    room_id, current_depth, lookahead=BACKFILL_PREFETCH_DEPTH,
+                    persist_lock=persist_lock,
+                )
+            except Exception:
+                logger.exception("Failed to prefetch history for %s", room_id)
+                return
+
+            if not success:
+                return
+
+            backfill_prefetch_counter.inc()
+
+    @defer.inlineCallbacks
+    def _get_backfill_extremities(self, room_id, current_depth, lookahead=0):
+        """Checks whether there is a gap in the room's history at or after the
+        given depth.
+
+        Args:
+            room_id (str)
+            current_depth (int)
+            lookahead (int): also count gaps up to this much before the given
+                depth.
+
+        Returns:
+            Deferred[dict[str, int]|None]: the deepest (up to 5) backwards
+                extremities to backfill from, with their depths, or None if
+                there's no need to backfill.
+        """
         extremities = yield self.store.get_oldest_events_with_depth_in_room(
             room_id
         )
@@ -859,6 +972,48 @@ class FederationHandler(BaseHandler):
             logger.debug("Not backfilling as no extremeties found.")
             return
 
+        # Check if we reached a point where we should start backfilling.
+        sorted_extremeties_tuple = sorted(
+            extremities.items(),
+            key=lambda e: -int(e[1])
+        )
+        max_depth = sorted_extremeties_tuple[0][1]
+
+        if current_depth - lookahead > max_depth:
+            logger.debug(
+                "Not backfilling as we don't need to. %d < %d",
+                max_depth, current_depth - lookahead,
+            )
+            return
+
+        # We don't want to specify too many extremities as it causes the backfill
+        # request URI to be too long.
+        defer.returnValue(dict(sorted_extremeties_tuple[:5]))
+
+    @defer.inlineCallbacks
+    def _maybe_backfill(self, room_id, current_depth, lookahead=0,
+                        persist_lock=None):
+        """Backfills the room if there is a gap in its history at or after the
+        given depth.
+
+        Args:
+            room_id (str)
+            current_depth (int)
+            lookahead (int): also backfill if there is a gap up to this much
+                before the given depth.
+            persist_lock (callable|None): if given, a function returning a
+                Deferred[context manager] to hold while persisting the events.
+                See backfill.
+
+        Returns:
+            Deferred[bool|None]: True if we backfilled some events
+        """
+        extremities = yield self._get_backfill_extremities(
+            room_id, current_depth, lookahead,
+        )
+        if not extremities:
+            return
+
         # We only want to paginate if we can actually see the events we'll get,
         # as otherwise we'll just spend a lot of resources to get redacted
         # events.
@@ -905,24 +1060,6 @@ class FederationHandler(BaseHandler):
         if not filtered_extremities:
             defer.returnValue(False)
 
-        # Check if we reached a point where we should start backfilling.
-        sorted_extremeties_tuple = sorted(
-            extremities.items(),
-            key=lambda e: -int(e[1])
-        )
-        max_depth = sorted_extremeties_tuple[0][1]
-
-        # We don't want to specify too many extremities as it causes the backfill
-        # request URI to be too long.
-        extremities = dict(sorted_extremeties_tuple[:5])
-
-        if current_depth > max_depth:
-            logger.debug(
-                "Not backfilling as we don't need to. %d < %d",
-                max_depth, current_depth,
-            )
-            return
-
         # Now we need to decide which hosts to hit first.
 
         # First we try hosts that are already in the room
@@ -978,6 +1115,7 @@ class FederationHandler(BaseHandler):
                         dom, room_id,
                         limit=100,
                         extremities=extremities,
+                        persist_lock=persist_lock,
                     )
                     # If this succeeded then we probably already have the
                     # appropriate stuff.
@@ -1050,7 +1188,7 @@ class FederationHandler(BaseHandler):
             } for key, state_dict in iteritems(states)
         }
 
-        for e_id, _ in sorted_extremeties_tuple:
+        for e_id, _ in sorted(extremities.items(), key=lambda e: -int(e[1])):
             likely_domains = get_domains_from_state(states[e_id])
 
             success = yield try_backfill([
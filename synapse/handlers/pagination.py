@@ -21,6 +21,7 @@ from twisted.python.failure import Failure
 from synapse.api.constants import EventTypes, Membership
 from synapse.api.errors import SynapseError
 from synapse.events.utils import serialize_event
+from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage.state import StateFilter
 from synapse.types import RoomStreamToken
 from synapse.util.async_helpers import ReadWriteLock
@@ -161,6 +162,16 @@ class PaginationHandler(object):
         """
         return self._purges_by_id.get(purge_id)
 
+    @defer.inlineCallbacks
+    def _prefetch_backfill(self, room_id, current_depth):
+        # we take the lock while persisting the events so that we don't backfill
+        # while a purge is going on. We don't hold it while fetching them, so
+        # that a slow server doesn't hold up purges.
+        yield self.hs.get_handlers().federation_handler.prefetch_backfill(
+            room_id, current_depth,
+            persist_lock=lambda: self.pagination_lock.read(room_id),
+        )
+
     @defer.inlineCallbacks
     def get_messages(self, requester, room_id=None, pagin_config=None,
                      as_client_event=True, event_filter=None):
@@ -239,6 +250,14 @@ class PaginationHandler(object):
                 "room_key", next_key
             )
 
+        if source_config.direction == 'b':
+            # the user is likely to ask for the next page soon, so start fetching
+            # any history beyond it that we don't have yet.
+            run_as_background_process(
+                "prefetch_backfill", self._prefetch_backfill,
+                room_id, RoomStreamToken.parse(next_key).topological or max_topo,
+            )
+
         if events:
             if event_filter:
                 events = event_filter.filter(events)
@@ -28,7 +28,7 @@ from synapse.api.constants import EventTypes, Membership
 from synapse.push.clientformat import format_push_rules_for_user
 from synapse.storage.roommember import MemberSummary
 from synapse.storage.state import StateFilter
-from synapse.types import RoomStreamToken
+from synapse.util import batch_iter
 from synapse.util.async_helpers import concurrently_execute
 from synapse.util.caches.expiringcache import ExpiringCache
 from synapse.util.caches.lrucache import LruCache
@@ -63,6 +63,12 @@ LAZY_LOADED_MEMBERS_CACHE_MAX_AGE = 30 * 60 * 1000
 # avoiding redundantly sending the same lazy-loaded members to the client
 LAZY_LOADED_MEMBERS_CACHE_MAX_SIZE = 100
 
+# How long we keep a client's sync session after its last sync.
+SYNC_SESSION_MAX_AGE = 30 * 60 * 1000
+
+# How many rooms to load the recent events of at once during an initial sync.
+RECENT_EVENTS_BATCH_SIZE = 100
+
 
 SyncConfig = collections.namedtuple("SyncConfig", [
     "user",
@@ -73,6 +79,16 @@ SyncConfig = collections.namedtuple("SyncConfig", [
 ])
 
 
+# The recent events in a room, loaded ahead of generating the room's entry.
+# `events` and `end_key` are as returned by `get_recent_events_for_room`, and
+# `filtered_events` are the events that the client should see.
+PrefetchedRecents = collections.namedtuple("PrefetchedRecents", [
+    "events",
+    "end_key",
+    "filtered_events",
+])
+
+
 class TimelineBatch(collections.namedtuple("TimelineBatch", [
     "prev_batch",
     "events",
@@ -202,6 +218,24 @@ class SyncResult(collections.namedtuple("SyncResult", [
     __bool__ = __nonzero__  # python3
 
 
+class SyncSession(object):
+    """What we remember about a client between syncs, so that incremental
+    syncs can apply the changes since the last one rather than recalculating
+    everything.
+
+    Attributes:
+        joined_room_ids (frozenset[str]): The rooms the user was joined to at
+            `room_stream_id`.
+        room_stream_id (int): The stream ordering `joined_room_ids` was
+            calculated at.
+    """
+    __slots__ = ["joined_room_ids", "room_stream_id"]
+
+    def __init__(self):
+        self.joined_room_ids = None
+        self.room_stream_id = None
+
+
 class SyncHandler(object):
 
     def __init__(self, hs):
@@ -221,6 +255,12 @@ class SyncHandler(object):
             max_len=0, expiry_ms=LAZY_LOADED_MEMBERS_CACHE_MAX_AGE,
         )
 
+        # ExpiringCache((User, Device)) -> SyncSession
+        self.sync_sessions = ExpiringCache(
+            "sync_sessions", self.clock,
+            max_len=0, expiry_ms=SYNC_SESSION_MAX_AGE,
+        )
+
     @defer.inlineCallbacks
     def wait_for_sync_for_user(self, sync_config, since_token=None, timeout=0,
                                full_state=False):
@@ -361,8 +401,14 @@ class SyncHandler(object):
 
     @defer.inlineCallbacks
     def _load_filtered_recents(self, room_id, sync_config, now_token,
-                               since_token=None, recents=None, newly_joined_room=False):
+                               since_token=None, recents=None, newly_joined_room=False,
+                               prefetched=None):
         """
+        Args:
+            prefetched (PrefetchedRecents|None): The room's recent events, if
+                they have already been loaded. Only used if there is no
+                `since_token`.
+
         Returns:
             a Deferred TimelineBatch
         """
@@ -402,8 +448,7 @@ class SyncHandler(object):
                     limited=False
                 ))
 
-            filtering_factor = 2
-            load_limit = max(timeline_limit * filtering_factor, 10)
+            load_limit = _get_timeline_load_limit(timeline_limit)
             max_repeat = 5  # Only try a few times per room, otherwise
             room_key = now_token.room_key
             end_key = room_key
@@ -413,42 +458,17 @@ class SyncHandler(object):
                 since_key = since_token.room_key
 
             while limited and len(recents) < timeline_limit and max_repeat:
-                # If we have a since_key then we are trying to get any events
-                # that have happened since `since_key` up to `end_key`, so we
-                # can just use `get_room_events_stream_for_room`.
-                # Otherwise, we want to return the last N events in the room
-                # in toplogical ordering.
-                if since_key:
-                    events, end_key = yield self.store.get_room_events_stream_for_room(
-                        room_id,
-                        limit=load_limit + 1,
-                        from_key=since_key,
-                        to_key=end_key,
-                    )
+                if prefetched is not None and not since_key:
+                    loaded = prefetched
+                    prefetched = None
                 else:
-                    events, end_key = yield self.store.get_recent_events_for_room(
-                        room_id,
-                        limit=load_limit + 1,
-                        end_token=end_key,
+                    loaded = yield self._load_recents(
+                        room_id, sync_config, since_key, end_key, load_limit + 1,
                     )
-                loaded_recents = sync_config.filter_collection.filter_room_timeline(
-                    events
-                )
-
-                # We check if there are any state events, if there are then we pass
-                # all current state events to the filter_events function. This is to
-                # ensure that we always include current state in the timeline
-                current_state_ids = frozenset()
-                if any(e.is_state() for e in loaded_recents):
-                    current_state_ids = yield self.state.get_current_state_ids(room_id)
-                    current_state_ids = frozenset(itervalues(current_state_ids))
 
-                loaded_recents = yield filter_events_for_client(
-                    self.store,
-                    sync_config.user.to_string(),
-                    loaded_recents,
-                    always_include_ids=current_state_ids,
-                )
+                events = loaded.events
+                end_key = loaded.end_key
+                loaded_recents = list(loaded.filtered_events)
                 loaded_recents.extend(recents)
                 recents = loaded_recents
 
@@ -472,6 +492,65 @@ class SyncHandler(object):
             limited=limited or newly_joined_room
         ))
 
+    @defer.inlineCallbacks
+    def _load_recents(self, room_id, sync_config, since_key, end_key, limit):
+        """Loads a batch of events in a room, and filters them for the client.
+
+        Args:
+            room_id (str)
+            sync_config (SyncConfig)
+            since_key (str|None): If given, load the events after this room
+                key. Otherwise load the most recent events in topological
+                order.
+            end_key (str): The room key to load events up to.
+            limit (int): The maximum number of events to load.
+
+        Returns:
+            Deferred[PrefetchedRecents]
+        """
+        # If we have a since_key then we are trying to get any events
+        # that have happened since `since_key` up to `end_key`, so we
+        # can just use `get_room_events_stream_for_room`.
+        # Otherwise, we want to return the last N events in the room
+        # in toplogical ordering.
+        if since_key:
+            events, end_key = yield self.store.get_room_events_stream_for_room(
+                room_id,
+                limit=limit,
+                from_key=since_key,
+                to_key=end_key,
+            )
+        else:
+            events, end_key = yield self.store.get_recent_events_for_room(
+                room_id,
+                limit=limit,
+                end_token=end_key,
+            )
+        filtered_events = sync_config.filter_collection.filter_room_timeline(
+            events
+        )
+
+        # We check if there are any state events, if there are then we pass
+        # all current state events to the filter_events function. This is to
+        # ensure that we always include current state in the timeline
+        current_state_ids = frozenset()
+        if any(e.is_state() for e in filtered_events):
+            current_state_ids = yield self.state.get_current_state_ids(room_id)
+            current_state_ids = frozenset(itervalues(current_state_ids))
+
+        filtered_events = yield filter_events_for_client(
+            self.store,
+            sync_config.user.to_string(),
+            filtered_events,
+            always_include_ids=current_state_ids,
+        )
+
+        defer.returnValue(PrefetchedRecents(
+            events=events,
+            end_key=end_key,
+            filtered_events=filtered_events,
+        ))
+
     @defer.inlineCallbacks
     def get_state_after_event(self, event, state_filter=StateFilter.all()):
         """
@@ -916,8 +995,8 @@ class SyncHandler(object):
             # See https://github.com/matrix-org/matrix-doc/issues/1144
             raise NotImplementedError()
         else:
-            joined_room_ids = yield self.get_rooms_for_user_at(
-                user_id, now_token.room_stream_id,
+            joined_room_ids = yield self._get_joined_room_ids(
+                sync_config, now_token.room_stream_id,
             )
 
         sync_result_builder = SyncResultBuilder(
@@ -1360,11 +1439,10 @@ class SyncHandler(object):
         if rooms_changed:
             defer.returnValue(True)
 
-        stream_id = RoomStreamToken.parse_stream_token(since_token.room_key).stream
-        for room_id in sync_result_builder.joined_room_ids:
-            if self.store.has_room_changed_since(room_id, stream_id):
-                defer.returnValue(True)
-        defer.returnValue(False)
+        rooms_changed = self.store.get_rooms_that_changed(
+            sync_result_builder.joined_room_ids, since_token.room_key,
+        )
+        defer.returnValue(bool(rooms_changed))
 
     @defer.inlineCallbacks
     def _get_rooms_changed(self, sync_result_builder, ignored_users):
@@ -1647,8 +1725,83 @@ class SyncHandler(object):
                     upto_token=leave_token,
                 ))
 
+        # With a since token (ie, a full_state incremental sync), the timelines
+        # are loaded from since_token rather than being the latest events, so
+        # there's nothing to prefetch.
+        if since_token is None:
+            yield self._prefetch_recents(
+                sync_config,
+                [entry for entry in room_entries if entry.rtype == "joined"],
+                now_token,
+            )
+
         defer.returnValue((room_entries, invited, []))
 
+    @defer.inlineCallbacks
+    def _prefetch_recents(self, sync_config, room_builders, now_token):
+        """Loads and filters the recent events for many rooms at once, rather
+        than leaving `_load_filtered_recents` to do so a room at a time.
+
+        Sets `prefetched_recents` on each of the given room builders.
+
+        Args:
+            sync_config (SyncConfig)
+            room_builders (list[RoomSyncResultBuilder]): The rooms to load the
+                events of. They must all have `now_token` as their upto_token
+                and have no since_token.
+            now_token (StreamToken)
+        """
+        timeline_limit = sync_config.filter_collection.timeline_limit()
+        if (
+            timeline_limit == 0
+            or sync_config.filter_collection.blocks_all_room_timeline()
+        ):
+            return
+
+        load_limit = _get_timeline_load_limit(timeline_limit)
+
+        with Measure(self.clock, "prefetch_recents"):
+            for batch in batch_iter(room_builders, RECENT_EVENTS_BATCH_SIZE):
+                recents_by_room = yield self.store.get_recent_events_for_rooms(
+                    [room_builder.room_id for room_builder in batch],
+                    limit=load_limit + 1,
+                    end_token=now_token.room_key,
+                )
+
+                # As in `_load_filtered_recents`, we always include current
+                # state events in the timeline.
+                recents = []
+                current_state_ids = set()
+                for room_id, (events, _) in iteritems(recents_by_room):
+                    events = sync_config.filter_collection.filter_room_timeline(
+                        events,
+                    )
+                    if any(e.is_state() for e in events):
+                        state_ids = yield self.state.get_current_state_ids(room_id)
+                        current_state_ids.update(itervalues(state_ids))
+                    recents.extend(events)
+
+                recents = yield filter_events_for_client(
+                    self.store,
+                    sync_config.user.to_string(),
+                    recents,
+                    always_include_ids=frozenset(current_state_ids),
+                )
+
+                filtered_by_room = {}
+                for event in recents:
+                    filtered_by_room.setdefault(event.room_id, []).append(event)
+
+                for room_builder in batch:
+                    events, end_key = recents_by_room[room_builder.room_id]
+                    room_builder.prefetched_recents = PrefetchedRecents(
+                        events=events,
+                        end_key=end_key,
+                        filtered_events=filtered_by_room.get(
+                            room_builder.room_id, [],
+                        ),
+                    )
+
     @defer.inlineCallbacks
     def _generate_room_entry(self, sync_result_builder, ignored_users,
                              room_builder, ephemeral, tags, account_data,
@@ -1693,6 +1846,7 @@ class SyncHandler(object):
             since_token=since_token,
             recents=events,
             newly_joined_room=newly_joined,
+            prefetched=room_builder.prefetched_recents,
         )
 
         if newly_joined:
@@ -1816,6 +1970,61 @@ class SyncHandler(object):
         else:
             raise Exception("Unrecognized rtype: %r", room_builder.rtype)
 
+    def get_sync_session(self, sync_config):
+        """Get the session for the client making this sync request, creating
+        it if necessary.
+
+        Args:
+            sync_config (SyncConfig)
+
+        Returns:
+            SyncSession
+        """
+        key = (sync_config.user.to_string(), sync_config.device_id)
+        session = self.sync_sessions.get(key)
+        if session is None:
+            session = SyncSession()
+            self.sync_sessions[key] = session
+        return session
+
+    @defer.inlineCallbacks
+    def _get_joined_room_ids(self, sync_config, stream_ordering):
+        """Get the set of rooms the user is joined to at the given stream
+        ordering, reusing the set calculated by the client's previous sync if
+        the user's memberships haven't changed since.
+
+        Args:
+            sync_config (SyncConfig)
+            stream_ordering (int)
+
+        Returns:
+            Deferred[frozenset[str]]
+        """
+        user_id = sync_config.user.to_string()
+        session = self.get_sync_session(sync_config)
+
+        previous_stream_id = session.room_stream_id
+        if (
+            previous_stream_id is not None
+            and previous_stream_id <= stream_ordering
+            and not self.store.has_membership_changed_since(
+                user_id, previous_stream_id,
+            )
+        ):
+            defer.returnValue(session.joined_room_ids)
+
+        joined_room_ids = yield self.get_rooms_for_user_at(
+            user_id, stream_ordering,
+        )
+
+        # Only move the session forwards: concurrent syncs from the same
+        # device may finish out of order.
+        if previous_stream_id is None or previous_stream_id < stream_ordering:
+            session.joined_room_ids = joined_room_ids
+            session.room_stream_id = stream_ordering
+
+        defer.returnValue(joined_room_ids)
+
     @defer.inlineCallbacks
     def get_rooms_for_user_at(self, user_id, stream_ordering):
         """Get set of joined rooms for a user at the given stream ordering.
@@ -1865,6 +2074,21 @@ class SyncHandler(object):
         defer.returnValue(joined_room_ids)
 
 
+def _get_timeline_load_limit(timeline_limit):
+    """Get how many events to load at a time when filling a timeline of the
+    given size. We load more than we need, as some events will be filtered
+    out.
+
+    Args:
+        timeline_limit (int)
+
+    Returns:
+        int
+    """
+    filtering_factor = 2
+    return max(timeline_limit * filtering_factor, 10)
+
+
 def _action_has_highlight(actions):
     for action in actions:
         try:
@@ -2002,3 +2226,7 @@ class RoomSyncResultBuilder(object):
         self.full_state = full_state
         self.since_token = since_token
         self.upto_token = upto_token
+
+        # PrefetchedRecents|None: the room's recent events, if they have been
+        # loaded in bulk with other rooms.
+        self.prefetched_recents = None
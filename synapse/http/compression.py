@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for gzipping the bodies of federation requests and responses."""
+
+import time
+import zlib
+
+from prometheus_client import Counter
+
+# Bodies smaller than this aren't worth compressing.
+MIN_COMPRESS_LENGTH = 1024
+
+# zlib's fastest level gets nearly all of the benefit for JSON, for less than
+# half the CPU of the default level.
+COMPRESSION_LEVEL = 1
+
+# The largest body we'll decompress, to protect ourselves from decompression
+# bombs.
+MAX_DECOMPRESSED_LENGTH = 512 * 1024 * 1024
+
+# tells zlib to read and write gzip headers
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# The size of the federation request and response bodies we've sent and
+# received, by whether it is before ("identity") or after ("gzip") compression.
+body_bytes_counter = Counter(
+    "synapse_http_federation_body_bytes", "", ["direction", "destination", "encoding"],
+)
+
+# Time spent compressing the bodies we send and decompressing those we receive
+compression_time_counter = Counter(
+    "synapse_http_federation_compression_seconds", "", ["direction", "destination"],
+)
+
+
+def accepts_gzip(headers):
+    """Checks whether some headers have an Accept-Encoding header which allows
+    gzip.
+
+    In a request, this means we can gzip the response. In a response, it means
+    that the server accepts gzipped request bodies (RFC 7694).
+
+    Args:
+        headers (twisted.web.http_headers.Headers)
+
+    Returns:
+        bool
+    """
+    for header in headers.getRawHeaders(b"Accept-Encoding", []):
+        for coding in header.split(b","):
+            params = coding.split(b";")
+            if params[0].strip().lower() not in (b"gzip", b"*"):
+                continue
+
+            for param in params[1:]:
+                name, _, value = param.partition(b"=")
+                if name.strip() == b"q" and value.strip() in (b"0", b"0.0", b"0.00"):
+                    break
+            else:
+                return True
+
+    return False
+
+
+def gzip_compress(data, destination):
+    """Gzips a body we're sending. May be called from a thread.
+
+    Args:
+        data (bytes): the body
+        destination (str): the server we're sending it to, for the metrics
+
+    Returns:
+        bytes: the compressed body
+    """
+    start = time.time()
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, _GZIP_WBITS)
+    compressed = compressor.compress(data) + compressor.flush()
+
+    compression_time_counter.labels("sent", destination).inc(time.time() - start)
+    body_bytes_counter.labels("sent", destination, "identity").inc(len(data))
+    body_bytes_counter.labels("sent", destination, "gzip").inc(len(compressed))
+
+    return compressed
+
+
+def record_uncompressed_body(direction, destination, length):
+    """Records the size of a body which we sent or received uncompressed
+
+    Args:
+        direction (str): "sent" or "received"
+        destination (str): the other server
+        length (int): the size of the body
+    """
+    body_bytes_counter.labels(direction, destination, "identity").inc(length)
+
+
+class GzipDecoder(object):
+    """Decompresses a gzipped body we've received a piece at a time.
+
+    Args:
+        max_length (int): the largest we'll allow the body to be, once
+            decompressed.
+
+    Attributes:
+        compressed_length (int): how much compressed data we've been given
+        length (int): how much data we've decompressed it to
+        seconds (float): how long we've spent decompressing
+    """
+
+    def __init__(self, max_length=MAX_DECOMPRESSED_LENGTH):
+        self._decompressor = zlib.decompressobj(_GZIP_WBITS)
+        self._max_length = max_length
+        self.compressed_length = 0
+        self.length = 0
+        self.seconds = 0
+
+    def decode(self, data):
+        """Decompresses the next piece of the body
+
+        Args:
+            data (bytes)
+
+        Returns:
+            bytes
+
+        Raises:
+            ValueError: if the body isn't valid gzip, or is too large
+        """
+        start = time.time()
+        self.compressed_length += len(data)
+
+        try:
+            # we ask for one more byte than we're allowed, so that we can tell
+            # if the body is too large without decompressing any further.
+            decoded = self._decompressor.decompress(
+                data, self._max_length - self.length + 1,
+            )
+        except zlib.error as e:
+            raise ValueError("Invalid gzip data: %s" % (e,))
+        finally:
+            self.seconds += time.time() - start
+
+        self.length += len(decoded)
+        if self.length > self._max_length:
+            raise ValueError(
+                "Body is larger than %i bytes once decompressed" % (self._max_length,),
+            )
+
+        return decoded
+
+    def finish(self):
+        """Checks that we have received the whole body
+
+        Raises:
+            ValueError: if the body was truncated
+        """
+        # python 2's decompressobj can't tell us whether it saw the end of the
+        # stream, so we can only check on python 3.
+        if not getattr(self._decompressor, "eof", True):
+            raise ValueError("Truncated gzip data")
+
+    def record_metrics(self, destination):
+        """Records how much data we decompressed, and how long it took
+
+        Args:
+            destination (str): the server we received the body from
+        """
+        compression_time_counter.labels("received", destination).inc(self.seconds)
+        body_bytes_counter.labels("received", destination, "identity").inc(self.length)
+        body_bytes_counter.labels("received", destination, "gzip").inc(
+            self.compressed_length,
+        )
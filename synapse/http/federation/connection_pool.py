@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+from collections import OrderedDict
+
+from prometheus_client import Counter
+
+from twisted.internet import defer
+from twisted.web.client import HTTPConnectionPool
+
+from synapse.metrics import LaterGauge
+
+logger = logging.getLogger(__name__)
+
+# The connections we've used for federation requests, by whether they were
+# taken from the pool ("reused") or newly opened ("new").
+connections_counter = Counter(
+    "synapse_http_federation_client_connections", "", ["type"],
+)
+
+# Idle connections we've closed because there were too many idle connections
+# in the pool overall.
+evicted_connections_counter = Counter(
+    "synapse_http_federation_client_evicted_idle_connections", "",
+)
+
+
+class FederationConnectionPool(HTTPConnectionPool):
+    """An HTTPConnectionPool which limits the number of idle connections it keeps,
+    both to each server and in total.
+
+    When a connection becomes idle and there are already too many idle
+    connections to its server, the oldest of those is closed; if there are too
+    many in total, the connection which has been idle longest is closed,
+    whichever server it is to.
+
+    Doesn't retry requests on connections which turn out to have been closed.
+
+    Args:
+        reactor (IReactor)
+        max_idle_connections_per_host (int): the most idle connections to keep
+            to each server.
+        max_idle_connections (int): the most idle connections to keep in total.
+        idle_timeout (float): how long to keep a connection idle before
+            closing it, in seconds.
+    """
+
+    def __init__(
+        self, reactor, max_idle_connections_per_host, max_idle_connections,
+        idle_timeout,
+    ):
+        super(FederationConnectionPool, self).__init__(reactor)
+        self.retryAutomatically = False
+        self.maxPersistentPerHost = max_idle_connections_per_host
+        self.cachedConnectionTimeout = idle_timeout
+        self._max_idle_connections = max_idle_connections
+
+        # all of our idle connections, mapped to their keys, in the order they
+        # became idle.
+        self._idle_connections = OrderedDict()
+
+        LaterGauge(
+            "synapse_http_federation_client_idle_connections", "", [],
+            lambda: len(self._idle_connections),
+        )
+
+    def getConnection(self, key, endpoint):
+        connections = self._connections.get(key)
+        while connections:
+            connection = connections[0]
+            self._remove_idle_connection(key, connection)
+            if connection.state == "QUIESCENT":
+                connections_counter.labels("reused").inc()
+                return defer.succeed(connection)
+
+        connections_counter.labels("new").inc()
+        return self._newConnection(key, endpoint)
+
+    def _putConnection(self, key, connection):
+        if connection.state != "QUIESCENT":
+            logger.error("BUG: Non-quiescent protocol added to connection pool")
+            return
+
+        if self.maxPersistentPerHost <= 0 or self._max_idle_connections <= 0:
+            connection.transport.loseConnection()
+            return
+
+        connections = self._connections.get(key, [])
+        if len(connections) >= self.maxPersistentPerHost:
+            self._close_idle_connection(key, connections[0])
+        elif len(self._idle_connections) >= self._max_idle_connections:
+            oldest_connection, oldest_key = next(iter(self._idle_connections.items()))
+            evicted_connections_counter.inc()
+            self._close_idle_connection(oldest_key, oldest_connection)
+
+        self._connections.setdefault(key, []).append(connection)
+        self._idle_connections[connection] = key
+        self._timeouts[connection] = self._reactor.callLater(
+            self.cachedConnectionTimeout, self._removeConnection, key, connection,
+        )
+
+    def _removeConnection(self, key, connection):
+        # called when an idle connection times out
+        self._close_idle_connection(key, connection)
+
+    def closeCachedConnections(self):
+        self._idle_connections = OrderedDict()
+        return super(FederationConnectionPool, self).closeCachedConnections()
+
+    def _close_idle_connection(self, key, connection):
+        self._remove_idle_connection(key, connection)
+        connection.transport.loseConnection()
+
+    def _remove_idle_connection(self, key, connection):
+        """Takes an idle connection out of the pool, without closing it.
+        """
+        connections = self._connections[key]
+        connections.remove(connection)
+        if not connections:
+            # don't keep an empty list around for every server we've ever
+            # talked to.
+            del self._connections[key]
+
+        timeout = self._timeouts.pop(connection)
+        if timeout.active():
+            timeout.cancel()
+
+        del self._idle_connections[connection]
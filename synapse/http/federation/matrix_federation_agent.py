@@ -24,11 +24,12 @@ from zope.interface import implementer
 from twisted.internet import defer
 from twisted.internet.endpoints import HostnameEndpoint, wrapClientTLS
 from twisted.internet.interfaces import IStreamClientEndpoint
-from twisted.web.client import URI, Agent, HTTPConnectionPool, RedirectAgent, readBody
+from twisted.web.client import URI, Agent, RedirectAgent, readBody
 from twisted.web.http import stringToDatetime
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IAgent
 
+from synapse.http.federation.connection_pool import FederationConnectionPool
 from synapse.http.federation.srv_resolver import SrvResolver, pick_server_from_list
 from synapse.util import Clock
 from synapse.util.caches.ttlcache import TTLCache
@@ -47,6 +48,9 @@ WELL_KNOWN_INVALID_CACHE_PERIOD = 1 * 3600
 # cap for .well-known cache period
 WELL_KNOWN_MAX_CACHE_PERIOD = 48 * 3600
 
+# how long to keep idle connections open for
+IDLE_CONNECTION_TIMEOUT = 2 * 60
+
 logger = logging.getLogger(__name__)
 well_known_cache = TTLCache('well-known')
 
@@ -64,6 +68,13 @@ class MatrixFederationAgent(object):
         tls_client_options_factory (ClientTLSOptionsFactory|None):
             factory to use for fetching client tls options, or none to disable TLS.
 
+        max_idle_connections_per_server (int): the most idle connections to keep
+            open to each server.
+
+        max_idle_connections (int): the most idle connections to keep open in
+            total. When there are more, those which have been idle longest are
+            closed.
+
         _well_known_tls_policy (IPolicyForHTTPS|None):
             TLS policy to use for fetching .well-known files. None to use a default
             (browser-like) implementation.
@@ -79,6 +90,8 @@ class MatrixFederationAgent(object):
 
     def __init__(
         self, reactor, tls_client_options_factory,
+        max_idle_connections_per_server=5,
+        max_idle_connections=1000,
         _well_known_tls_policy=None,
         _srv_resolver=None,
         _well_known_cache=well_known_cache,
@@ -91,10 +104,12 @@ class MatrixFederationAgent(object):
             _srv_resolver = SrvResolver()
         self._srv_resolver = _srv_resolver
 
-        self._pool = HTTPConnectionPool(reactor)
-        self._pool.retryAutomatically = False
-        self._pool.maxPersistentPerHost = 5
-        self._pool.cachedConnectionTimeout = 2 * 60
+        self._pool = FederationConnectionPool(
+            reactor,
+            max_idle_connections_per_host=max_idle_connections_per_server,
+            max_idle_connections=max_idle_connections,
+            idle_timeout=IDLE_CONNECTION_TIMEOUT,
+        )
 
         agent_args = {}
         if _well_known_tls_policy is not None:
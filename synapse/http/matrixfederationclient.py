@@ -23,8 +23,7 @@ from six import PY3, raise_from, string_types
 from six.moves import urllib
 
 import attr
-import treq
-from canonicaljson import encode_canonical_json
+from canonicaljson import encode_canonical_json, json
 from prometheus_client import Counter
 from signedjson.sign import sign_json
 
@@ -32,6 +31,7 @@ from twisted.internet import defer, protocol
 from twisted.internet.error import DNSLookupError
 from twisted.internet.task import _EPSILON, Cooperator
 from twisted.web._newclient import ResponseDone
+from twisted.web.http import PotentialDataLoss
 from twisted.web.http_headers import Headers
 
 import synapse.metrics
@@ -44,6 +44,13 @@ from synapse.api.errors import (
     SynapseError,
 )
 from synapse.http import QuieterFileBodyProducer
+from synapse.http.compression import (
+    MIN_COMPRESS_LENGTH,
+    GzipDecoder,
+    accepts_gzip,
+    gzip_compress,
+    record_uncompressed_body,
+)
 from synapse.http.federation.matrix_federation_agent import MatrixFederationAgent
 from synapse.util.async_helpers import timeout_deferred
 from synapse.util.logcontext import make_deferred_yieldable
@@ -117,15 +124,20 @@ class MatrixFederationRequest(object):
 
 
 @defer.inlineCallbacks
-def _handle_json_response(reactor, timeout_sec, request, response):
+def _handle_json_response(reactor, timeout_sec, request, response, parser=None):
     """
-    Reads the JSON body of a response, with a timeout
+    Reads the JSON body of a response, with a timeout. Decompresses the body
+    as it arrives if it is gzipped.
 
     Args:
         reactor (IReactor): twisted reactor, for the timeout
         timeout_sec (float): number of seconds to wait for response to complete
         request (MatrixFederationRequest): the request that triggered the response
         response (IResponse): response to the request
+        parser (object|None): if given, the body is passed to the parser's
+            `write` method as it arrives, instead of being decoded as a
+            whole once it has all arrived. The result is then the return
+            value of the parser's `finish` method.
 
     Returns:
         dict: parsed JSON response
@@ -133,7 +145,7 @@ def _handle_json_response(reactor, timeout_sec, request, response):
     try:
         check_content_type_is_json(response.headers)
 
-        d = treq.json_content(response)
+        d = _read_body(response, request.destination, parser)
         d = timeout_deferred(
             d,
             timeout=timeout_sec,
@@ -141,6 +153,8 @@ def _handle_json_response(reactor, timeout_sec, request, response):
         )
 
         body = yield make_deferred_yieldable(d)
+        if parser is None:
+            body = json.loads(body.decode("utf-8"))
     except Exception as e:
         logger.warn(
             "{%s} [%s] Error reading response: %s",
@@ -177,6 +191,10 @@ class MatrixFederationHttpClient(object):
         self.agent = MatrixFederationAgent(
             hs.get_reactor(),
             tls_client_options_factory,
+            max_idle_connections_per_server=(
+                hs.config.federation_max_idle_connections_per_server
+            ),
+            max_idle_connections=hs.config.federation_max_idle_connections,
         )
         self.clock = hs.get_clock()
         self._store = hs.get_datastore()
@@ -188,6 +206,12 @@ class MatrixFederationHttpClient(object):
 
         self._cooperator = Cooperator(scheduler=schedule)
 
+        self._compress = hs.config.federation_compression
+
+        # The servers which have told us that they accept gzipped request
+        # bodies, with an Accept-Encoding header in a response (RFC 7694).
+        self._gzip_destinations = set()
+
     @defer.inlineCallbacks
     def _send_request_with_optional_trailing_slash(
         self,
@@ -249,6 +273,7 @@ class MatrixFederationHttpClient(object):
         long_retries=False,
         ignore_backoff=False,
         backoff_on_404=False,
+        accept_gzip=True,
     ):
         """
         Sends a request to the given server.
@@ -264,6 +289,8 @@ class MatrixFederationHttpClient(object):
 
             backoff_on_404 (bool): Back off if we get a 404
 
+            accept_gzip (bool): whether we can handle a gzipped response body.
+
         Returns:
             Deferred[twisted.web.client.Response]: resolves with the HTTP
             response object on success.
@@ -308,6 +335,8 @@ class MatrixFederationHttpClient(object):
         headers_dict = {
             b"User-Agent": [self.version_string_bytes],
         }
+        if self._compress and accept_gzip:
+            headers_dict[b"Accept-Encoding"] = [b"gzip"]
 
         with limiter:
             # XXX: Would be much nicer to retry only at the transaction-layer
@@ -338,6 +367,18 @@ class MatrixFederationHttpClient(object):
                             json,
                         )
                         data = encode_canonical_json(json)
+                        if (
+                            self._compress
+                            and request.destination in self._gzip_destinations
+                            and len(data) >= MIN_COMPRESS_LENGTH
+                        ):
+                            data = gzip_compress(data, request.destination)
+                            headers_dict[b"Content-Encoding"] = [b"gzip"]
+                        else:
+                            record_uncompressed_body(
+                                "sent", request.destination, len(data),
+                            )
+                            headers_dict.pop(b"Content-Encoding", None)
                         producer = QuieterFileBodyProducer(
                             BytesIO(data),
                             cooperator=self._cooperator,
@@ -388,12 +429,15 @@ class MatrixFederationHttpClient(object):
                         response.phrase.decode('ascii', errors='replace'),
                     )
 
+                    if self._compress and accepts_gzip(response.headers):
+                        self._gzip_destinations.add(request.destination)
+
                     if 200 <= response.code < 300:
                         pass
                     else:
                         # :'(
                         # Update transactions table?
-                        d = treq.content(response)
+                        d = _read_body(response, request.destination)
                         d = timeout_deferred(
                             d,
                             timeout=_sec_timeout,
@@ -415,6 +459,19 @@ class MatrixFederationHttpClient(object):
                             )
                             body = None
 
+                        if (
+                            response.code == 415
+                            and b"Content-Encoding" in headers_dict
+                        ):
+                            # The server doesn't accept gzipped bodies after
+                            # all: send it again uncompressed.
+                            logger.info(
+                                "{%s} [%s] Server rejected gzipped body",
+                                request.txn_id, request.destination,
+                            )
+                            self._gzip_destinations.discard(request.destination)
+                            continue
+
                         e = HttpResponseException(
                             response.code, response.phrase, body
                         )
@@ -526,7 +583,8 @@ class MatrixFederationHttpClient(object):
                  long_retries=False, timeout=None,
                  ignore_backoff=False,
                  backoff_on_404=False,
-                 try_trailing_slash_on_400=False):
+                 try_trailing_slash_on_400=False,
+                 parser=None):
         """ Sends the specifed json data using PUT
 
         Args:
@@ -552,6 +610,10 @@ class MatrixFederationHttpClient(object):
                 of the request. Workaround for #3622 in Synapse <= v0.99.3. This
                 will be attempted before backing off if backing off has been
                 enabled.
+            parser (object|None): something to parse the response body as it
+                arrives, instead of decoding it once it has all arrived. Must
+                have `write(bytes)` and `finish()` methods; the result is the
+                return value of `finish`.
 
         Returns:
             Deferred[dict|list]: Succeeds when we get a 2xx HTTP response. The
@@ -587,6 +649,7 @@ class MatrixFederationHttpClient(object):
 
         body = yield _handle_json_response(
             self.hs.get_reactor(), self.default_timeout, request, response,
+            parser=parser,
         )
 
         defer.returnValue(body)
@@ -795,6 +858,7 @@ class MatrixFederationHttpClient(object):
             request,
             retry_on_dns_fail=retry_on_dns_fail,
             ignore_backoff=ignore_backoff,
+            accept_gzip=False,
         )
 
         headers = dict(response.headers.getAllRawHeaders())
@@ -854,6 +918,97 @@ def _readBodyToFile(response, stream, max_size):
     return d
 
 
+class _ReadBodyProtocol(protocol.Protocol):
+    def __init__(self, deferred, destination, decoder, parser):
+        self.deferred = deferred
+        self.destination = destination
+        self.decoder = decoder
+        self.parser = parser
+        self.chunks = []
+        self.length = 0
+
+    def dataReceived(self, data):
+        if self.deferred.called:
+            return
+
+        try:
+            if self.decoder:
+                data = self.decoder.decode(data)
+
+            self.length += len(data)
+            if self.parser:
+                self.parser.write(data)
+            else:
+                self.chunks.append(data)
+        except Exception as e:
+            self.deferred.errback(e)
+            self.transport.stopProducing()
+
+    def connectionLost(self, reason):
+        if self.deferred.called:
+            return
+
+        if not reason.check(ResponseDone, PotentialDataLoss):
+            self.deferred.errback(reason)
+            return
+
+        try:
+            if self.decoder:
+                self.decoder.finish()
+
+            if self.parser:
+                body = self.parser.finish()
+            else:
+                body = b"".join(self.chunks)
+        except Exception as e:
+            self.deferred.errback(e)
+            return
+
+        if self.decoder:
+            self.decoder.record_metrics(self.destination)
+        else:
+            record_uncompressed_body("received", self.destination, self.length)
+
+        self.deferred.callback(body)
+
+
+def _read_body(response, destination, parser=None):
+    """Reads the body of a response, decompressing it as it arrives if it is
+    gzipped.
+
+    Args:
+        response (IResponse)
+        destination (str): the server which sent the response
+        parser (object|None): if given, the (decompressed) body is passed to
+            its `write` method as it arrives, and the result is the return
+            value of its `finish` method.
+
+    Returns:
+        Deferred[bytes|object]: the (decompressed) body, or the result of the
+            parser
+    """
+    content_encoding = response.headers.getRawHeaders(
+        b"Content-Encoding", [b"identity"],
+    )[-1].strip().lower()
+
+    if content_encoding == b"gzip":
+        decoder = GzipDecoder()
+    elif content_encoding == b"identity":
+        decoder = None
+    else:
+        return defer.fail(ValueError(
+            "Unsupported Content-Encoding %r" % (content_encoding,),
+        ))
+
+    def cancel(d):
+        reader.transport.stopProducing()
+
+    d = defer.Deferred(cancel)
+    reader = _ReadBodyProtocol(d, destination, decoder, parser)
+    response.deliverBody(reader)
+    return d
+
+
 def _flatten_response_never_received(e):
     if hasattr(e, "reasons"):
         reasons = ", ".join(
@@ -22,8 +22,9 @@ from six import PY3
 from six.moves import http_client, urllib
 
 from canonicaljson import encode_canonical_json, encode_pretty_printed_json, json
+from zope.interface import implementer
 
-from twisted.internet import defer
+from twisted.internet import defer, interfaces
 from twisted.python import failure
 from twisted.web import resource
 from twisted.web.server import NOT_DONE_YET
@@ -48,6 +49,10 @@ else:
 
 logger = logging.getLogger(__name__)
 
+# How many bytes of a streamed JSON response we encode before handing control
+# back to the reactor.
+JSON_STREAM_BUFFER_SIZE = 64 * 1024
+
 HTML_ERROR_TEMPLATE = """<!DOCTYPE html>
 <html lang=en>
   <head>
@@ -244,7 +249,9 @@ class JsonResource(HttpServer, resource.Resource):
     Register callbacks via register_paths()
 
     Callbacks can return a tuple of status code and a dict in which case the
-    the dict will automatically be sent to the client as a JSON object.
+    the dict will automatically be sent to the client as a JSON object. If
+    they return a LazyJsonObject instead of a dict, it is encoded bit by bit as
+    it is sent.
 
     The JsonResource is primarily intended for returning JSON, but callbacks
     may send something other than JSON, they may do so by using the methods
@@ -316,7 +323,7 @@ class JsonResource(HttpServer, resource.Resource):
         callback_return = yield callback(request, **kwargs)
         if callback_return is not None:
             code, response = callback_return
-            self._send_response(request, code, response)
+            yield self._send_response(request, code, response)
 
     def _get_handler_for_request(self, request):
         """Finds a callback method to handle the given request
@@ -349,6 +356,15 @@ class JsonResource(HttpServer, resource.Resource):
 
     def _send_response(self, request, code, response_json_object,
                        response_code_message=None):
+        if isinstance(response_json_object, LazyJsonObject):
+            respond_with_json_stream(
+                request, code, response_json_object,
+                send_cors=True,
+                response_code_message=response_code_message,
+                canonical_json=self.canonical_json,
+            )
+            return
+
         # TODO: Only enable CORS for the requests that need it.
         respond_with_json(
             request, code, response_json_object,
@@ -415,14 +431,9 @@ def respond_with_json(request, code, json_object, send_cors=False,
             request)
         return
 
-    if pretty_print:
-        json_bytes = encode_pretty_printed_json(json_object) + b"\n"
-    else:
-        if canonical_json or synapse.events.USE_FROZEN_DICTS:
-            # canonicaljson already encodes to bytes
-            json_bytes = encode_canonical_json(json_object)
-        else:
-            json_bytes = json.dumps(json_object).encode("utf-8")
+    json_bytes = encode_json_response(
+        json_object, pretty_print=pretty_print, canonical_json=canonical_json,
+    )
 
     return respond_with_json_bytes(
         request, code, json_bytes,
@@ -431,6 +442,27 @@ def respond_with_json(request, code, json_object, send_cors=False,
     )
 
 
+def encode_json_response(json_object, pretty_print=False, canonical_json=True):
+    """Encodes the body of a JSON response
+
+    Args:
+        json_object (object): the response
+        pretty_print (bool): whether to pretty print the JSON
+        canonical_json (bool): whether to encode the JSON canonically
+
+    Returns:
+        bytes
+    """
+    if pretty_print:
+        return encode_pretty_printed_json(json_object) + b"\n"
+
+    if canonical_json or synapse.events.USE_FROZEN_DICTS:
+        # canonicaljson already encodes to bytes
+        return encode_canonical_json(json_object)
+
+    return json.dumps(json_object).encode("utf-8")
+
+
 def respond_with_json_bytes(request, code, json_bytes, send_cors=False,
                             response_code_message=None):
     """Sends encoded JSON in response to the given request.
@@ -461,6 +493,154 @@ def respond_with_json_bytes(request, code, json_bytes, send_cors=False,
     return NOT_DONE_YET
 
 
+class LazyJsonObject(object):
+    """A JSON object whose members are only generated, and encoded, when it is
+    written out by `respond_with_json_stream`. This means that a large
+    response never has to be held in memory all at once.
+
+    Members whose values are themselves LazyJsonObjects are streamed in the
+    same way. The members are written in the order they are generated, and
+    can only be generated once.
+
+    Args:
+        items (iterable[tuple[str, object]]): The members of the object.
+    """
+    __slots__ = ["items"]
+
+    def __init__(self, items):
+        self.items = items
+
+
+def respond_with_json_stream(request, code, json_object, send_cors=False,
+                             response_code_message=None, canonical_json=True):
+    """Sends a JSON response, encoding it a piece at a time as the client
+    reads it rather than all at once.
+
+    Args:
+        request (twisted.web.http.Request): The http request to respond to.
+        code (int): The HTTP response code.
+        json_object (LazyJsonObject): The response body.
+        send_cors (bool): Whether to send Cross-Origin Resource Sharing headers
+            http://www.w3.org/TR/cors/
+        canonical_json (bool): Whether to use canonical JSON encoding for the
+            parts of the response. Even if set, the members of LazyJsonObjects
+            are not sorted.
+
+    Returns:
+        twisted.web.server.NOT_DONE_YET
+    """
+    if request._disconnected:
+        logger.warn(
+            "Not sending response to request %s, already disconnected.",
+            request)
+        return
+
+    if canonical_json or synapse.events.USE_FROZEN_DICTS:
+        encode = encode_canonical_json
+    else:
+        def encode(json_object):
+            return json.dumps(json_object).encode("utf-8")
+
+    # We don't know how long the response will be, so we don't set a
+    # Content-Length and it is sent chunked.
+    request.setResponseCode(code, message=response_code_message)
+    request.setHeader(b"Content-Type", b"application/json")
+    request.setHeader(b"Cache-Control", b"no-cache, no-store, must-revalidate")
+
+    if send_cors:
+        set_cors_headers(request)
+
+    producer = _JsonStreamProducer(
+        request, _iterencode_json(json_object, encode),
+    )
+    producer.start()
+    return NOT_DONE_YET
+
+
+def _iterencode_json(json_object, encode):
+    """Encodes a JSON value, generating the members of any LazyJsonObjects as
+    it goes.
+
+    Args:
+        json_object (LazyJsonObject|object): The value to encode.
+        encode (callable[object, bytes]): Encodes anything other than a
+            LazyJsonObject.
+
+    Returns:
+        iterator[bytes]: The encoded value, in pieces.
+    """
+    if not isinstance(json_object, LazyJsonObject):
+        yield encode(json_object)
+        return
+
+    yield b"{"
+    first = True
+    for key, value in json_object.items:
+        if first:
+            first = False
+        else:
+            yield b","
+        yield encode(key) + b":"
+        for fragment in _iterencode_json(value, encode):
+            yield fragment
+    yield b"}"
+
+
+@implementer(interfaces.IPullProducer)
+class _JsonStreamProducer(object):
+    """Writes an encoded JSON response to a request, around
+    JSON_STREAM_BUFFER_SIZE bytes each time the transport asks for more, so
+    that the reactor can get on with other work between writes.
+
+    Args:
+        request (twisted.web.http.Request): The request to write to.
+        fragments (iterator[bytes]): The encoded response.
+    """
+    def __init__(self, request, fragments):
+        self._request = request
+        self._fragments = fragments
+
+    def start(self):
+        self._request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        if not self._request:
+            return
+
+        buf = []
+        size = 0
+        finished = True
+        try:
+            for fragment in self._fragments:
+                buf.append(fragment)
+                size += len(fragment)
+                if size >= JSON_STREAM_BUFFER_SIZE:
+                    finished = False
+                    break
+        except Exception:
+            # We've already sent the headers, so the best we can do is drop
+            # the connection so that the client doesn't take the truncated
+            # response as complete.
+            logger.exception("Failed to encode response to %r", self._request)
+            request = self._request
+            self.stopProducing()
+            request.unregisterProducer()
+            request.loseConnection()
+            return
+
+        self._request.write(b"".join(buf))
+
+        if finished:
+            request = self._request
+            self.stopProducing()
+            request.unregisterProducer()
+            request.finish()
+
+    def stopProducing(self):
+        self._request = None
+        self._fragments = None
+
+
 def set_cors_headers(request):
     """Set the CORs headers so that javascript running in a web browsers can
     use this API
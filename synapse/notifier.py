@@ -16,7 +16,7 @@
 import logging
 from collections import namedtuple
 
-from prometheus_client import Counter
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 
@@ -39,6 +39,18 @@ notified_events_counter = Counter("synapse_notifier_notified_events", "")
 users_woken_by_stream_counter = Counter(
     "synapse_notifier_users_woken_by_stream", "", ["stream"])
 
+users_woken_per_event_histogram = Histogram(
+    "synapse_notifier_users_woken_per_event",
+    "Number of user streams notified about each new event",
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000),
+)
+
+notify_latency_histogram = Histogram(
+    "synapse_notifier_notify_latency_seconds",
+    "Time between the notifier being told about new events and it having "
+    "woken up the listeners for them",
+)
+
 
 # TODO(paul): Should be shared somewhere
 def count(func, l):
@@ -90,6 +102,11 @@ class _NotifierUserStream(object):
     def notify(self, stream_key, stream_id, time_now_ms):
         """Notify any listeners for this user of a new event from an
         event source.
+
+        The new token takes effect straight away, but the listeners aren't
+        woken up until `wake_listeners` is called. This means several
+        notifications can be passed on together.
+
         Args:
             stream_key(str): The stream the event came from.
             stream_id(str): The new id for the stream the event came from.
@@ -100,13 +117,24 @@ class _NotifierUserStream(object):
         )
         self.last_notified_token = self.current_token
         self.last_notified_ms = time_now_ms
-        noify_deferred = self.notify_deferred
 
         users_woken_by_stream_counter.labels(stream_key).inc()
 
+    def wake_listeners(self):
+        """Wake up any listeners waiting for this user, passing them the
+        current token.
+        """
+        notify_deferred = self.notify_deferred
+
+        # Anyone who starts listening from now on will compare their token
+        # against last_notified_token, so if nobody is waiting there is no
+        # need to replace the deferred.
+        if not notify_deferred.observers():
+            return
+
         with PreserveLoggingContext():
             self.notify_deferred = ObservableDeferred(defer.Deferred())
-            noify_deferred.callback(self.current_token)
+            notify_deferred.callback(self.current_token)
 
     def remove(self, notifier):
         """ Remove this listener from all the indexes in the Notifier
@@ -114,8 +142,7 @@ class _NotifierUserStream(object):
         """
 
         for room in self.rooms:
-            lst = notifier.room_to_user_streams.get(room, set())
-            lst.discard(self)
+            notifier._remove_from_room_index(self, room)
 
         notifier.user_to_user_stream.pop(self.user_id)
 
@@ -162,6 +189,15 @@ class Notifier(object):
         self.store = hs.get_datastore()
         self.pending_new_room_events = []
 
+        # User streams which have been notified but whose listeners have not
+        # yet been woken up, and when the oldest of those notifications was.
+        # We wake them all together at the end of the reactor tick, so that a
+        # listener only gets woken once however many events it is notified
+        # about in that time.
+        self._pending_wakeups = set()
+        self._pending_wakeups_since = None
+        self._wake_pending_listeners_call = None
+
         self.replication_callbacks = []
 
         self.clock = hs.get_clock()
@@ -266,6 +302,13 @@ class Notifier(object):
             rooms=[event.room_id],
         )
 
+        # Only stop listening to the room once the user has been told that
+        # they've left it.
+        if event.type == EventTypes.Member and event.membership in (
+            Membership.LEAVE, Membership.BAN,
+        ):
+            self._user_left_room(event.state_key, event.room_id)
+
     @defer.inlineCallbacks
     def _notify_app_services(self, room_stream_id):
         try:
@@ -297,8 +340,38 @@ class Notifier(object):
                     except Exception:
                         logger.exception("Failed to notify listener")
 
+                users_woken_per_event_histogram.observe(len(user_streams))
+
+                if user_streams:
+                    self._pending_wakeups |= user_streams
+                    if self._wake_pending_listeners_call is None:
+                        self._pending_wakeups_since = self.clock.time()
+                        self._wake_pending_listeners_call = self.clock.call_later(
+                            0, self._wake_pending_listeners,
+                        )
+
                 self.notify_replication()
 
+    def _wake_pending_listeners(self):
+        """Wake the listeners of all the user streams that have been notified
+        since we last did so.
+        """
+        self._wake_pending_listeners_call = None
+
+        pending = self._pending_wakeups
+        self._pending_wakeups = set()
+
+        with Measure(self.clock, "wake_pending_listeners"):
+            for user_stream in pending:
+                try:
+                    user_stream.wake_listeners()
+                except Exception:
+                    logger.exception("Failed to notify listener")
+
+        notify_latency_histogram.observe(
+            self.clock.time() - self._pending_wakeups_since
+        )
+
     def on_new_replication_data(self):
         """Used to inform replication listeners that something has happend
         without waking up any of the normal user event streams"""
@@ -515,6 +588,21 @@ class Notifier(object):
             room_streams.add(new_user_stream)
             new_user_stream.rooms.add(room_id)
 
+    def _user_left_room(self, user_id, room_id):
+        user_stream = self.user_to_user_stream.get(user_id)
+        if user_stream is not None and room_id in user_stream.rooms:
+            user_stream.rooms.discard(room_id)
+            self._remove_from_room_index(user_stream, room_id)
+
+    def _remove_from_room_index(self, user_stream, room_id):
+        room_streams = self.room_to_user_streams.get(room_id)
+        if room_streams is None:
+            return
+
+        room_streams.discard(user_stream)
+        if not room_streams:
+            del self.room_to_user_streams[room_id]
+
     def notify_replication(self):
         """Notify the any replication listeners that there's a new event"""
         for cb in self.replication_callbacks:
@@ -29,8 +29,9 @@ from synapse.state import POWER_KEY
 from synapse.util.async_helpers import Linearizer
 from synapse.util.caches import register_cache
 from synapse.util.caches.descriptors import cached
+from synapse.util.metrics import Measure
 
-from .push_rule_evaluator import PushRuleEvaluatorForEvent
+from .push_rule_evaluator import PushRuleEvaluatorForEvent, compile_push_rules
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +62,7 @@ class BulkPushRuleEvaluator(object):
         self.hs = hs
         self.store = hs.get_datastore()
         self.auth = hs.get_auth()
+        self.clock = hs.get_clock()
 
         self.room_push_rule_cache_metrics = register_cache(
             "cache",
@@ -143,7 +145,6 @@ class BulkPushRuleEvaluator(object):
             Deferred
         """
         rules_by_user = yield self._get_rules_for_event(event, context)
-        actions_by_user = {}
 
         room_members = yield self.store.get_joined_users_from_context(
             event, context
@@ -157,41 +158,16 @@ class BulkPushRuleEvaluator(object):
             event, len(room_members), sender_power_level, power_levels,
         )
 
-        condition_cache = {}
-
-        for uid, rules in iteritems(rules_by_user):
-            if event.sender == uid:
-                continue
+        with Measure(self.clock, "push_rules.evaluate"):
+            actions_by_user = _actions_for_users(
+                evaluator, event, rules_by_user, room_members,
+            )
 
-            if not event.is_state():
+        if not event.is_state():
+            for uid in list(actions_by_user):
                 is_ignored = yield self.store.is_ignored_by(event.sender, uid)
                 if is_ignored:
-                    continue
-
-            display_name = None
-            profile_info = room_members.get(uid)
-            if profile_info:
-                display_name = profile_info.display_name
-
-            if not display_name:
-                # Handle the case where we are pushing a membership event to
-                # that user, as they might not be already joined.
-                if event.type == EventTypes.Member and event.state_key == uid:
-                    display_name = event.content.get("displayname", None)
-
-            for rule in rules:
-                if 'enabled' in rule and not rule['enabled']:
-                    continue
-
-                matches = _condition_checker(
-                    evaluator, rule['conditions'], uid, display_name, condition_cache
-                )
-                if matches:
-                    actions = [x for x in rule['actions'] if x != 'dont_notify']
-                    if actions and 'notify' in actions:
-                        # Push rules say we should notify the user of this event
-                        actions_by_user[uid] = actions
-                    break
+                    del actions_by_user[uid]
 
         # Mark in the DB staging area the push actions for users who should be
         # notified for this event. (This will then get handled when we persist
@@ -201,24 +177,66 @@ class BulkPushRuleEvaluator(object):
         )
 
 
-def _condition_checker(evaluator, conditions, uid, display_name, cache):
-    for cond in conditions:
-        _id = cond.get("_id", None)
-        if _id:
-            res = cache.get(_id, None)
-            if res is False:
-                return False
-            elif res is True:
-                continue
+def _actions_for_users(evaluator, event, rules_by_user, room_members):
+    """Evaluate the push rules of each user for an event.
 
-        res = evaluator.matches(cond, uid, display_name)
-        if _id:
-            cache[_id] = bool(res)
+    Users with the same rules share a CompiledPushRules, so the conditions
+    which only depend on the event are checked once for each distinct list of
+    rules, and only the user-specific conditions (such as display name
+    mentions) are checked for each user.
 
-        if not res:
-            return False
+    Args:
+        evaluator (PushRuleEvaluatorForEvent): evaluator for the event
+        event (FrozenEvent)
+        rules_by_user (dict[str, list[dict]]): map from user_id to push rules
+        room_members (dict[str, ProfileInfo]): the joined users in the room
 
-    return True
+    Returns:
+        dict[str, list]: map from user_id to the push actions for the users
+        who should be notified of the event
+    """
+    actions_by_user = {}
+
+    # condition cache key -> bool, for the conditions which only depend on the
+    # event
+    condition_cache = {}
+
+    # CompiledPushRules -> the rules which may match the event
+    candidates_by_rules = {}
+
+    sender = event.sender
+    for uid, rules in iteritems(rules_by_user):
+        if sender == uid:
+            continue
+
+        compiled = compile_push_rules(rules)
+        candidates = candidates_by_rules.get(compiled)
+        if candidates is None:
+            candidates = compiled.rules_for_event(evaluator, condition_cache)
+            candidates_by_rules[compiled] = candidates
+
+        if not candidates:
+            continue
+
+        display_name = None
+        profile_info = room_members.get(uid)
+        if profile_info:
+            display_name = profile_info.display_name
+
+        if not display_name:
+            # Handle the case where we are pushing a membership event to
+            # that user, as they might not be already joined.
+            if event.type == EventTypes.Member and event.state_key == uid:
+                display_name = event.content.get("displayname", None)
+
+        for user_conditions, actions in candidates:
+            if evaluator.user_conditions_match(user_conditions, uid, display_name):
+                if actions:
+                    # Push rules say we should notify the user of this event
+                    actions_by_user[uid] = actions
+                break
+
+    return actions_by_user
 
 
 class RulesForRoom(object):
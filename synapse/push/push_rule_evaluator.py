@@ -14,6 +14,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+import json
 import logging
 import re
 
@@ -29,6 +31,12 @@ logger = logging.getLogger(__name__)
 GLOB_REGEX = re.compile(r'\\\[(\\\!|)(.*)\\\]')
 IS_GLOB = re.compile(r'[\?\*\[\]]')
 INEQUALITY_EXPR = re.compile("^([=<>]*)([0-9]*)$")
+NON_WORD = re.compile(r"\W")
+
+# Bodies longer than this aren't split into whole-word substrings, and names
+# longer than this aren't looked up in them. See _whole_word_substrings
+MAX_BODY_LENGTH_FOR_WORDS = 1000
+MAX_BODY_WORD_LENGTH = 64
 
 
 def _room_member_count(ev, condition, room_member_count):
@@ -92,6 +100,24 @@ class PushRuleEvaluatorForEvent(object):
         # Maps strings of e.g. 'content.body' -> event["content"]["body"]
         self._value_cache = _flatten_dict(event)
 
+        self._body = event.content.get("body", None)
+
+        # The set of whole-word substrings of the body, if it is plain ASCII
+        # and not too long. Mentions of names which aren't globs can then be
+        # found with a set lookup rather than a regex search for each name.
+        self._body_words = None
+        if (
+            self._body
+            and isinstance(self._body, string_types)
+            and _is_ascii(self._body)
+        ):
+            self._body_words = _whole_word_substrings(self._body.lower())
+
+        # Maps other patterns which have been matched against the body to the
+        # result, so that names shared by many users are only matched once
+        # per event.
+        self._body_match_cache = {}
+
     def matches(self, condition, user_id, display_name):
         if condition['kind'] == 'event_match':
             return self._event_match(condition, user_id)
@@ -122,13 +148,8 @@ class PushRuleEvaluatorForEvent(object):
             logger.warn("event_match condition with no pattern")
             return False
 
-        # XXX: optimisation: cache our pattern regexps
         if condition['key'] == 'content.body':
-            body = self._event.content.get("body", None)
-            if not body:
-                return False
-
-            return _glob_matches(pattern, body, word_boundary=True)
+            return self._body_matches(pattern)
         else:
             haystack = self._get_value(condition['key'])
             if haystack is None:
@@ -140,16 +161,231 @@ class PushRuleEvaluatorForEvent(object):
         if not display_name:
             return False
 
-        body = self._event.content.get("body", None)
+        return self._body_matches(display_name)
+
+    def _body_matches(self, pattern):
+        """Tests if the pattern matches a whole word (or words) in the body of
+        the event.
+
+        Args:
+            pattern (str): a glob, or a literal string such as a display name
+
+        Returns:
+            bool
+        """
+        body = self._body
         if not body:
             return False
 
-        return _glob_matches(display_name, body, word_boundary=True)
+        if self._body_words is not None:
+            lowered = _plain_patterns.get(pattern)
+            if lowered is None:
+                lowered = _plain_pattern(pattern)
+            if lowered and len(lowered) <= MAX_BODY_WORD_LENGTH:
+                return lowered in self._body_words
+
+        res = self._body_match_cache.get(pattern)
+        if res is None:
+            res = bool(_glob_matches(pattern, body, word_boundary=True))
+            self._body_match_cache[pattern] = res
+        return res
+
+    def user_conditions_match(self, user_conditions, user_id, display_name):
+        """Check the user-dependent conditions of a compiled push rule.
+
+        Args:
+            user_conditions (list[tuple[int|None, dict]]): the conditions, as
+                returned by CompiledPushRules.rules_for_event
+            user_id (str): the user the rule belongs to
+            display_name (str|None): the user's display name in the room
+
+        Returns:
+            bool: whether all of the conditions match
+        """
+        for kind, condition in user_conditions:
+            if kind == _DISPLAY_NAME_MENTION:
+                pattern = display_name
+            elif kind == _LOCALPART_MENTION:
+                pattern = user_id[1:].split(":", 1)[0]
+            else:
+                if not self.matches(condition, user_id, display_name):
+                    return False
+                continue
+
+            if not pattern or not self._body_matches(pattern):
+                return False
+
+        return True
 
     def _get_value(self, dotted_key):
         return self._value_cache.get(dotted_key, None)
 
 
+# Kinds of user-dependent condition which CompiledPushRules can check without
+# going through PushRuleEvaluatorForEvent.matches
+_DISPLAY_NAME_MENTION = 1
+_LOCALPART_MENTION = 2
+
+
+def _is_user_dependent(condition):
+    """Whether the result of a push rule condition depends on the user the
+    rule belongs to (as opposed to only depending on the event).
+    """
+    if condition['kind'] == 'contains_display_name':
+        return True
+    if condition['kind'] == 'event_match' and not condition.get('pattern', None):
+        # the pattern comes from the user's ID
+        return True
+    return False
+
+
+def _user_condition_kind(condition):
+    """Work out if a user-dependent condition is a mention of the user in the
+    body of the event.
+
+    Returns:
+        int|None: _DISPLAY_NAME_MENTION, _LOCALPART_MENTION or None
+    """
+    if condition['kind'] == 'contains_display_name':
+        return _DISPLAY_NAME_MENTION
+    if (
+        condition['kind'] == 'event_match'
+        and condition.get('key') == 'content.body'
+        and condition.get('pattern_type') == 'user_localpart'
+    ):
+        return _LOCALPART_MENTION
+    return None
+
+
+class CompiledPushRules(object):
+    """A list of push rules, preprocessed for evaluating against an event for
+    lots of users at once.
+
+    The conditions which only depend on the event are separated from those
+    which depend on the user, so that users with the same rules can share the
+    results of the former.
+
+    Use `compile_push_rules` rather than creating these directly, so that the
+    compiled rules are shared between users.
+
+    Args:
+        rules (list[dict]): the push rules, in order of priority
+    """
+    __slots__ = ["rules"]
+
+    def __init__(self, rules):
+        # list of (event_conditions, user_conditions, actions), where
+        # event_conditions is a list of (cache key, condition), user_conditions
+        # is a list of (kind, condition) (see _user_condition_kind), and
+        # actions is None if the rule doesn't notify.
+        self.rules = []
+
+        for rule in rules:
+            if 'enabled' in rule and not rule['enabled']:
+                continue
+
+            event_conditions = []
+            user_conditions = []
+            for condition in rule['conditions']:
+                if _is_user_dependent(condition):
+                    user_conditions.append(
+                        (_user_condition_kind(condition), condition),
+                    )
+                else:
+                    key = condition.get("_id", None)
+                    if not key:
+                        key = json.dumps(condition, sort_keys=True)
+                    event_conditions.append((key, condition))
+
+            actions = [x for x in rule['actions'] if x != 'dont_notify']
+            if not actions or 'notify' not in actions:
+                actions = None
+
+            self.rules.append((event_conditions, user_conditions, actions))
+
+    def rules_for_event(self, evaluator, condition_cache):
+        """Check the conditions which only depend on the event, and return the
+        rules which could still match.
+
+        Args:
+            evaluator (PushRuleEvaluatorForEvent)
+            condition_cache (dict): map from condition cache key to result,
+                shared between all the rule lists checked for the event.
+
+        Returns:
+            list[tuple[list, list|None]]: (user_conditions, actions) for each
+            rule which could match, in order of priority. The list stops at the
+            first rule which matches for all users. The user conditions should
+            be checked with `PushRuleEvaluatorForEvent.user_conditions_match`.
+        """
+        candidates = []
+        for event_conditions, user_conditions, actions in self.rules:
+            matches = True
+            for key, condition in event_conditions:
+                res = condition_cache.get(key, None)
+                if res is None:
+                    res = bool(evaluator.matches(condition, None, None))
+                    condition_cache[key] = res
+                if not res:
+                    matches = False
+                    break
+
+            if not matches:
+                continue
+
+            candidates.append((user_conditions, actions))
+            if not user_conditions:
+                break
+
+        return candidates
+
+
+def compile_push_rules(rules):
+    """Get the CompiledPushRules for a list of push rules.
+
+    Args:
+        rules (list[dict]): the push rules, in order of priority
+
+    Returns:
+        CompiledPushRules
+    """
+    # We look up the list itself first, to avoid working out its contents
+    # every time. The cache holds a reference to the list, so while the entry
+    # exists no other list can have the same id.
+    entry = _compiled_rules_by_list.get(id(rules), None)
+    if entry and entry[0] is rules:
+        return entry[1]
+
+    content = json.dumps([
+        (rule.get('enabled', True), rule['conditions'], rule['actions'])
+        for rule in rules
+    ], sort_keys=True)
+
+    compiled = compiled_rules_by_content.get(content, None)
+    if compiled is None:
+        compiled = CompiledPushRules(rules)
+        compiled_rules_by_content[content] = compiled
+
+    if len(_compiled_rules_by_list) >= MAX_COMPILED_RULE_LISTS:
+        _compiled_rules_by_list.clear()
+    _compiled_rules_by_list[id(rules)] = (rules, compiled)
+    return compiled
+
+
+# Maps id(rules) -> (rules, CompiledPushRules). This is looked up for every
+# user each time an event is evaluated, so is a plain dict (which is emptied
+# when it gets too big) rather than an LruCache. See compile_push_rules
+_compiled_rules_by_list = {}
+MAX_COMPILED_RULE_LISTS = int(50000 * CACHE_SIZE_FACTOR)
+
+# Caches the contents of a rule list -> CompiledPushRules, so that users with
+# the same rules share the compiled version. See compile_push_rules
+compiled_rules_by_content = LruCache(10000 * CACHE_SIZE_FACTOR)
+register_cache(
+    "cache", "compiled_push_rules_by_content", compiled_rules_by_content,
+)
+
+
 # Caches (glob, word_boundary) -> regex for push. See _glob_matches
 regex_cache = LruCache(50000 * CACHE_SIZE_FACTOR)
 register_cache("cache", "regex_push_cache", regex_cache)
@@ -236,6 +472,76 @@ def _re_word_boundary(r):
     return r"(^|\W)%s(\W|$)" % (r,)
 
 
+def _whole_word_substrings(body):
+    """Get every substring of the body which starts at the beginning of the
+    body or after a non-word character, and ends at the end of the body or
+    before a non-word character.
+
+    These are exactly the literal strings which `_re_word_boundary` regexes
+    would find in the body, so testing a (lower-cased, ASCII, non-glob) name
+    for membership of the set is equivalent to matching it against the body.
+
+    Args:
+        body (str): lower-cased ASCII body
+
+    Returns:
+        set[str]|None: the substrings which are no longer than
+        MAX_BODY_WORD_LENGTH, or None if the body is too long.
+    """
+    if len(body) > MAX_BODY_LENGTH_FOR_WORDS:
+        return None
+
+    boundaries = [m.start() for m in NON_WORD.finditer(body)]
+    starts = [0] + [b + 1 for b in boundaries]
+    ends = boundaries + [len(body)]
+
+    words = set()
+    for start in starts:
+        # ends are in order, so find the first one after start
+        i = bisect.bisect_right(ends, start)
+        while i < len(ends) and ends[i] - start <= MAX_BODY_WORD_LENGTH:
+            words.add(body[start:ends[i]])
+            i += 1
+
+    return words
+
+
+def _plain_pattern(pattern):
+    """Check if a pattern can be matched by looking it up in the result of
+    `_whole_word_substrings`, and remember the answer in `_plain_patterns`.
+
+    Args:
+        pattern (str)
+
+    Returns:
+        str: the lower-cased pattern, or an empty string if it is a glob or
+        isn't ASCII.
+    """
+    if IS_GLOB.search(pattern) or not _is_ascii(pattern):
+        lowered = ""
+    else:
+        lowered = pattern.lower()
+
+    if len(_plain_patterns) >= MAX_PLAIN_PATTERNS:
+        _plain_patterns.clear()
+    _plain_patterns[pattern] = lowered
+    return lowered
+
+
+# Maps pattern -> result of _plain_pattern. Display names and localparts don't
+# change often, so this saves working it out for every user for every event.
+_plain_patterns = {}
+MAX_PLAIN_PATTERNS = int(100000 * CACHE_SIZE_FACTOR)
+
+
+def _is_ascii(s):
+    try:
+        s.encode("ascii")
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return False
+    return True
+
+
 def _flatten_dict(d, prefix=[], result=None):
     if result is None:
         result = {}
@@ -119,3 +119,7 @@ class SlavedEventStore(EventFederationWorkerStore,
                 state_key, stream_ordering
             )
             self.get_invited_rooms_for_user.invalidate((state_key,))
+
+            # Do this now rather than waiting for the caches stream, so that
+            # anything woken up by this event sees the new members.
+            self.get_joined_host_counts.invalidate((room_id,))
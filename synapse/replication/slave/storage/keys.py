@@ -32,3 +32,4 @@ class SlavedKeyStore(BaseSlavedStore):
 
     get_server_keys_json = __func__(DataStore.get_server_keys_json)
     store_server_keys_json = __func__(DataStore.store_server_keys_json)
+    get_valid_server_keys_json = __func__(DataStore.get_valid_server_keys_json)
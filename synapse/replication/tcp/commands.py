@@ -43,6 +43,10 @@ class Command(object):
     """
     NAME = None
 
+    # For commands with a length prefixed payload, the length of the payload
+    # still to be read after the command line has been parsed.
+    payload_length = None
+
     def __init__(self, data):
         self.data = data
 
@@ -59,6 +63,15 @@ class Command(object):
         """
         return self.data
 
+    def get_payload(self):
+        """Returns the bytes to send straight after the command's line, for
+        commands which carry a length prefixed payload (see RdataBatchCommand).
+
+        Returns:
+            bytes|None: the payload, or None if the command is a single line.
+        """
+        return None
+
     def get_logcontext_id(self):
         """Get a suitable string for the logcontext when processing this command"""
 
@@ -126,6 +139,63 @@ class RdataCommand(Command):
         return "RDATA-" + self.stream_name
 
 
+class RdataBatchCommand(Command):
+    """Sent by the server instead of RDATA, to send many updates for a stream at
+    once. Only sent if the client has asked for it with a FRAMING command.
+
+    Format::
+
+        RDATA_BATCH <stream_name> <length>
+        <payload>
+
+    Where `<payload>` is `<length>` bytes of UTF-8 encoded JSON (which may
+    contain newlines), and is a list of `[<token>, <row>]` pairs. A `<token>`
+    of null has the same meaning as "batch" in RDATA, and the updates are
+    otherwise processed as though they had been sent as a series of RDATA
+    commands.
+
+    As the payload is length prefixed, the receiver can read it without
+    scanning it for delimiters and parse all the rows with a single call to
+    `json.loads`. It is also encoded at most once, so the same command can be
+    sent down many connections.
+    """
+    NAME = "RDATA_BATCH"
+
+    def __init__(self, stream_name, updates, payload_length=None):
+        self.stream_name = stream_name
+        self.updates = updates
+
+        # Set when parsing the command line, until the payload has been read.
+        self.payload_length = payload_length
+
+        self._payload = None
+
+    @classmethod
+    def from_line(cls, line):
+        stream_name, length = line.split(" ", 1)
+        return cls(stream_name, None, int(length))
+
+    def to_line(self):
+        return " ".join((self.stream_name, str(len(self.get_payload()))))
+
+    def get_payload(self):
+        if self._payload is None:
+            self._payload = _json_encoder.encode(self.updates).encode("utf-8")
+        return self._payload
+
+    def load_payload(self, payload):
+        """Parses the updates out of the payload received after the command line.
+
+        Args:
+            payload (bytes)
+        """
+        self.updates = json.loads(payload.decode("utf-8"))
+        self.payload_length = None
+
+    def get_logcontext_id(self):
+        return "RDATA_BATCH-" + self.stream_name
+
+
 class PositionCommand(Command):
     """Sent by the server to tell the client the stream postition without
     needing to send an RDATA.
@@ -157,6 +227,9 @@ class ErrorCommand(Command):
 
 class PingCommand(Command):
     """Sent by either side as a keep alive. The data is arbitary (often timestamp)
+
+    The server adds "RDATA_BATCH" after the timestamp if it can send
+    RDATA_BATCH commands.
     """
     NAME = "PING"
 
@@ -168,6 +241,20 @@ class NameCommand(Command):
     NAME = "NAME"
 
 
+class FramingCommand(Command):
+    """Sent by the client to tell the server that it can receive commands which
+    use an alternative framing to the line protocol. The data is the name of the
+    command, and currently the only valid name is "RDATA_BATCH".
+
+    Only sent once the server has said that it supports the command.
+
+    Format::
+
+        FRAMING <command_name>
+    """
+    NAME = "FRAMING"
+
+
 class ReplicateCommand(Command):
     """Sent by the client to subscribe to the stream.
 
@@ -367,10 +454,12 @@ COMMAND_MAP = {
     for cmd in (
         ServerCommand,
         RdataCommand,
+        RdataBatchCommand,
         PositionCommand,
         ErrorCommand,
         PingCommand,
         NameCommand,
+        FramingCommand,
         ReplicateCommand,
         UserSyncCommand,
         FederationAckCommand,
@@ -385,6 +474,7 @@ COMMAND_MAP = {
 VALID_SERVER_COMMANDS = (
     ServerCommand.NAME,
     RdataCommand.NAME,
+    RdataBatchCommand.NAME,
     PositionCommand.NAME,
     ErrorCommand.NAME,
     PingCommand.NAME,
@@ -394,6 +484,7 @@ VALID_SERVER_COMMANDS = (
 # The commands the client is allowed to send
 VALID_CLIENT_COMMANDS = (
     NameCommand.NAME,
+    FramingCommand.NAME,
     ReplicateCommand.NAME,
     PingCommand.NAME,
     UserSyncCommand.NAME,
@@ -25,6 +25,14 @@ command. For example, the `RDATA` command is defined as::
 
 Blank lines are ignored.
 
+The exception is `RDATA_BATCH`, which the server sends instead of `RDATA` if
+the client has asked for it with `FRAMING RDATA_BATCH` (which it only does
+once the server has said that it supports it in a `PING`). Its line gives the
+length of a payload of many rows, which directly follows the line::
+
+    RDATA_BATCH <stream_name> <length>
+    <payload>
+
 # Example
 
 An example iteraction is shown below. Each line is prefixed with '>' or '<' to
@@ -59,11 +67,12 @@ from six import iteritems, iterkeys
 from prometheus_client import Counter
 
 from twisted.internet import defer
-from twisted.protocols.basic import LineOnlyReceiver
+from twisted.protocols.basic import LineReceiver
 from twisted.python.failure import Failure
 
 from synapse.metrics import LaterGauge
 from synapse.metrics.background_process_metrics import run_as_background_process
+from synapse.util import unwrapFirstError
 from synapse.util.logcontext import make_deferred_yieldable, run_in_background
 from synapse.util.stringutils import random_string
 
@@ -72,9 +81,11 @@ from .commands import (
     VALID_CLIENT_COMMANDS,
     VALID_SERVER_COMMANDS,
     ErrorCommand,
+    FramingCommand,
     NameCommand,
     PingCommand,
     PositionCommand,
+    RdataBatchCommand,
     RdataCommand,
     ReplicateCommand,
     ServerCommand,
@@ -98,6 +109,12 @@ PING_TIME = 5000
 PING_TIMEOUT_MULTIPLIER = 5
 PING_TIMEOUT_MS = PING_TIME * PING_TIMEOUT_MULTIPLIER
 
+# The most rows we send in a single RDATA_BATCH command
+RDATA_BATCH_MAX_ROWS = 500
+
+# The largest payload we'll send or accept for a command
+MAX_PAYLOAD_LENGTH = 16 * 1024 * 1024
+
 
 class ConnectionStates(object):
     CONNECTING = "connecting"
@@ -106,12 +123,13 @@ class ConnectionStates(object):
     CLOSED = "closed"
 
 
-class BaseReplicationStreamProtocol(LineOnlyReceiver):
+class BaseReplicationStreamProtocol(LineReceiver):
     """Base replication protocol shared between client and server.
 
     Reads lines (ignoring blank ones) and parses them into command classes,
     asserting that they are valid for the given direction, i.e. server commands
-    are only sent by the server.
+    are only sent by the server. Commands with a payload have it read in raw
+    mode, before switching back to reading lines.
 
     On receiving a new command it calls `on_<COMMAND_NAME>` with the parsed
     command.
@@ -149,6 +167,12 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
         self.inbound_commands_counter = defaultdict(int)
         self.outbound_commands_counter = defaultdict(int)
 
+        # The command whose payload we're currently reading, if any, and the
+        # data received for it so far.
+        self._payload_command = None
+        self._payload_buffer = []
+        self._payload_buffer_length = 0
+
     def connectionMade(self):
         logger.info("[%s] Connection established", self.id())
 
@@ -165,7 +189,18 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
 
         # Always send the initial PING so that the other side knows that they
         # can time us out.
-        self.send_command(PingCommand(self.clock.time_msec()))
+        self.send_command(self._ping_command(self.clock.time_msec()))
+
+    def _ping_command(self, now):
+        """Build a PING command to send to the other side
+
+        Args:
+            now (int): the current time in msec
+
+        Returns:
+            PingCommand
+        """
+        return PingCommand(now)
 
     def send_ping(self):
         """Periodically sends a ping and checks if we should close the connection
@@ -181,7 +216,7 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
                 self.transport.abortConnection()
         else:
             if now - self.last_sent_command >= PING_TIME:
-                self.send_command(PingCommand(now))
+                self.send_command(self._ping_command(now))
 
             if self.received_ping and now - self.last_received_command > PING_TIMEOUT_MS:
                 logger.info(
@@ -222,6 +257,47 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
             )
             return
 
+        if cmd.payload_length is not None:
+            if cmd.payload_length > MAX_PAYLOAD_LENGTH:
+                self.send_error("Payload length exceeded")
+                return
+
+            # Read the payload before handling the command
+            self._payload_command = cmd
+            self.setRawMode()
+            return
+
+        self._run_command(cmd)
+
+    def rawDataReceived(self, data):
+        """Called when we've received data while reading a command's payload
+        """
+        cmd = self._payload_command
+        self._payload_buffer.append(data)
+        self._payload_buffer_length += len(data)
+
+        if self._payload_buffer_length < cmd.payload_length:
+            return
+
+        data = b"".join(self._payload_buffer)
+        payload, rest = data[:cmd.payload_length], data[cmd.payload_length:]
+        self._payload_command = None
+        self._payload_buffer = []
+        self._payload_buffer_length = 0
+
+        try:
+            cmd.load_payload(payload)
+        except Exception as e:
+            logger.exception(
+                "[%s] failed to parse payload for %r", self.id(), cmd.NAME,
+            )
+            self.send_error("failed to parse payload for %r: %r" % (cmd.NAME, e))
+            return
+
+        self._run_command(cmd)
+        self.setLineMode(rest)
+
+    def _run_command(self, cmd):
         # Now lets try and call on_<CMD_NAME> function
         run_as_background_process(
             "replication-" + cmd.get_logcontext_id(),
@@ -289,7 +365,17 @@ class BaseReplicationStreamProtocol(LineOnlyReceiver):
                 )
             )
 
+        payload = cmd.get_payload()
+        if payload is not None and len(payload) > MAX_PAYLOAD_LENGTH:
+            raise Exception(
+                "Failed to send command %s as payload too long (%d > %d)" % (
+                    cmd.NAME, len(payload), MAX_PAYLOAD_LENGTH,
+                )
+            )
+
         self.sendLine(encoded_string)
+        if payload is not None:
+            self.transport.write(payload)
 
         self.last_sent_command = self.clock.time_msec()
 
@@ -411,15 +497,30 @@ class ServerReplicationStreamProtocol(BaseReplicationStreamProtocol):
         # subscribing the client to the stream.
         self.pending_rdata = {}
 
+        # Whether the client has asked for updates to be sent as RDATA_BATCH
+        self.use_rdata_batch = False
+
     def connectionMade(self):
         self.send_command(ServerCommand(self.server_name))
         BaseReplicationStreamProtocol.connectionMade(self)
         self.streamer.new_connection(self)
 
+    def _ping_command(self, now):
+        # Tell the client that we can send RDATA_BATCH commands. Clients which
+        # don't know about them ignore everything after the PING.
+        return PingCommand("%d %s" % (now, RdataBatchCommand.NAME))
+
     def on_NAME(self, cmd):
         logger.info("[%s] Renamed to %r", self.id(), cmd.data)
         self.name = cmd.data
 
+    def on_FRAMING(self, cmd):
+        if cmd.data == RdataBatchCommand.NAME:
+            logger.info("[%s] Sending updates as %s", self.id(), cmd.data)
+            self.use_rdata_batch = True
+        else:
+            logger.warn("[%s] Ignoring unknown framing %r", self.id(), cmd.data)
+
     def on_USER_SYNC(self, cmd):
         return self.streamer.on_user_sync(
             self.conn_id, cmd.user_id, cmd.is_syncing, cmd.last_sync_ms,
@@ -446,7 +547,7 @@ class ServerReplicationStreamProtocol(BaseReplicationStreamProtocol):
             return self.subscribe_to_stream(stream_name, token)
 
     def on_FEDERATION_ACK(self, cmd):
-        return self.streamer.federation_ack(cmd.token)
+        return self.streamer.federation_ack(cmd.token, self.name)
 
     def on_REMOVE_PUSHER(self, cmd):
         return self.streamer.on_remove_pusher(
@@ -480,9 +581,16 @@ class ServerReplicationStreamProtocol(BaseReplicationStreamProtocol):
             )
 
             # Send all the missing updates
-            for update in updates:
-                token, row = update[0], update[1]
-                self.send_command(RdataCommand(stream_name, token, row))
+            if self.use_rdata_batch:
+                batches = rdata_batch_commands(stream_name, [
+                    (update[0], update[1]) for update in updates
+                ])
+                for batch in batches:
+                    self._send_batch(batch)
+            else:
+                for update in updates:
+                    token, row = update[0], update[1]
+                    self.send_command(RdataCommand(stream_name, token, row))
 
             # We send a POSITION command to ensure that they have an up to
             # date token (especially useful if we didn't send any updates
@@ -529,6 +637,44 @@ class ServerReplicationStreamProtocol(BaseReplicationStreamProtocol):
         finally:
             self.connecting_streams.discard(stream_name)
 
+    def stream_updates(self, stream_name, batches):
+        """Called when new updates are available to stream to clients.
+
+        The updates are sent as RDATA_BATCH commands if the client supports
+        them, and otherwise as one RDATA command per row.
+
+        Args:
+            stream_name (str)
+            batches (list[RdataBatchCommand]): the updates, as returned by
+                `rdata_batch_commands`. The same commands are given to every
+                connection, so that each is encoded at most once.
+        """
+        if self.use_rdata_batch and stream_name in self.replication_streams:
+            for batch in batches:
+                self._send_batch(batch)
+            return
+
+        for batch in batches:
+            for token, row in batch.updates:
+                try:
+                    self.stream_update(stream_name, token, row)
+                except Exception:
+                    logger.exception("[%s] Failed to replicate", self.id())
+
+    def _send_batch(self, batch):
+        """Sends an RDATA_BATCH command, falling back to RDATA if the batch is
+        too large.
+
+        Args:
+            batch (RdataBatchCommand)
+        """
+        if len(batch.get_payload()) <= MAX_PAYLOAD_LENGTH:
+            self.send_command(batch)
+            return
+
+        for token, row in batch.updates:
+            self.send_command(RdataCommand(batch.stream_name, token, row))
+
     def stream_update(self, stream_name, token, data):
         """Called when a new update is available to stream to clients.
 
@@ -573,6 +719,9 @@ class ClientReplicationStreamProtocol(BaseReplicationStreamProtocol):
         # batching works.
         self.pending_batches = {}
 
+        # Whether we have asked the server to send us RDATA_BATCH commands
+        self.requested_rdata_batch = False
+
     def connectionMade(self):
         self.send_command(NameCommand(self.client_name))
         BaseReplicationStreamProtocol.connectionMade(self)
@@ -600,20 +749,81 @@ class ClientReplicationStreamProtocol(BaseReplicationStreamProtocol):
             logger.error("[%s] Connected to wrong remote: %r", self.id(), cmd.data)
             self.send_error("Wrong remote")
 
+    def on_PING(self, cmd):
+        BaseReplicationStreamProtocol.on_PING(self, cmd)
+
+        # Servers which can send RDATA_BATCH commands say so after the
+        # timestamp. Older servers would reject the FRAMING command, so we only
+        # ask for them once we know the server supports them.
+        if self.requested_rdata_batch:
+            return
+
+        if RdataBatchCommand.NAME in cmd.data.split(" ")[1:]:
+            self.requested_rdata_batch = True
+            self.send_command(FramingCommand(RdataBatchCommand.NAME))
+
     def on_RDATA(self, cmd):
+        inbound_rdata_count.labels(cmd.stream_name).inc()
+        row = self._parse_rdata_row(cmd.stream_name, cmd.row)
+        return self._on_rdata_row(cmd.stream_name, cmd.token, row)
+
+    def on_RDATA_BATCH(self, cmd):
         stream_name = cmd.stream_name
-        inbound_rdata_count.labels(stream_name).inc()
+        inbound_rdata_count.labels(stream_name).inc(len(cmd.updates))
+
+        # Parse all the rows before handling any of them, so that we don't
+        # handle half a batch.
+        updates = [
+            (token, self._parse_rdata_row(stream_name, raw_row))
+            for token, raw_row in cmd.updates
+        ]
+
+        # As with a run of RDATA commands, we don't wait for each update to be
+        # handled before passing on the next.
+        deferreds = []
+        for token, row in updates:
+            d = self._on_rdata_row(stream_name, token, row)
+            if isinstance(d, defer.Deferred):
+                deferreds.append(d)
+
+        if deferreds:
+            return make_deferred_yieldable(defer.gatherResults(
+                deferreds, consumeErrors=True,
+            ).addErrback(unwrapFirstError))
+
+    def _parse_rdata_row(self, stream_name, raw_row):
+        """Turn a row received in either RDATA or RDATA_BATCH into the stream's
+        row type
+
+        Args:
+            stream_name (str)
+            raw_row (list): the row, as decoded from JSON
 
+        Returns:
+            tuple
+        """
         try:
-            row = STREAMS_MAP[stream_name].ROW_TYPE(*cmd.row)
+            return STREAMS_MAP[stream_name].ROW_TYPE(*raw_row)
         except Exception:
             logger.exception(
                 "[%s] Failed to parse RDATA: %r %r",
-                self.id(), stream_name, cmd.row
+                self.id(), stream_name, raw_row
             )
             raise
 
-        if cmd.token is None:
+    def _on_rdata_row(self, stream_name, token, row):
+        """Handle a row received in either RDATA or RDATA_BATCH
+
+        Args:
+            stream_name (str)
+            token (int|None): the stream token, or None if the row is part of a
+                batch of updates.
+            row (tuple): the row
+
+        Returns:
+            Deferred|None
+        """
+        if token is None:
             # I.e. this is part of a batch of updates for this stream. Batch
             # until we get an update for the stream with a non None token
             self.pending_batches.setdefault(stream_name, []).append(row)
@@ -621,7 +831,7 @@ class ClientReplicationStreamProtocol(BaseReplicationStreamProtocol):
             # Check if this is the last of a batch of updates
             rows = self.pending_batches.pop(stream_name, [])
             rows.append(row)
-            return self.handler.on_rdata(stream_name, cmd.token, rows)
+            return self.handler.on_rdata(stream_name, token, rows)
 
     def on_POSITION(self, cmd):
         # When we get a `POSITION` command it means we've finished getting
@@ -655,6 +865,22 @@ class ClientReplicationStreamProtocol(BaseReplicationStreamProtocol):
         self.handler.update_connection(None)
 
 
+def rdata_batch_commands(stream_name, updates):
+    """Splits updates to a stream into RDATA_BATCH commands.
+
+    Args:
+        stream_name (str)
+        updates (list[tuple[int|None, tuple]]): the updates, as (token, row).
+
+    Returns:
+        list[RdataBatchCommand]
+    """
+    return [
+        RdataBatchCommand(stream_name, updates[i:i + RDATA_BATCH_MAX_ROWS])
+        for i in range(0, len(updates), RDATA_BATCH_MAX_ROWS)
+    ]
+
+
 # The following simply registers metrics for the replication connections
 
 pending_commands = LaterGauge(
@@ -29,7 +29,7 @@ from synapse.metrics import LaterGauge
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.util.metrics import Measure, measure_func
 
-from .protocol import ServerReplicationStreamProtocol
+from .protocol import ServerReplicationStreamProtocol, rdata_batch_commands
 from .streams import STREAMS_MAP, FederationStream
 
 stream_updates_counter = Counter("synapse_replication_tcp_resource_stream_updates",
@@ -107,6 +107,11 @@ class ReplicationStreamer(object):
         if not hs.config.send_federation:
             self.federation_sender = hs.get_federation_sender()
 
+        # If federation sending is sharded, the names of the shards and the last
+        # position each has acknowledged in the federation stream.
+        self._federation_sender_instances = hs.config.federation_sender_instances
+        self._federation_acks = {}
+
         self.notifier.add_replication_callback(self.on_notifier_poke)
 
         # Keeps track of whether we are currently checking for updates
@@ -203,13 +208,13 @@ class ReplicationStreamer(object):
                         # a series of updates with the same token to have a None
                         # token. See RdataCommand for more details.
                         batched_updates = _batch_updates(updates)
+                        batches = rdata_batch_commands(stream.NAME, batched_updates)
 
                         for conn in self.connections:
-                            for token, row in batched_updates:
-                                try:
-                                    conn.stream_update(stream.NAME, token, row)
-                                except Exception:
-                                    logger.exception("Failed to replicate")
+                            try:
+                                conn.stream_updates(stream.NAME, batches)
+                            except Exception:
+                                logger.exception("Failed to replicate")
 
             logger.debug("No more pending updates, breaking poke loop")
         finally:
@@ -228,12 +233,29 @@ class ReplicationStreamer(object):
         return stream.get_updates_since(token)
 
     @measure_func("repl.federation_ack")
-    def federation_ack(self, token):
+    def federation_ack(self, token, instance_name=None):
         """We've received an ack for federation stream from a client.
+
+        Args:
+            token (int): the position in the federation stream
+            instance_name (str|None): the name of the client
         """
         federation_ack_counter.inc()
-        if self.federation_sender:
-            self.federation_sender.federation_ack(token)
+        if not self.federation_sender:
+            return
+
+        if self._federation_sender_instances:
+            # We can only drop the updates that every shard has handled.
+            self._federation_acks[instance_name] = token
+            tokens = [
+                self._federation_acks.get(name)
+                for name in self._federation_sender_instances
+            ]
+            if None in tokens:
+                return
+            token = min(tokens)
+
+        self.federation_sender.federation_ack(token)
 
     @measure_func("repl.on_user_sync")
     @defer.inlineCallbacks
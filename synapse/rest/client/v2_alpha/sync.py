@@ -30,6 +30,7 @@ from synapse.events.utils import (
 )
 from synapse.handlers.presence import format_user_presence_state
 from synapse.handlers.sync import SyncConfig
+from synapse.http.server import LazyJsonObject
 from synapse.http.servlet import RestServlet, parse_boolean, parse_integer, parse_string
 from synapse.types import StreamToken
 
@@ -200,29 +201,31 @@ class SyncRestServlet(RestServlet):
             event_formatter,
         )
 
-        return {
-            "account_data": {"events": sync_result.account_data},
-            "to_device": {"events": sync_result.to_device},
-            "device_lists": {
+        # The rooms can make up most of a large response, so we only encode
+        # each room as it is written out.
+        return LazyJsonObject([
+            ("account_data", {"events": sync_result.account_data}),
+            ("to_device", {"events": sync_result.to_device}),
+            ("device_lists", {
                 "changed": list(sync_result.device_lists.changed),
                 "left": list(sync_result.device_lists.left),
-            },
-            "presence": SyncRestServlet.encode_presence(
+            }),
+            ("presence", SyncRestServlet.encode_presence(
                 sync_result.presence, time_now
-            ),
-            "rooms": {
-                "join": joined,
-                "invite": invited,
-                "leave": archived,
-            },
-            "groups": {
+            )),
+            ("rooms", LazyJsonObject([
+                ("join", LazyJsonObject(joined)),
+                ("invite", invited),
+                ("leave", LazyJsonObject(archived)),
+            ])),
+            ("groups", {
                 "join": sync_result.groups.join,
                 "invite": sync_result.groups.invite,
                 "leave": sync_result.groups.leave,
-            },
-            "device_one_time_keys_count": sync_result.device_one_time_keys_count,
-            "next_batch": sync_result.next_batch.to_string(),
-        }
+            }),
+            ("device_one_time_keys_count", sync_result.device_one_time_keys_count),
+            ("next_batch", sync_result.next_batch.to_string()),
+        ])
 
     @staticmethod
     def encode_presence(events, time_now):
@@ -256,18 +259,15 @@ class SyncRestServlet(RestServlet):
             event_formatter (func[dict]): function to convert from federation format
                 to client format
         Returns:
-            dict[str, dict[str, object]]: the joined rooms list, in our
-                response format
+            iterator[tuple[str, dict[str, object]]]: the joined rooms, in our
+                response format. Each room is only encoded when it is reached.
         """
-        joined = {}
         for room in rooms:
-            joined[room.room_id] = SyncRestServlet.encode_room(
+            yield room.room_id, SyncRestServlet.encode_room(
                 room, time_now, token_id, joined=True, only_fields=event_fields,
                 event_formatter=event_formatter,
             )
 
-        return joined
-
     @staticmethod
     def encode_invited(rooms, time_now, token_id, event_formatter):
         """
@@ -321,19 +321,16 @@ class SyncRestServlet(RestServlet):
             event_formatter (func[dict]): function to convert from federation format
                 to client format
         Returns:
-            dict[str, dict[str, object]]: The invited rooms list, in our
-                response format
+            iterator[tuple[str, dict[str, object]]]: The archived rooms, in our
+                response format. Each room is only encoded when it is reached.
         """
-        joined = {}
         for room in rooms:
-            joined[room.room_id] = SyncRestServlet.encode_room(
+            yield room.room_id, SyncRestServlet.encode_room(
                 room, time_now, token_id, joined=False,
                 only_fields=event_fields,
                 event_formatter=event_formatter,
             )
 
-        return joined
-
     @staticmethod
     def encode_room(
             room, time_now, token_id, joined,
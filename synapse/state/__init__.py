@@ -14,13 +14,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import heapq
 import logging
-from collections import namedtuple
+from collections import defaultdict, namedtuple
 
 from six import iteritems, itervalues
 
 import attr
 from frozendict import frozendict
+from prometheus_client import Histogram
 
 from twisted.internet import defer
 
@@ -30,6 +32,7 @@ from synapse.state import v1, v2
 from synapse.util.async_helpers import Linearizer
 from synapse.util.caches import get_cache_factor_for
 from synapse.util.caches.expiringcache import ExpiringCache
+from synapse.util.logcontext import LoggingContext
 from synapse.util.logutils import log_function
 from synapse.util.metrics import Measure
 
@@ -47,6 +50,23 @@ _NEXT_STATE_ID = 1
 
 POWER_KEY = (EventTypes.PowerLevels, "")
 
+# how often we report on the rooms which took longest to resolve
+STATE_RES_METRICS_PERIOD_MS = 120 * 1000
+
+# how many rooms we log when reporting
+STATE_RES_METRICS_ROOMS_TO_LOG = 3
+
+_biggest_room_by_cpu_counter = Histogram(
+    "synapse_state_res_cpu_for_biggest_room_seconds",
+    "CPU time spent performing state resolution for the single most expensive "
+    "room for state resolution in each reporting period",
+)
+_biggest_room_by_db_counter = Histogram(
+    "synapse_state_res_db_for_biggest_room_seconds",
+    "Database time spent performing state resolution for the single most "
+    "expensive room for state resolution in each reporting period",
+)
+
 
 def _gen_state_id():
     global _NEXT_STATE_ID
@@ -171,7 +191,10 @@ class StateHandler(object):
     @defer.inlineCallbacks
     def get_current_hosts_in_room(self, room_id, latest_event_ids=None):
         if not latest_event_ids:
-            latest_event_ids = yield self.store.get_latest_event_ids_in_room(room_id)
+            # the joined hosts index is kept up to date with the current state,
+            # so we don't need to resolve it.
+            host_counts = yield self.store.get_joined_host_counts(room_id)
+            defer.returnValue(frozenset(host_counts))
         logger.debug("calling resolve_state_groups from get_current_hosts_in_room")
         entry = yield self.resolve_state_groups_for_events(room_id, latest_event_ids)
         joined_hosts = yield self.store.get_joined_hosts(room_id, entry)
@@ -429,6 +452,17 @@ class StateResolutionHandler(object):
             reset_expiry_on_get=True,
         )
 
+        # results of v2 state resolution which can be reused between
+        # resolutions
+        self._state_res_cache = v2.StateResolutionCache()
+
+        # room_id -> _StateResRoomMetrics, for the current reporting period
+        self._state_res_metrics = defaultdict(_StateResRoomMetrics)
+
+        self.clock.looping_call(
+            self._report_metrics, STATE_RES_METRICS_PERIOD_MS,
+        )
+
     @defer.inlineCallbacks
     @log_function
     def resolve_state_groups(
@@ -495,14 +529,28 @@ class StateResolutionHandler(object):
 
             if conflicted_state:
                 logger.info("Resolving conflicted state for %r", room_id)
+
+                context = LoggingContext.current_context()
+                start_usage = context.get_resource_usage() if context else None
+                start = self.clock.time()
+
                 with Measure(self.clock, "state._resolve_events"):
                     new_state = yield resolve_events_with_store(
                         room_version,
                         list(itervalues(state_groups_ids)),
                         event_map=event_map,
                         state_res_store=state_res_store,
+                        state_res_cache=self._state_res_cache,
                     )
 
+                metrics = self._state_res_metrics[room_id]
+                metrics.count += 1
+                metrics.wall_time += self.clock.time() - start
+                if start_usage is not None:
+                    usage = context.get_resource_usage() - start_usage
+                    metrics.cpu_time += usage.ru_utime + usage.ru_stime
+                    metrics.db_time += usage.db_txn_duration_sec
+
             # if the new state matches any of the input state groups, we can
             # use that state group again. Otherwise we will generate a state_id
             # which will be used as a cache key for future resolutions, but
@@ -516,6 +564,64 @@ class StateResolutionHandler(object):
 
             defer.returnValue(cache)
 
+    def _report_metrics(self):
+        """Log the rooms which have been most expensive to resolve since the
+        last report, and reset the per-room counters.
+        """
+        metrics, self._state_res_metrics = (
+            self._state_res_metrics, defaultdict(_StateResRoomMetrics),
+        )
+        if not metrics:
+            return
+
+        self._report_biggest(
+            metrics, lambda m: m.cpu_time, "CPU time",
+            _biggest_room_by_cpu_counter,
+        )
+        self._report_biggest(
+            metrics, lambda m: m.db_time, "DB time",
+            _biggest_room_by_db_counter,
+        )
+
+    def _report_biggest(self, metrics, extract_key, metric_name, histogram):
+        """Log the rooms with the largest value of a metric, and record the
+        largest value in a histogram.
+
+        Args:
+            metrics (dict[str, _StateResRoomMetrics]): the metrics to report on
+            extract_key (func): function which returns the value of the metric
+                for a room
+            metric_name (str): description of the metric, for the log line
+            histogram (prometheus_client.Histogram): histogram to record the
+                largest value in
+        """
+        biggest = heapq.nlargest(
+            STATE_RES_METRICS_ROOMS_TO_LOG, iteritems(metrics),
+            key=lambda i: extract_key(i[1]),
+        )
+        histogram.observe(extract_key(biggest[0][1]))
+
+        for room_id, room_metrics in biggest:
+            logger.info(
+                "%s for state res in %s: %.3fs over %i resolutions "
+                "(%.3fs wall clock)",
+                metric_name, room_id, extract_key(room_metrics),
+                room_metrics.count, room_metrics.wall_time,
+            )
+
+
+class _StateResRoomMetrics(object):
+    """The time spent resolving state in a room during the current reporting
+    period.
+    """
+    __slots__ = ["count", "wall_time", "cpu_time", "db_time"]
+
+    def __init__(self):
+        self.count = 0
+        self.wall_time = 0.
+        self.cpu_time = 0.
+        self.db_time = 0.
+
 
 def _make_state_cache_entry(
     new_state,
@@ -581,7 +687,8 @@ def _make_state_cache_entry(
     )
 
 
-def resolve_events_with_store(room_version, state_sets, event_map, state_res_store):
+def resolve_events_with_store(room_version, state_sets, event_map, state_res_store,
+                              state_res_cache=None):
     """
     Args:
         room_version(str): Version of the room
@@ -599,6 +706,9 @@ def resolve_events_with_store(room_version, state_sets, event_map, state_res_sto
 
         state_res_store (StateResolutionStore)
 
+        state_res_cache (synapse.state.v2.StateResolutionCache|None): cache of
+            partial results to reuse, for room versions which support it.
+
     Returns
         Deferred[dict[(str, str), str]]:
             a map from (type, state_key) to event_id.
@@ -612,6 +722,7 @@ def resolve_events_with_store(room_version, state_sets, event_map, state_res_sto
     ):
         return v2.resolve_events_with_store(
             room_version, state_sets, event_map, state_res_store,
+            state_res_cache=state_res_cache,
         )
     else:
         # This should only happen if we added a version but forgot to add it to
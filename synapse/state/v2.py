@@ -24,12 +24,43 @@ from twisted.internet import defer
 from synapse import event_auth
 from synapse.api.constants import EventTypes
 from synapse.api.errors import AuthError
+from synapse.util.caches import get_cache_factor_for, register_cache
+from synapse.util.caches.lrucache import LruCache
 
 logger = logging.getLogger(__name__)
 
 
+class StateResolutionCache(object):
+    """Caches the parts of the v2 state resolution algorithm which only depend
+    on immutable events, so that they can be reused between resolutions.
+
+    When the forward extremities of a room change, the new set of state groups
+    to resolve usually overlaps heavily with the previous one, so most of the
+    conflicted events (and their power levels and mainline depths) are the
+    same as last time.
+
+    Args:
+        max_entries (int): the maximum size of each of the caches
+    """
+
+    def __init__(self, max_entries=50000):
+        max_entries = int(max_entries * get_cache_factor_for("state_res_cache"))
+
+        # event_id -> power level of the event's sender, according to the
+        # event's auth events
+        self.sender_power_levels = LruCache(max_entries)
+        register_cache(
+            "cache", "state_res_sender_power_levels", self.sender_power_levels,
+        )
+
+        # (power level event_id, event_id) -> mainline depth of the event
+        self.mainline_depths = LruCache(max_entries)
+        register_cache("cache", "state_res_mainline_depths", self.mainline_depths)
+
+
 @defer.inlineCallbacks
-def resolve_events_with_store(room_version, state_sets, event_map, state_res_store):
+def resolve_events_with_store(room_version, state_sets, event_map, state_res_store,
+                              state_res_cache=None):
     """Resolves the state using the v2 state resolution algorithm
 
     Args:
@@ -48,6 +79,9 @@ def resolve_events_with_store(room_version, state_sets, event_map, state_res_sto
 
         state_res_store (StateResolutionStore)
 
+        state_res_cache (StateResolutionCache|None): if given, used to reuse
+            the results of previous resolutions.
+
     Returns
         Deferred[dict[(str, str), str]]:
             a map from (type, state_key) to event_id.
@@ -100,6 +134,7 @@ def resolve_events_with_store(room_version, state_sets, event_map, state_res_sto
         event_map,
         state_res_store,
         full_conflicted_set,
+        state_res_cache,
     )
 
     logger.debug("sorted %d power events", len(sorted_power_events))
@@ -125,7 +160,7 @@ def resolve_events_with_store(room_version, state_sets, event_map, state_res_sto
 
     pl = resolved_state.get((EventTypes.PowerLevels, ""), None)
     leftover_events = yield _mainline_sort(
-        leftover_events, pl, event_map, state_res_store,
+        leftover_events, pl, event_map, state_res_store, state_res_cache,
     )
 
     logger.debug("resolving remaining events")
@@ -310,7 +345,8 @@ def _add_event_and_auth_chain_to_graph(graph, event_id, event_map,
 
 
 @defer.inlineCallbacks
-def _reverse_topological_power_sort(event_ids, event_map, state_res_store, auth_diff):
+def _reverse_topological_power_sort(event_ids, event_map, state_res_store, auth_diff,
+                                    state_res_cache=None):
     """Returns a list of the event_ids sorted by reverse topological ordering,
     and then by power level and origin_server_ts
 
@@ -319,6 +355,7 @@ def _reverse_topological_power_sort(event_ids, event_map, state_res_store, auth_
         event_map (dict[str,FrozenEvent])
         state_res_store (StateResolutionStore)
         auth_diff (set[str]): Set of event IDs that are in the auth difference.
+        state_res_cache (StateResolutionCache|None)
 
     Returns:
         Deferred[list[str]]: The sorted list
@@ -332,7 +369,17 @@ def _reverse_topological_power_sort(event_ids, event_map, state_res_store, auth_
 
     event_to_pl = {}
     for event_id in graph:
-        pl = yield _get_power_level_for_sender(event_id, event_map, state_res_store)
+        pl = None
+        if state_res_cache is not None:
+            pl = state_res_cache.sender_power_levels.get(event_id)
+
+        if pl is None:
+            pl = yield _get_power_level_for_sender(
+                event_id, event_map, state_res_store,
+            )
+            if state_res_cache is not None:
+                state_res_cache.sender_power_levels[event_id] = pl
+
         event_to_pl[event_id] = pl
 
     def _get_power_order(event_id):
@@ -403,7 +450,7 @@ def _iterative_auth_checks(room_version, event_ids, base_state, event_map,
 
 @defer.inlineCallbacks
 def _mainline_sort(event_ids, resolved_power_event_id, event_map,
-                   state_res_store):
+                   state_res_store, state_res_cache=None):
     """Returns a sorted list of event_ids sorted by mainline ordering based on
     the given event resolved_power_event_id
 
@@ -412,13 +459,27 @@ def _mainline_sort(event_ids, resolved_power_event_id, event_map,
         resolved_power_event_id (str): The final resolved power level event ID
         event_map (dict[str,FrozenEvent])
         state_res_store (StateResolutionStore)
+        state_res_cache (StateResolutionCache|None)
 
     Returns:
         Deferred[list[str]]: The sorted list
     """
+    event_ids = list(event_ids)
+
+    # The mainline depth of an event only depends on the power level event
+    # we're sorting against, so look up any we've already calculated.
+    depths = {}
+    if state_res_cache is not None:
+        for ev_id in event_ids:
+            depth = state_res_cache.mainline_depths.get(
+                (resolved_power_event_id, ev_id),
+            )
+            if depth is not None:
+                depths[ev_id] = depth
+
     mainline = []
     pl = resolved_power_event_id
-    while pl:
+    while pl and len(depths) < len(event_ids):
         mainline.append(pl)
         pl_ev = yield _get_event(pl, event_map, state_res_store)
         auth_events = pl_ev.auth_event_ids()
@@ -431,14 +492,18 @@ def _mainline_sort(event_ids, resolved_power_event_id, event_map,
 
     mainline_map = {ev_id: i + 1 for i, ev_id in enumerate(reversed(mainline))}
 
-    event_ids = list(event_ids)
-
     order_map = {}
     for ev_id in event_ids:
-        depth = yield _get_mainline_depth_for_event(
-            event_map[ev_id], mainline_map,
-            event_map, state_res_store,
-        )
+        depth = depths.get(ev_id)
+        if depth is None:
+            depth = yield _get_mainline_depth_for_event(
+                event_map[ev_id], mainline_map,
+                event_map, state_res_store,
+            )
+            if state_res_cache is not None:
+                state_res_cache.mainline_depths[
+                    (resolved_power_event_id, ev_id)
+                ] = depth
         order_map[ev_id] = (depth, event_map[ev_id].origin_server_ts, ev_id)
 
     event_ids.sort(key=lambda ev_id: order_map[ev_id])
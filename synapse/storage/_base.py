@@ -32,6 +32,7 @@ from synapse.storage.engines import PostgresEngine, Sqlite3Engine
 from synapse.types import get_domain_from_id
 from synapse.util import batch_iter
 from synapse.util.caches.descriptors import Cache
+from synapse.util.caches.shared_memory_cache import SharedMemoryCache
 from synapse.util.logcontext import LoggingContext, PreserveLoggingContext
 from synapse.util.stringutils import exception_to_unicode
 
@@ -215,10 +216,23 @@ class SQLBaseStore(object):
         self._get_event_cache = Cache("*getEvent*", keylen=3,
                                       max_entries=hs.config.event_cache_size)
 
-        self._event_fetch_lock = threading.Condition()
+        self._shared_event_cache = None
+        if hs.config.shared_event_cache_path:
+            self._shared_event_cache = SharedMemoryCache(
+                "*getEvent*shared",
+                hs.config.shared_event_cache_path,
+                hs.config.shared_event_cache_size,
+            )
+
+        self._event_fetch_lock = threading.Lock()
         self._event_fetch_list = []
         self._event_fetch_ongoing = 0
 
+        # Map from event_id to the ObservableDeferred of the queued fetch
+        # which will return it, so that concurrent requests for the same event
+        # share a single database lookup. Only accessed from the main thread.
+        self._event_fetch_in_flight = {}
+
         self._pending_ds = []
 
         self.database_engine = hs.database_engine
@@ -1371,6 +1385,10 @@ class SQLBaseStore(object):
         self._attempt_to_invalidate_cache(
             "get_users_in_room", (room_id,),
         )
+        if members_changed:
+            self._attempt_to_invalidate_cache(
+                "get_joined_host_counts", (room_id,),
+            )
         self._attempt_to_invalidate_cache(
             "get_room_summary", (room_id,),
         )
@@ -1653,3 +1671,30 @@ def db_to_json(db_content):
     except Exception:
         logging.warning("Tried to decode '%r' as JSON and failed", db_content)
         raise
+
+
+def make_in_list_sql_clause(database_engine, column, iterable):
+    """Returns an SQL clause that checks the given column is in the iterable.
+
+    On SQLite this expands to `column IN (?, ?, ...)`, whereas on Postgres
+    it expands to `column = ANY(?)`. While both DBs support the `IN` form,
+    using the `ANY` form on postgres means that it views queries with
+    different length iterables as the same, helping the query stats.
+
+    Args:
+        database_engine
+        column (str): Name of the column
+        iterable (Iterable): The values to check the column against.
+
+    Returns:
+        tuple[str, list[Any]]: The SQL clause to use and the list of args to
+        pass to execute.
+    """
+
+    if database_engine.supports_using_any_list:
+        # This should hopefully be faster, but also makes postgres query
+        # stats easier to understand.
+        return "%s = ANY(?)" % (column,), [list(iterable)]
+    else:
+        values = list(iterable)
+        return "%s IN (%s)" % (column, ",".join("?" for _ in values)), values
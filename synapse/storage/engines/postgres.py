@@ -69,6 +69,18 @@ class PostgresEngine(object):
         """
         return self._version >= 90500
 
+    @property
+    def supports_using_any_list(self):
+        """Do we support using `a = ANY(?)` and passing a list
+        """
+        return True
+
+    @property
+    def supports_recursive_cte(self):
+        """Do we support `WITH RECURSIVE`?
+        """
+        return True
+
     def is_deadlock(self, error):
         if isinstance(error, self.module.DatabaseError):
             # https://www.postgresql.org/docs/current/static/errcodes-appendix.html
@@ -38,6 +38,18 @@ class Sqlite3Engine(object):
         """
         return self.module.sqlite_version_info >= (3, 24, 0)
 
+    @property
+    def supports_using_any_list(self):
+        """Do we support using `a = ANY(?)` and passing a list
+        """
+        return False
+
+    @property
+    def supports_recursive_cte(self):
+        """Do we support `WITH RECURSIVE`? This requires SQLite3 3.8.3+.
+        """
+        return self.module.sqlite_version_info >= (3, 8, 3)
+
     def check_database(self, txn):
         pass
 
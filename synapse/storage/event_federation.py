@@ -12,12 +12,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import itertools
 import logging
 import random
 
+from six import iteritems, itervalues
 from six.moves import range
 from six.moves.queue import Empty, PriorityQueue
 
+from canonicaljson import json
 from unpaddedbase64 import encode_base64
 
 from twisted.internet import defer
@@ -27,7 +30,9 @@ from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.storage._base import SQLBaseStore
 from synapse.storage.events_worker import EventsWorkerStore
 from synapse.storage.signatures import SignatureWorkerStore
+from synapse.util import batch_iter
 from synapse.util.caches.descriptors import cached
+from synapse.util.frozenutils import frozendict_json_encoder
 
 logger = logging.getLogger(__name__)
 
@@ -76,11 +81,17 @@ class EventFederationWorkerStore(EventsWorkerStore, SignatureWorkerStore,
 
         front = set(event_ids)
         while front:
+            # The auth chains of events which are in the auth chain index can
+            # be read directly: we only need to walk event_auth for the rest.
+            chains = self._get_indexed_auth_chains_txn(txn, front)
+            for chain in itervalues(chains):
+                results.update(chain)
+
             new_front = set()
-            front_list = list(front)
+            front_list = [event_id for event_id in front if event_id not in chains]
             chunks = [
                 front_list[x:x + 100]
-                for x in range(0, len(front), 100)
+                for x in range(0, len(front_list), 100)
             ]
             for chunk in chunks:
                 txn.execute(
@@ -96,6 +107,35 @@ class EventFederationWorkerStore(EventsWorkerStore, SignatureWorkerStore,
 
         return list(results)
 
+    def _get_indexed_auth_chains_txn(self, txn, event_ids):
+        """Look up the auth chains of the given events in the auth chain index.
+
+        Args:
+            txn
+            event_ids (iterable[str]): state events
+
+        Returns:
+            dict[str, set[str]]: map from event_id to the ids of the events in
+            its auth chain, for those of the given events which have been
+            indexed.
+        """
+        chains = {}
+        for chunk in batch_iter(event_ids, 100):
+            rows = self._simple_select_many_txn(
+                txn,
+                table="event_auth_chain_closure",
+                column="event_id",
+                iterable=chunk,
+                keyvalues={},
+                retcols=("event_id", "auth_id"),
+            )
+            for row in rows:
+                chain = chains.setdefault(row["event_id"], set())
+                if row["auth_id"] != row["event_id"]:
+                    chain.add(row["auth_id"])
+
+        return chains
+
     def get_oldest_events_in_room(self, room_id):
         return self.runInteraction(
             "get_oldest_events_in_room",
@@ -464,6 +504,148 @@ class EventFederationWorkerStore(EventsWorkerStore, SignatureWorkerStore,
             row["event_id"] for row in rows
         ])
 
+    def insert_received_events_to_staging(self, instance_name, origin,
+                                          received_ts, events):
+        """Stages PDUs received over federation, to be processed later.
+
+        PDUs which are already staged from this origin are ignored.
+
+        Args:
+            instance_name (str): the process which received the PDUs, and is
+                to process them
+            origin (str): the server which sent us the PDUs
+            received_ts (int): when we received them
+            events (list[tuple[FrozenEvent, int]]): the PDUs, with the priority
+                to process them with.
+
+        Returns:
+            Deferred
+        """
+        def _insert_received_events_to_staging_txn(txn):
+            for event, priority in events:
+                self._simple_upsert_txn(
+                    txn,
+                    table="federation_inbound_events_staging",
+                    keyvalues={
+                        "origin": origin,
+                        "event_id": event.event_id,
+                    },
+                    values={},
+                    insertion_values={
+                        "instance_name": instance_name,
+                        "room_id": event.room_id,
+                        "depth": event.depth,
+                        "received_ts": received_ts,
+                        "priority": priority,
+                        "event_json": frozendict_json_encoder.encode(
+                            event.get_pdu_json(),
+                        ),
+                    },
+                )
+
+        return self.runInteraction(
+            "insert_received_events_to_staging",
+            _insert_received_events_to_staging_txn,
+        )
+
+    def remove_received_event_from_staging(self, origin, event_id):
+        """Removes a PDU from the staging area, once it has been processed.
+
+        Args:
+            origin (str)
+            event_id (str)
+
+        Returns:
+            Deferred
+        """
+        return self._simple_delete(
+            table="federation_inbound_events_staging",
+            keyvalues={
+                "origin": origin,
+                "event_id": event_id,
+            },
+            desc="remove_received_event_from_staging",
+        )
+
+    def count_received_events_in_staging(self, origin):
+        """Counts the PDUs from a server which are waiting to be processed.
+
+        Args:
+            origin (str)
+
+        Returns:
+            Deferred[int]
+        """
+        def _count_received_events_in_staging_txn(txn):
+            txn.execute(
+                "SELECT COUNT(*) FROM federation_inbound_events_staging"
+                " WHERE origin = ?",
+                (origin,),
+            )
+            return txn.fetchone()[0]
+
+        return self.runInteraction(
+            "count_received_events_in_staging",
+            _count_received_events_in_staging_txn,
+        )
+
+    @defer.inlineCallbacks
+    def get_next_staged_events_for_room(self, instance_name, room_id, limit):
+        """Gets the PDUs staged for a room which we received first.
+
+        Args:
+            instance_name (str): the process which received the PDUs
+            room_id (str)
+            limit (int): the most PDUs to return
+
+        Returns:
+            Deferred[list[tuple[str, str, dict]]]: the origin, event_id and pdu
+                json of each PDU, in the order they should be processed.
+        """
+        def _get_next_staged_events_for_room_txn(txn):
+            sql = """
+                SELECT origin, event_id, event_json
+                FROM federation_inbound_events_staging
+                WHERE instance_name = ? AND room_id = ?
+                ORDER BY received_ts ASC, depth ASC
+                LIMIT ?
+            """
+            txn.execute(sql, (instance_name, room_id, limit))
+            return txn.fetchall()
+
+        rows = yield self.runInteraction(
+            "get_next_staged_events_for_room",
+            _get_next_staged_events_for_room_txn,
+        )
+
+        defer.returnValue([
+            (origin, event_id, json.loads(event_json))
+            for origin, event_id, event_json in rows
+        ])
+
+    def get_rooms_with_staged_events(self, instance_name):
+        """Gets the rooms which have PDUs waiting in the staging area.
+
+        Args:
+            instance_name (str): the process which received the PDUs
+
+        Returns:
+            Deferred[dict[str, int]]: map from room_id to the highest priority
+                (ie, lowest value) of its staged PDUs.
+        """
+        def _get_rooms_with_staged_events_txn(txn):
+            sql = """
+                SELECT room_id, MIN(priority) FROM federation_inbound_events_staging
+                WHERE instance_name = ?
+                GROUP BY room_id
+            """
+            txn.execute(sql, (instance_name,))
+            return dict(txn)
+
+        return self.runInteraction(
+            "get_rooms_with_staged_events", _get_rooms_with_staged_events_txn,
+        )
+
 
 class EventFederationStore(EventFederationWorkerStore):
     """ Responsible for storing and serving up the various graphs associated
@@ -476,6 +658,7 @@ class EventFederationStore(EventFederationWorkerStore):
     """
 
     EVENT_AUTH_STATE_ONLY = "event_auth_state_only"
+    EVENT_AUTH_CHAIN_CLOSURE = "event_auth_chain_closure"
 
     def __init__(self, db_conn, hs):
         super(EventFederationStore, self).__init__(db_conn, hs)
@@ -485,6 +668,11 @@ class EventFederationStore(EventFederationWorkerStore):
             self._background_delete_non_state_event_auth,
         )
 
+        self.register_background_update_handler(
+            self.EVENT_AUTH_CHAIN_CLOSURE,
+            self._background_index_auth_chains,
+        )
+
         hs.get_clock().looping_call(
             self._delete_old_forward_extrem_cache, 60 * 60 * 1000,
         )
@@ -656,3 +844,223 @@ class EventFederationStore(EventFederationWorkerStore):
             yield self._end_background_update(self.EVENT_AUTH_STATE_ONLY)
 
         defer.returnValue(batch_size)
+
+    def _index_auth_chains_txn(self, txn, event_ids):
+        """Add state events to the auth chain index, along with any unindexed
+        events in their auth chains.
+
+        An event is only indexed once all of the events in its auth chain are,
+        so that the index never holds a partial chain for an event whose
+        auth events we haven't yet received. Such events are recorded in
+        event_auth_chain_unindexed, and indexed here once the events they were
+        waiting for are.
+
+        Args:
+            txn
+            event_ids (iterable[str]): state events which have been persisted,
+                along with their event_auth rows.
+
+        Returns:
+            int: the number of events which were added to the index
+        """
+        count = 0
+        while event_ids:
+            new_event_ids = self._index_auth_chains_and_ancestors_txn(
+                txn, event_ids,
+            )
+            count += len(new_event_ids)
+
+            # Now that these events are indexed, we may be able to index events
+            # which were waiting for them.
+            event_ids = set()
+            sql = """
+                SELECT DISTINCT u.event_id FROM event_auth_chain_unindexed AS u
+                INNER JOIN event_auth AS a USING (event_id)
+                WHERE a.auth_id IN (%s)
+            """
+            for chunk in batch_iter(new_event_ids, 100):
+                txn.execute(sql % (",".join("?" for _ in chunk),), chunk)
+                event_ids.update(r[0] for r in txn)
+
+        return count
+
+    def _index_auth_chains_and_ancestors_txn(self, txn, event_ids):
+        """Does a single pass of _index_auth_chains_txn, walking the auth
+        chains of the given events to index them and their unindexed ancestors.
+
+        Args:
+            txn
+            event_ids (iterable[str]): state events to index
+
+        Returns:
+            list[str]: the events which were added to the index
+        """
+        # event_id -> auth chain, for indexed events
+        chains = {}
+        # event_id -> auth event ids, for the unindexed events we have found
+        auth_map = {}
+        # events which can't be indexed yet
+        unindexable = set()
+
+        front = set(event_ids)
+        while front:
+            chains.update(self._get_indexed_auth_chains_txn(txn, front))
+            unindexed = [event_id for event_id in front if event_id not in chains]
+
+            existing = set()
+            for chunk in batch_iter(unindexed, 100):
+                rows = self._simple_select_many_txn(
+                    txn,
+                    table="events",
+                    column="event_id",
+                    iterable=chunk,
+                    keyvalues={},
+                    retcols=("event_id",),
+                )
+                existing.update(row["event_id"] for row in rows)
+            unindexable.update(e for e in unindexed if e not in existing)
+
+            for event_id in existing:
+                auth_map[event_id] = set()
+            for chunk in batch_iter(existing, 100):
+                rows = self._simple_select_many_txn(
+                    txn,
+                    table="event_auth",
+                    column="event_id",
+                    iterable=chunk,
+                    keyvalues={},
+                    retcols=("event_id", "auth_id"),
+                )
+                for row in rows:
+                    auth_map[row["event_id"]].add(row["auth_id"])
+
+            front = set(
+                auth_id
+                for event_id in existing
+                for auth_id in auth_map[event_id]
+                if auth_id not in chains and auth_id not in auth_map
+                and auth_id not in unindexable
+            )
+
+        # Now work out the chains of the unindexed events, auth events first.
+        new_chains = {}
+        for root in auth_map:
+            stack = [root]
+            in_progress = set()
+            while stack:
+                event_id = stack[-1]
+                if event_id in chains or event_id in unindexable:
+                    stack.pop()
+                    continue
+
+                auth_ids = auth_map[event_id]
+                pending = [
+                    auth_id for auth_id in auth_ids
+                    if auth_id not in chains and auth_id not in unindexable
+                ]
+                if pending and event_id not in in_progress:
+                    in_progress.add(event_id)
+                    stack.extend(pending)
+                    continue
+
+                stack.pop()
+                in_progress.discard(event_id)
+
+                if pending:
+                    # there's a cycle in the auth events
+                    unindexable.add(event_id)
+                    continue
+
+                if any(auth_id in unindexable for auth_id in auth_ids):
+                    # we're missing some of the auth chain
+                    unindexable.add(event_id)
+                    continue
+
+                chain = set(auth_ids)
+                for auth_id in auth_ids:
+                    chain.update(chains[auth_id])
+                chains[event_id] = chain
+                new_chains[event_id] = chain
+
+        self._simple_insert_many_txn(
+            txn,
+            table="event_auth_chain_closure",
+            values=[
+                {"event_id": event_id, "auth_id": auth_id}
+                for event_id, chain in iteritems(new_chains)
+                for auth_id in itertools.chain((event_id,), chain)
+            ],
+        )
+
+        for chunk in batch_iter(new_chains, 100):
+            self._simple_delete_many_txn(
+                txn,
+                table="event_auth_chain_unindexed",
+                column="event_id",
+                iterable=chunk,
+                keyvalues={},
+            )
+
+        # Record the events we have which are still missing some of their auth
+        # chain, so that we come back to them once it arrives.
+        still_unindexed = [
+            (event_id,) for event_id in auth_map if event_id not in chains
+        ]
+        if still_unindexed:
+            self._simple_upsert_many_txn(
+                txn,
+                table="event_auth_chain_unindexed",
+                key_names=("event_id",),
+                key_values=still_unindexed,
+                value_names=(),
+                value_values=(),
+            )
+
+        return list(new_chains)
+
+    @defer.inlineCallbacks
+    def _background_index_auth_chains(self, progress, batch_size):
+        """Add the existing state events to the auth chain index, in
+        stream order.
+        """
+        last_stream_ordering = progress.get("last_stream_ordering")
+
+        def index_auth_chains_txn(txn):
+            last = last_stream_ordering
+            if last is None:
+                txn.execute(
+                    "SELECT COALESCE(MIN(stream_ordering), 0) - 1 FROM events"
+                )
+                last = txn.fetchone()[0]
+
+            txn.execute(
+                """
+                SELECT stream_ordering, event_id FROM events
+                INNER JOIN state_events USING (event_id)
+                WHERE stream_ordering > ?
+                ORDER BY stream_ordering ASC
+                LIMIT ?
+                """,
+                (last, batch_size),
+            )
+            rows = txn.fetchall()
+            if not rows:
+                return 0
+
+            self._index_auth_chains_txn(txn, [event_id for _, event_id in rows])
+
+            self._background_update_progress_txn(
+                txn, self.EVENT_AUTH_CHAIN_CLOSURE,
+                {"last_stream_ordering": rows[-1][0]},
+            )
+
+            return len(rows)
+
+        result = yield self.runInteraction(
+            self.EVENT_AUTH_CHAIN_CLOSURE, index_auth_chains_txn,
+        )
+
+        if not result:
+            yield self._end_background_update(self.EVENT_AUTH_CHAIN_CLOSURE)
+
+        defer.returnValue(result)
@@ -886,6 +886,17 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             ],
         )
 
+        # Add the new state events to the auth chain index, so that their
+        # auth chains can be looked up without walking event_auth.
+        self._index_auth_chains_txn(
+            txn,
+            [
+                event.event_id
+                for event, _ in events_and_contexts
+                if event.is_state()
+            ],
+        )
+
         # _store_rejected_events_txn filters out any events which were
         # rejected, and returns the filtered list.
         events_and_contexts = self._store_rejected_events_txn(
@@ -903,6 +914,22 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             backfilled=backfilled,
         )
 
+        # Now that the room_memberships rows for the new events exist, we can
+        # apply the membership changes in the current state to the joined hosts
+        # index.
+        self._update_joined_host_counts_txn(
+            txn,
+            room_ids=[
+                room_id
+                for room_id, (to_delete, to_insert) in iteritems(state_delta_for_room)
+                if any(
+                    ev_type == EventTypes.Member
+                    for ev_type, _ in itertools.chain(to_delete, to_insert)
+                )
+            ],
+            stream_id=max_stream_order,
+        )
+
     def _update_current_state_txn(self, txn, state_delta_by_room, max_stream_order):
         for room_id, current_state_tuple in iteritems(state_delta_by_room):
             to_delete, to_insert = current_state_tuple
@@ -1183,6 +1210,7 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
         for table in (
                 "events",
                 "event_auth",
+                "event_auth_chain_closure",
                 "event_json",
                 "event_content_hashes",
                 "event_destinations",
@@ -2093,6 +2121,10 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
             ((sg,) for sg in state_groups_to_delete),
         )
 
+        if self._state_snapshot_cache is not None:
+            for sg in state_groups_to_delete:
+                txn.call_after(self._state_snapshot_cache.invalidate, sg)
+
         logger.info("[purge] removing events from event_to_state_groups")
         txn.execute(
             "DELETE FROM event_to_state_groups "
@@ -2103,6 +2135,11 @@ class EventsStore(StateGroupWorkerStore, EventFederationStore, EventsWorkerStore
                 event_id,
             ))
 
+            # the events are either deleted or turned into outliers, so drop
+            # them from the event caches. In particular the shared event cache
+            # would otherwise keep returning them, even across restarts.
+            txn.call_after(self._invalidate_get_event_cache, event_id)
+
         # Delete all remote non-state events
         for table in (
             "events",
@@ -15,9 +15,14 @@
 
 import itertools
 import logging
+import struct
+import time
 from collections import namedtuple
 
+from six import iteritems, itervalues
+
 from canonicaljson import json
+from prometheus_client import Counter, Histogram
 
 from twisted.internet import defer
 
@@ -29,32 +34,116 @@ from synapse.events.snapshot import EventContext  # noqa: F401
 from synapse.events.utils import prune_event
 from synapse.metrics.background_process_metrics import run_as_background_process
 from synapse.types import get_domain_from_id
+from synapse.util import batch_iter, unwrapFirstError
+from synapse.util.async_helpers import ObservableDeferred
 from synapse.util.logcontext import (
     LoggingContext,
     PreserveLoggingContext,
     make_deferred_yieldable,
-    run_in_background,
 )
 from synapse.util.metrics import Measure
 
-from ._base import SQLBaseStore
+from ._base import SQLBaseStore, make_in_list_sql_clause
 
 logger = logging.getLogger(__name__)
 
 
-# These values are used in the `enqueus_event` and `_do_fetch` methods to
+# This value is used in the `_enqueue_events` and `_do_fetch` methods to
 # control how we batch/bulk fetch events from the database.
-# The values are plucked out of thing air to make initial sync run faster
+# The value is plucked out of thing air to make initial sync run faster
 # on jki.re
-# TODO: Make these configurable.
+# TODO: Make this configurable.
 EVENT_QUEUE_THREADS = 3  # Max number of threads that will fetch events
-EVENT_QUEUE_ITERATIONS = 3  # No. times we block waiting for requests for events
-EVENT_QUEUE_TIMEOUT_S = 0.1  # Timeout when waiting for requests for events
+
+
+event_fetch_batch_size = Histogram(
+    "synapse_storage_event_fetch_batch_size",
+    "Number of events fetched from the database in each batch",
+    buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+)
+
+event_fetch_queue_wait_timer = Histogram(
+    "synapse_storage_event_fetch_queue_wait", "sec",
+)
+
+event_fetch_decode_timer = Histogram(
+    "synapse_storage_event_fetch_decode_time", "sec",
+)
+
+event_fetch_deduplicated_counter = Counter(
+    "synapse_storage_event_fetch_deduplicated",
+    "Number of requested events which were already being fetched",
+)
 
 
 _EventCacheEntry = namedtuple("_EventCacheEntry", ("event", "redacted_event"))
 
 
+# Entries in the shared event cache are the event's format version, the
+# lengths of its internal metadata and rejection reason, and then the internal
+# metadata, rejection reason and event json themselves.
+_SHARED_CACHE_HEADER = struct.Struct("!BII")
+
+
+def _serialize_shared_cache_row(row):
+    """Encode a row from _fetch_event_rows for the shared event cache
+
+    Args:
+        row (dict)
+
+    Returns:
+        bytes
+    """
+    internal_metadata = _to_bytes(row["internal_metadata"])
+    rejects = _to_bytes(row["rejects"] or "")
+    return b"".join((
+        _SHARED_CACHE_HEADER.pack(
+            row["format_version"] or 0, len(internal_metadata), len(rejects),
+        ),
+        internal_metadata,
+        rejects,
+        _to_bytes(row["json"]),
+    ))
+
+
+def _deserialize_shared_cache_row(event_id, value):
+    """Turn an entry from the shared event cache back into a row as returned by
+    _fetch_event_rows
+
+    Args:
+        event_id (str)
+        value (bytes)
+
+    Returns:
+        dict
+    """
+    format_version, metadata_len, rejects_len = _SHARED_CACHE_HEADER.unpack_from(
+        value,
+    )
+    offset = _SHARED_CACHE_HEADER.size
+    internal_metadata = value[offset:offset + metadata_len]
+    offset += metadata_len
+    rejects = value[offset:offset + rejects_len]
+    offset += rejects_len
+
+    return {
+        "event_id": event_id,
+        "internal_metadata": internal_metadata.decode("utf8"),
+        "json": value[offset:].decode("utf8"),
+        "format_version": format_version or None,
+        "redaction_id": None,
+        "rejects": rejects.decode("utf8") or None,
+    }
+
+
+def _to_bytes(value):
+    if isinstance(value, memoryview):
+        return value.tobytes()
+    if isinstance(value, bytes):
+        return value
+    return value.encode("utf8")
+
+
 class EventsWorkerStore(SQLBaseStore):
     def get_received_ts(self, event_id):
         """Get received_ts (when it was persisted) for the event.
@@ -162,7 +251,7 @@ class EventsWorkerStore(SQLBaseStore):
             log_ctx.record_event_fetch(len(missing_events_ids))
 
             # Note that _enqueue_events is also responsible for turning db rows
-            # into FrozenEvents (via _get_event_from_row), which involves seeing if
+            # into FrozenEvents (via _get_events_from_rows), which involves seeing if
             # the events have been redacted, and if so pulling the redaction event out
             # of the database to check it.
             #
@@ -203,7 +292,7 @@ class EventsWorkerStore(SQLBaseStore):
                     #  1. split _get_events up so that it is divided into (a) get the
                     #     rawish event from the db/cache, (b) do the redaction/rejection
                     #     filtering
-                    #  2. have _get_event_from_row just call the first half of that
+                    #  2. have _get_events_from_rows just call the first half of that
 
                     orig_sender = yield self._simple_select_one_onecol(
                         table="events",
@@ -248,6 +337,8 @@ class EventsWorkerStore(SQLBaseStore):
 
     def _invalidate_get_event_cache(self, event_id):
         self._get_event_cache.invalidate((event_id,))
+        if self._shared_event_cache is not None:
+            self._shared_event_cache.invalidate(event_id.encode("utf8"))
 
     def _get_events_from_cache(self, events, allow_rejected, update_metrics=True):
         """Fetch events from the caches
@@ -269,6 +360,8 @@ class EventsWorkerStore(SQLBaseStore):
                 (event_id,), None,
                 update_metrics=update_metrics,
             )
+            if not ret:
+                ret = self._get_event_from_shared_cache(event_id)
             if not ret:
                 continue
 
@@ -279,26 +372,49 @@ class EventsWorkerStore(SQLBaseStore):
 
         return event_map
 
+    def _get_event_from_shared_cache(self, event_id):
+        """Look for an event in the shared event cache, and if it is there add
+        it to our own event cache.
+
+        Args:
+            event_id (str)
+
+        Returns:
+            _EventCacheEntry|None
+        """
+        # some callers ask for `None`, which can't be in the cache.
+        if self._shared_event_cache is None or event_id is None:
+            return None
+
+        value = self._shared_event_cache.get(event_id.encode("utf8"))
+        if value is None:
+            return None
+
+        cache_entry = _EventCacheEntry(
+            event=self._event_from_row(
+                _deserialize_shared_cache_row(event_id, value),
+            ),
+            redacted_event=None,
+        )
+        self._get_event_cache.prefill((event_id,), cache_entry)
+        return cache_entry
+
     def _do_fetch(self, conn):
-        """Takes a database connection and waits for requests for events from
-        the _event_fetch_list queue.
+        """Takes a database connection and services requests for events from
+        the _event_fetch_list queue until it is empty.
+
+        Each iteration takes everything that has been queued since the last
+        one, so requests which arrive while we are busy with the database are
+        coalesced into a single batch.
         """
-        i = 0
         while True:
             with self._event_fetch_lock:
                 event_list = self._event_fetch_list
                 self._event_fetch_list = []
 
                 if not event_list:
-                    single_threaded = self.database_engine.single_threaded
-                    if single_threaded or i > EVENT_QUEUE_ITERATIONS:
-                        self._event_fetch_ongoing -= 1
-                        return
-                    else:
-                        self._event_fetch_lock.wait(EVENT_QUEUE_TIMEOUT_S)
-                        i += 1
-                        continue
-                i = 0
+                    self._event_fetch_ongoing -= 1
+                    return
 
             self._fetch_event_list(conn, event_list)
 
@@ -308,18 +424,27 @@ class EventsWorkerStore(SQLBaseStore):
         Args:
             conn (twisted.enterprise.adbapi.Connection): database connection
 
-            event_list (list[Tuple[list[str], Deferred]]):
+            event_list (list[Tuple[list[str], Deferred, float]]):
                 The fetch requests. Each entry consists of a list of event
-                ids to be fetched, and a deferred to be completed once the
-                events have been fetched.
+                ids to be fetched, a deferred to be completed once the
+                events have been fetched, and the time the request was queued.
 
         """
         with Measure(self._clock, "_fetch_event_list"):
             try:
-                event_id_lists = list(zip(*event_list))[0]
-                event_ids = [
-                    item for sublist in event_id_lists for item in sublist
-                ]
+                now = time.time()
+                event_ids = []
+                for ids, _, queued_at in event_list:
+                    event_fetch_queue_wait_timer.observe(now - queued_at)
+                    event_ids.extend(ids)
+
+                event_fetch_batch_size.observe(len(event_ids))
+
+                # take the versions of the shared cache entries before reading
+                # the rows, so that if an event is invalidated (eg, because it
+                # has been redacted) while we are doing so, we won't put the
+                # stale row in the shared cache.
+                shared_cache_versions = self._get_shared_cache_versions(event_ids)
 
                 rows = self._new_transaction(
                     conn, "do_fetch", [], [],
@@ -332,26 +457,18 @@ class EventsWorkerStore(SQLBaseStore):
                 }
 
                 # We only want to resolve deferreds from the main thread
-                def fire(lst, res):
-                    for ids, d in lst:
-                        if not d.called:
-                            try:
-                                with PreserveLoggingContext():
-                                    d.callback([
-                                        res[i]
-                                        for i in ids
-                                        if i in res
-                                    ])
-                            except Exception:
-                                logger.exception("Failed to callback")
                 with PreserveLoggingContext():
-                    self.hs.get_reactor().callFromThread(fire, event_list, row_dict)
+                    self.hs.get_reactor().callFromThread(
+                        self._on_event_rows_fetched, event_list, row_dict,
+                        shared_cache_versions,
+                    )
             except Exception as e:
                 logger.exception("do_fetch")
 
                 # We only want to resolve deferreds from the main thread
                 def fire(evs, exc):
-                    for _, d in evs:
+                    for ids, d, _ in evs:
+                        self._forget_event_fetch(ids)
                         if not d.called:
                             with PreserveLoggingContext():
                                 d.errback(exc)
@@ -359,23 +476,160 @@ class EventsWorkerStore(SQLBaseStore):
                 with PreserveLoggingContext():
                     self.hs.get_reactor().callFromThread(fire, event_list, e)
 
+    def _get_shared_cache_versions(self, event_ids):
+        """Get the versions of the shared event cache entries for some events,
+        to be passed to `_get_events_from_rows`.
+
+        Args:
+            event_ids (list[str])
+
+        Returns:
+            dict[str, int]|None: the versions, keyed by event id, or None if
+            there is no shared event cache.
+        """
+        if self._shared_event_cache is None:
+            return None
+
+        # some callers ask for `None`, which can't be in the cache.
+        return {
+            event_id: self._shared_event_cache.get_version(event_id.encode("utf8"))
+            for event_id in event_ids
+            if event_id is not None
+        }
+
+    def _on_event_rows_fetched(self, event_list, row_dict, shared_cache_versions):
+        """Called on the main thread once a batch of requests from the
+        _event_fetch_list queue has been fetched from the database.
+
+        Args:
+            event_list (list[Tuple[list[str], Deferred, float]]): the requests
+                in the batch
+            row_dict (dict[str, dict]): the rows fetched, keyed by event id
+            shared_cache_versions (dict[str, int]|None): the versions of the
+                shared event cache entries from before the rows were fetched
+        """
+        for ids, _, _ in event_list:
+            self._forget_event_fetch(ids)
+
+        run_as_background_process(
+            "decode_fetched_events",
+            self._decode_fetched_events,
+            event_list, row_dict, shared_cache_versions,
+        )
+
+    @defer.inlineCallbacks
+    def _decode_fetched_events(self, event_list, row_dict, shared_cache_versions):
+        """Turn a batch of fetched rows into events, and complete the requests
+        which were waiting for them.
+        """
+        try:
+            event_map = yield self._get_events_from_rows(
+                row_dict, shared_cache_versions,
+            )
+        except Exception as e:
+            logger.exception("Failed to decode fetched events")
+            for _, d, _ in event_list:
+                if not d.called:
+                    with PreserveLoggingContext():
+                        d.errback(e)
+            return
+
+        for ids, d, _ in event_list:
+            if not d.called:
+                try:
+                    with PreserveLoggingContext():
+                        d.callback({
+                            i: event_map[i]
+                            for i in ids
+                            if i in event_map
+                        })
+                except Exception:
+                    logger.exception("Failed to callback")
+
+    def _forget_event_fetch(self, event_ids):
+        for event_id in event_ids:
+            self._event_fetch_in_flight.pop(event_id, None)
+
     @defer.inlineCallbacks
     def _enqueue_events(self, events, allow_rejected=False):
         """Fetches events from the database using the _event_fetch_list. This
         allows batch and bulk fetching of events - it allows us to fetch events
         without having to create a new transaction for each request for events.
+
+        Events which are already being fetched for another caller are not
+        queued again: we wait for the existing fetch instead.
+
+        Args:
+            events (list[str]): the event ids to fetch
+            allow_rejected (bool): whether to include rejected events
+
+        Returns:
+            Deferred[dict[str, _EventCacheEntry]]: map from event id to cache
+            entry for each of the events we found.
         """
         if not events:
             defer.returnValue({})
 
+        fetches = set()
+        to_fetch = []
+        for event_id in events:
+            fetch = self._event_fetch_in_flight.get(event_id)
+            if fetch is None:
+                to_fetch.append(event_id)
+            else:
+                fetches.add(fetch)
+
+        if len(to_fetch) < len(events):
+            event_fetch_deduplicated_counter.inc(len(events) - len(to_fetch))
+
+        if to_fetch:
+            fetches.add(self._queue_event_fetch(to_fetch))
+
+        logger.debug("Loading %d events", len(events))
+        results = yield make_deferred_yieldable(defer.gatherResults(
+            [defer.maybeDeferred(fetch.observe) for fetch in fetches],
+            consumeErrors=True,
+        ).addErrback(unwrapFirstError))
+
+        event_map = {}
+        for entries in results:
+            event_map.update(entries)
+
+        res = {}
+        for event_id in events:
+            entry = event_map.get(event_id)
+            if not entry:
+                continue
+            if not allow_rejected and entry.event.rejected_reason:
+                continue
+            res[event_id] = entry
+
+        logger.debug("Loaded %d events (%d found)", len(events), len(res))
+
+        defer.returnValue(res)
+
+    def _queue_event_fetch(self, event_ids):
+        """Adds a request for the given events to the _event_fetch_list queue,
+        starting a new fetch thread if fewer than EVENT_QUEUE_THREADS are
+        running.
+
+        Args:
+            event_ids (list[str]): events to fetch. None of them should already
+                be in flight.
+
+        Returns:
+            ObservableDeferred[dict[str, _EventCacheEntry]]
+        """
         events_d = defer.Deferred()
+        fetch = ObservableDeferred(events_d, consumeErrors=True)
+        for event_id in event_ids:
+            self._event_fetch_in_flight[event_id] = fetch
+
         with self._event_fetch_lock:
             self._event_fetch_list.append(
-                (events, events_d)
+                (event_ids, events_d, time.time())
             )
 
-            self._event_fetch_lock.notify()
-
             if self._event_fetch_ongoing < EVENT_QUEUE_THREADS:
                 self._event_fetch_ongoing += 1
                 should_start = True
@@ -389,39 +643,35 @@ class EventsWorkerStore(SQLBaseStore):
                 self._do_fetch,
             )
 
-        logger.debug("Loading %d events", len(events))
-        with PreserveLoggingContext():
-            rows = yield events_d
-        logger.debug("Loaded %d events (%d rows)", len(events), len(rows))
-
-        if not allow_rejected:
-            rows[:] = [r for r in rows if not r["rejects"]]
-
-        res = yield make_deferred_yieldable(defer.gatherResults(
-            [
-                run_in_background(
-                    self._get_event_from_row,
-                    row["internal_metadata"], row["json"], row["redacts"],
-                    rejected_reason=row["rejects"],
-                    format_version=row["format_version"],
-                )
-                for row in rows
-            ],
-            consumeErrors=True
-        ))
+        return fetch
 
-        defer.returnValue({
-            e.event.event_id: e
-            for e in res if e
-        })
+    def _fetch_event_rows(self, txn, event_ids):
+        """Fetch event rows from the database
+
+        On postgres the whole batch is looked up with a single `= ANY(?)`
+        query; on sqlite we have to split it up to stay under the limit on
+        the number of bound parameters.
+
+        Args:
+            txn (LoggingTransaction)
+            event_ids (list[str]): event ids to fetch
+
+        Returns:
+            list[dict]: one row per event found, with keys `event_id`,
+            `internal_metadata`, `json`, `format_version`, `redaction_id`
+            (the id of a redaction of the event, if any) and `rejects` (the
+            reason the event was rejected, if it was).
+        """
+        if self.database_engine.supports_using_any_list:
+            chunks = [event_ids]
+        else:
+            chunks = batch_iter(event_ids, 200)
 
-    def _fetch_event_rows(self, txn, events):
         rows = []
-        N = 200
-        for i in range(1 + len(events) // N):
-            evs = events[i * N:(i + 1) * N]
-            if not evs:
-                break
+        for chunk in chunks:
+            clause, args = make_in_list_sql_clause(
+                self.database_engine, "e.event_id", chunk,
+            )
 
             sql = (
                 "SELECT "
@@ -429,91 +679,141 @@ class EventsWorkerStore(SQLBaseStore):
                 " e.internal_metadata,"
                 " e.json,"
                 " e.format_version, "
-                " r.redacts as redacts,"
-                " rej.event_id as rejects "
+                " r.event_id as redaction_id,"
+                " rej.reason as rejects "
                 " FROM event_json as e"
                 " LEFT JOIN rejections as rej USING (event_id)"
                 " LEFT JOIN redactions as r ON e.event_id = r.redacts"
-                " WHERE e.event_id IN (%s)"
-            ) % (",".join(["?"] * len(evs)),)
+                " WHERE " + clause
+            )
 
-            txn.execute(sql, evs)
+            txn.execute(sql, args)
             rows.extend(self.cursor_to_dict(txn))
 
         return rows
 
+    def _event_from_row(self, row):
+        """Build an event from a row returned by _fetch_event_rows
+
+        Args:
+            row (dict)
+
+        Returns:
+            FrozenEvent
+        """
+        d = json.loads(row["json"])
+        internal_metadata = json.loads(row["internal_metadata"])
+
+        format_version = row["format_version"]
+        if format_version is None:
+            # This means that we stored the event before we had the concept
+            # of a event format version, so it must be a V1 event.
+            format_version = EventFormatVersions.V1
+
+        return event_type_from_format_version(
+            format_version, compact=self.hs.config.compact_event_cache,
+        )(
+            event_dict=d,
+            internal_metadata_dict=internal_metadata,
+            rejected_reason=row["rejects"],
+        )
+
     @defer.inlineCallbacks
-    def _get_event_from_row(self, internal_metadata, js, redacted,
-                            format_version, rejected_reason=None):
-        with Measure(self._clock, "_get_event_from_row"):
-            d = json.loads(js)
-            internal_metadata = json.loads(internal_metadata)
-
-            if rejected_reason:
-                rejected_reason = yield self._simple_select_one_onecol(
-                    table="rejections",
-                    keyvalues={"event_id": rejected_reason},
-                    retcol="reason",
-                    desc="_get_event_from_row_rejected_reason",
-                )
+    def _get_events_from_rows(self, rows, shared_cache_versions=None):
+        """Build events from a batch of rows returned by _fetch_event_rows,
+        and add them to the event cache.
 
-            if format_version is None:
-                # This means that we stored the event before we had the concept
-                # of a event format version, so it must be a V1 event.
-                format_version = EventFormatVersions.V1
+        All the rows are decoded in one go; the redaction events needed to
+        build redacted events are then fetched with a single `get_events`
+        call, unless they are part of the same batch.
 
-            original_ev = event_type_from_format_version(format_version)(
-                event_dict=d,
-                internal_metadata_dict=internal_metadata,
-                rejected_reason=rejected_reason,
-            )
+        Events which haven't been redacted are also added to the shared event
+        cache, if there is one.
 
-            redacted_event = None
-            if redacted:
-                redacted_event = prune_event(original_ev)
+        Args:
+            rows (dict[str, dict]): the rows, keyed by event id
+            shared_cache_versions (dict[str, int]|None): the versions of the
+                shared event cache entries from before the rows were fetched,
+                as returned by `_get_shared_cache_versions`. Rows are only
+                added to the shared cache if this is given.
 
-                redaction_id = yield self._simple_select_one_onecol(
-                    table="redactions",
-                    keyvalues={"redacts": redacted_event.event_id},
-                    retcol="event_id",
-                    desc="_get_event_from_row_redactions",
-                )
+        Returns:
+            Deferred[dict[str, _EventCacheEntry]]: the cache entries, keyed
+            by event id
+        """
+        with Measure(self._clock, "_get_events_from_rows"):
+            start = time.time()
+
+            original_events = {}
+            redaction_ids = {}
+            for event_id, row in iteritems(rows):
+                original_events[event_id] = self._event_from_row(row)
+
+                if row["redaction_id"]:
+                    redaction_ids[event_id] = row["redaction_id"]
+                elif shared_cache_versions is not None:
+                    self._shared_event_cache.set(
+                        event_id.encode("utf8"), _serialize_shared_cache_row(row),
+                        version=shared_cache_versions.get(event_id),
+                    )
 
-                redacted_event.unsigned["redacted_by"] = redaction_id
-                # Get the redaction event.
+            event_fetch_decode_timer.observe(time.time() - start)
 
-                because = yield self.get_event(
-                    redaction_id,
+            # Get the redaction events which aren't part of this batch.
+            missing_redaction_ids = set(
+                redaction_id for redaction_id in itervalues(redaction_ids)
+                if redaction_id not in original_events
+            )
+            redaction_events = {}
+            if missing_redaction_ids:
+                redaction_events = yield self.get_events(
+                    missing_redaction_ids,
                     check_redacted=False,
-                    allow_none=True,
                 )
 
-                if because:
-                    # It's fine to do add the event directly, since get_pdu_json
-                    # will serialise this field correctly
-                    redacted_event.unsigned["redacted_because"] = because
-
-                    # Starting in room version v3, some redactions need to be
-                    # rechecked if we didn't have the redacted event at the
-                    # time, so we recheck on read instead.
-                    if because.internal_metadata.need_to_check_redaction():
-                        expected_domain = get_domain_from_id(original_ev.sender)
-                        if get_domain_from_id(because.sender) == expected_domain:
-                            # This redaction event is allowed. Mark as not needing a
-                            # recheck.
-                            because.internal_metadata.recheck_redaction = False
-                        else:
-                            # Senders don't match, so the event isn't actually redacted
-                            redacted_event = None
-
-            cache_entry = _EventCacheEntry(
-                event=original_ev,
-                redacted_event=redacted_event,
-            )
+            result = {}
+            for event_id, original_ev in iteritems(original_events):
+                redacted_event = None
+
+                redaction_id = redaction_ids.get(event_id)
+                if redaction_id:
+                    redacted_event = prune_event(original_ev)
+                    redacted_event.unsigned["redacted_by"] = redaction_id
+
+                    because = original_events.get(redaction_id)
+                    if because is not None and because.rejected_reason:
+                        because = None
+                    if because is None:
+                        because = redaction_events.get(redaction_id)
+
+                    if because:
+                        # It's fine to do add the event directly, since
+                        # get_pdu_json will serialise this field correctly
+                        redacted_event.unsigned["redacted_because"] = because
+
+                        # Starting in room version v3, some redactions need to
+                        # be rechecked if we didn't have the redacted event at
+                        # the time, so we recheck on read instead.
+                        if because.internal_metadata.need_to_check_redaction():
+                            expected_domain = get_domain_from_id(original_ev.sender)
+                            if get_domain_from_id(because.sender) == expected_domain:
+                                # This redaction event is allowed. Mark as not
+                                # needing a recheck.
+                                because.internal_metadata.recheck_redaction = False
+                            else:
+                                # Senders don't match, so the event isn't
+                                # actually redacted
+                                redacted_event = None
+
+                cache_entry = _EventCacheEntry(
+                    event=original_ev,
+                    redacted_event=redacted_event,
+                )
 
-            self._get_event_cache.prefill((original_ev.event_id,), cache_entry)
+                self._get_event_cache.prefill((event_id,), cache_entry)
+                result[event_id] = cache_entry
 
-        defer.returnValue(cache_entry)
+        defer.returnValue(result)
 
     @defer.inlineCallbacks
     def have_events_in_timeline(self, event_ids):
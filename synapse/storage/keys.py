@@ -225,3 +225,34 @@ class KeyStore(SQLBaseStore):
         return self.runInteraction(
             "get_server_keys_json", _get_server_keys_json_txn
         )
+
+    def get_valid_server_keys_json(self, valid_after_ms):
+        """Retrieve the key json for all the keys which are valid for longer
+        than a given time. Used to warm the Keyring's cache at startup.
+
+        Args:
+            valid_after_ms (int): only return keys which are valid after this
+                time.
+
+        Returns:
+            Deferred[list[dict]]: a dict for each server_name, key_id pair, with
+                "server_name", "key_id", "ts_valid_until_ms" and "key_json"
+                keys. Where we have the key json from several servers, the one
+                which is valid for the longest is returned.
+        """
+        def _get_valid_server_keys_json_txn(txn):
+            sql = """
+                SELECT server_name, key_id, ts_valid_until_ms, key_json
+                FROM server_keys_json
+                WHERE ts_valid_until_ms > ?
+                ORDER BY ts_valid_until_ms ASC
+            """
+            txn.execute(sql, (valid_after_ms,))
+
+            results = {}
+            for row in self.cursor_to_dict(txn):
+                results[(row["server_name"], row["key_id"])] = row
+            return list(results.values())
+        return self.runInteraction(
+            "get_valid_server_keys_json", _get_valid_server_keys_json_txn
+        )
@@ -15,7 +15,7 @@
 # limitations under the License.
 
 import logging
-from collections import namedtuple
+from collections import Counter, namedtuple
 
 from six import iteritems, itervalues
 
@@ -59,9 +59,14 @@ MemberSummary = namedtuple(
 )
 
 _MEMBERSHIP_PROFILE_UPDATE_NAME = "room_membership_profile_update"
+_JOINED_HOST_COUNTS_POPULATE_NAME = "room_joined_host_counts_populate"
 
 
 class RoomMemberWorkerStore(EventsWorkerStore):
+    # Whether the background update which fills in room_joined_host_counts for
+    # existing rooms has finished.
+    _joined_host_counts_populated = False
+
     @cachedInlineCallbacks(max_entries=100000, iterable=True, cache_context=True)
     def get_hosts_in_room(self, room_id, cache_context):
         """Returns the set of all hosts currently in the room
@@ -88,6 +93,94 @@ class RoomMemberWorkerStore(EventsWorkerStore):
             return [to_ascii(r[0]) for r in txn]
         return self.runInteraction("get_users_in_room", f)
 
+    @cached(max_entries=100000, iterable=True)
+    def get_joined_host_counts(self, room_id):
+        """Get the number of users each server has joined to a room, according
+        to the room's current state.
+
+        This is read from an index which is updated as the current state
+        changes, so is much cheaper for large rooms than counting up the members.
+
+        Args:
+            room_id (str)
+
+        Returns:
+            Deferred[dict[str, int]]: map from server name to the number of its
+                users that are joined to the room.
+        """
+        return self.runInteraction(
+            "get_joined_host_counts", self._get_joined_host_counts_txn, room_id,
+        )
+
+    def get_joined_host_counts_before(self, room_id, stream_ordering):
+        """Get the number of users each server had joined to a room just before
+        the given event, if the room's current state hasn't changed since.
+
+        Unlike get_joined_host_counts, this always reads from the database, and
+        checks the current state and reads the index together, so the counts
+        can't include a later change to the state.
+
+        Args:
+            room_id (str)
+            stream_ordering (int): the stream ordering of the event
+
+        Returns:
+            Deferred[dict[str, int]|None]: map from server name to the number of
+                its users that were joined to the room, or None if the current
+                state has changed since (or with) the event.
+        """
+        def f(txn):
+            txn.execute(
+                "SELECT 1 FROM current_state_delta_stream"
+                " WHERE room_id = ? AND stream_id >= ?"
+                " LIMIT 1",
+                (room_id, stream_ordering),
+            )
+            if txn.fetchone():
+                return None
+            return self._get_joined_host_counts_txn(txn, room_id)
+        return self.runInteraction("get_joined_host_counts_before", f)
+
+    def _get_joined_host_counts_txn(self, txn, room_id):
+        if not self._joined_host_counts_populated:
+            txn.execute(
+                "SELECT 1 FROM background_updates WHERE update_name = ?",
+                (_JOINED_HOST_COUNTS_POPULATE_NAME,),
+            )
+            if txn.fetchone():
+                # The index may not cover this room yet, so count the
+                # members up instead.
+                return self._count_joined_hosts_txn(txn, room_id)
+            self._joined_host_counts_populated = True
+
+        txn.execute(
+            "SELECT host, member_count FROM room_joined_host_counts"
+            " WHERE room_id = ?",
+            (room_id,),
+        )
+        return {to_ascii(host): count for host, count in txn}
+
+    def _count_joined_hosts_txn(self, txn, room_id):
+        """Counts the joined members of each server in a room's current state.
+
+        Args:
+            txn
+            room_id (str)
+
+        Returns:
+            dict[str, int]: map from server name to number of joined users
+        """
+        sql = (
+            "SELECT m.user_id FROM room_memberships as m"
+            " INNER JOIN current_state_events as c"
+            " ON m.event_id = c.event_id "
+            " AND m.room_id = c.room_id "
+            " AND m.user_id = c.state_key"
+            " WHERE c.type = 'm.room.member' AND c.room_id = ? AND m.membership = ?"
+        )
+        txn.execute(sql, (room_id, Membership.JOIN,))
+        return dict(Counter(to_ascii(get_domain_from_id(r[0])) for r in txn))
+
     @cached(max_entries=100000)
     def get_room_summary(self, room_id):
         """ Get the details of a room roughly suitable for use by the room
@@ -251,7 +344,9 @@ class RoomMemberWorkerStore(EventsWorkerStore):
 
         return results
 
-    @cachedInlineCallbacks(max_entries=500000, iterable=True)
+    @cachedInlineCallbacks(
+        max_entries=500000, iterable=True, idle_expiry_ms=30 * 60 * 1000,
+    )
     def get_rooms_for_user_with_stream_ordering(self, user_id):
         """Returns a set of room_ids the user is currently joined to
 
@@ -280,7 +375,10 @@ class RoomMemberWorkerStore(EventsWorkerStore):
         )
         defer.returnValue(frozenset(r.room_id for r in rooms))
 
-    @cachedInlineCallbacks(max_entries=500000, cache_context=True, iterable=True)
+    @cachedInlineCallbacks(
+        max_entries=500000, cache_context=True, iterable=True,
+        idle_expiry_ms=30 * 60 * 1000,
+    )
     def get_users_who_share_room_with_user(self, user_id, cache_context):
         """Returns the set of users who share a room with `user_id`
         """
@@ -557,6 +655,10 @@ class RoomMemberStore(RoomMemberWorkerStore):
         self.register_background_update_handler(
             _MEMBERSHIP_PROFILE_UPDATE_NAME, self._background_add_membership_profile
         )
+        self.register_background_update_handler(
+            _JOINED_HOST_COUNTS_POPULATE_NAME,
+            self._background_populate_joined_host_counts,
+        )
 
     def _store_room_members_txn(self, txn, events, backfilled):
         """Store a room member in the database.
@@ -623,6 +725,93 @@ class RoomMemberStore(RoomMemberWorkerStore):
                         event.state_key,
                     ))
 
+    def _update_joined_host_counts_txn(self, txn, room_ids, stream_id):
+        """Applies the membership changes in the current state deltas which were
+        just written to the room_joined_host_counts index.
+
+        Must be called after the room_memberships rows for the new events have
+        been inserted.
+
+        Args:
+            txn
+            room_ids (iterable[str]): the rooms whose membership has changed
+            stream_id (int): the stream ID of the current state deltas
+        """
+        sql = """
+            SELECT d.state_key, prev.membership, new.membership
+            FROM current_state_delta_stream AS d
+            LEFT JOIN room_memberships AS prev ON prev.event_id = d.prev_event_id
+            LEFT JOIN room_memberships AS new ON new.event_id = d.event_id
+            WHERE d.stream_id = ? AND d.room_id = ? AND d.type = ?
+        """
+
+        for room_id in room_ids:
+            txn.execute(sql, (stream_id, room_id, EventTypes.Member))
+
+            changes = Counter()
+            for state_key, prev_membership, membership in txn:
+                was_joined = prev_membership == Membership.JOIN
+                is_joined = membership == Membership.JOIN
+                if was_joined != is_joined:
+                    changes[get_domain_from_id(state_key)] += 1 if is_joined else -1
+
+            removed_any = False
+            for host, change in iteritems(changes):
+                if not change:
+                    continue
+
+                if change < 0:
+                    removed_any = True
+
+                self._add_to_joined_host_count_txn(txn, room_id, host, change)
+
+            if removed_any:
+                txn.execute(
+                    "DELETE FROM room_joined_host_counts"
+                    " WHERE room_id = ? AND member_count <= 0",
+                    (room_id,),
+                )
+
+    def _add_to_joined_host_count_txn(self, txn, room_id, host, change):
+        """Adds `change` to the member count of the host in the room, inserting
+        a row for it if there isn't one already.
+
+        This can race with other updates to the same room and host, including
+        the background update which populates the table, so has to be done as
+        an upsert.
+        """
+        if self.database_engine.can_native_upsert:
+            txn.execute(
+                "INSERT INTO room_joined_host_counts (room_id, host, member_count)"
+                " VALUES (?, ?, ?)"
+                " ON CONFLICT (room_id, host) DO UPDATE"
+                " SET member_count ="
+                " room_joined_host_counts.member_count + EXCLUDED.member_count",
+                (room_id, host, change),
+            )
+            return
+
+        # As in _simple_upsert_txn_emulated, we have to lock the table to stop
+        # anyone else inserting the row between our UPDATE and INSERT.
+        self.database_engine.lock_table(txn, "room_joined_host_counts")
+
+        txn.execute(
+            "UPDATE room_joined_host_counts"
+            " SET member_count = member_count + ?"
+            " WHERE room_id = ? AND host = ?",
+            (change, room_id, host),
+        )
+        if txn.rowcount == 0:
+            self._simple_insert_txn(
+                txn,
+                table="room_joined_host_counts",
+                values={
+                    "room_id": room_id,
+                    "host": host,
+                    "member_count": change,
+                },
+            )
+
     @defer.inlineCallbacks
     def locally_reject_invite(self, user_id, room_id):
         sql = (
@@ -739,6 +928,65 @@ class RoomMemberStore(RoomMemberWorkerStore):
 
         defer.returnValue(result)
 
+    @defer.inlineCallbacks
+    def _background_populate_joined_host_counts(self, progress, batch_size):
+        """Fills in room_joined_host_counts for the rooms which existed before it
+        was added.
+        """
+        last_room_id = progress.get("last_room_id", "")
+
+        def populate_joined_host_counts_txn(txn):
+            # Lock out the updates to the table made as events are persisted
+            # (see _add_to_joined_host_count_txn) while we rebuild the rows for
+            # this batch of rooms, so that they neither collide with the rows
+            # we insert nor get lost by us deleting the rows they wrote after
+            # our snapshot of the memberships was taken. This must come before
+            # any other statement, as that is what takes the snapshot.
+            self.database_engine.lock_table(txn, "room_joined_host_counts")
+
+            txn.execute(
+                "SELECT room_id FROM rooms WHERE room_id > ?"
+                " ORDER BY room_id ASC LIMIT ?",
+                (last_room_id, batch_size),
+            )
+            room_ids = [r[0] for r in txn]
+
+            for room_id in room_ids:
+                counts = self._count_joined_hosts_txn(txn, room_id)
+
+                # Any rows we have already are from updates to the current state
+                # since the table was added, which only record the changes.
+                self._simple_delete_txn(
+                    txn,
+                    table="room_joined_host_counts",
+                    keyvalues={"room_id": room_id},
+                )
+                self._simple_insert_many_txn(
+                    txn,
+                    table="room_joined_host_counts",
+                    values=[
+                        {"room_id": room_id, "host": host, "member_count": count}
+                        for host, count in iteritems(counts)
+                    ],
+                )
+
+            if room_ids:
+                self._background_update_progress_txn(
+                    txn, _JOINED_HOST_COUNTS_POPULATE_NAME,
+                    {"last_room_id": room_ids[-1]},
+                )
+
+            return len(room_ids)
+
+        result = yield self.runInteraction(
+            _JOINED_HOST_COUNTS_POPULATE_NAME, populate_joined_host_counts_txn,
+        )
+
+        if not result:
+            yield self._end_background_update(_JOINED_HOST_COUNTS_POPULATE_NAME)
+
+        defer.returnValue(result)
+
 
 class _JoinedHostsCache(object):
     """Cache for joined hosts in a room that is optimised to handle updates
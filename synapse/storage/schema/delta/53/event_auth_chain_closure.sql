@@ -0,0 +1,29 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The transitive closure of event_auth: for each state event which has been
+-- indexed there is a row for every event in its auth chain, plus a row with
+-- auth_id = event_id to mark the event as indexed.
+CREATE TABLE event_auth_chain_closure (
+    event_id TEXT NOT NULL,
+    auth_id TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX event_auth_chain_closure_id ON event_auth_chain_closure(
+    event_id, auth_id
+);
+
+INSERT INTO background_updates (update_name, progress_json) VALUES
+    ('event_auth_chain_closure', '{}');
@@ -0,0 +1,31 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- State events which couldn't be added to event_auth_chain_closure because
+-- some of their auth chain is missing (eg, an auth event we haven't received
+-- yet). They are indexed once the missing events are.
+CREATE TABLE event_auth_chain_unindexed (
+    event_id TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX event_auth_chain_unindexed_id ON event_auth_chain_unindexed(
+    event_id
+);
+
+-- Run the index's background update again, to pick up any events which were
+-- skipped before they could be recorded here.
+DELETE FROM background_updates WHERE update_name = 'event_auth_chain_closure';
+INSERT INTO background_updates (update_name, progress_json) VALUES
+    ('event_auth_chain_closure', '{}');
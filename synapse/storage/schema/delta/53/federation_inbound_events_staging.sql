@@ -0,0 +1,32 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- PDUs we've received over federation and acknowledged, but not yet
+-- processed. See FederationServer._handle_incoming_transaction.
+CREATE TABLE federation_inbound_events_staging (
+    origin TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    depth BIGINT NOT NULL,
+    received_ts BIGINT NOT NULL,
+    priority SMALLINT NOT NULL,
+    event_json TEXT NOT NULL
+);
+
+CREATE UNIQUE INDEX federation_inbound_events_staging_origin_event_id
+    ON federation_inbound_events_staging(origin, event_id);
+
+CREATE INDEX federation_inbound_events_staging_room_id
+    ON federation_inbound_events_staging(room_id, received_ts);
@@ -0,0 +1,23 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The process which received each staged PDU. Only that process processes it,
+-- so that federation readers don't all pick up each other's PDUs on startup.
+ALTER TABLE federation_inbound_events_staging ADD COLUMN instance_name TEXT NOT NULL DEFAULT 'master';
+
+DROP INDEX federation_inbound_events_staging_room_id;
+
+CREATE INDEX federation_inbound_events_staging_instance_room_id
+    ON federation_inbound_events_staging(instance_name, room_id, received_ts);
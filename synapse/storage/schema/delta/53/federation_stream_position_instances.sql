@@ -0,0 +1,26 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The federation_sender_instances the rows in federation_stream_position were
+-- written for, as a JSON list. When the configured list changes, the positions
+-- are reset to that of the furthest behind of the old instances.
+CREATE TABLE federation_stream_position_instances (
+    Lock CHAR(1) NOT NULL DEFAULT 'X' UNIQUE,  -- Makes sure this table only has one row.
+    instances TEXT NOT NULL,
+    CHECK (Lock='X')
+);
+
+-- Until now, sending has not been sharded.
+INSERT INTO federation_stream_position_instances (instances) VALUES ('[]');
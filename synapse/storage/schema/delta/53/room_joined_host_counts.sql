@@ -0,0 +1,31 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The number of members each server has joined to each room, according to the
+-- room's current state. This is kept up to date as the current state changes,
+-- so that we don't have to count up the members of a room to find out which
+-- servers are in it.
+CREATE TABLE room_joined_host_counts (
+    room_id TEXT NOT NULL,
+    host TEXT NOT NULL,
+    member_count BIGINT NOT NULL
+);
+
+CREATE UNIQUE INDEX room_joined_host_counts_room_id_host
+    ON room_joined_host_counts(room_id, host);
+
+-- Fill in the counts for existing rooms
+INSERT INTO background_updates (update_name, progress_json) VALUES
+    ('room_joined_host_counts_populate', '{}');
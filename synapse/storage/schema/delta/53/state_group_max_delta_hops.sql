@@ -0,0 +1,27 @@
+/* Copyright 2019 New Vector Ltd
+ *
+ * Licensed under the Apache License, Version 2.0 (the "License");
+ * you may not use this file except in compliance with the License.
+ * You may obtain a copy of the License at
+ *
+ *    http://www.apache.org/licenses/LICENSE-2.0
+ *
+ * Unless required by applicable law or agreed to in writing, software
+ * distributed under the License is distributed on an "AS IS" BASIS,
+ * WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+ * See the License for the specific language governing permissions and
+ * limitations under the License.
+ */
+
+-- The longest chain of state group deltas which may be in the database. If
+-- max_state_delta_hops is configured to be lower than this, the
+-- state_group_chain_compaction background update is scheduled to shorten the
+-- existing chains.
+CREATE TABLE state_group_max_delta_hops (
+    Lock CHAR(1) NOT NULL DEFAULT 'X' UNIQUE,  -- Makes sure this table only has one row.
+    max_hops INTEGER NOT NULL,
+    CHECK (Lock='X')
+);
+
+-- Until now, chains have been limited to 100 hops.
+INSERT INTO state_group_max_delta_hops (max_hops) VALUES (100);
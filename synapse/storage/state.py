@@ -32,14 +32,16 @@ from synapse.storage.events_worker import EventsWorkerStore
 from synapse.util.caches import get_cache_factor_for, intern_string
 from synapse.util.caches.descriptors import cached, cachedList
 from synapse.util.caches.dictionary_cache import DictionaryCache
+from synapse.util.caches.state_snapshot_cache import (
+    StateSnapshot,
+    StateSnapshotCache,
+    encode_state_snapshot,
+)
 from synapse.util.stringutils import to_ascii
 
 logger = logging.getLogger(__name__)
 
 
-MAX_STATE_DELTA_HOPS = 100
-
-
 class _GetStateGroupDelta(namedtuple("_GetStateGroupDelta", ("prev_group", "delta_ids"))):
     """Return type of get_state_group_delta that implements __len__, which lets
     us use the itrable flag when caching
@@ -374,6 +376,9 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
     def __init__(self, db_conn, hs):
         super(StateGroupWorkerStore, self).__init__(db_conn, hs)
 
+        # The longest a chain of state group deltas is allowed to get
+        self._max_state_delta_hops = hs.config.max_state_delta_hops
+
         # Originally the state store used a single DictionaryCache to cache the
         # event IDs for the state types in a given state group to avoid hammering
         # on the state_group* tables.
@@ -413,6 +418,21 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
             500000 * get_cache_factor_for("stateGroupMembersCache")
         )
 
+        self._state_snapshot_cache = None
+        if hs.config.state_snapshot_cache_path:
+            txn = db_conn.cursor()
+            txn.execute("SELECT COALESCE(MAX(id), 0) FROM state_groups")
+            max_state_group, = txn.fetchone()
+            txn.close()
+
+            self._state_snapshot_cache = StateSnapshotCache(
+                "*stateGroupSnapshots*",
+                hs.config.state_snapshot_cache_path,
+                hs.config.state_snapshot_cache_size,
+                server_name=hs.hostname,
+                max_state_group=max_state_group,
+            )
+
     @defer.inlineCallbacks
     def get_room_version(self, room_id):
         """Get the room_version of a given room
@@ -756,11 +776,36 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
                     typ, state_key, event_id = row
                     key = (typ, state_key)
                     results[group][key] = event_id
+        elif self.database_engine.supports_recursive_cte:
+            # SQLite doesn't have window functions until 3.25, so we fetch the
+            # matching rows from every group in the tree, most recent first,
+            # and keep the first event we see for each (type, state_key).
+            sql = """
+                WITH RECURSIVE state(state_group) AS (
+                    VALUES(?)
+                    UNION ALL
+                    SELECT prev_state_group FROM state_group_edges e, state s
+                    WHERE s.state_group = e.state_group
+                )
+                SELECT type, state_key, event_id FROM state_groups_state
+                WHERE state_group IN (
+                    SELECT state_group FROM state
+                )
+            """
+
+            for group in groups:
+                args = [group]
+                args.extend(where_args)
+
+                txn.execute(
+                    sql + where_clause + " ORDER BY state_group DESC", args,
+                )
+                for typ, state_key, event_id in txn:
+                    results[group].setdefault((typ, state_key), event_id)
         else:
             max_entries_returned = state_filter.max_entries_returned()
 
-            # We don't use WITH RECURSIVE on sqlite3 as there are distributions
-            # that ship with an sqlite3 version that doesn't support it (e.g. wheezy)
+            # This sqlite3 is too old to support WITH RECURSIVE (e.g. wheezy)
             for group in groups:
                 next_group = group
 
@@ -902,7 +947,7 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
         state_map = yield self.get_state_ids_for_events([event_id], state_filter)
         defer.returnValue(state_map[event_id])
 
-    @cached(max_entries=50000)
+    @cached(max_entries=50000, idle_expiry_ms=30 * 60 * 1000)
     def _get_state_group_for_event(self, event_id):
         return self._simple_select_one_onecol(
             table="event_to_state_groups",
@@ -1018,11 +1063,24 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
         # Help the cache hit ratio by expanding the filter a bit
         db_state_filter = state_filter.return_expanded()
 
-        group_to_state_dict = yield self._get_state_groups_from_groups(
-            list(incomplete_groups),
-            state_filter=db_state_filter,
+        group_to_state_dict = self._get_state_for_groups_from_snapshots(
+            incomplete_groups, db_state_filter,
         )
 
+        missing_groups = incomplete_groups - set(group_to_state_dict)
+        if missing_groups:
+            db_group_to_state_dict = yield self._get_state_groups_from_groups(
+                list(missing_groups),
+                state_filter=db_state_filter,
+            )
+            group_to_state_dict.update(db_group_to_state_dict)
+
+            if self._state_snapshot_cache is not None and db_state_filter.is_full():
+                for group, group_state_dict in iteritems(db_group_to_state_dict):
+                    self._state_snapshot_cache.set(
+                        group, encode_state_snapshot(group_state_dict),
+                    )
+
         # Now lets update the caches
         self._insert_into_cache(
             group_to_state_dict,
@@ -1040,6 +1098,32 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         defer.returnValue(state)
 
+    def _get_state_for_groups_from_snapshots(self, groups, state_filter):
+        """Gets the state at each of a list of state groups from the state
+        snapshot cache, if it is enabled.
+
+        Args:
+            groups (iterable[int]): list of state groups for which we want
+                to get the state.
+            state_filter (StateFilter): The state filter used to fetch state
+                from the database.
+
+        Returns:
+            dict[int, dict[tuple[str, str], str]]: state_group_id ->
+            (dict of (type, state_key) -> event id) for the groups which were
+            in the cache.
+        """
+        results = {}
+        if self._state_snapshot_cache is None:
+            return results
+
+        for group in groups:
+            payload = self._state_snapshot_cache.get(group)
+            if payload is not None:
+                results[group] = StateSnapshot(payload).filter_state(state_filter)
+
+        return results
+
     def _get_state_for_groups_using_cache(
         self, groups, cache, state_filter,
     ):
@@ -1185,7 +1269,7 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
                 potential_hops = self._count_state_group_hops_txn(
                     txn, prev_group
                 )
-            if prev_group and potential_hops < MAX_STATE_DELTA_HOPS:
+            if prev_group and potential_hops < self._max_state_delta_hops:
                 self._simple_insert_txn(
                     txn,
                     table="state_group_edges",
@@ -1254,6 +1338,13 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
                 value=dict(current_non_member_state_ids),
             )
 
+            if self._state_snapshot_cache is not None:
+                txn.call_after(
+                    self._state_snapshot_cache.set,
+                    state_group,
+                    encode_state_snapshot(current_state_ids),
+                )
+
             return state_group
 
         return self.runInteraction("store_state_group", _store_state_group_txn)
@@ -1280,9 +1371,23 @@ class StateGroupWorkerStore(EventsWorkerStore, SQLBaseStore):
                 return row[0]
             else:
                 return 0
+        elif self.database_engine.supports_recursive_cte:
+            # Unlike the postgres query, this doesn't count the group itself,
+            # to match the loop below.
+            sql = ("""
+                WITH RECURSIVE state(state_group) AS (
+                    VALUES(?)
+                    UNION ALL
+                    SELECT prev_state_group FROM state_group_edges e, state s
+                    WHERE s.state_group = e.state_group
+                )
+                SELECT count(*) - 1 FROM state;
+            """)
+
+            txn.execute(sql, (state_group,))
+            return txn.fetchone()[0]
         else:
-            # We don't use WITH RECURSIVE on sqlite3 as there are distributions
-            # that ship with an sqlite3 version that doesn't support it (e.g. wheezy)
+            # This sqlite3 is too old to support WITH RECURSIVE (e.g. wheezy)
             next_group = state_group
             count = 0
 
@@ -1323,6 +1428,7 @@ class StateStore(StateGroupWorkerStore, BackgroundUpdateStore):
     STATE_GROUP_INDEX_UPDATE_NAME = "state_group_state_type_index"
     CURRENT_STATE_INDEX_UPDATE_NAME = "current_state_members_idx"
     EVENT_STATE_GROUP_INDEX_UPDATE_NAME = "event_to_state_groups_sg_index"
+    STATE_GROUP_CHAIN_COMPACTION_UPDATE_NAME = "state_group_chain_compaction"
 
     def __init__(self, db_conn, hs):
         super(StateStore, self).__init__(db_conn, hs)
@@ -1347,6 +1453,45 @@ class StateStore(StateGroupWorkerStore, BackgroundUpdateStore):
             table="event_to_state_groups",
             columns=["state_group"],
         )
+        self.register_background_update_handler(
+            self.STATE_GROUP_CHAIN_COMPACTION_UPDATE_NAME,
+            self._background_compact_state_group_chains,
+        )
+
+        self._schedule_state_group_chain_compaction(db_conn)
+
+    def _schedule_state_group_chain_compaction(self, db_conn):
+        """Check whether the state group delta chains in the database may be
+        longer than we now allow, and if so schedule a background update to
+        shorten them.
+        """
+        txn = db_conn.cursor()
+
+        txn.execute("SELECT max_hops FROM state_group_max_delta_hops")
+        stored_max_hops, = txn.fetchone()
+
+        if self._max_state_delta_hops >= stored_max_hops:
+            # New state groups are now limited to the configured number of
+            # hops, so that is the longest chain there can be.
+            txn.execute(self.database_engine.convert_param_style(
+                "UPDATE state_group_max_delta_hops SET max_hops = ?"
+            ), (self._max_state_delta_hops,))
+        else:
+            txn.execute(self.database_engine.convert_param_style(
+                "SELECT update_name FROM background_updates WHERE update_name = ?"
+            ), (self.STATE_GROUP_CHAIN_COMPACTION_UPDATE_NAME,))
+
+            if not txn.fetchall():
+                logger.info(
+                    "Scheduling background update to shorten state group chains"
+                    " to at most %d hops", self._max_state_delta_hops,
+                )
+                txn.execute(self.database_engine.convert_param_style(
+                    "INSERT INTO background_updates (update_name, progress_json)"
+                    " VALUES (?, ?)"
+                ), (self.STATE_GROUP_CHAIN_COMPACTION_UPDATE_NAME, "{}"))
+
+        txn.close()
 
     def _store_event_state_mappings_txn(self, txn, events_and_contexts):
         state_groups = {}
@@ -1440,7 +1585,7 @@ class StateStore(StateGroupWorkerStore, BackgroundUpdateStore):
                     potential_hops = self._count_state_group_hops_txn(
                         txn, prev_group
                     )
-                    if potential_hops >= MAX_STATE_DELTA_HOPS:
+                    if potential_hops >= self._max_state_delta_hops:
                         # We want to ensure chains are at most this long,#
                         # otherwise read performance degrades.
                         continue
@@ -1525,6 +1670,105 @@ class StateStore(StateGroupWorkerStore, BackgroundUpdateStore):
 
         defer.returnValue(result * BATCH_SIZE_SCALE_FACTOR)
 
+    @defer.inlineCallbacks
+    def _background_compact_state_group_chains(self, progress, batch_size):
+        """This background update stores state groups which are too many hops
+        from the start of their delta chain in full, so that each chain is
+        broken up into shorter chains.
+
+        State groups are visited in ascending order, which means the chain
+        behind a state group has already been shortened by the time we get to
+        it, so we only need to store a group in full when its chain is just
+        over the limit.
+        """
+        last_state_group = progress.get("last_state_group", 0)
+        max_group = progress.get("max_group", None)
+        max_hops = progress.get("max_hops", self._max_state_delta_hops)
+
+        if max_group is None:
+            rows = yield self._execute(
+                "_background_compact_state_group_chains", None,
+                "SELECT coalesce(max(id), 0) FROM state_groups",
+            )
+            max_group = rows[0][0]
+
+        def compact_txn(txn):
+            txn.execute(
+                "SELECT id, room_id FROM state_groups"
+                " WHERE ? < id AND id <= ?"
+                " ORDER BY id ASC"
+                " LIMIT ?",
+                (last_state_group, max_group, batch_size),
+            )
+            rows = txn.fetchall()
+            if not rows:
+                return True, 0
+
+            for state_group, room_id in rows:
+                hops = self._count_state_group_hops_txn(txn, state_group)
+                if hops <= max_hops:
+                    continue
+
+                state = self._get_state_groups_from_groups_txn(
+                    txn, [state_group],
+                )[state_group]
+
+                self._simple_delete_txn(
+                    txn,
+                    table="state_group_edges",
+                    keyvalues={"state_group": state_group},
+                )
+
+                self._simple_delete_txn(
+                    txn,
+                    table="state_groups_state",
+                    keyvalues={"state_group": state_group},
+                )
+
+                self._simple_insert_many_txn(
+                    txn,
+                    table="state_groups_state",
+                    values=[
+                        {
+                            "state_group": state_group,
+                            "room_id": room_id,
+                            "type": key[0],
+                            "state_key": key[1],
+                            "event_id": state_id,
+                        }
+                        for key, state_id in iteritems(state)
+                    ],
+                )
+
+            progress = {
+                "last_state_group": rows[-1][0],
+                "max_group": max_group,
+                "max_hops": max_hops,
+            }
+
+            self._background_update_progress_txn(
+                txn, self.STATE_GROUP_CHAIN_COMPACTION_UPDATE_NAME, progress
+            )
+
+            return False, len(rows)
+
+        finished, result = yield self.runInteraction(
+            self.STATE_GROUP_CHAIN_COMPACTION_UPDATE_NAME, compact_txn
+        )
+
+        if finished:
+            yield self._simple_update_one(
+                table="state_group_max_delta_hops",
+                keyvalues={},
+                updatevalues={"max_hops": max_hops},
+                desc="_background_compact_state_group_chains",
+            )
+            yield self._end_background_update(
+                self.STATE_GROUP_CHAIN_COMPACTION_UPDATE_NAME
+            )
+
+        defer.returnValue(result)
+
     @defer.inlineCallbacks
     def _background_index_state(self, progress, batch_size):
         def reindex_txn(conn):
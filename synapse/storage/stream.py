@@ -37,6 +37,9 @@ import abc
 import logging
 from collections import namedtuple
 
+from canonicaljson import json
+
+from six import iteritems, itervalues
 from six.moves import range
 
 from twisted.internet import defer
@@ -45,6 +48,7 @@ from synapse.storage._base import SQLBaseStore
 from synapse.storage.engines import PostgresEngine
 from synapse.storage.events_worker import EventsWorkerStore
 from synapse.types import RoomStreamToken
+from synapse.util import batch_iter
 from synapse.util.caches.stream_change_cache import StreamChangeCache
 from synapse.util.logcontext import make_deferred_yieldable, run_in_background
 
@@ -180,6 +184,10 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         self._stream_order_on_start = self.get_room_max_stream_ordering()
 
+        # Whether we've checked that the stored federation stream positions
+        # match the configured federation_sender_instances.
+        self._federation_out_pos_reconciled = False
+
     @abc.abstractmethod
     def get_room_max_stream_ordering(self):
         raise NotImplementedError()
@@ -242,10 +250,7 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
             from_key (str): The room_key portion of a StreamToken
         """
         from_key = RoomStreamToken.parse_stream_token(from_key).stream
-        return set(
-            room_id for room_id in room_ids
-            if self._events_stream_cache.has_entity_changed(room_id, from_key)
-        )
+        return self._events_stream_cache.get_entities_changed(room_ids, from_key)
 
     @defer.inlineCallbacks
     def get_room_events_stream_for_room(self, room_id, from_key, to_key, limit=0,
@@ -419,6 +424,118 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
 
         defer.returnValue((rows, token))
 
+    @defer.inlineCallbacks
+    def get_recent_events_for_rooms(self, room_ids, limit, end_token):
+        """Get the most recent events in each of the given rooms in
+        topological ordering. This is equivalent to calling
+        `get_recent_events_for_room` for each room, but uses far fewer
+        queries.
+
+        Args:
+            room_ids (iterable[str])
+            limit (int): The maximum number of events to return per room.
+            end_token (str): The stream token representing now.
+
+        Returns:
+            Deferred[dict[str, tuple[list[FrozenEvent], str]]]: Map from room
+            ID to a list of events, in ascending order, and a token pointing
+            to the start of the returned events.
+        """
+        rows_by_room = yield self.runInteraction(
+            "get_recent_event_ids_for_rooms",
+            self._get_recent_event_ids_for_rooms_txn,
+            room_ids, limit, RoomStreamToken.parse(end_token),
+        )
+
+        events = yield self._get_events(
+            [r.event_id for rows, _ in itervalues(rows_by_room) for r in rows],
+            get_prev_content=True,
+        )
+        event_map = {e.event_id: e for e in events}
+
+        results = {}
+        for room_id, (rows, token) in iteritems(rows_by_room):
+            rows = [r for r in rows if r.event_id in event_map]
+            room_events = [event_map[r.event_id] for r in rows]
+            self._set_before_and_after(room_events, rows)
+            results[room_id] = (room_events, token)
+
+        defer.returnValue(results)
+
+    def _get_recent_event_ids_for_rooms_txn(self, txn, room_ids, limit,
+                                            end_token):
+        """Returns the most recent event IDs in each room, as
+        `get_recent_event_ids_for_room` would.
+
+        Rather than numbering every event in each room with a window function,
+        this unions a per room query for each room, so that each one only
+        reads the rows it returns from the room ordering index.
+
+        Args:
+            txn
+            room_ids (iterable[str])
+            limit (int)
+            end_token (RoomStreamToken)
+
+        Returns:
+            dict[str, tuple[list[_EventDictReturn], str]]
+        """
+        bounds = upper_bound(end_token, self.database_engine)
+
+        rows_by_room = {room_id: [] for room_id in room_ids}
+        if limit == 0:
+            return {
+                room_id: ([], str(end_token)) for room_id in rows_by_room
+            }
+
+        for batch in batch_iter(rows_by_room, 100):
+            # Each room gets its own subquery so that the LIMIT applies per
+            # room.
+            sql = " UNION ALL ".join(
+                "SELECT * FROM ("
+                " SELECT room_id, event_id, topological_ordering,"
+                " stream_ordering"
+                " FROM events"
+                " WHERE outlier = ? AND room_id = ? AND %(bounds)s"
+                " ORDER BY topological_ordering DESC, stream_ordering DESC"
+                " LIMIT ?"
+                ") AS r%(idx)d" % {
+                    "bounds": bounds,
+                    "idx": idx,
+                }
+                for idx in range(len(batch))
+            )
+
+            args = []
+            for room_id in batch:
+                args.extend((False, room_id, int(limit)))
+
+            txn.execute(sql, args)
+
+            for room_id, event_id, topological_ordering, stream_ordering in txn:
+                rows_by_room[room_id].append(_EventDictReturn(
+                    event_id, topological_ordering, stream_ordering,
+                ))
+
+        results = {}
+        for room_id, rows in iteritems(rows_by_room):
+            # UNION ALL doesn't guarantee that each subquery's ordering is
+            # preserved, so we sort the rows ourselves.
+            rows.sort(key=lambda r: (r.topological_ordering, r.stream_ordering))
+
+            if rows:
+                # See _paginate_room_events_txn: the token points to the event
+                # before the earliest one we return.
+                token = str(RoomStreamToken(
+                    rows[0].topological_ordering, rows[0].stream_ordering - 1,
+                ))
+            else:
+                token = str(end_token)
+
+            results[room_id] = (rows, token)
+
+        return results
+
     def get_room_event_after_stream_ordering(self, room_id, stream_ordering):
         """Gets details of the first event in a room at or after a stream ordering
 
@@ -662,7 +779,8 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
              Deferred[Tuple[int, list[FrozenEvent]]]: A tuple of (next_id, events), where
              `next_id` is the next value to pass as `from_id` (it will either be the
              stream_ordering of the last returned event, or, if fewer than `limit` events
-             were found, `current_id`.
+             were found, `current_id`. The events have their
+             `internal_metadata.stream_ordering` set.
          """
 
         def get_all_new_events_stream_txn(txn):
@@ -682,35 +800,147 @@ class StreamWorkerStore(EventsWorkerStore, SQLBaseStore):
             if len(rows) == limit:
                 upper_bound = rows[-1][0]
 
-            return upper_bound, [row[1] for row in rows]
+            return upper_bound, rows
 
-        upper_bound, event_ids = yield self.runInteraction(
+        upper_bound, rows = yield self.runInteraction(
             "get_all_new_events_stream", get_all_new_events_stream_txn,
         )
 
-        events = yield self._get_events(event_ids)
+        events = yield self._get_events([row[1] for row in rows])
+
+        # the federation sender needs to know the position of each event
+        stream_orderings = {event_id: ordering for ordering, event_id in rows}
+        for event in events:
+            event.internal_metadata.stream_ordering = stream_orderings[event.event_id]
 
         defer.returnValue((upper_bound, events))
 
-    def get_federation_out_pos(self, typ):
-        return self._simple_select_one_onecol(
-            table="federation_stream_position",
-            retcol="stream_id",
-            keyvalues={"type": typ},
-            desc="get_federation_out_pos"
+    @defer.inlineCallbacks
+    def get_federation_out_pos(self, typ, instance_name="master"):
+        """Get how far a federation sender has got through a stream.
+
+        Args:
+            typ (str): "events" or "federation"
+            instance_name (str): the federation sender shard, or "master" if
+                sending isn't sharded.
+
+        Returns:
+            Deferred[int|None]
+        """
+        def get_federation_out_pos_txn(txn):
+            if not self._federation_out_pos_reconciled:
+                self.reconcile_federation_out_pos_txn(
+                    txn, self.hs.config.federation_sender_instances,
+                )
+            return self._get_federation_out_pos_txn(txn, typ, instance_name)
+
+        ret = yield self.runInteraction(
+            "get_federation_out_pos", get_federation_out_pos_txn,
+        )
+        self._federation_out_pos_reconciled = True
+        defer.returnValue(ret)
+
+    def _get_federation_out_pos_txn(self, txn, typ, instance_name):
+        txn.execute(
+            "SELECT stream_id FROM federation_stream_position"
+            " WHERE type = ? AND instance_name = ?",
+            (typ, instance_name),
+        )
+        row = txn.fetchone()
+        return row[0] if row else None
+
+    def reconcile_federation_out_pos_txn(self, txn, instances):
+        """Make sure there is a position for each of the given federation
+        sender instances.
+
+        If the list of instances has changed since the positions were written,
+        which destinations each instance sends to has changed too. Every
+        instance (or "master", if sending isn't sharded) is then given the
+        position of the furthest behind of the old instances, and the old rows
+        are removed. That way nothing is skipped, at the risk of sending some
+        destinations a few things twice.
+
+        Args:
+            txn (cursor)
+            instances (list[str]): the configured federation_sender_instances
+        """
+        # Stop several processes rewriting the positions at once.
+        self.database_engine.lock_table(txn, "federation_stream_position")
+
+        stored = self._simple_select_one_onecol_txn(
+            txn,
+            table="federation_stream_position_instances",
+            keyvalues={},
+            retcol="instances",
+        )
+        if json.loads(stored) == list(instances):
+            return
+
+        logger.info(
+            "federation_sender_instances changed from %s to %s: resetting"
+            " federation stream positions",
+            stored, instances,
+        )
+
+        for typ in ("events", "federation"):
+            txn.execute(
+                "SELECT MIN(stream_id) FROM federation_stream_position"
+                " WHERE type = ?",
+                (typ,),
+            )
+            min_stream_id = txn.fetchone()[0]
+            if min_stream_id is None:
+                continue
+
+            self._simple_delete_txn(
+                txn,
+                table="federation_stream_position",
+                keyvalues={"type": typ},
+            )
+            self._simple_insert_many_txn(
+                txn,
+                table="federation_stream_position",
+                values=[
+                    {
+                        "type": typ,
+                        "stream_id": min_stream_id,
+                        "instance_name": instance_name,
+                    }
+                    for instance_name in instances or ["master"]
+                ],
+            )
+
+        self._simple_update_one_txn(
+            txn,
+            table="federation_stream_position_instances",
+            keyvalues={},
+            updatevalues={"instances": json.dumps(list(instances))},
         )
 
-    def update_federation_out_pos(self, typ, stream_id):
-        return self._simple_update_one(
+    def update_federation_out_pos(self, typ, stream_id, instance_name="master"):
+        return self._simple_upsert(
             table="federation_stream_position",
-            keyvalues={"type": typ},
-            updatevalues={"stream_id": stream_id},
+            keyvalues={"type": typ, "instance_name": instance_name},
+            values={"stream_id": stream_id},
             desc="update_federation_out_pos",
         )
 
     def has_room_changed_since(self, room_id, stream_id):
         return self._events_stream_cache.has_entity_changed(room_id, stream_id)
 
+    def has_membership_changed_since(self, user_id, stream_id):
+        """Returns whether the user's membership of any room may have changed
+        since the given stream ordering.
+
+        Args:
+            user_id (str)
+            stream_id (int)
+
+        Returns:
+            bool
+        """
+        return self._membership_stream_cache.has_entity_changed(user_id, stream_id)
+
     def _paginate_room_events_txn(self, txn, room_id, from_token, to_token=None,
                                   direction='b', limit=-1, event_filter=None):
         """Returns list of events before or after a given token.
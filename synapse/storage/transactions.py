@@ -286,6 +286,129 @@ class TransactionStore(SQLBaseStore):
         txn.execute(query, (self._clock.time_msec(),))
         return self.cursor_to_dict(txn)
 
+    def store_destination_rooms_entries(self, destinations, room_id, stream_ordering):
+        """Records that we are sending an event in a room to some destinations,
+        so that we can catch them up if it doesn't get through.
+
+        Args:
+            destinations (Iterable[str])
+            room_id (str)
+            stream_ordering (int): the stream_ordering of the event
+
+        Returns:
+            Deferred
+        """
+        destinations = list(destinations)
+        return self.runInteraction(
+            "store_destination_rooms_entries",
+            self._simple_upsert_many_txn,
+            table="destination_rooms",
+            key_names=("destination", "room_id"),
+            key_values=[(destination, room_id) for destination in destinations],
+            value_names=("stream_ordering",),
+            value_values=[(stream_ordering,)] * len(destinations),
+        )
+
+    def get_destination_last_successful_stream_ordering(self, destination):
+        """Gets the stream_ordering of the most recent PDU the destination has
+        successfully received from us.
+
+        Args:
+            destination (str)
+
+        Returns:
+            Deferred[int|None]: None if we've never successfully sent them one
+        """
+        return self._simple_select_one_onecol(
+            table="destinations",
+            keyvalues={"destination": destination},
+            retcol="last_successful_stream_ordering",
+            allow_none=True,
+            desc="get_destination_last_successful_stream_ordering",
+        )
+
+    def set_destination_last_successful_stream_ordering(
+        self, destination, stream_ordering,
+    ):
+        """Sets the stream_ordering of the most recent PDU the destination has
+        successfully received from us.
+
+        Args:
+            destination (str)
+            stream_ordering (int)
+
+        Returns:
+            Deferred
+        """
+        return self._simple_upsert(
+            table="destinations",
+            keyvalues={"destination": destination},
+            values={"last_successful_stream_ordering": stream_ordering},
+            insertion_values={"retry_last_ts": 0, "retry_interval": 0},
+            desc="set_destination_last_successful_stream_ordering",
+            lock=False,
+        )
+
+    def get_catch_up_room_events(
+        self, destination, last_successful_stream_ordering, limit,
+    ):
+        """Gets the most recent event we've tried to send to the destination in
+        each room where it hasn't successfully received it.
+
+        Args:
+            destination (str)
+            last_successful_stream_ordering (int): the stream_ordering of the
+                most recent PDU the destination has received from us
+            limit (int): the most events to return
+
+        Returns:
+            Deferred[list[tuple[str, int]]]: the event_id and stream_ordering of
+                each event, ordered by stream_ordering
+        """
+        def get_catch_up_room_events_txn(txn):
+            sql = (
+                "SELECT event_id, stream_ordering FROM destination_rooms"
+                " INNER JOIN events USING (room_id, stream_ordering)"
+                " WHERE destination = ? AND stream_ordering > ?"
+                " ORDER BY stream_ordering"
+                " LIMIT ?"
+            )
+            txn.execute(sql, (destination, last_successful_stream_ordering, limit))
+            return txn.fetchall()
+
+        return self.runInteraction(
+            "get_catch_up_room_events", get_catch_up_room_events_txn,
+        )
+
+    def get_catch_up_outstanding_destinations(self, after_destination, limit):
+        """Gets destinations which we have tried to send a PDU to since the
+        last one they successfully received from us.
+
+        Args:
+            after_destination (str): only return destinations which sort after
+                this one, for paging through them
+            limit (int): the most destinations to return
+
+        Returns:
+            Deferred[list[str]]: the destinations, in order
+        """
+        def get_catch_up_outstanding_destinations_txn(txn):
+            sql = (
+                "SELECT DISTINCT destination FROM destinations"
+                " INNER JOIN destination_rooms USING (destination)"
+                " WHERE stream_ordering > last_successful_stream_ordering"
+                " AND destination > ?"
+                " ORDER BY destination"
+                " LIMIT ?"
+            )
+            txn.execute(sql, (after_destination, limit))
+            return [row[0] for row in txn]
+
+        return self.runInteraction(
+            "get_catch_up_outstanding_destinations",
+            get_catch_up_outstanding_destinations_txn,
+        )
+
     def _start_cleanup_transactions(self):
         return run_as_background_process(
             "cleanup_transactions", self._cleanup_transactions,
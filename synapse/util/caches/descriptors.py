@@ -28,6 +28,7 @@ from synapse.util import logcontext, unwrapFirstError
 from synapse.util.async_helpers import ObservableDeferred
 from synapse.util.caches import get_cache_factor_for
 from synapse.util.caches.lrucache import LruCache
+from synapse.util.caches.memory_budget import get_global_memory_budget
 from synapse.util.caches.treecache import TreeCache, iterate_tree_cache_entry
 from synapse.util.stringutils import to_ascii
 
@@ -68,7 +69,8 @@ class Cache(object):
         "_pending_deferred_cache",
     )
 
-    def __init__(self, name, max_entries=1000, keylen=1, tree=False, iterable=False):
+    def __init__(self, name, max_entries=1000, keylen=1, tree=False, iterable=False,
+                 expiry_ms=None, idle_expiry_ms=None, clock=None):
         cache_type = TreeCache if tree else dict
         self._pending_deferred_cache = cache_type()
 
@@ -76,6 +78,10 @@ class Cache(object):
             max_size=max_entries, keylen=keylen, cache_type=cache_type,
             size_callback=(lambda d: len(d)) if iterable else None,
             evicted_callback=self._on_evicted,
+            memory_budget=get_global_memory_budget(),
+            expiry_ms=expiry_ms,
+            idle_expiry_ms=idle_expiry_ms,
+            clock=clock,
         )
 
         self.name = name
@@ -303,9 +309,17 @@ class CacheDescriptor(_CacheDescriptorBase):
         num_args (int): number of positional arguments (excluding ``self`` and
             ``cache_context``) to use as cache keys. Defaults to all named
             args of the function.
+        expiry_ms (int|None): if set, entries are dropped from the cache once
+            they are this old.
+        idle_expiry_ms (int|None): if set, entries are dropped from the cache
+            once they have not been looked up for this long.
+
+            If either of these is set, the object the method is on must have
+            an ``hs`` attribute, whose clock is used to time the entries.
     """
     def __init__(self, orig, max_entries=1000, num_args=None, tree=False,
-                 inlineCallbacks=False, cache_context=False, iterable=False):
+                 inlineCallbacks=False, cache_context=False, iterable=False,
+                 expiry_ms=None, idle_expiry_ms=None):
 
         super(CacheDescriptor, self).__init__(
             orig, num_args=num_args, inlineCallbacks=inlineCallbacks,
@@ -316,14 +330,23 @@ class CacheDescriptor(_CacheDescriptorBase):
         self.max_entries = max_entries
         self.tree = tree
         self.iterable = iterable
+        self.expiry_ms = expiry_ms
+        self.idle_expiry_ms = idle_expiry_ms
 
     def __get__(self, obj, objtype=None):
+        clock = None
+        if self.expiry_ms is not None or self.idle_expiry_ms is not None:
+            clock = obj.hs.get_clock()
+
         cache = Cache(
             name=self.orig.__name__,
             max_entries=self.max_entries,
             keylen=self.num_args,
             tree=self.tree,
             iterable=self.iterable,
+            expiry_ms=self.expiry_ms,
+            idle_expiry_ms=self.idle_expiry_ms,
+            clock=clock,
         )
 
         def get_cache_key_gen(args, kwargs):
@@ -587,7 +610,7 @@ class _CacheContext(namedtuple("_CacheContext", ("cache", "key"))):
 
 
 def cached(max_entries=1000, num_args=None, tree=False, cache_context=False,
-           iterable=False):
+           iterable=False, expiry_ms=None, idle_expiry_ms=None):
     return lambda orig: CacheDescriptor(
         orig,
         max_entries=max_entries,
@@ -595,11 +618,14 @@ def cached(max_entries=1000, num_args=None, tree=False, cache_context=False,
         tree=tree,
         cache_context=cache_context,
         iterable=iterable,
+        expiry_ms=expiry_ms,
+        idle_expiry_ms=idle_expiry_ms,
     )
 
 
 def cachedInlineCallbacks(max_entries=1000, num_args=None, tree=False,
-                          cache_context=False, iterable=False):
+                          cache_context=False, iterable=False, expiry_ms=None,
+                          idle_expiry_ms=None):
     return lambda orig: CacheDescriptor(
         orig,
         max_entries=max_entries,
@@ -608,6 +634,8 @@ def cachedInlineCallbacks(max_entries=1000, num_args=None, tree=False,
         inlineCallbacks=True,
         cache_context=cache_context,
         iterable=iterable,
+        expiry_ms=expiry_ms,
+        idle_expiry_ms=idle_expiry_ms,
     )
 
 
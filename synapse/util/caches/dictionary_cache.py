@@ -17,7 +17,10 @@ import logging
 import threading
 from collections import namedtuple
 
+from six import iteritems
+
 from synapse.util.caches.lrucache import LruCache
+from synapse.util.caches.memory_budget import estimate_size, get_global_memory_budget
 
 from . import register_cache
 
@@ -45,7 +48,10 @@ class DictionaryCache(object):
     """
 
     def __init__(self, name, max_entries=1000):
-        self.cache = LruCache(max_size=max_entries, size_callback=len)
+        self.cache = LruCache(
+            max_size=max_entries, size_callback=len,
+            memory_budget=get_global_memory_budget(),
+        )
 
         self.name = name
         self.sequence = 0
@@ -133,12 +139,27 @@ class DictionaryCache(object):
 
     def _update_or_insert(self, key, value, known_absent):
         # We pop and reinsert as we need to tell the cache the size may have
-        # changed
+        # changed. If the cache is tracking the memory used by its entries, we
+        # work out the new size from the old one, rather than having it look
+        # at the whole of the (possibly very large) dict again.
+        memory_size = self.cache.get_memory_size(key)
 
         entry = self.cache.pop(key, DictionaryEntry(False, set(), {}))
+
+        if memory_size is not None:
+            memory_size += sum(
+                estimate_size(k) + estimate_size(v)
+                for k, v in iteritems(value)
+                if k not in entry.value
+            )
+            memory_size += sum(
+                estimate_size(k) for k in known_absent
+                if k not in entry.known_absent
+            )
+
         entry.value.update(value)
         entry.known_absent.update(known_absent)
-        self.cache[key] = entry
+        self.cache.set(key, entry, memory_size=memory_size)
 
     def _insert(self, key, value, known_absent):
         self.cache[key] = DictionaryEntry(True, known_absent, value)
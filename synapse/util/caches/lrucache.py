@@ -15,9 +15,37 @@
 
 
 import threading
+import weakref
 from functools import wraps
 
+from synapse.util.caches.memory_budget import estimate_size
 from synapse.util.caches.treecache import TreeCache
+from synapse.util.wheel_timer import WheelTimer
+
+# How often to look for expired entries in caches which have an expiry time
+EXPIRY_SWEEP_INTERVAL_MS = 30 * 1000
+
+# All the LruCaches which have an expiry time, so that the sweep can find them.
+_expiring_caches = weakref.WeakSet()
+
+
+def expire_lru_cache_entries():
+    """Evict the entries which have expired from all the LruCaches with an
+    expiry time.
+    """
+    for cache in list(_expiring_caches):
+        cache.expire()
+
+
+def setup_expire_lru_cache_entries(hs):
+    """Start the periodic sweep of expired cache entries.
+
+    Args:
+        hs (synapse.server.HomeServer)
+    """
+    hs.get_clock().looping_call(
+        expire_lru_cache_entries, EXPIRY_SWEEP_INTERVAL_MS,
+    )
 
 
 def enumerate_leaves(node, depth):
@@ -40,6 +68,40 @@ class _Node(object):
         self.callbacks = callbacks
 
 
+class _BudgetedNode(_Node):
+    """A node in an LruCache which shares a MemoryBudget. As well as being in
+    the cache's own list, it is in the budget's list of entries across all the
+    caches.
+    """
+    __slots__ = ["memory_size", "budget_prev", "budget_next", "evict_from_owner"]
+
+    def __init__(self, prev_node, next_node, key, value, callbacks, memory_size,
+                 evict_from_owner):
+        super(_BudgetedNode, self).__init__(
+            prev_node, next_node, key, value, callbacks,
+        )
+        self.memory_size = memory_size
+        self.budget_prev = None
+        self.budget_next = None
+        self.evict_from_owner = evict_from_owner
+
+
+class _TimedNode(_BudgetedNode):
+    """A node in an LruCache with an expiry time, which tracks when the entry
+    was added and last accessed.
+    """
+    __slots__ = ["inserted_ms", "accessed_ms"]
+
+    def __init__(self, prev_node, next_node, key, value, callbacks, memory_size,
+                 evict_from_owner, now):
+        super(_TimedNode, self).__init__(
+            prev_node, next_node, key, value, callbacks, memory_size,
+            evict_from_owner,
+        )
+        self.inserted_ms = now
+        self.accessed_ms = now
+
+
 class LruCache(object):
     """
     Least-recently-used cache.
@@ -50,7 +112,8 @@ class LruCache(object):
     when that key gets invalidated/evicted.
     """
     def __init__(self, max_size, keylen=1, cache_type=dict, size_callback=None,
-                 evicted_callback=None):
+                 evicted_callback=None, memory_budget=None, expiry_ms=None,
+                 idle_expiry_ms=None, clock=None):
         """
         Args:
             max_size (int):
@@ -66,6 +129,24 @@ class LruCache(object):
             evicted_callback (func(int)|None):
                 if not None, called on eviction with the size of the evicted
                 entry
+
+            memory_budget (MemoryBudget|None):
+                if not None, entries are charged against the given budget by
+                their approximate size in bytes, and are evicted when the
+                caches sharing the budget go over it, as well as when this
+                cache has more than max_size entries.
+
+            expiry_ms (int|None):
+                if not None, entries are evicted once they have been in the
+                cache for this long
+
+            idle_expiry_ms (int|None):
+                if not None, entries are evicted once they have not been
+                accessed for this long
+
+            clock (synapse.util.Clock|None):
+                used to time entries for expiry. Required if expiry_ms or
+                idle_expiry_ms is given.
         """
         cache = cache_type()
         self.cache = cache  # Used for introspection.
@@ -75,7 +156,35 @@ class LruCache(object):
 
         lock = threading.Lock()
 
+        memory_used = [0]
+
+        expires = expiry_ms is not None or idle_expiry_ms is not None
+        if expires and clock is None:
+            raise ValueError("A clock is needed for caches which expire entries")
+
+        # The wheel timer holds the keys of the entries, rather than the nodes,
+        # so that entries which are removed from the cache can be freed straight
+        # away. A key is only in the timer once, so we keep track of which keys
+        # are in it.
+        wheel_timer = [WheelTimer()]
+        keys_in_wheel = set()
+
+        def schedule_expiry(now, key, then):
+            if key not in keys_in_wheel:
+                keys_in_wheel.add(key)
+                wheel_timer[0].insert(now, key, then)
+
+        def expiry_time(node):
+            times = []
+            if expiry_ms is not None:
+                times.append(node.inserted_ms + expiry_ms)
+            if idle_expiry_ms is not None:
+                times.append(node.accessed_ms + idle_expiry_ms)
+            return min(times)
+
         def evict():
+            # if there is a memory budget, it does its own evicting once we have
+            # dropped our lock.
             while cache_len() > max_size:
                 todelete = list_root.prev_node
                 evicted_len = delete_node(todelete)
@@ -101,14 +210,38 @@ class LruCache(object):
 
         self.len = synchronized(cache_len)
 
-        def add_node(key, value, callbacks=set()):
+        def entry_size(key, value, memory_size):
+            if memory_budget is None:
+                return 0
+            if memory_size is None:
+                memory_size = estimate_size(value)
+            return estimate_size(key) + memory_size
+
+        def add_node(key, value, callbacks=set(), memory_size=None):
             prev_node = list_root
             next_node = prev_node.next_node
-            node = _Node(prev_node, next_node, key, value, callbacks)
+            if expires:
+                now = clock.time_msec()
+                node = _TimedNode(
+                    prev_node, next_node, key, value, callbacks,
+                    entry_size(key, value, memory_size), evict_budgeted_node, now,
+                )
+                schedule_expiry(now, key, expiry_time(node))
+            elif memory_budget is not None:
+                node = _BudgetedNode(
+                    prev_node, next_node, key, value, callbacks,
+                    entry_size(key, value, memory_size), evict_budgeted_node,
+                )
+            else:
+                node = _Node(prev_node, next_node, key, value, callbacks)
             prev_node.next_node = node
             next_node.prev_node = node
             cache[key] = node
 
+            if memory_budget is not None:
+                memory_used[0] += node.memory_size
+                memory_budget.add(node)
+
             if size_callback:
                 cached_cache_len[0] += size_callback(node.value)
 
@@ -124,6 +257,12 @@ class LruCache(object):
             prev_node.next_node = node
             next_node.prev_node = node
 
+            if memory_budget is not None:
+                memory_budget.touch(node)
+
+            if idle_expiry_ms is not None:
+                node.accessed_ms = clock.time_msec()
+
         def delete_node(node):
             prev_node = node.prev_node
             next_node = node.next_node
@@ -135,11 +274,27 @@ class LruCache(object):
                 deleted_len = size_callback(node.value)
                 cached_cache_len[0] -= deleted_len
 
+            if memory_budget is not None:
+                memory_used[0] -= node.memory_size
+                memory_budget.remove(node)
+
             for cb in node.callbacks:
                 cb()
             node.callbacks.clear()
             return deleted_len
 
+        @synchronized
+        def evict_budgeted_node(node):
+            # Called by the memory budget once it has picked this node to evict.
+            # It may have been removed from the cache in the meantime.
+            if cache.get(node.key, None) is not node:
+                return
+
+            evicted_len = delete_node(node)
+            cache.pop(node.key, None)
+            if evicted_callback:
+                evicted_callback(evicted_len)
+
         @synchronized
         def cache_get(key, default=None, callbacks=[]):
             node = cache.get(key, None)
@@ -151,7 +306,14 @@ class LruCache(object):
                 return default
 
         @synchronized
-        def cache_set(key, value, callbacks=[]):
+        def cache_get_memory_size(key):
+            node = cache.get(key, None)
+            if node is None or memory_budget is None:
+                return None
+            return node.memory_size - estimate_size(key)
+
+        @synchronized
+        def _cache_set(key, value, callbacks=[], memory_size=None):
             node = cache.get(key, None)
             if node is not None:
                 # We sometimes store large objects, e.g. dicts, which cause
@@ -170,17 +332,41 @@ class LruCache(object):
                     cached_cache_len[0] -= size_callback(node.value)
                     cached_cache_len[0] += size_callback(value)
 
+                if memory_budget is not None:
+                    new_size = entry_size(key, value, memory_size)
+                    memory_used[0] += new_size - node.memory_size
+                    memory_budget.resize(node, new_size)
+
                 node.callbacks.update(callbacks)
 
+                if expiry_ms is not None:
+                    node.inserted_ms = clock.time_msec()
+
                 move_node_to_front(node)
                 node.value = value
             else:
-                add_node(key, value, set(callbacks))
+                add_node(key, value, set(callbacks), memory_size)
 
             evict()
 
+        def cache_set(key, value, callbacks=[], memory_size=None):
+            """Add or replace an entry.
+
+            Args:
+                key
+                value
+                callbacks (list[callable]): called when the entry is
+                    invalidated or evicted
+                memory_size (int|None): the approximate size of the value in
+                    bytes, if the caller already knows it. Otherwise it is
+                    estimated, which means looking at the whole value.
+            """
+            _cache_set(key, value, callbacks, memory_size)
+            if memory_budget is not None:
+                memory_budget.evict()
+
         @synchronized
-        def cache_set_default(key, value):
+        def _cache_set_default(key, value):
             node = cache.get(key, None)
             if node is not None:
                 return node.value
@@ -189,6 +375,12 @@ class LruCache(object):
                 evict()
                 return value
 
+        def cache_set_default(key, value):
+            value = _cache_set_default(key, value)
+            if memory_budget is not None:
+                memory_budget.evict()
+            return value
+
         @synchronized
         def cache_pop(key, default=None):
             node = cache.get(key, None)
@@ -217,14 +409,54 @@ class LruCache(object):
             for node in cache.values():
                 for cb in node.callbacks:
                     cb()
+                if memory_budget is not None:
+                    memory_budget.remove(node)
             cache.clear()
             if size_callback:
                 cached_cache_len[0] = 0
+            memory_used[0] = 0
+            wheel_timer[0] = WheelTimer()
+            keys_in_wheel.clear()
+
+        @synchronized
+        def cache_expire():
+            now = clock.time_msec()
+            for key in wheel_timer[0].fetch(now):
+                keys_in_wheel.discard(key)
+
+                # skip entries which have since been removed
+                node = cache.get(key, None)
+                if node is None:
+                    continue
+
+                # entries which have been accessed or replaced since they were
+                # added to the timer get put back in for their new expiry time
+                then = expiry_time(node)
+                if then > now:
+                    schedule_expiry(now, key, then)
+                    continue
+
+                evicted_len = delete_node(node)
+                cache.pop(node.key, None)
+                if evicted_callback:
+                    evicted_callback(evicted_len)
 
         @synchronized
         def cache_contains(key):
             return key in cache
 
+        @synchronized
+        def cache_items():
+            """Returns the (key, value) pairs in the cache, most recently used
+            first, without marking any of them as used.
+            """
+            items = []
+            node = list_root.next_node
+            while node is not list_root:
+                items.append((node.key, node.value))
+                node = node.next_node
+            return items
+
         self.sentinel = object()
         self.get = cache_get
         self.set = cache_set
@@ -234,7 +466,13 @@ class LruCache(object):
             self.del_multi = cache_del_multi
         self.len = synchronized(cache_len)
         self.contains = cache_contains
+        self.items = cache_items
         self.clear = cache_clear
+        self.memory_usage = synchronized(lambda: memory_used[0])
+        self.get_memory_size = cache_get_memory_size
+        if expires:
+            self.expire = cache_expire
+            _expiring_caches.add(self)
 
     def __getitem__(self, key):
         result = self.get(key, self.sentinel)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import os
+import sys
+import threading
+
+from six import integer_types, string_types
+
+from frozendict import frozendict
+from prometheus_client import Gauge
+
+logger = logging.getLogger(__name__)
+
+# types which don't refer to any other objects, so we don't need to look inside
+# them when estimating sizes.
+_ATOMIC_TYPES = string_types + integer_types + (bytes, float, bool, type(None))
+
+_SEQUENCE_TYPES = (list, tuple, set, frozenset)
+
+# how far to follow references when estimating the size of an object
+_MAX_SIZE_DEPTH = 8
+
+_SIZE_SUFFIXES = {
+    "K": 1024,
+    "M": 1024 * 1024,
+    "G": 1024 * 1024 * 1024,
+}
+
+
+def estimate_size(obj):
+    """Estimate how much memory an object takes up, including the objects it
+    refers to.
+
+    This is only an approximation: objects which are shared with other cache
+    entries (such as interned strings) are counted against each entry, and
+    only the first few levels of nested objects are looked at.
+
+    Args:
+        obj: the object to measure
+
+    Returns:
+        int: the approximate size in bytes
+    """
+    seen = set()
+    size = 0
+    to_visit = [(obj, 0)]
+
+    while to_visit:
+        o, depth = to_visit.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+
+        size += sys.getsizeof(o)
+
+        if depth >= _MAX_SIZE_DEPTH or isinstance(o, _ATOMIC_TYPES):
+            continue
+
+        depth += 1
+        if isinstance(o, dict):
+            for k, v in dict.items(o):
+                to_visit.append((k, depth))
+                to_visit.append((v, depth))
+        elif isinstance(o, frozendict):
+            for k, v in o.items():
+                to_visit.append((k, depth))
+                to_visit.append((v, depth))
+        elif isinstance(o, _SEQUENCE_TYPES):
+            # Go via the base type, since some subclasses (such as UserID)
+            # refuse to be iterated.
+            base = next(t for t in _SEQUENCE_TYPES if isinstance(o, t))
+            to_visit.extend((item, depth) for item in base.__iter__(o))
+        else:
+            if hasattr(o, "__dict__"):
+                to_visit.append((o.__dict__, depth))
+            for cls in type(o).__mro__:
+                for slot in getattr(cls, "__slots__", ()):
+                    try:
+                        to_visit.append((getattr(o, slot), depth))
+                    except AttributeError:
+                        pass
+
+    return size
+
+
+class _BudgetListNode(object):
+    """The root of the list of entries charged to a MemoryBudget. The entries
+    themselves are nodes in the LruCaches which share the budget.
+    """
+    __slots__ = ["budget_prev", "budget_next"]
+
+    def __init__(self):
+        self.budget_prev = self
+        self.budget_next = self
+
+
+class MemoryBudget(object):
+    """A limit on the approximate total size of the entries in a set of
+    LruCaches.
+
+    The entries in all the caches which share a budget are kept in a single
+    list in order of last access. When the total size goes over the budget, the
+    least recently used entries are evicted from whichever caches they are in.
+
+    Args:
+        max_bytes (int): the size the caches are allowed to grow to, in bytes
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+
+        self._lock = threading.Lock()
+        self._root = _BudgetListNode()
+
+    def add(self, node):
+        """Start charging a new cache entry against the budget.
+
+        Args:
+            node (synapse.util.caches.lrucache._BudgetedNode)
+        """
+        with self._lock:
+            self._link_to_front(node)
+            self.used_bytes += node.memory_size
+
+    def touch(self, node):
+        """Mark a cache entry as having been accessed.
+
+        Args:
+            node (synapse.util.caches.lrucache._BudgetedNode)
+        """
+        with self._lock:
+            # the entry may already have been picked for eviction by evict()
+            if node.budget_prev is None:
+                return
+            self._unlink(node)
+            self._link_to_front(node)
+
+    def resize(self, node, new_size):
+        """Update the size charged for a cache entry.
+
+        Args:
+            node (synapse.util.caches.lrucache._BudgetedNode)
+            new_size (int): the new size of the entry, in bytes
+        """
+        with self._lock:
+            if node.budget_prev is not None:
+                self.used_bytes += new_size - node.memory_size
+            node.memory_size = new_size
+
+    def remove(self, node):
+        """Stop charging a cache entry against the budget. Does nothing if the
+        entry has already been removed.
+
+        Args:
+            node (synapse.util.caches.lrucache._BudgetedNode)
+        """
+        with self._lock:
+            if node.budget_prev is None:
+                return
+            self._unlink(node)
+            self.used_bytes -= node.memory_size
+
+    def evict(self):
+        """Evict the least recently used entries until we are within the
+        budget.
+
+        This must not be called with any cache locks held, since evicting an
+        entry takes the lock of the cache which holds it.
+        """
+        while True:
+            with self._lock:
+                if self.used_bytes <= self.max_bytes:
+                    return
+
+                node = self._root.budget_prev
+                if node is self._root:
+                    return
+
+                self._unlink(node)
+                self.used_bytes -= node.memory_size
+
+            node.evict_from_owner(node)
+
+    def _link_to_front(self, node):
+        node.budget_prev = self._root
+        node.budget_next = self._root.budget_next
+        self._root.budget_next.budget_prev = node
+        self._root.budget_next = node
+
+    def _unlink(self, node):
+        node.budget_prev.budget_next = node.budget_next
+        node.budget_next.budget_prev = node.budget_prev
+        node.budget_prev = None
+        node.budget_next = None
+
+
+def parse_memory_size(value):
+    """Parse a size such as "512M" or "2G" into a number of bytes
+
+    Args:
+        value (str)
+
+    Returns:
+        int
+    """
+    value = value.strip().upper()
+    multiplier = 1
+    if value and value[-1] in _SIZE_SUFFIXES:
+        multiplier = _SIZE_SUFFIXES[value[-1]]
+        value = value[:-1]
+    return int(float(value) * multiplier)
+
+
+def _budget_from_environment():
+    value = os.environ.get("SYNAPSE_CACHE_MEMORY_BUDGET")
+    if not value:
+        return None
+
+    try:
+        return MemoryBudget(parse_memory_size(value))
+    except ValueError:
+        logger.error(
+            "Ignoring invalid SYNAPSE_CACHE_MEMORY_BUDGET %r", value,
+        )
+        return None
+
+
+_global_budget = _budget_from_environment()
+
+
+def get_global_memory_budget():
+    """Get the memory budget shared by the caches registered with
+    `register_cache`, if one has been configured with the
+    SYNAPSE_CACHE_MEMORY_BUDGET environment variable.
+
+    Returns:
+        MemoryBudget|None
+    """
+    return _global_budget
+
+
+Gauge(
+    "synapse_util_caches_memory_budget_used_bytes",
+    "Approximate size of the entries in caches which share the memory budget",
+).set_function(lambda: _global_budget.used_bytes if _global_budget else 0)
+
+Gauge(
+    "synapse_util_caches_memory_budget_max_bytes",
+    "Size of the memory budget shared by caches",
+).set_function(lambda: _global_budget.max_bytes if _global_budget else 0)
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import zlib
+from contextlib import contextmanager
+
+from synapse.util.caches import register_cache
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"SYNSHMC2"
+
+# magic, number of slots, size of each slot
+_FILE_HEADER = struct.Struct("!8sII")
+
+# the number of slots which hold an entry, which follows the file header
+_ENTRY_COUNT = struct.Struct("!I")
+_ENTRY_COUNT_OFFSET = _FILE_HEADER.size
+
+# the offset of the first slot in the file
+_SLOTS_OFFSET = _ENTRY_COUNT_OFFSET + _ENTRY_COUNT.size
+
+# sequence number, version, key length, value length
+_SLOT_HEADER = struct.Struct("!IIHI")
+_SLOT_SEQ = struct.Struct("!I")
+_SLOT_VERSION = struct.Struct("!I")
+_SLOT_VERSION_OFFSET = _SLOT_SEQ.size
+
+
+def allocate_file(fd, size):
+    """Set the size of a newly created file, allocating its disk space up front
+    where possible.
+
+    A sparse file only gets space allocated as its pages are first written to,
+    and if the filesystem (eg, a tmpfs) is full by then, writing to a mmap of
+    it raises SIGBUS. Allocating it here instead means we fail on startup.
+
+    Args:
+        fd (int): the file, which must be empty
+        size (int): the size to make it, in bytes
+
+    Raises:
+        OSError: if the space couldn't be allocated. The file is left empty.
+    """
+    # posix_fallocate isn't available on python 2 or some platforms, and some
+    # filesystems don't support it. In those cases we have to make do with a
+    # sparse file.
+    fallocate = getattr(os, "posix_fallocate", None)
+    if fallocate is not None:
+        try:
+            fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                os.ftruncate(fd, 0)
+                raise
+
+    os.ftruncate(fd, size)
+
+
+class SharedMemoryCache(object):
+    """A fixed size cache of byte strings, held in a memory-mapped file so that
+    every process on the host which opens the same file shares its entries.
+
+    The file is split up into equal sized slots, and each key is stored in the
+    slot picked by a CRC of the key, evicting whatever was there before.
+    Entries which don't fit into a slot are not cached.
+
+    Writers take a lock on the slot they are updating. Readers don't take any
+    locks: instead each slot has a sequence number which is odd while the slot
+    is being written to, and a read which sees the sequence number change is
+    treated as a miss.
+
+    Each slot also has a version, which is bumped whenever a key which maps to
+    the slot is invalidated. A process which loads a value from elsewhere can
+    take the version before doing so, and pass it to `set`: if the key has been
+    invalidated in the meantime, the (now stale) value is not stored.
+
+    Args:
+        cache_name (str): name of the cache, for metrics
+        path (str): the file to map. It is created if it doesn't exist.
+        max_size (int): the size of the file, in bytes
+        slot_size (int): the size of each slot, in bytes
+    """
+
+    def __init__(self, cache_name, path, max_size, slot_size=4096):
+        num_slots = (max_size - _SLOTS_OFFSET) // slot_size
+        if num_slots < 1:
+            raise ValueError(
+                "Shared cache size %d is smaller than a single slot" % (max_size,)
+            )
+
+        self._slot_size = slot_size
+        self._num_slots = num_slots
+        self._max_entry_size = slot_size - _SLOT_HEADER.size
+
+        file_size = _SLOTS_OFFSET + num_slots * slot_size
+        header = _FILE_HEADER.pack(_MAGIC, num_slots, slot_size)
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        # Hold an exclusive lock on the file while we check whether someone has
+        # already set it up, so that two processes starting at the same time
+        # don't both try to do so.
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            if os.fstat(self._fd).st_size == 0:
+                allocate_file(self._fd, file_size)
+                self._mmap = mmap.mmap(self._fd, file_size)
+                self._mmap[:_FILE_HEADER.size] = header
+            else:
+                existing_header = os.read(self._fd, _FILE_HEADER.size)
+                if existing_header != header:
+                    raise ValueError(
+                        "Shared cache file %s was created with different"
+                        " settings" % (path,)
+                    )
+                self._mmap = mmap.mmap(self._fd, file_size)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+        self._metrics = register_cache("shared", cache_name, self)
+
+    def _slot_offset(self, key):
+        slot = (zlib.crc32(key) & 0xffffffff) % self._num_slots
+        return _SLOTS_OFFSET + slot * self._slot_size
+
+    @contextmanager
+    def _lock(self, offset, length):
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, length, offset)
+        try:
+            yield
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, length, offset)
+
+    def _lock_slot(self, offset):
+        return self._lock(offset, self._slot_size)
+
+    def _update_entry_count(self, delta):
+        with self._lock(_ENTRY_COUNT_OFFSET, _ENTRY_COUNT.size):
+            count = _ENTRY_COUNT.unpack_from(self._mmap, _ENTRY_COUNT_OFFSET)[0]
+            _ENTRY_COUNT.pack_into(
+                self._mmap, _ENTRY_COUNT_OFFSET, max(count + delta, 0),
+            )
+
+    def get(self, key, default=None):
+        """Look up a key in the cache
+
+        Args:
+            key (bytes): the key to look up
+            default: value to return if the key is not found
+
+        Returns:
+            bytes: the value from the cache, or the default
+        """
+        offset = self._slot_offset(key)
+        seq, _, key_len, value_len = _SLOT_HEADER.unpack_from(self._mmap, offset)
+
+        if seq & 1 or key_len != len(key) or (
+            key_len + value_len > self._max_entry_size
+        ):
+            self._metrics.inc_misses()
+            return default
+
+        start = offset + _SLOT_HEADER.size
+        data = self._mmap[start:start + key_len + value_len]
+
+        # check that the slot wasn't rewritten underneath us
+        if data[:key_len] != key or (
+            _SLOT_SEQ.unpack_from(self._mmap, offset)[0] != seq
+        ):
+            self._metrics.inc_misses()
+            return default
+
+        self._metrics.inc_hits()
+        return data[key_len:]
+
+    def get_version(self, key):
+        """Get the current version of the key's slot, to be passed to `set`
+        once the value for the key has been loaded.
+
+        Args:
+            key (bytes)
+
+        Returns:
+            int
+        """
+        offset = self._slot_offset(key)
+        return _SLOT_VERSION.unpack_from(
+            self._mmap, offset + _SLOT_VERSION_OFFSET,
+        )[0]
+
+    def set(self, key, value, version=None):
+        """Add an entry to the cache, evicting the previous occupant of its slot
+
+        Args:
+            key (bytes)
+            value (bytes)
+            version (int|None): the result of `get_version` from before the
+                value was loaded. If given, the entry is only stored if the
+                key hasn't been invalidated since.
+
+        Returns:
+            bool: whether the entry was stored. Entries which are too big for a
+            slot, or which are out of date, are not.
+        """
+        if len(key) + len(value) > self._max_entry_size:
+            return False
+
+        offset = self._slot_offset(key)
+        start = offset + _SLOT_HEADER.size
+
+        with self._lock_slot(offset):
+            _, slot_version, key_len, _ = _SLOT_HEADER.unpack_from(
+                self._mmap, offset,
+            )
+            if version is not None and version != slot_version:
+                return False
+
+            seq = self._start_write(offset)
+            self._mmap[start:start + len(key) + len(value)] = key + value
+            _SLOT_HEADER.pack_into(
+                self._mmap, offset,
+                (seq + 1) & 0xffffffff, slot_version, len(key), len(value),
+            )
+
+        if not key_len:
+            self._update_entry_count(1)
+
+        return True
+
+    def invalidate(self, key):
+        """Remove the entry for the key, if there is one, and stop any values
+        for the key which are currently being loaded from being stored.
+
+        Args:
+            key (bytes)
+        """
+        offset = self._slot_offset(key)
+        start = offset + _SLOT_HEADER.size
+
+        with self._lock_slot(offset):
+            seq, version, key_len, value_len = _SLOT_HEADER.unpack_from(
+                self._mmap, offset,
+            )
+            version = (version + 1) & 0xffffffff
+
+            removed = (
+                key_len == len(key) and self._mmap[start:start + key_len] == key
+            )
+            if removed:
+                seq = self._start_write(offset)
+                key_len = value_len = 0
+                seq += 1
+
+            # a set which has loaded its value before now will see the new
+            # version and drop the value.
+            _SLOT_HEADER.pack_into(
+                self._mmap, offset, seq & 0xffffffff, version, key_len, value_len,
+            )
+
+        if removed:
+            self._update_entry_count(-1)
+
+    def _start_write(self, offset):
+        """Mark the slot at the given offset as being written to. Must be
+        called with the slot locked.
+
+        Returns:
+            int: the (odd) sequence number of the slot. The write is completed
+            by setting the sequence number to one more than this.
+        """
+        seq = _SLOT_SEQ.unpack_from(self._mmap, offset)[0]
+
+        # an odd sequence number means a process died in the middle of
+        # writing the slot, in which case we skip past it.
+        if seq & 1:
+            seq += 1
+
+        seq = (seq + 1) & 0xffffffff
+        _SLOT_SEQ.pack_into(self._mmap, offset, seq)
+        return seq
+
+    def __len__(self):
+        return _ENTRY_COUNT.unpack_from(self._mmap, _ENTRY_COUNT_OFFSET)[0]
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
@@ -0,0 +1,477 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+
+from six import iteritems
+
+from synapse.util.caches import register_cache
+from synapse.util.caches.shared_memory_cache import allocate_file
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"SYNSTSN2"
+
+# magic, number of index slots, size of the data area
+_FILE_HEADER = struct.Struct("!8sIQ")
+
+# generation, end of the data written so far. The generation is odd while the
+# file is being reset.
+_FILE_STATE = struct.Struct("!IQ")
+_FILE_STATE_OFFSET = _FILE_HEADER.size
+
+# which database the entries came from: sha256 of the server name, the highest
+# state group which has been stored
+_FILE_IDENTITY = struct.Struct("!32sq")
+_FILE_IDENTITY_OFFSET = _FILE_STATE_OFFSET + _FILE_STATE.size
+
+# state group, offset of the entry in the data area, length of the entry
+_INDEX_SLOT = struct.Struct("!qQI")
+_INDEX_START = _FILE_IDENTITY_OFFSET + _FILE_IDENTITY.size
+
+# state group, length of the payload, crc32 of the payload
+_ENTRY_HEADER = struct.Struct("!qII")
+
+# index slots with this state group have been invalidated
+_TOMBSTONE = -1
+
+# how many slots to try when looking up a state group
+_MAX_PROBES = 8
+
+# number of rows, number of strings, length of the string data
+_SNAPSHOT_HEADER = struct.Struct("=III")
+
+
+class StateSnapshotCache(object):
+    """A cache of the full state at each state group, held in a memory-mapped
+    file so that it survives restarts and is shared between every process on
+    the host which opens the same file.
+
+    The file has an index of fixed size slots, keyed by state group, pointing
+    into a data area which entries are appended to. State groups never change,
+    so entries are only ever removed when their state group is purged, or
+    when the data area fills up and the whole file is reset.
+
+    Writers lock the whole file. Readers don't take any locks: instead the
+    file has a generation number which is changed whenever the file is reset,
+    and a read which sees it change is treated as a miss.
+
+    As state group ids are only unique within a database, the file records the
+    server it belongs to and the highest state group stored in it. It is reset
+    on startup if either shows that it was written from another database, eg
+    because the database has since been restored from a backup and the later
+    state group ids will be reused.
+
+    Args:
+        cache_name (str): name of the cache, for metrics
+        path (str): the file to map. It is created if it doesn't exist.
+        max_size (int): the size of the file, in bytes
+        server_name (str): the name of the server whose database the state
+            groups are from
+        max_state_group (int): the highest state group in the database
+    """
+
+    def __init__(self, cache_name, path, max_size, server_name, max_state_group):
+        num_slots = max(1024, max_size // 4096)
+        data_start = _INDEX_START + num_slots * _INDEX_SLOT.size
+        data_size = max_size - data_start
+        if data_size <= 0:
+            raise ValueError(
+                "State snapshot cache size %d is too small" % (max_size,)
+            )
+
+        self._num_slots = num_slots
+        self._data_start = data_start
+        self._data_size = data_size
+
+        header = _FILE_HEADER.pack(_MAGIC, num_slots, data_size)
+        self._server_hash = hashlib.sha256(server_name.encode("utf-8")).digest()
+
+        self._lock = threading.Lock()
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            if os.fstat(self._fd).st_size == 0:
+                allocate_file(self._fd, max_size)
+                self._mmap = mmap.mmap(self._fd, max_size)
+                self._mmap[:_FILE_HEADER.size] = header
+                _FILE_IDENTITY.pack_into(
+                    self._mmap, _FILE_IDENTITY_OFFSET,
+                    self._server_hash, max_state_group,
+                )
+            else:
+                existing_header = os.read(self._fd, _FILE_HEADER.size)
+                if existing_header != header:
+                    raise ValueError(
+                        "State snapshot cache file %s was created with"
+                        " different settings" % (path,)
+                    )
+                self._mmap = mmap.mmap(self._fd, max_size)
+                self._check_identity(max_state_group)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+        self._metrics = register_cache("state_snapshot", cache_name, self)
+
+    def _check_identity(self, max_state_group):
+        """Reset the file if its entries can't have come from our database.
+        Must be called with the file locked.
+        """
+        server_hash, stored_max = _FILE_IDENTITY.unpack_from(
+            self._mmap, _FILE_IDENTITY_OFFSET,
+        )
+        if server_hash == self._server_hash and stored_max <= max_state_group:
+            return
+
+        logger.warning(
+            "State snapshot cache was written from a different database:"
+            " resetting it",
+        )
+        generation, _ = _FILE_STATE.unpack_from(self._mmap, _FILE_STATE_OFFSET)
+        self._reset(generation)
+        _FILE_IDENTITY.pack_into(
+            self._mmap, _FILE_IDENTITY_OFFSET, self._server_hash, max_state_group,
+        )
+
+    @contextmanager
+    def _write_lock(self):
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _slot_offsets(self, state_group):
+        for i in range(_MAX_PROBES):
+            slot = (state_group + i) % self._num_slots
+            yield _INDEX_START + slot * _INDEX_SLOT.size
+
+    def get(self, state_group):
+        """Look up the snapshot for a state group
+
+        Args:
+            state_group (int)
+
+        Returns:
+            bytes|None: the encoded snapshot, as passed to `set`, or None if
+            the state group isn't in the cache.
+        """
+        generation, _ = _FILE_STATE.unpack_from(self._mmap, _FILE_STATE_OFFSET)
+        if generation & 1:
+            self._metrics.inc_misses()
+            return None
+
+        for offset in self._slot_offsets(state_group):
+            slot_group, entry_offset, entry_len = _INDEX_SLOT.unpack_from(
+                self._mmap, offset,
+            )
+            if slot_group == 0:
+                break
+            if slot_group != state_group:
+                continue
+
+            start = self._data_start + entry_offset
+            entry = self._mmap[start:start + entry_len]
+
+            # check that the file wasn't reset underneath us, and that the
+            # entry is complete.
+            if _FILE_STATE.unpack_from(
+                self._mmap, _FILE_STATE_OFFSET,
+            )[0] != generation or len(entry) < _ENTRY_HEADER.size:
+                break
+
+            entry_group, payload_len, crc = _ENTRY_HEADER.unpack_from(entry)
+            payload = entry[_ENTRY_HEADER.size:]
+            if entry_group != state_group or len(payload) != payload_len or (
+                zlib.crc32(payload) & 0xffffffff
+            ) != crc:
+                break
+
+            self._metrics.inc_hits()
+            return payload
+
+        self._metrics.inc_misses()
+        return None
+
+    def set(self, state_group, payload):
+        """Add the snapshot for a state group to the cache.
+
+        Args:
+            state_group (int)
+            payload (bytes): the encoded snapshot, from `encode_state_snapshot`
+
+        Returns:
+            bool: whether the entry was stored. Entries which are too big for
+            the file are not.
+        """
+        entry = _ENTRY_HEADER.pack(
+            state_group, len(payload), zlib.crc32(payload) & 0xffffffff,
+        ) + payload
+
+        if len(entry) > self._data_size:
+            return False
+
+        with self._write_lock():
+            free_slot = None
+            for offset in self._slot_offsets(state_group):
+                slot_group = _INDEX_SLOT.unpack_from(self._mmap, offset)[0]
+                if slot_group == state_group:
+                    # state groups never change, so there's nothing to do
+                    return True
+                if free_slot is None and slot_group in (0, _TOMBSTONE):
+                    free_slot = offset
+                if slot_group == 0:
+                    break
+
+            if free_slot is None:
+                # all the slots are full, so we replace the first one.
+                free_slot = next(self._slot_offsets(state_group))
+
+            generation, data_end = _FILE_STATE.unpack_from(
+                self._mmap, _FILE_STATE_OFFSET,
+            )
+            if data_end + len(entry) > self._data_size:
+                logger.info("State snapshot cache is full: resetting it")
+                self._reset(generation)
+                generation, data_end = _FILE_STATE.unpack_from(
+                    self._mmap, _FILE_STATE_OFFSET,
+                )
+                free_slot = next(self._slot_offsets(state_group))
+
+            start = self._data_start + data_end
+            self._mmap[start:start + len(entry)] = entry
+            _FILE_STATE.pack_into(
+                self._mmap, _FILE_STATE_OFFSET, generation, data_end + len(entry),
+            )
+
+            # Fill in the slot with an invalid state group first, so that
+            # readers don't see the state group until the rest of it is there.
+            _INDEX_SLOT.pack_into(
+                self._mmap, free_slot, _TOMBSTONE, data_end, len(entry),
+            )
+            _INDEX_SLOT.pack_into(
+                self._mmap, free_slot, state_group, data_end, len(entry),
+            )
+
+            server_hash, stored_max = _FILE_IDENTITY.unpack_from(
+                self._mmap, _FILE_IDENTITY_OFFSET,
+            )
+            if state_group > stored_max:
+                _FILE_IDENTITY.pack_into(
+                    self._mmap, _FILE_IDENTITY_OFFSET, server_hash, state_group,
+                )
+
+        return True
+
+    def invalidate(self, state_group):
+        """Remove the entry for a state group, if there is one
+
+        Args:
+            state_group (int)
+        """
+        with self._write_lock():
+            for offset in self._slot_offsets(state_group):
+                slot_group, entry_offset, entry_len = _INDEX_SLOT.unpack_from(
+                    self._mmap, offset,
+                )
+                if slot_group == 0:
+                    return
+                if slot_group == state_group:
+                    _INDEX_SLOT.pack_into(
+                        self._mmap, offset, _TOMBSTONE, entry_offset, entry_len,
+                    )
+
+    def _reset(self, generation):
+        """Empty the cache. Must be called with the write lock held.
+        """
+        _FILE_STATE.pack_into(
+            self._mmap, _FILE_STATE_OFFSET, (generation + 1) & 0xffffffff, 0,
+        )
+        index_len = self._num_slots * _INDEX_SLOT.size
+        self._mmap[_INDEX_START:_INDEX_START + index_len] = b"\0" * index_len
+        _FILE_STATE.pack_into(
+            self._mmap, _FILE_STATE_OFFSET, (generation + 2) & 0xffffffff, 0,
+        )
+
+    def __len__(self):
+        count = 0
+        for slot in range(self._num_slots):
+            offset = _INDEX_START + slot * _INDEX_SLOT.size
+            if _INDEX_SLOT.unpack_from(self._mmap, offset)[0] > 0:
+                count += 1
+        return count
+
+    def close(self):
+        self._mmap.close()
+        os.close(self._fd)
+
+
+def encode_state_snapshot(state):
+    """Encode a state map for the state snapshot cache.
+
+    The strings in the map are stored once each, in sorted order, and the map
+    itself as three columns of string ids, sorted by (type, state_key).
+
+    Args:
+        state (dict[tuple[str, str], str]): map from (type, state_key) to
+            event_id
+
+    Returns:
+        bytes
+    """
+    strings = set()
+    for (typ, state_key), event_id in iteritems(state):
+        strings.add(typ.encode("utf-8"))
+        strings.add(state_key.encode("utf-8"))
+        strings.add(event_id.encode("utf-8"))
+
+    strings = sorted(strings)
+    string_ids = {s: i for i, s in enumerate(strings)}
+
+    offsets = [0]
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+
+    rows = sorted(
+        (
+            string_ids[typ.encode("utf-8")],
+            string_ids[state_key.encode("utf-8")],
+            string_ids[event_id.encode("utf-8")],
+        )
+        for (typ, state_key), event_id in iteritems(state)
+    )
+
+    num_rows = len(rows)
+    columns = list(zip(*rows)) if rows else [(), (), ()]
+
+    return b"".join([
+        _SNAPSHOT_HEADER.pack(num_rows, len(strings), offsets[-1]),
+        struct.pack("=%dI" % (len(offsets),), *offsets),
+        b"".join(strings),
+        struct.pack("=%dI" % (num_rows,), *columns[0]),
+        struct.pack("=%dI" % (num_rows,), *columns[1]),
+        struct.pack("=%dI" % (num_rows,), *columns[2]),
+    ])
+
+
+class StateSnapshot(object):
+    """A state map encoded by `encode_state_snapshot`, which can be filtered
+    without decoding the whole thing.
+
+    Args:
+        payload (bytes)
+    """
+
+    __slots__ = ["_offsets", "_strings", "_types", "_state_keys", "_event_ids"]
+
+    def __init__(self, payload):
+        num_rows, num_strings, strings_len = _SNAPSHOT_HEADER.unpack_from(payload)
+        pos = _SNAPSHOT_HEADER.size
+
+        self._offsets = struct.unpack_from("=%dI" % (num_strings + 1,), payload, pos)
+        pos += 4 * (num_strings + 1)
+
+        self._strings = payload[pos:pos + strings_len]
+        pos += strings_len
+
+        column = struct.Struct("=%dI" % (num_rows,))
+        self._types = column.unpack_from(payload, pos)
+        self._state_keys = column.unpack_from(payload, pos + column.size)
+        self._event_ids = column.unpack_from(payload, pos + 2 * column.size)
+
+    def _get_string(self, string_id):
+        return self._strings[
+            self._offsets[string_id]:self._offsets[string_id + 1]
+        ].decode("utf-8")
+
+    def _find_string(self, s):
+        """Find the id of a string, by binary search of the sorted strings.
+
+        Returns:
+            int|None
+        """
+        s = s.encode("utf-8")
+        lo, hi = 0, len(self._offsets) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            candidate = self._strings[self._offsets[mid]:self._offsets[mid + 1]]
+            if candidate < s:
+                lo = mid + 1
+            elif candidate > s:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def _get_rows(self, lo, hi, state):
+        for i in range(lo, hi):
+            key = (
+                self._get_string(self._types[i]),
+                self._get_string(self._state_keys[i]),
+            )
+            state[key] = self._get_string(self._event_ids[i])
+
+    def filter_state(self, state_filter):
+        """Get the state which matches a filter.
+
+        Args:
+            state_filter (StateFilter)
+
+        Returns:
+            dict[tuple[str, str], str]: map from (type, state_key) to event_id
+        """
+        state = {}
+
+        if state_filter.is_full() or state_filter.include_others:
+            self._get_rows(0, len(self._types), state)
+            return state_filter.filter_state(state)
+
+        for typ, state_keys in iteritems(state_filter.types):
+            type_id = self._find_string(typ)
+            if type_id is None:
+                continue
+
+            # the rows are sorted by type then state key, so the rows for each
+            # type (and each state key within it) are next to each other.
+            lo = bisect_left(self._types, type_id)
+            hi = bisect_right(self._types, type_id)
+
+            if state_keys is None:
+                self._get_rows(lo, hi, state)
+                continue
+
+            type_state_keys = self._state_keys[lo:hi]
+            for state_key in state_keys:
+                state_key_id = self._find_string(state_key)
+                if state_key_id is None:
+                    continue
+                i = bisect_left(type_state_keys, state_key_id)
+                if i < len(type_state_keys) and type_state_keys[i] == state_key_id:
+                    self._get_rows(lo + i, lo + i + 1, state)
+
+        return state
@@ -14,10 +14,11 @@
 # limitations under the License.
 import time
 
-from mock import Mock
+from mock import Mock, patch
 
 import signedjson.key
 import signedjson.sign
+from signedjson.sign import encode_canonical_json
 
 from twisted.internet import defer, reactor
 
@@ -38,12 +39,14 @@ class MockPerspectiveServer(object):
         vk = signedjson.key.get_verify_key(self.key)
         return {"%s:%s" % (vk.alg, vk.version): vk}
 
-    def get_signed_key(self, server_name, verify_key):
+    def get_signed_key(self, server_name, verify_key, valid_until_ts=None):
+        if valid_until_ts is None:
+            valid_until_ts = time.time() * 1000 + 3600
         key_id = "%s:%s" % (verify_key.alg, verify_key.version)
         res = {
             "server_name": server_name,
             "old_verify_keys": {},
-            "valid_until_ts": time.time() * 1000 + 3600,
+            "valid_until_ts": valid_until_ts,
             "verify_keys": {
                 key_id: {"key": signedjson.key.encode_verify_key_base64(verify_key)}
             },
@@ -223,3 +226,164 @@ class KeyringTestCase(unittest.TestCase):
             yield defer
 
             self.assertIs(LoggingContext.current_context(), context_one)
+
+    @defer.inlineCallbacks
+    def _verify_many(self, kr):
+        key1 = signedjson.key.generate_signing_key(1)
+        yield self.hs.datastore.store_server_verify_key(
+            "server9", "", time.time() * 1000, signedjson.key.get_verify_key(key1)
+        )
+
+        json_objects = []
+        for i in range(5):
+            json_object = {"i": i}
+            signedjson.sign.sign_json(json_object, "server9", key1)
+            json_objects.append(json_object)
+
+        # tamper with one of them
+        json_objects[3]["i"] = 10
+
+        verify_signatures = Mock(side_effect=keyring._verify_signatures)
+        with patch.object(keyring, "_verify_signatures", verify_signatures):
+            res_deferreds = kr.verify_json_objects_for_server(
+                [("server9", json_object) for json_object in json_objects]
+            )
+            results = yield defer.DeferredList(res_deferreds, consumeErrors=True)
+
+        for i, (success, result) in enumerate(results):
+            if i == 3:
+                self.assertFalse(success)
+                self.assertIsInstance(result.value, SynapseError)
+            else:
+                self.assertTrue(success)
+
+        defer.returnValue(verify_signatures)
+
+    @defer.inlineCallbacks
+    def test_verify_json_objects(self):
+        kr = keyring.Keyring(self.hs)
+        verify_signatures = yield self._verify_many(kr)
+
+        # on the main thread, the signatures are checked straight away
+        verify_signatures.assert_not_called()
+
+    @defer.inlineCallbacks
+    def test_verify_json_objects_in_threadpool(self):
+        self.hs.config.verify_signatures_in_threadpool = True
+        kr = keyring.Keyring(self.hs)
+        # the batch is checked on a later reactor tick
+        kr.clock = Clock(reactor)
+        verify_signatures = yield self._verify_many(kr)
+
+        # the signatures were all checked together
+        verify_signatures.assert_called_once()
+        self.assertEqual(len(verify_signatures.call_args[0][0]), 5)
+
+    @defer.inlineCallbacks
+    def test_verify_key_cache_warmed_from_db(self):
+        kr = keyring.Keyring(self.hs)
+
+        key1 = signedjson.key.generate_signing_key(1)
+        verify_key = signedjson.key.get_verify_key(key1)
+        key_json = self.mock_perspective_server.get_signed_key(
+            "server9", verify_key, valid_until_ts=kr.clock.time_msec() + 3600 * 1000,
+        )
+        yield self.hs.datastore.store_server_keys_json(
+            server_name="server9",
+            key_id="ed25519:1",
+            from_server="server9",
+            ts_now_ms=kr.clock.time_msec(),
+            ts_expires_ms=key_json["valid_until_ts"],
+            key_json_bytes=encode_canonical_json(key_json),
+        )
+
+        yield kr._warm_key_cache()
+        self.assertTrue(kr._verify_key_cache.contains("server9"))
+
+        # the key isn't in server_signature_keys, so we must be using the cache
+        json1 = {}
+        signedjson.sign.sign_json(json1, "server9", key1)
+        yield kr.verify_json_for_server("server9", json1)
+        self.http_client.post_json.assert_not_called()
+
+    @defer.inlineCallbacks
+    def test_refresh_expiring_keys(self):
+        kr = keyring.Keyring(self.hs)
+        now = kr.clock.time_msec()
+
+        key1 = signedjson.key.generate_signing_key(1)
+        verify_key = signedjson.key.get_verify_key(key1)
+
+        # server9's keys are about to expire, server10's are about to expire
+        # but we haven't heard from it for a while, server11's are fine, and
+        # server12's have expired.
+        kr._cache_verify_keys("server9", {"ed25519:1": verify_key}, now + 1000)
+        kr._cache_verify_keys("server10", {"ed25519:1": verify_key}, now + 1000)
+        kr._cache_verify_keys(
+            "server11", {"ed25519:1": verify_key}, now + 7 * 24 * 3600 * 1000,
+        )
+        kr._cache_verify_keys("server12", {"ed25519:1": verify_key}, now - 1000)
+        for server_name, last_used in (
+            ("server9", now),
+            ("server10", now - 7 * 24 * 3600 * 1000),
+            ("server11", now),
+            ("server12", now - 7 * 24 * 3600 * 1000),
+        ):
+            kr._verify_key_cache.get(server_name).last_used_ms = last_used
+
+        new_valid_until = now + 7 * 24 * 3600 * 1000
+        self.http_client.post_json.return_value = defer.succeed({
+            "server_keys": [
+                self.mock_perspective_server.get_signed_key(
+                    "server9", verify_key, valid_until_ts=new_valid_until,
+                ),
+            ],
+        })
+
+        yield kr._refresh_expiring_keys()
+
+        # we asked the perspective server about server9 in one request
+        self.http_client.post_json.assert_called_once()
+        server_keys = self.http_client.post_json.call_args[1]["data"]["server_keys"]
+        self.assertEqual(list(server_keys), ["server9"])
+        self.assertEqual(
+            kr._verify_key_cache.get("server9").valid_until_ms, new_valid_until,
+        )
+
+        # and forgot about server12
+        self.assertFalse(kr._verify_key_cache.contains("server12"))
+        self.assertTrue(kr._verify_key_cache.contains("server10"))
+
+    @defer.inlineCallbacks
+    def test_last_used_after_verification(self):
+        kr = keyring.Keyring(self.hs)
+
+        key1 = signedjson.key.generate_signing_key(1)
+        kr._cache_verify_keys(
+            "server9", {"ed25519:1": signedjson.key.get_verify_key(key1)},
+        )
+        cached = kr._verify_key_cache.get("server9")
+
+        # a bad signature doesn't count as using the keys
+        json1 = {}
+        signedjson.sign.sign_json(json1, "server9", key1)
+        json1["tampered"] = True
+        yield self.assertFailure(
+            kr.verify_json_for_server("server9", json1), SynapseError,
+        )
+        self.assertEqual(cached.last_used_ms, 0)
+
+        # nor does an unknown server
+        json2 = {}
+        signedjson.sign.sign_json(json2, "server10", key1)
+        self.http_client.get_json.side_effect = Exception("unreachable")
+        self.http_client.post_json.side_effect = Exception("unreachable")
+        yield self.assertFailure(
+            kr.verify_json_for_server("server10", json2), SynapseError,
+        )
+        self.assertFalse(kr._verify_key_cache.contains("server10"))
+
+        json3 = {}
+        signedjson.sign.sign_json(json3, "server9", key1)
+        yield kr.verify_json_for_server("server9", json3)
+        self.assertEqual(cached.last_used_ms, kr.clock.time_msec())
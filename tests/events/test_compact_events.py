@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.events import (
+    CompactFrozenEvent,
+    CompactFrozenEventV2,
+    FrozenEvent,
+    FrozenEventV2,
+)
+from synapse.events.utils import prune_event
+
+from .. import unittest
+
+V1_EVENT = {
+    "event_id": "$3:domain",
+    "type": "m.room.member",
+    "state_key": "@2:domain",
+    "room_id": "!1:domain",
+    "sender": "@2:domain",
+    "origin": "domain",
+    "origin_server_ts": 1234,
+    "depth": 5,
+    "content": {"membership": "join", "displayname": "Two"},
+    "prev_events": [["$1:domain", {"sha256": "abc"}]],
+    "auth_events": [["$0:domain", {"sha256": "def"}]],
+    "hashes": {"sha256": "ghi"},
+    "signatures": {"domain": {"ed25519:1": "sig"}},
+    "unsigned": {"age_ts": 1000},
+}
+
+V2_EVENT = {
+    "type": "m.room.message",
+    "room_id": "!1:domain",
+    "sender": "@2:domain",
+    "origin": "domain",
+    "origin_server_ts": 1234,
+    "depth": 5,
+    "content": {"body": "hello"},
+    "prev_events": ["$abc"],
+    "auth_events": ["$def", "$ghi"],
+    "hashes": {"sha256": "jkl"},
+    "signatures": {"domain": {"ed25519:1": "sig"}},
+    "unsigned": {},
+}
+
+
+class CompactEventTestCase(unittest.TestCase):
+    def test_v1_matches_frozen_event(self):
+        compact = CompactFrozenEvent(V1_EVENT, {"outlier": True})
+        frozen = FrozenEvent(V1_EVENT, {"outlier": True})
+
+        self.assertEqual(compact.get_dict(), frozen.get_dict())
+        self.assertEqual(compact.get_pdu_json(), frozen.get_pdu_json())
+        self.assertEqual(compact.event_id, "$3:domain")
+        self.assertEqual(compact.membership, "join")
+        self.assertEqual(compact.user_id, "@2:domain")
+        self.assertEqual(compact.prev_event_ids(), frozen.prev_event_ids())
+        self.assertEqual(compact.auth_event_ids(), frozen.auth_event_ids())
+        self.assertTrue(compact.is_state())
+        self.assertTrue(compact.internal_metadata.is_outlier())
+
+    def test_v2_matches_frozen_event(self):
+        compact = CompactFrozenEventV2(V2_EVENT)
+        frozen = FrozenEventV2(V2_EVENT)
+
+        self.assertEqual(compact.get_dict(), frozen.get_dict())
+        self.assertEqual(compact.event_id, frozen.event_id)
+        self.assertEqual(compact.prev_event_ids(), ["$abc"])
+        self.assertEqual(compact.auth_event_ids(), ["$def", "$ghi"])
+        self.assertFalse(compact.is_state())
+
+    def test_missing_fields(self):
+        compact = CompactFrozenEvent(V1_EVENT)
+
+        self.assertFalse(hasattr(compact, "redacts"))
+        self.assertIsNone(compact.get("redacts"))
+        self.assertNotIn("redacts", compact)
+        self.assertIn("hashes", compact)
+
+    def test_content_is_decoded_lazily(self):
+        compact = CompactFrozenEvent(V1_EVENT)
+
+        self.assertIsNone(compact._content)
+        self.assertEqual(compact["content"]["displayname"], "Two")
+        self.assertIsNotNone(compact._content)
+
+    def test_prune(self):
+        compact = CompactFrozenEvent(V1_EVENT)
+        frozen = FrozenEvent(V1_EVENT)
+
+        self.assertEqual(
+            prune_event(compact).get_dict(), prune_event(frozen).get_dict(),
+        )
+
+    def test_no_dict(self):
+        compact = CompactFrozenEvent(V1_EVENT)
+
+        self.assertFalse(hasattr(compact, "__dict__"))
@@ -17,6 +17,15 @@ from mock import Mock
 
 from twisted.internet import defer
 
+from synapse.api.constants import EventTypes, Membership, RoomVersions
+from synapse.api.errors import RequestSendFailed
+from synapse.federation.sender import (
+    CATCH_UP_STARTUP_INTERVAL_SEC,
+    get_shard_for_destination,
+)
+from synapse.replication.tcp.resource import ReplicationStreamer
+from synapse.rest import admin
+from synapse.rest.client.v1 import login, room
 from synapse.types import ReadReceipt
 
 from tests.unittest import HomeserverTestCase
@@ -126,3 +135,291 @@ class FederationSenderTestCases(HomeserverTestCase):
                 },
             },
         ])
+
+
+class ShardedFederationSenderTestCases(HomeserverTestCase):
+    def make_homeserver(self, reactor, clock):
+        config = self.default_config()
+        config.worker_app = "synapse.app.federation_sender"
+        config.worker_name = "sender1"
+        config.federation_sender_instances = ["sender0", "sender1", "sender2"]
+
+        return super(ShardedFederationSenderTestCases, self).setup_test_homeserver(
+            config=config,
+            state_handler=Mock(spec=["get_current_hosts_in_room"]),
+            federation_transport_client=Mock(spec=["send_transaction"]),
+        )
+
+    def test_shard_for_destination(self):
+        self.assertEqual(get_shard_for_destination("example.com", 3), 2)
+        self.assertEqual(get_shard_for_destination("matrix.org", 3), 0)
+
+        shards = set(
+            get_shard_for_destination("host%i" % (i,), 3) for i in range(100)
+        )
+        self.assertEqual(shards, {0, 1, 2})
+
+    def test_only_send_to_own_destinations(self):
+        hosts = ["host%i" % (i,) for i in range(20)]
+        mock_state_handler = self.hs.get_state_handler()
+        mock_state_handler.get_current_hosts_in_room.return_value = hosts
+
+        mock_send_transaction = self.hs.get_federation_transport_client().send_transaction
+        mock_send_transaction.return_value = defer.succeed({})
+
+        sender = self.hs.get_federation_sender()
+        receipt = ReadReceipt("room_id", "m.read", "user_id", ["event_id"], {"ts": 1234})
+        self.successResultOf(sender.send_read_receipt(receipt))
+        self.pump()
+
+        expected = [h for h in hosts if get_shard_for_destination(h, 3) == 1]
+        self.assertTrue(expected)
+        self.assertEqual(
+            sorted(c[0][0].destination for c in mock_send_transaction.call_args_list),
+            sorted(expected),
+        )
+
+        # EDUs for other shards' destinations are dropped
+        for host in hosts:
+            sender.build_and_send_edu(host, "m.test", {})
+        self.assertEqual(sorted(sender._per_destination_queues), sorted(expected))
+
+    def test_positions(self):
+        store = self.hs.get_datastore()
+        sender = self.hs.get_federation_sender()
+        self.assertEqual(sender.instance_name, "sender1")
+
+        # the position from before sending was sharded
+        self.get_success(store.update_federation_out_pos("events", 5))
+
+        # every shard starts from there, and the old position is retired
+        for name in ("sender0", "sender1", "sender2"):
+            self.assertEqual(
+                self.get_success(store.get_federation_out_pos("events", name)), 5,
+            )
+        self.assertIsNone(self.get_success(store.get_federation_out_pos("events")))
+
+        self.get_success(store.update_federation_out_pos("events", 10, "sender0"))
+        self.get_success(store.update_federation_out_pos("events", 20, "sender1"))
+        self.get_success(store.update_federation_out_pos("events", 7, "sender2"))
+        self.assertEqual(
+            self.get_success(store.get_federation_out_pos("events", "sender1")), 20,
+        )
+
+        # when the shards change, they all go back to the furthest behind, as
+        # their destinations may have been sent to by a different shard
+        self.get_success(store.runInteraction(
+            "reconcile", store.reconcile_federation_out_pos_txn,
+            ["sender0", "sender1", "sender3"],
+        ))
+        for name in ("sender0", "sender1", "sender3"):
+            self.assertEqual(
+                self.get_success(store.get_federation_out_pos("events", name)), 7,
+            )
+        self.assertIsNone(
+            self.get_success(store.get_federation_out_pos("events", "sender2")),
+        )
+
+    def test_federation_ack(self):
+        streamer = ReplicationStreamer(self.hs)
+        streamer.federation_sender = Mock(spec=["federation_ack"])
+
+        # nothing is dropped until every shard has acked
+        streamer.federation_ack(10, "sender0")
+        streamer.federation_ack(12, "sender1")
+        streamer.federation_sender.federation_ack.assert_not_called()
+
+        streamer.federation_ack(11, "sender2")
+        streamer.federation_sender.federation_ack.assert_called_once_with(10)
+
+        streamer.federation_ack(15, "sender0")
+        streamer.federation_sender.federation_ack.assert_called_with(11)
+
+
+class FederationCatchUpTestCases(HomeserverTestCase):
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+    ]
+
+    def make_homeserver(self, reactor, clock):
+        return self.setup_test_homeserver(
+            federation_transport_client=Mock(spec=["send_transaction"]),
+        )
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.sender = hs.get_federation_sender()
+
+        self.user_id = self.register_user("user", "pass")
+        self.tok = self.login("user", "pass")
+        self.room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+        self.pump()
+
+        # from now on, pretend there is another server in the room
+        hs.get_state_handler().get_current_hosts_in_room = Mock(
+            side_effect=lambda *args, **kwargs: defer.succeed(["test", "host2"]),
+        )
+        self.store.get_joined_host_counts_before = Mock(
+            side_effect=lambda *args: defer.succeed({"test": 1, "host2": 1}),
+        )
+
+        self.sent_pdus = []
+        self.fail_sends = False
+
+        def send_transaction(transaction, json_data_cb):
+            if self.fail_sends:
+                return defer.fail(RequestSendFailed(Exception("down"), False))
+            self.sent_pdus.append(
+                [pdu["event_id"] for pdu in json_data_cb()["pdus"]],
+            )
+            return defer.succeed({})
+
+        hs.get_federation_transport_client().send_transaction.side_effect = (
+            send_transaction
+        )
+
+    def _send_message(self):
+        event_id = self.helper.send(self.room_id, "hi", tok=self.tok)["event_id"]
+        self.pump()
+        return event_id
+
+    def _get_last_successful_stream_ordering(self):
+        return self.get_success(
+            self.store.get_destination_last_successful_stream_ordering("host2"),
+        )
+
+    def test_catch_up(self):
+        first_id = self._send_message()
+        self.assertEqual(self.sent_pdus, [[first_id]])
+        first_ordering = self._get_last_successful_stream_ordering()
+        self.assertIsNotNone(first_ordering)
+
+        # host2 goes down: nothing is held in memory for it
+        self.fail_sends = True
+        for _ in range(3):
+            self._send_message()
+        queue = self.sender._per_destination_queues["host2"]
+        self.assertTrue(queue._catching_up)
+        self.assertEqual(queue._pending_pdus, [])
+        self.assertEqual(self._get_last_successful_stream_ordering(), first_ordering)
+
+        # when it comes back, it is just sent the latest event in the room
+        self.fail_sends = False
+        self.sent_pdus = []
+        last_id = self._send_message()
+        self.assertEqual(self.sent_pdus, [[last_id]])
+        self.assertFalse(queue._catching_up)
+        self.assertGreater(self._get_last_successful_stream_ordering(), first_ordering)
+
+        # and then new events are sent as normal
+        self.sent_pdus = []
+        next_id = self._send_message()
+        self.assertEqual(self.sent_pdus, [[next_id]])
+
+    def test_wake_destinations_after_restart(self):
+        self._send_message()
+
+        self.fail_sends = True
+        missed_id = self._send_message()
+
+        # forget about host2, as if we had restarted
+        self.sender._per_destination_queues = {}
+        self.fail_sends = False
+        self.sent_pdus = []
+
+        d = self.sender._wake_destinations_needing_catchup()
+        self.pump()
+        self.assertEqual(self.sent_pdus, [[missed_id]])
+
+        # it waits a while before looking for the next batch
+        self.reactor.advance(CATCH_UP_STARTUP_INTERVAL_SEC)
+        self.successResultOf(d)
+
+        # now that it has caught up, there's nothing left to wake
+        self.assertEqual(
+            self.get_success(
+                self.store.get_catch_up_outstanding_destinations("", 10),
+            ),
+            [],
+        )
+
+
+class FederationSenderDestinationsTestCases(HomeserverTestCase):
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+    ]
+
+    def make_homeserver(self, reactor, clock):
+        return self.setup_test_homeserver(
+            federation_transport_client=Mock(spec=["send_transaction"]),
+        )
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+        self.user_id = self.register_user("user", "pass")
+        self.tok = self.login("user", "pass")
+        self.room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+
+        # a user on another server joins the room
+        builder = hs.get_event_builder_factory().new(
+            RoomVersions.V1,
+            {
+                "type": EventTypes.Member,
+                "sender": "@charlie:host2",
+                "state_key": "@charlie:host2",
+                "room_id": self.room_id,
+                "content": {"membership": Membership.JOIN},
+            }
+        )
+        event, context = self.get_success(
+            hs.get_event_creation_handler().create_new_client_event(builder)
+        )
+        self.get_success(self.store.persist_event(event, context))
+        self.pump()
+
+        self.state_handler = hs.get_state_handler()
+        self.state_handler.get_current_hosts_in_room = Mock(
+            wraps=self.state_handler.get_current_hosts_in_room,
+        )
+
+        self.sent_pdus = []
+
+        def send_transaction(transaction, json_data_cb):
+            for pdu in json_data_cb()["pdus"]:
+                self.sent_pdus.append((transaction.destination, pdu["event_id"]))
+            return defer.succeed({})
+
+        hs.get_federation_transport_client().send_transaction.side_effect = (
+            send_transaction
+        )
+
+    def test_uses_joined_hosts_index(self):
+        event_id = self.helper.send(self.room_id, "hi", tok=self.tok)["event_id"]
+        self.pump()
+
+        self.assertEqual(self.sent_pdus, [("host2", event_id)])
+        self.state_handler.get_current_hosts_in_room.assert_not_called()
+
+    def test_ban_is_sent_to_banned_server(self):
+        self.helper.change_membership(
+            self.room_id, self.user_id, "@charlie:host2", Membership.BAN,
+            tok=self.tok,
+        )
+        self.pump()
+        state = self.get_success(self.store.get_current_state_ids(self.room_id))
+        ban_id = state[(EventTypes.Member, "@charlie:host2")]
+
+        # the ban changed the current state, so the hosts were calculated from
+        # the state before it.
+        self.assertEqual(self.sent_pdus, [("host2", ban_id)])
+        self.assertEqual(self.state_handler.get_current_hosts_in_room.call_count, 1)
+
+        self.sent_pdus = []
+        self.helper.send(self.room_id, "hi", tok=self.tok)
+        self.pump()
+        self.assertEqual(self.sent_pdus, [])
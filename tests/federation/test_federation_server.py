@@ -14,8 +14,20 @@
 # limitations under the License.
 import logging
 
+from mock import Mock
+
+from twisted.internet import defer
+
 from synapse.events import FrozenEvent
-from synapse.federation.federation_server import server_matches_acl_event
+from synapse.federation.federation_server import (
+    BACKFILL_PDU_AGE_MS,
+    MAX_STAGED_PDUS_PER_ORIGIN,
+    PDU_PRIORITY_BACKFILL,
+    PDU_PRIORITY_LIVE,
+    server_matches_acl_event,
+)
+from synapse.rest.client.v1 import admin, login, room
+from synapse.util.logcontext import make_deferred_yieldable
 
 from tests import unittest
 
@@ -42,6 +54,178 @@ class ServerACLsTestCase(unittest.TestCase):
         self.assertTrue(server_matches_acl_event("1:2:3:4", e))
 
 
+class StagedPdusTestCase(unittest.HomeserverTestCase):
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+    ]
+
+    def make_homeserver(self, reactor, clock):
+        config = self.default_config()
+        config.stage_incoming_federation_events = True
+        return self.setup_test_homeserver(config=config)
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.federation_server = hs.get_federation_server()
+
+        # record the PDUs we're asked to handle, and block on each of them
+        # until the test says so.
+        self.handled = []
+        self.handling = []
+
+        def handle_received_pdu(origin, pdu):
+            self.handled.append(pdu.event_id)
+            d = defer.Deferred()
+            self.handling.append(d)
+            return make_deferred_yieldable(d)
+
+        self.federation_server._handle_received_pdu = Mock(
+            side_effect=handle_received_pdu,
+        )
+
+        self.user_id = self.register_user("user", "pass")
+        self.tok = self.login("user", "pass")
+
+    def _make_pdu(self, room_id, i, age=0):
+        return {
+            "event_id": "$%i:other.example.com" % (i,),
+            "room_id": room_id,
+            "type": "m.room.message",
+            "sender": "@remote:other.example.com",
+            "origin": "other.example.com",
+            "origin_server_ts": self.clock.time_msec() - age,
+            "depth": 10 + i,
+            "prev_events": [],
+            "auth_events": [],
+            "content": {"body": "message %i" % (i,)},
+        }
+
+    def _send_transaction(self, txn_id, pdus):
+        d = self.federation_server.on_incoming_transaction("other.example.com", {
+            "transaction_id": txn_id,
+            "origin": "other.example.com",
+            "destination": "test",
+            "origin_server_ts": self.clock.time_msec(),
+            "pdus": pdus,
+        })
+        return self.get_success(d)
+
+    def _finish_handling(self):
+        handling = self.handling
+        self.handling = []
+        for d in handling:
+            d.callback(None)
+        self.pump()
+
+    def test_transaction_acknowledged_before_processing(self):
+        room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+        pdus = [self._make_pdu(room_id, i) for i in range(2)]
+
+        # the transaction is acknowledged straight away
+        code, response = self._send_transaction("1", pdus)
+        self.assertEqual(code, 200)
+        self.assertEqual(response["pdus"], {
+            "$0:other.example.com": {},
+            "$1:other.example.com": {},
+        })
+
+        # the PDUs in the room are handled in series, in the background
+        self.assertEqual(self.handled, ["$0:other.example.com"])
+        self._finish_handling()
+        self.assertEqual(
+            self.handled, ["$0:other.example.com", "$1:other.example.com"],
+        )
+        self._finish_handling()
+
+        staged = self.get_success(
+            self.store.get_rooms_with_staged_events("master"),
+        )
+        self.assertEqual(staged, {})
+
+    def test_rooms_processed_in_parallel(self):
+        room_1 = self.helper.create_room_as(self.user_id, tok=self.tok)
+        room_2 = self.helper.create_room_as(self.user_id, tok=self.tok)
+
+        self._send_transaction("1", [
+            self._make_pdu(room_1, 0),
+            self._make_pdu(room_1, 1),
+            self._make_pdu(room_2, 2),
+        ])
+
+        # a slow PDU in one room doesn't hold up the other
+        self.assertEqual(
+            sorted(self.handled), ["$0:other.example.com", "$2:other.example.com"],
+        )
+
+    def test_live_rooms_processed_first(self):
+        room_1 = self.helper.create_room_as(self.user_id, tok=self.tok)
+        room_2 = self.helper.create_room_as(self.user_id, tok=self.tok)
+
+        # pretend we're too busy to start processing anything
+        self.federation_server._processing_staged_rooms.update(
+            "!busy%i:test" % (i,) for i in range(10)
+        )
+
+        self._send_transaction("1", [
+            self._make_pdu(room_1, 0, age=BACKFILL_PDU_AGE_MS * 2),
+        ])
+        self._send_transaction("2", [self._make_pdu(room_2, 1)])
+
+        self.assertEqual(self.handled, [])
+        self.assertEqual(self.federation_server._staged_rooms, {
+            PDU_PRIORITY_LIVE: {room_2: None},
+            PDU_PRIORITY_BACKFILL: {room_1: None},
+        })
+        self.assertEqual(self.federation_server._pop_staged_room(), room_2)
+        self.assertEqual(self.federation_server._pop_staged_room(), room_1)
+
+    def test_too_many_staged(self):
+        room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+
+        # we're busy with the first PDU, so the rest wait in the staging area
+        for i in range(MAX_STAGED_PDUS_PER_ORIGIN // 50):
+            code, _ = self._send_transaction(str(i), [
+                self._make_pdu(room_id, i * 50 + j) for j in range(50)
+            ])
+            self.assertEqual(code, 200)
+
+        # now the server has to wait for us to catch up
+        code, response = self._send_transaction("last", [
+            self._make_pdu(room_id, MAX_STAGED_PDUS_PER_ORIGIN),
+        ])
+        self.assertEqual(code, 429)
+        self.assertEqual(response["errcode"], "M_LIMIT_EXCEEDED")
+
+        # and it can try the same transaction again once we have
+        self._finish_handling()
+        code, _ = self._send_transaction("last", [
+            self._make_pdu(room_id, MAX_STAGED_PDUS_PER_ORIGIN),
+        ])
+        self.assertEqual(code, 200)
+
+    def test_resume_only_own_pdus(self):
+        room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+        pdu = FrozenEvent(self._make_pdu(room_id, 0))
+        for instance_name in ("master", "federation_reader1"):
+            self.get_success(self.store.insert_received_events_to_staging(
+                instance_name, "other%s.example.com" % (instance_name,),
+                self.clock.time_msec(), [(pdu, PDU_PRIORITY_LIVE)],
+            ))
+
+        self.get_success(self.federation_server._resume_staged_pdus())
+        self.pump()
+        self.assertEqual(self.handled, [pdu.event_id])
+        self._finish_handling()
+
+        # the other process's PDU is left for it to process
+        staged = self.get_success(
+            self.store.get_rooms_with_staged_events("federation_reader1"),
+        )
+        self.assertEqual(staged, {room_id: PDU_PRIORITY_LIVE})
+
+
 def _create_acl_event(content):
     return FrozenEvent(
         {
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from canonicaljson import json
+
+from synapse.api.constants import EventFormatVersions
+from synapse.federation.transport.client import SendJoinParser
+
+from tests import unittest
+
+
+def make_pdu(event_id, body):
+    return {
+        "event_id": event_id,
+        "room_id": "!room:test",
+        "type": "m.room.message",
+        "sender": "@user:test",
+        "origin": "test",
+        "origin_server_ts": 1550000000000,
+        "depth": 1,
+        "prev_events": [],
+        "auth_events": [],
+        "content": {"body": body},
+    }
+
+
+class SendJoinParserTestCase(unittest.TestCase):
+    def _parse(self, response, chunk_size):
+        parser = SendJoinParser(EventFormatVersions.V1)
+        for i in range(0, len(response), chunk_size):
+            parser.write(response[i:i + chunk_size])
+        return parser.finish()
+
+    def test_parse(self):
+        response = json.dumps([200, {
+            "origin": "test",
+            "other": [make_pdu("$other:test", "ignored")],
+            "state": [
+                make_pdu("$state1:test", 'brackets ]}[{ and "quotes" \\'),
+                make_pdu("$state2:test", u"unicode \u2603"),
+            ],
+            "auth_chain": [make_pdu("$auth:test", "")],
+        }], ensure_ascii=False).encode("utf-8")
+
+        for chunk_size in (1, 7, len(response)):
+            res = self._parse(response, chunk_size)
+
+            self.assertEqual(
+                [e.event_id for e in res["state"]], ["$state1:test", "$state2:test"],
+            )
+            self.assertEqual(
+                res["state"][0].content["body"], 'brackets ]}[{ and "quotes" \\',
+            )
+            self.assertEqual(res["state"][1].content["body"], u"unicode \u2603")
+            self.assertTrue(res["state"][0].internal_metadata.is_outlier())
+            self.assertEqual([e.event_id for e in res["auth_chain"]], ["$auth:test"])
+
+    def test_truncated(self):
+        response = json.dumps([200, {
+            "state": [make_pdu("$state:test", "a")], "auth_chain": [],
+        }]).encode("utf-8")
+
+        with self.assertRaises(ValueError):
+            self._parse(response[:-1], 10)
+
+        with self.assertRaises(ValueError):
+            self._parse(response[:20], 10)
+
+    def test_long_pdu(self):
+        response = json.dumps([200, {
+            "state": [make_pdu("$state:test", "a" * 2 * 1024 * 1024)],
+        }]).encode("utf-8")
+
+        with self.assertRaises(ValueError):
+            self._parse(response, 64 * 1024)
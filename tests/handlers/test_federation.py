@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+
+from synapse.events import FrozenEvent
+from synapse.handlers.federation import (
+    BACKFILL_PREFETCH_DEPTH,
+    BACKFILL_PREFETCH_MAX_REQUESTS,
+)
+from synapse.util.async_helpers import ReadWriteLock
+
+from tests import unittest
+
+ROOM_ID = "!room:test"
+
+
+class BackfillPrefetchTestCase(unittest.HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.handler = hs.get_handlers().federation_handler
+        self.store = hs.get_datastore()
+
+    def test_lookahead(self):
+        self.store.get_oldest_events_with_depth_in_room = Mock(
+            side_effect=lambda room_id: defer.succeed({"$extremity:other": 100}),
+        )
+        self.store.get_successor_events = Mock(
+            side_effect=lambda event_ids: defer.succeed([]),
+        )
+
+        # the user isn't close enough to the gap for a normal backfill...
+        self.get_success(self.handler.maybe_backfill(ROOM_ID, 110))
+        self.store.get_successor_events.assert_not_called()
+
+        # ... but they are close enough to start prefetching
+        self.get_success(self.handler.prefetch_backfill(ROOM_ID, 110))
+        self.store.get_successor_events.assert_called_once()
+
+        # and no further than the lookahead
+        self.store.get_successor_events.reset_mock()
+        self.get_success(
+            self.handler.prefetch_backfill(ROOM_ID, 101 + BACKFILL_PREFETCH_DEPTH),
+        )
+        self.store.get_successor_events.assert_not_called()
+
+    def test_request_budget(self):
+        self.handler._maybe_backfill = Mock(
+            side_effect=lambda *args, **kwargs: defer.succeed(True),
+        )
+
+        self.get_success(self.handler.prefetch_backfill(ROOM_ID, 100))
+
+        self.assertEqual(
+            self.handler._maybe_backfill.call_count, BACKFILL_PREFETCH_MAX_REQUESTS,
+        )
+        self.handler._maybe_backfill.assert_called_with(
+            ROOM_ID, 100, lookahead=BACKFILL_PREFETCH_DEPTH, persist_lock=None,
+        )
+
+    def test_stops_when_nothing_backfilled(self):
+        results = [True, False]
+        self.handler._maybe_backfill = Mock(
+            side_effect=lambda *args, **kwargs: defer.succeed(results.pop(0)),
+        )
+
+        self.get_success(self.handler.prefetch_backfill(ROOM_ID, 100))
+
+        self.assertEqual(self.handler._maybe_backfill.call_count, 2)
+
+    def test_one_prefetch_per_room(self):
+        self.store.get_oldest_events_with_depth_in_room = Mock(
+            side_effect=lambda room_id: defer.succeed({"$extremity:other": 100}),
+        )
+        d = defer.Deferred()
+        self.handler._maybe_backfill = Mock(return_value=d)
+
+        first = self.handler.prefetch_backfill(ROOM_ID, 100)
+        second = self.handler.prefetch_backfill(ROOM_ID, 100)
+        self.successResultOf(second)
+        self.assertEqual(self.handler._maybe_backfill.call_count, 1)
+
+        # a paginating user waits for the prefetch rather than asking for the
+        # same events again
+        paginate = self.handler.maybe_backfill(ROOM_ID, 100)
+        self.assertNoResult(paginate)
+        self.assertEqual(self.handler._maybe_backfill.call_count, 1)
+
+        self.handler._maybe_backfill.return_value = defer.succeed(None)
+        d.callback(False)
+        self.successResultOf(first)
+        self.successResultOf(paginate)
+        self.assertEqual(self.handler._maybe_backfill.call_count, 2)
+        self.handler._maybe_backfill.assert_called_with(ROOM_ID, 100)
+
+        # once it has finished we can prefetch again
+        self.get_success(self.handler.prefetch_backfill(ROOM_ID, 100))
+        self.assertEqual(self.handler._maybe_backfill.call_count, 3)
+
+    def test_only_wait_for_prefetch_when_needed(self):
+        self.store.get_oldest_events_with_depth_in_room = Mock(
+            side_effect=lambda room_id: defer.succeed({"$extremity:other": 100}),
+        )
+        d = defer.Deferred()
+        self.handler._maybe_backfill = Mock(return_value=d)
+        self.handler.prefetch_backfill(ROOM_ID, 110)
+
+        # a page which doesn't reach the gap doesn't wait for the prefetch
+        self.handler._maybe_backfill.return_value = defer.succeed(None)
+        self.successResultOf(self.handler.maybe_backfill(ROOM_ID, 110))
+
+        d.callback(False)
+
+    def test_lock_only_held_while_persisting(self):
+        event = FrozenEvent({
+            "event_id": "$1:other",
+            "room_id": ROOM_ID,
+            "type": "m.room.message",
+            "sender": "@user:other",
+            "content": {},
+            "depth": 5,
+            "prev_events": [],
+            "auth_events": [],
+        })
+        fetched = defer.Deferred()
+        self.handler.federation_client.backfill = Mock(return_value=fetched)
+        self.store.get_room_version = Mock(
+            side_effect=lambda room_id: defer.succeed("1"),
+        )
+        self.handler._handle_new_events = Mock(
+            side_effect=lambda *args, **kwargs: defer.succeed(None),
+        )
+        self.handler._handle_new_event = Mock(
+            side_effect=lambda *args, **kwargs: defer.succeed(None),
+        )
+
+        lock = ReadWriteLock()
+        d = self.handler.backfill(
+            "other", ROOM_ID, 10, ["$extremity:other"],
+            persist_lock=lambda: lock.read(ROOM_ID),
+        )
+
+        # we can purge while the events are being fetched...
+        with self.successResultOf(lock.write(ROOM_ID)):
+            fetched.callback([event])
+            self.pump()
+
+            # ... but they aren't persisted until the purge has finished
+            self.handler._handle_new_event.assert_not_called()
+
+        self.pump()
+        self.successResultOf(d)
+        self.handler._handle_new_event.assert_called_once()
@@ -12,11 +12,14 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from mock import Mock
+
 from twisted.internet import defer
 
 from synapse.api.errors import Codes, ResourceLimitError
 from synapse.api.filtering import DEFAULT_FILTER_COLLECTION
 from synapse.handlers.sync import SyncConfig, SyncHandler
+from synapse.rest.client.v1 import admin, login, room
 from synapse.types import UserID
 
 import tests.unittest
@@ -69,3 +72,188 @@ class SyncTestCase(tests.unittest.TestCase):
             request_key="request_key",
             device_id="device_id",
         )
+
+
+class SyncSessionTestCase(tests.unittest.HomeserverTestCase):
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.sync_handler = hs.get_sync_handler()
+
+        self.user_id = self.register_user("user", "pass")
+        self.tok = self.login("user", "pass")
+        self.sync_config = SyncConfig(
+            user=UserID.from_string(self.user_id),
+            filter_collection=DEFAULT_FILTER_COLLECTION,
+            is_guest=False,
+            request_key="request_key",
+            device_id="device_id",
+        )
+
+        self.get_rooms_for_user_at = Mock(
+            side_effect=self.sync_handler.get_rooms_for_user_at,
+        )
+        self.sync_handler.get_rooms_for_user_at = self.get_rooms_for_user_at
+
+    def _sync(self, since_token=None):
+        return self.get_success(
+            self.sync_handler.generate_sync_result(self.sync_config, since_token),
+        )
+
+    def test_joined_rooms_reused(self):
+        room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+
+        result = self._sync()
+        self.assertEqual([r.room_id for r in result.joined], [room_id])
+        self.assertEqual(self.get_rooms_for_user_at.call_count, 1)
+
+        # Nothing has changed, so the joined rooms come from the session
+        result = self._sync(result.next_batch)
+        self.assertEqual(result.joined, [])
+        self.assertEqual(self.get_rooms_for_user_at.call_count, 1)
+
+        # ... and messages don't change the user's rooms either
+        self.helper.send(room_id, "hello", tok=self.tok)
+        result = self._sync(result.next_batch)
+        self.assertEqual([r.room_id for r in result.joined], [room_id])
+        self.assertEqual(self.get_rooms_for_user_at.call_count, 1)
+
+    def test_membership_change_recalculates(self):
+        room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+        result = self._sync()
+
+        room_id2 = self.helper.create_room_as(self.user_id, tok=self.tok)
+        result = self._sync(result.next_batch)
+        self.assertEqual([r.room_id for r in result.joined], [room_id2])
+        self.assertEqual(self.get_rooms_for_user_at.call_count, 2)
+
+        session = self.sync_handler.get_sync_session(self.sync_config)
+        self.assertEqual(session.joined_room_ids, {room_id, room_id2})
+
+        self.helper.leave(room_id, self.user_id, tok=self.tok)
+        result = self._sync(result.next_batch)
+        self.assertEqual([r.room_id for r in result.archived], [room_id])
+        self.assertEqual(session.joined_room_ids, {room_id2})
+
+
+class InitialSyncTestCase(tests.unittest.HomeserverTestCase):
+    servlets = [
+        admin.register_servlets,
+        login.register_servlets,
+        room.register_servlets,
+    ]
+
+    def prepare(self, reactor, clock, hs):
+        self.sync_handler = hs.get_sync_handler()
+        self.store = hs.get_datastore()
+
+        self.user_id = self.register_user("user", "pass")
+        self.tok = self.login("user", "pass")
+        self.sync_config = SyncConfig(
+            user=UserID.from_string(self.user_id),
+            filter_collection=DEFAULT_FILTER_COLLECTION,
+            is_guest=False,
+            request_key="request_key",
+            device_id="device_id",
+        )
+
+        # A room with more messages than the timeline limit, one with a
+        # few, and one with none.
+        self.room_ids = []
+        for messages in (15, 3, 0):
+            room_id = self.helper.create_room_as(self.user_id, tok=self.tok)
+            for i in range(messages):
+                self.helper.send(room_id, "message %d" % (i,), tok=self.tok)
+            self.room_ids.append(room_id)
+
+    def test_get_recent_events_for_rooms(self):
+        end_token = self.store.get_room_max_stream_ordering()
+        end_token = "s%d" % (end_token,)
+
+        results = self.get_success(
+            self.store.get_recent_events_for_rooms(
+                self.room_ids, limit=5, end_token=end_token,
+            )
+        )
+
+        for room_id in self.room_ids:
+            expected_events, expected_token = self.get_success(
+                self.store.get_recent_events_for_room(
+                    room_id, limit=5, end_token=end_token,
+                )
+            )
+            events, token = results[room_id]
+            self.assertEqual(
+                [e.event_id for e in events],
+                [e.event_id for e in expected_events],
+            )
+            self.assertEqual(
+                [e.internal_metadata.before for e in events],
+                [e.internal_metadata.before for e in expected_events],
+            )
+            self.assertEqual(token, expected_token)
+
+    def test_initial_sync_matches_per_room(self):
+        def sync_by_room(result):
+            return {
+                r.room_id: (
+                    [e.event_id for e in r.timeline.events],
+                    r.timeline.prev_batch,
+                    r.timeline.limited,
+                )
+                for r in result.joined
+            }
+
+        get_recent_events_for_room = Mock(
+            side_effect=self.store.get_recent_events_for_room,
+        )
+        self.store.get_recent_events_for_room = get_recent_events_for_room
+
+        result = self.get_success(
+            self.sync_handler.generate_sync_result(self.sync_config),
+        )
+        rooms = sync_by_room(result)
+        get_recent_events_for_room.assert_not_called()
+        self.assertEqual(set(rooms), set(self.room_ids))
+        self.assertTrue(rooms[self.room_ids[0]][2])
+
+        # Now sync without loading the rooms' events in bulk
+        self.sync_handler._prefetch_recents = Mock(
+            return_value=defer.succeed(None),
+        )
+        expected = self.get_success(
+            self.sync_handler.generate_sync_result(self.sync_config),
+        )
+        self.assertEqual(get_recent_events_for_room.call_count, 3)
+        self.assertEqual(rooms, sync_by_room(expected))
+
+    def test_full_state_sync_with_since_token(self):
+        result = self.get_success(
+            self.sync_handler.generate_sync_result(self.sync_config),
+        )
+        self.helper.send(self.room_ids[1], "new message", tok=self.tok)
+
+        get_recent_events_for_rooms = Mock(
+            side_effect=self.store.get_recent_events_for_rooms,
+        )
+        self.store.get_recent_events_for_rooms = get_recent_events_for_rooms
+
+        result = self.get_success(
+            self.sync_handler.generate_sync_result(
+                self.sync_config, result.next_batch, full_state=True,
+            ),
+        )
+
+        # the timelines start from the since token, so there's nothing to
+        # prefetch
+        get_recent_events_for_rooms.assert_not_called()
+        timelines = {
+            r.room_id: [e.content.get("body") for e in r.timeline.events]
+            for r in result.joined
+        }
+        self.assertEqual(timelines[self.room_ids[1]], ["new message"])
+        self.assertEqual(timelines[self.room_ids[0]], [])
@@ -72,6 +72,7 @@ class TypingNotificationsTestCase(unittest.HomeserverTestCase):
                     "get_received_txn_response",
                     "set_received_txn_response",
                     "get_destination_retry_timings",
+                    "get_destination_last_successful_stream_ordering",
                     "get_devices_by_remote",
                     # Bits that user_directory needs
                     "get_user_directory_stream_pos",
@@ -102,6 +103,10 @@ class TypingNotificationsTestCase(unittest.HomeserverTestCase):
             retry_timings_res
         )
 
+        self.datastore.get_destination_last_successful_stream_ordering.return_value = (
+            defer.succeed(None)
+        )
+
         self.datastore.get_devices_by_remote.return_value = (0, [])
 
         def get_received_txn_response(*args):
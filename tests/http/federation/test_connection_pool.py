@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from mock import Mock
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from synapse.http.federation.connection_pool import FederationConnectionPool
+
+from tests.unittest import TestCase
+
+
+def _make_connection():
+    connection = Mock(spec=["state", "transport"])
+    connection.state = "QUIESCENT"
+    return connection
+
+
+class FederationConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = FederationConnectionPool(
+            self.clock,
+            max_idle_connections_per_host=2,
+            max_idle_connections=3,
+            idle_timeout=60,
+        )
+
+        self.new_connections = []
+
+        def connect(factory):
+            connection = _make_connection()
+            self.new_connections.append(connection)
+            return defer.succeed(connection)
+
+        self.endpoint = Mock(spec=["connect"])
+        self.endpoint.connect.side_effect = connect
+
+    def _get_connection(self, key):
+        return self.successResultOf(self.pool.getConnection(key, self.endpoint))
+
+    def test_reuses_idle_connection(self):
+        connection = self._get_connection("a")
+        self.pool._putConnection("a", connection)
+
+        self.assertIs(self._get_connection("a"), connection)
+        self.assertEqual(len(self.new_connections), 1)
+
+        # it's no longer idle, so another request needs a new connection
+        self._get_connection("a")
+        self.assertEqual(len(self.new_connections), 2)
+
+    def test_per_host_limit(self):
+        connections = [self._get_connection("a") for _ in range(3)]
+        for connection in connections:
+            self.pool._putConnection("a", connection)
+
+        # the oldest idle connection was closed to make room for the others
+        connections[0].transport.loseConnection.assert_called_once_with()
+        self.assertEqual(self.pool._connections["a"], connections[1:])
+
+    def test_evicts_least_recently_idle(self):
+        connections = [self._get_connection(key) for key in ("a", "b", "c", "d")]
+        for key, connection in zip(("a", "b", "c"), connections):
+            self.pool._putConnection(key, connection)
+
+        # there are now too many idle connections in total, so "a"'s is closed
+        self.pool._putConnection("d", connections[3])
+        connections[0].transport.loseConnection.assert_called_once_with()
+        self.assertNotIn("a", self.pool._connections)
+        self.assertEqual(len(self.pool._idle_connections), 3)
+
+        # and "b" can still reuse its connection
+        self.assertIs(self._get_connection("b"), connections[1])
+
+    def test_idle_timeout(self):
+        connection = self._get_connection("a")
+        self.pool._putConnection("a", connection)
+
+        self.clock.advance(61)
+        connection.transport.loseConnection.assert_called_once_with()
+        self.assertEqual(self.pool._connections, {})
+        self.assertEqual(len(self.pool._idle_connections), 0)
+
+        self._get_connection("a")
+        self.assertEqual(len(self.new_connections), 2)
+
+    def test_skips_closed_connections(self):
+        connections = [self._get_connection("a") for _ in range(2)]
+        for connection in connections:
+            self.pool._putConnection("a", connection)
+
+        connections[0].state = "CONNECTION_LOST"
+        self.assertIs(self._get_connection("a"), connections[1])
+        self.assertEqual(len(self.pool._idle_connections), 0)
@@ -17,6 +17,7 @@ import logging
 from mock import Mock
 
 import treq
+from prometheus_client import REGISTRY
 from zope.interface import implementer
 
 from twisted.internet import defer
@@ -59,15 +60,22 @@ class MatrixFederationAgentTests(TestCase):
             _well_known_cache=self.well_known_cache,
         )
 
-    def _make_connection(self, client_factory, expected_sni):
+    def _make_connection(self, client_factory, expected_sni, server_tls_context=None):
         """Builds a test server, and completes the outgoing client connection
 
+        Args:
+            client_factory (IProtocolFactory): outgoing connection
+            expected_sni (bytes|None): SNI that we expect the outgoing connection to
+                send, or None to not check it.
+            server_tls_context (ServerTLSContext|None): the server's TLS
+                context. None to use a new one.
+
         Returns:
             HTTPChannel: the test server
         """
 
         # build the test server
-        server_tls_protocol = _build_test_server()
+        server_tls_protocol = _build_test_server(server_tls_context)
 
         # now, tell the client protocol factory to build the client protocol (it will be a
         # _WrappingProtocol, around a TLSMemoryBIOProtocol, around an
@@ -90,12 +98,13 @@ class MatrixFederationAgentTests(TestCase):
         self.reactor.pump((0.1,))
 
         # check the SNI
-        server_name = server_tls_protocol._tlsConnection.get_servername()
-        self.assertEqual(
-            server_name,
-            expected_sni,
-            "Expected SNI %s but got %s" % (expected_sni, server_name),
-        )
+        if expected_sni is not None:
+            server_name = server_tls_protocol._tlsConnection.get_servername()
+            self.assertEqual(
+                server_name,
+                expected_sni,
+                "Expected SNI %s but got %s" % (expected_sni, server_name),
+            )
 
         # fish the test server back out of the server-side TLS protocol.
         return server_tls_protocol.wrappedProtocol
@@ -223,6 +232,82 @@ class MatrixFederationAgentTests(TestCase):
         json = self.successResultOf(treq.json_content(response))
         self.assertEqual(json, {"a": 1})
 
+    def _make_request_and_respond(self, server_tls_context, expected_sni=b"testserv"):
+        """Sends a request to testserv, connecting to it if there are no idle
+        connections to reuse, and responds to it.
+
+        Returns:
+            bool: whether a new connection was made for the request
+        """
+        clients = self.reactor.tcpClients
+        connection_count = len(clients)
+
+        test_d = self._make_get_request(b"matrix://testserv:8448/foo/bar")
+
+        connected = len(clients) > connection_count
+        if connected:
+            client_factory = clients[-1][2]
+            self._http_server = self._make_connection(
+                client_factory,
+                expected_sni=expected_sni,
+                server_tls_context=server_tls_context,
+            )
+        else:
+            self.reactor.pump((0.1,))
+
+        request = self._http_server.requests[-1]
+        request.write(b"{}")
+        request.finish()
+        self.reactor.pump((0.1,))
+
+        response = self.successResultOf(test_d)
+        self.successResultOf(treq.json_content(response))
+        self.reactor.pump((0.1,))
+
+        return connected
+
+    def test_connection_and_tls_session_reuse(self):
+        """
+        Idle connections are reused, and new connections resume the TLS session
+        """
+        self.reactor.lookups["testserv"] = "1.2.3.4"
+        server_tls_context = _SessionCachingServerTLSContext()
+
+        def count(name, labels):
+            return REGISTRY.get_sample_value(name, labels) or 0
+
+        def counts():
+            return (
+                count("synapse_http_federation_client_connections", {
+                    "type": "reused",
+                }),
+                count("synapse_http_federation_client_tls_handshake_seconds_count", {
+                    "session": "full",
+                }),
+                count("synapse_http_federation_client_tls_handshake_seconds_count", {
+                    "session": "resumed",
+                }),
+            )
+
+        reused, full, resumed = counts()
+
+        self.assertTrue(self._make_request_and_respond(server_tls_context))
+        self.assertEqual(counts(), (reused, full + 1, resumed))
+
+        # the connection is reused for the next request
+        self.assertFalse(self._make_request_and_respond(server_tls_context))
+        self.assertEqual(counts(), (reused + 1, full + 1, resumed))
+
+        # once it has been closed, the next connection resumes the TLS session
+        self.agent._pool.closeCachedConnections()
+        self.reactor.pump((0.1,))
+
+        # (the test server doesn't remember the SNI in resumed sessions)
+        self.assertTrue(self._make_request_and_respond(
+            server_tls_context, expected_sni=None,
+        ))
+        self.assertEqual(counts(), (reused + 1, full + 1, resumed + 1))
+
     def test_get_ip_address(self):
         """
         Test the behaviour when the server name contains an explicit IP (with no port)
@@ -959,25 +1044,47 @@ def _check_logcontext(context):
         )
 
 
-def _build_test_server():
+def _build_test_server(server_tls_context=None):
     """Construct a test server
 
     This builds an HTTP channel, wrapped with a TLSMemoryBIOProtocol
 
+    Args:
+        server_tls_context (ServerTLSContext|None): the server's TLS context. None
+            to use a new one.
+
     Returns:
         TLSMemoryBIOProtocol
     """
+    if server_tls_context is None:
+        server_tls_context = ServerTLSContext()
+
     server_factory = Factory.forProtocol(HTTPChannel)
     # Request.finish expects the factory to have a 'log' method.
     server_factory.log = _log_request
 
     server_tls_factory = TLSMemoryBIOFactory(
-        ServerTLSContext(), isClient=False, wrappedFactory=server_factory,
+        server_tls_context, isClient=False, wrappedFactory=server_factory,
     )
 
     return server_tls_factory.buildProtocol(None)
 
 
+class _SessionCachingServerTLSContext(ServerTLSContext):
+    """A ServerTLSContext which uses the same OpenSSL context for each connection,
+    so that clients can resume their TLS sessions.
+    """
+    def __init__(self):
+        super(_SessionCachingServerTLSContext, self).__init__()
+        self._context = None
+
+    def getContext(self):
+        if self._context is None:
+            self._context = super(_SessionCachingServerTLSContext, self).getContext()
+            self._context.set_session_id(b"test")
+        return self._context
+
+
 def _log_request(request):
     """Implements Factory.log, which is expected by Request.finish"""
     logger.info("Completed request %s", request)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.web.http_headers import Headers
+
+from synapse.http.compression import GzipDecoder, accepts_gzip, gzip_compress
+
+from tests import unittest
+
+
+class CompressionTestCase(unittest.TestCase):
+    def test_accepts_gzip(self):
+        test_data = {
+            b"gzip": True,
+            b"deflate, gzip;q=0.5": True,
+            b"*": True,
+            b"identity": False,
+            b"gzip;q=0": False,
+            b"GZIP ; q=1.0": True,
+        }
+
+        for header, expected in test_data.items():
+            headers = Headers({b"Accept-Encoding": [header]})
+            self.assertEqual(accepts_gzip(headers), expected, header)
+
+        self.assertFalse(accepts_gzip(Headers()))
+
+    def test_decode(self):
+        data = b'{"a": "%s"}' % (b"b" * 10000,)
+        compressed = gzip_compress(data, "test")
+
+        decoder = GzipDecoder()
+        decoded = b"".join(
+            decoder.decode(compressed[i:i + 100])
+            for i in range(0, len(compressed), 100)
+        )
+        decoder.finish()
+
+        self.assertEqual(decoded, data)
+        self.assertEqual(decoder.length, len(data))
+        self.assertEqual(decoder.compressed_length, len(compressed))
+
+    def test_decode_too_large(self):
+        compressed = gzip_compress(b"a" * 10000, "test")
+
+        decoder = GzipDecoder(max_length=1000)
+        with self.assertRaises(ValueError):
+            decoder.decode(compressed)
+
+    def test_decode_invalid(self):
+        decoder = GzipDecoder()
+        with self.assertRaises(ValueError):
+            decoder.decode(b"not gzip")
@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import zlib
+
 from mock import Mock
 
 from twisted.internet import defer
@@ -49,6 +51,7 @@ class FederationClientTests(HomeserverTestCase):
     def prepare(self, reactor, clock, homeserver):
         self.cl = MatrixFederationHttpClient(self.hs, None)
         self.reactor.lookups["testserv"] = "1.2.3.4"
+        self._server = None
 
     def test_client_get(self):
         """
@@ -390,6 +393,89 @@ class FederationClientTests(HomeserverTestCase):
         content = request.content.read()
         self.assertEqual(content, b'{"a":"b"}')
 
+    def test_client_decodes_gzipped_response(self):
+        """The client asks for a gzipped response, and decompresses it"""
+        d = self.cl.get_json("testserv:8008", "foo/bar")
+
+        self.pump()
+
+        (_host, _port, factory, _timeout, _bindAddress) = self.reactor.tcpClients[0]
+        client = factory.buildProtocol(None)
+        conn = StringTransport()
+        client.makeConnection(conn)
+
+        self.assertRegex(conn.value(), b"Accept-Encoding: gzip")
+
+        compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        res_json = compressor.compress(b'{"a": 1}') + compressor.flush()
+        client.dataReceived(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: application/json\r\n"
+            b"Content-Encoding: gzip\r\n"
+            b"Content-Length: %i\r\n"
+            b"\r\n"
+            b"%s" % (len(res_json), res_json)
+        )
+
+        self.assertEqual(self.successResultOf(d), {"a": 1})
+
+    def _send_body_and_respond(self, data, response_headers):
+        """Sends a PUT request with the given body, and responds to it.
+
+        Returns:
+            tuple[Headers, bytes]: the headers and body of the request the
+                server received
+        """
+        d = self.cl.put_json("testserv:8008", "foo/bar", data=data)
+
+        self.pump()
+
+        # the connection is reused for subsequent requests
+        server = self._server
+        if server is None:
+            client = self.reactor.tcpClients[0][2].buildProtocol(None)
+            server = self._server = HTTPChannel()
+
+            client.makeConnection(FakeTransport(server, self.reactor))
+            server.makeConnection(FakeTransport(client, self.reactor))
+
+        self.pump(0.1)
+
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        self.assertEqual(len(server.requests), 1)
+        request = server.requests[0]
+        content = request.content.read()
+        for name, value in response_headers:
+            request.setHeader(name, value)
+        request.setHeader(b"Content-Type", b"application/json")
+        request.write(b"{}")
+        request.finish()
+
+        self.pump(0.1)
+        self.assertEqual(self.successResultOf(d), {})
+        return request.requestHeaders, content
+
+    def test_client_gzips_body(self):
+        """Once a server has said it accepts gzipped bodies, large bodies sent
+        to it are gzipped.
+        """
+        data = {"a": "b" * 2000}
+
+        headers, content = self._send_body_and_respond(
+            data, [(b"Accept-Encoding", b"gzip")],
+        )
+        self.assertFalse(headers.hasHeader(b"Content-Encoding"))
+        self.assertEqual(content, b'{"a":"%s"}' % (b"b" * 2000,))
+
+        headers, content = self._send_body_and_respond(data, [])
+        self.assertEqual(headers.getRawHeaders(b"Content-Encoding"), [b"gzip"])
+        content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+        self.assertEqual(content, b'{"a":"%s"}' % (b"b" * 2000,))
+
+        # small bodies aren't worth compressing
+        headers, content = self._send_body_and_respond({"a": "b"}, [])
+        self.assertFalse(headers.hasHeader(b"Content-Encoding"))
+
     def test_closes_connection(self):
         """Check that the client closes unused HTTP connections"""
         d = self.cl.get_json("testserv:8008", "foo/bar")
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.events import FrozenEvent
+from synapse.push.bulk_push_rule_evaluator import _actions_for_users
+from synapse.push.push_rule_evaluator import (
+    PushRuleEvaluatorForEvent,
+    compile_push_rules,
+)
+from synapse.storage.event_push_actions import _action_has_highlight
+from synapse.storage.push_rule import _load_rules
+from synapse.storage.roommember import ProfileInfo
+
+from tests import unittest
+
+SENDER = "@sender:test"
+
+
+def _message(body):
+    return FrozenEvent({
+        "event_id": "$event:test",
+        "room_id": "!room:test",
+        "type": "m.room.message",
+        "sender": SENDER,
+        "content": {"msgtype": "m.text", "body": body},
+    })
+
+
+class CompiledPushRulesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.room_members = {
+            SENDER: ProfileInfo(avatar_url=None, display_name="Sender"),
+            "@alice:test": ProfileInfo(avatar_url=None, display_name="Alice"),
+            "@bob:test": ProfileInfo(avatar_url=None, display_name="Robert"),
+            "@carol:test": ProfileInfo(avatar_url=None, display_name=u"Zoë"),
+        }
+        self.rules_by_user = {
+            user_id: _load_rules([], {})
+            for user_id in self.room_members
+        }
+
+    def _actions_for_users(self, event, sender_power_level=0):
+        evaluator = PushRuleEvaluatorForEvent(
+            event, len(self.room_members), sender_power_level, {},
+        )
+        return _actions_for_users(
+            evaluator, event, self.rules_by_user, self.room_members,
+        )
+
+    def _highlighted(self, actions_by_user):
+        return set(
+            user_id for user_id, actions in actions_by_user.items()
+            if _action_has_highlight(actions)
+        )
+
+    def test_rules_shared_between_users(self):
+        compiled = set(
+            compile_push_rules(rules) for rules in self.rules_by_user.values()
+        )
+        self.assertEqual(len(compiled), 1)
+
+        # changing a rule gives a different compiled version
+        rules = _load_rules([], {"global/underride/.m.rule.message": False})
+        self.assertNotIn(compile_push_rules(rules), compiled)
+
+    def test_notify_all_but_sender(self):
+        actions_by_user = self._actions_for_users(_message("hello"))
+        self.assertEqual(
+            set(actions_by_user), {"@alice:test", "@bob:test", "@carol:test"},
+        )
+        self.assertEqual(self._highlighted(actions_by_user), set())
+
+    def test_mentions(self):
+        # alice is mentioned by display name, and bob by localpart
+        actions_by_user = self._actions_for_users(
+            _message("alice: have you seen bob?"),
+        )
+        self.assertEqual(
+            self._highlighted(actions_by_user), {"@alice:test", "@bob:test"},
+        )
+
+        # names must be whole words
+        actions_by_user = self._actions_for_users(_message("malice and bobsleds"))
+        self.assertEqual(self._highlighted(actions_by_user), set())
+
+    def test_non_ascii_mentions(self):
+        actions_by_user = self._actions_for_users(_message(u"hi ZOË"))
+        self.assertEqual(self._highlighted(actions_by_user), {"@carol:test"})
+
+        actions_by_user = self._actions_for_users(_message(u"hi ALICE ☃"))
+        self.assertEqual(self._highlighted(actions_by_user), {"@alice:test"})
+
+    def test_disabled_rule(self):
+        self.rules_by_user["@alice:test"] = _load_rules(
+            [], {"global/underride/.m.rule.message": False},
+        )
+
+        actions_by_user = self._actions_for_users(_message("hello"))
+        self.assertEqual(set(actions_by_user), {"@bob:test", "@carol:test"})
+
+        # alice's other rules still apply
+        actions_by_user = self._actions_for_users(_message("hello alice"))
+        self.assertEqual(
+            set(actions_by_user), {"@alice:test", "@bob:test", "@carol:test"},
+        )
+
+    def test_room_notification(self):
+        actions_by_user = self._actions_for_users(
+            _message("@room hello"), sender_power_level=0,
+        )
+        self.assertEqual(self._highlighted(actions_by_user), set())
+
+        actions_by_user = self._actions_for_users(
+            _message("@room hello"), sender_power_level=100,
+        )
+        self.assertEqual(
+            self._highlighted(actions_by_user),
+            {"@alice:test", "@bob:test", "@carol:test"},
+        )
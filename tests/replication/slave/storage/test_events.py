@@ -17,6 +17,7 @@ from canonicaljson import encode_canonical_json
 from synapse.events import FrozenEvent, _EventInternalMetadata
 from synapse.events.snapshot import EventContext
 from synapse.replication.slave.storage.events import SlavedEventStore
+from synapse.replication.tcp.streams import EventStreamRow
 from synapse.storage.roommember import RoomsForUser
 
 from ._base import BaseSlavedStoreTestCase
@@ -130,6 +131,28 @@ class SlavedEventStoreTestCase(BaseSlavedStoreTestCase):
             ],
         )
 
+    def test_joined_host_counts(self):
+        self.persist(type="m.room.create", key="", creator=USER_ID)
+        self.persist(type="m.room.member", key=USER_ID, membership="join")
+        self.replicate()
+        self.check("get_joined_host_counts", (ROOM_ID,), {"blue": 1})
+
+        user_id = "@other:red"
+        join = self.persist(
+            type="m.room.member", sender=user_id, key=user_id, membership="join",
+        )
+
+        # the cache is invalidated by the events stream, without waiting for
+        # the caches stream
+        self.slaved_store.process_replication_rows(
+            "events", join.internal_metadata.stream_ordering,
+            [EventStreamRow(join.event_id, ROOM_ID, join.type, user_id, None)],
+        )
+        self.assertEqual(
+            self.get_success(self.slaved_store.get_joined_host_counts(ROOM_ID)),
+            {"blue": 1, "red": 1},
+        )
+
     def test_push_actions_for_user(self):
         self.persist(type="m.room.create", key="", creator=USER_ID)
         self.persist(type="m.room.join", key=USER_ID, membership="join")
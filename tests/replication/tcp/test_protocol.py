@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from synapse.replication.tcp.commands import PingCommand, RdataBatchCommand
+from synapse.replication.tcp.protocol import rdata_batch_commands
+from synapse.replication.tcp.streams import CachesStreamRow
+
+from tests.replication.tcp.streams._base import BaseStreamTestCase
+
+ROWS = [
+    ["get_user_by_id", ["@user%i:test" % (i,)], 1550000000000 + i]
+    for i in range(3)
+]
+
+
+class RdataBatchTestCase(BaseStreamTestCase):
+    def prepare(self, reactor, clock, hs):
+        super(RdataBatchTestCase, self).prepare(reactor, clock, hs)
+        self.pump()
+
+        self.server = self.streamer.connections[0]
+        self.server.replication_streams.add("caches")
+
+    def _send_updates(self):
+        updates = [(None, ROWS[0]), (5, ROWS[1]), (6, ROWS[2])]
+        self.server.stream_updates("caches", rdata_batch_commands("caches", updates))
+        self.pump()
+
+    def _assert_received_updates(self):
+        self.assertEqual(self.test_handler.received_rdata_rows, [
+            ("caches", 5, CachesStreamRow(*ROWS[0])),
+            ("caches", 5, CachesStreamRow(*ROWS[1])),
+            ("caches", 6, CachesStreamRow(*ROWS[2])),
+        ])
+
+    def test_batched(self):
+        # the server told the client that it could send RDATA_BATCH in its
+        # initial PING
+        self.assertTrue(self.client.requested_rdata_batch)
+        self.assertTrue(self.server.use_rdata_batch)
+
+        self._send_updates()
+        self._assert_received_updates()
+        self.assertEqual(self.server.outbound_commands_counter["RDATA_BATCH"], 1)
+        self.assertEqual(self.server.outbound_commands_counter["RDATA"], 0)
+
+    def test_line_protocol(self):
+        # e.g. the client is running an older version
+        self.server.use_rdata_batch = False
+
+        self._send_updates()
+        self._assert_received_updates()
+        self.assertEqual(self.server.outbound_commands_counter["RDATA_BATCH"], 0)
+        self.assertEqual(self.server.outbound_commands_counter["RDATA"], 3)
+
+    def test_older_server(self):
+        """A client doesn't ask servers which haven't said that they support
+        RDATA_BATCH to use it.
+        """
+        self.client.requested_rdata_batch = False
+        self.server.use_rdata_batch = False
+
+        self.client.dataReceived(b"PING 1550000000000\n")
+        self.pump()
+
+        # the only FRAMING is the one from when the client connected
+        self.assertFalse(self.client.requested_rdata_batch)
+        self.assertEqual(self.client.outbound_commands_counter["FRAMING"], 1)
+        self.assertFalse(self.server.use_rdata_batch)
+
+        self.client.handle_command(PingCommand("1550000000000 RDATA_BATCH"))
+        self.pump()
+        self.assertTrue(self.server.use_rdata_batch)
+
+    def test_payload_in_pieces(self):
+        cmd = RdataBatchCommand("caches", [(5, ROWS[0]), (6, ROWS[1])])
+        data = (
+            b"RDATA_BATCH " + cmd.to_line().encode("ascii") + b"\n"
+            + cmd.get_payload()
+            + b'RDATA caches 7 ["a", ["b"], 1]\n'
+        )
+
+        # split the data up so that the payload is received over several reads,
+        # and the following command arrives with the end of the payload.
+        for i in range(0, len(data), 20):
+            self.client.dataReceived(data[i:i + 20])
+        self.pump()
+
+        self.assertEqual(self.test_handler.received_rdata_rows, [
+            ("caches", 5, CachesStreamRow(*ROWS[0])),
+            ("caches", 6, CachesStreamRow(*ROWS[1])),
+            ("caches", 7, CachesStreamRow("a", ["b"], 1)),
+        ])
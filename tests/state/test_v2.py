@@ -22,7 +22,11 @@ import attr
 from synapse.api.constants import EventTypes, JoinRules, Membership, RoomVersions
 from synapse.event_auth import auth_types_for_event
 from synapse.events import FrozenEvent
-from synapse.state.v2 import lexicographical_topological_sort, resolve_events_with_store
+from synapse.state.v2 import (
+    StateResolutionCache,
+    lexicographical_topological_sort,
+    resolve_events_with_store,
+)
 from synapse.types import EventID
 
 from tests import unittest
@@ -527,6 +531,8 @@ class StateTestCase(unittest.TestCase):
         # We copy the map as the sort consumes the graph
         graph_copy = {k: set(v) for k, v in graph.items()}
 
+        state_res_cache = StateResolutionCache()
+
         for node_id in lexicographical_topological_sort(graph_copy, key=lambda e: e):
             fake_event = fake_event_map[node_id]
             event_id = fake_event.event_id
@@ -547,6 +553,19 @@ class StateTestCase(unittest.TestCase):
 
                 state_before = self.successResultOf(state_d)
 
+                # resolving with a cache of partial results should give the
+                # same answer, both when the cache is populated and when it is
+                # used.
+                for _ in range(2):
+                    state_d = resolve_events_with_store(
+                        RoomVersions.V2,
+                        [state_at_event[n] for n in prev_events],
+                        event_map=event_map,
+                        state_res_store=TestStateResolutionStore(event_map),
+                        state_res_cache=state_res_cache,
+                    )
+                    self.assertEqual(self.successResultOf(state_d), state_before)
+
             state_after = dict(state_before)
             if fake_event.state_key is not None:
                 state_after[(fake_event.type, fake_event.state_key)] = event_id
@@ -696,6 +715,31 @@ class SimpleParamStateTestCase(unittest.TestCase):
 
         self.assert_dict(self.expected_combined_state, state)
 
+    def test_state_res_cache(self):
+        state_res_cache = StateResolutionCache()
+
+        for _ in range(2):
+            state_d = resolve_events_with_store(
+                RoomVersions.V2,
+                [self.state_at_bob, self.state_at_charlie],
+                event_map=None,
+                state_res_store=TestStateResolutionStore(self.event_map),
+                state_res_cache=state_res_cache,
+            )
+
+            state = self.successResultOf(state_d)
+            self.assert_dict(self.expected_combined_state, state)
+
+        # the conflicted members were sorted by mainline depth, which should
+        # have been remembered
+        pl = (EventTypes.PowerLevels, "")
+        self.assertEqual(
+            state_res_cache.mainline_depths.get(
+                (self.expected_combined_state.get(pl), self.bob_member.event_id),
+            ),
+            0,
+        )
+
 
 def pairwise(iterable):
     "s -> (s0,s1), (s1,s2), (s2, s3), ..."
@@ -51,6 +51,7 @@ class SQLBaseStoreTestCase(unittest.TestCase):
         config = Mock()
         config._disable_native_upserts = True
         config.event_cache_size = 1
+        config.shared_event_cache_path = None
         config.database_config = {"name": "sqlite3"}
         engine = create_engine(config.database_config)
         fake_engine = Mock(wraps=engine)
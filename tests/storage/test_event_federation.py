@@ -15,6 +15,9 @@
 
 from twisted.internet import defer
 
+from synapse.events import FrozenEvent
+from synapse.rest.client.v1 import room
+
 import tests.unittest
 import tests.utils
 
@@ -75,3 +78,148 @@ class EventFederationWorkerStoreTestCase(tests.unittest.TestCase):
             el = r[i]
             depth = el[2]
             self.assertLessEqual(5, depth)
+
+
+class AuthChainIndexTestCase(tests.unittest.HomeserverTestCase):
+
+    user_id = "@red:server"
+    servlets = [room.register_servlets]
+
+    def make_homeserver(self, reactor, clock):
+        return self.setup_test_homeserver("server", http_client=None)
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.state_handler = hs.get_state_handler()
+        self.room_id = self.helper.create_room_as(self.user_id)
+
+        state = self.get_success(self.store.get_current_state_ids(self.room_id))
+        self.state_event_ids = list(state.values())
+
+    def _get_auth_chains(self):
+        chains = {}
+        for event_id in self.state_event_ids:
+            chains[event_id] = set(self.get_success(
+                self.store.get_auth_chain_ids([event_id]),
+            ))
+        return chains
+
+    def _count_indexed(self):
+        return self.get_success(self.store._simple_select_one_onecol(
+            table="event_auth_chain_closure",
+            keyvalues={},
+            retcol="COUNT(*)",
+        ))
+
+    def _get_indexed_chain(self, event_id):
+        rows = self.get_success(self.store._simple_select_onecol(
+            table="event_auth_chain_closure",
+            keyvalues={"event_id": event_id},
+            retcol="auth_id",
+        ))
+        return set(rows) - {event_id}
+
+    def _persist_outlier(self, event_id, state_key, auth_event_ids):
+        event = FrozenEvent({
+            "event_id": event_id,
+            "type": "m.room.member",
+            "state_key": state_key,
+            "sender": state_key,
+            "room_id": self.room_id,
+            "content": {"membership": "join"},
+            "auth_events": [(auth_id, {}) for auth_id in auth_event_ids],
+            "prev_events": [],
+            "depth": 10,
+            "origin_server_ts": 0,
+            "hashes": {"sha256": "aaa"},
+            "signatures": {},
+        })
+        event.internal_metadata.outlier = True
+        context = self.get_success(self.state_handler.compute_event_context(event))
+        self.get_success(self.store.persist_event(event, context))
+
+    def _delete_index(self):
+        self.get_success(self.store.runInteraction(
+            "delete_index",
+            lambda txn: txn.execute("DELETE FROM event_auth_chain_closure"),
+        ))
+
+    def test_index_matches_event_auth(self):
+        """The chains in the index are the same as we get by walking event_auth
+        """
+        self.assertGreater(self._count_indexed(), len(self.state_event_ids))
+        indexed_chains = self._get_auth_chains()
+
+        self._delete_index()
+        self.assertEqual(indexed_chains, self._get_auth_chains())
+
+        # the power levels event's chain includes the create event and the
+        # creator's join
+        state = self.get_success(self.store.get_current_state_ids(self.room_id))
+        self.assertEqual(
+            indexed_chains[state[("m.room.power_levels", "")]],
+            {state[("m.room.create", "")], state[("m.room.member", self.user_id)]},
+        )
+
+    def test_background_update(self):
+        """The background update rebuilds the index for existing events
+        """
+        indexed_chains = self._get_auth_chains()
+        count = self._count_indexed()
+        self._delete_index()
+
+        self.get_success(self.store._simple_insert(
+            "background_updates",
+            {"update_name": "event_auth_chain_closure", "progress_json": "{}"},
+        ))
+        self.store._all_done = False
+        while not self.get_success(self.store.has_completed_background_updates()):
+            self.get_success(self.store.do_next_background_update(100), by=0.1)
+
+        self.assertEqual(self._count_indexed(), count)
+        self.assertEqual(indexed_chains, self._get_auth_chains())
+
+    def test_auth_event_received_after_dependent(self):
+        """An event whose auth event we don't have yet is indexed once we do,
+        along with the events which depend on it in turn
+        """
+        state = self.get_success(self.store.get_current_state_ids(self.room_id))
+        create_id = state[("m.room.create", "")]
+
+        # the second event is authed by the first, which we receive last
+        self._persist_outlier("$second:other", "@second:other", ["$first:other"])
+        self._persist_outlier("$third:other", "@third:other", ["$second:other"])
+        self.assertEqual(self._get_indexed_chain("$second:other"), set())
+        self.assertEqual(self._get_indexed_chain("$third:other"), set())
+
+        self._persist_outlier("$first:other", "@first:other", [create_id])
+
+        self.assertEqual(self._get_indexed_chain("$first:other"), {create_id})
+        self.assertEqual(
+            self._get_indexed_chain("$second:other"), {create_id, "$first:other"},
+        )
+        self.assertEqual(
+            self._get_indexed_chain("$third:other"),
+            {create_id, "$first:other", "$second:other"},
+        )
+        self.assertEqual(
+            self.get_success(self.store._simple_select_onecol(
+                table="event_auth_chain_unindexed",
+                keyvalues={},
+                retcol="event_id",
+            )),
+            [],
+        )
+
+    def test_unindexed_auth_event_indexed_with_dependent(self):
+        """If an event's auth events exist but aren't indexed yet, they are
+        indexed along with it
+        """
+        state = self.get_success(self.store.get_current_state_ids(self.room_id))
+        create_id = state[("m.room.create", "")]
+        self._delete_index()
+
+        self._persist_outlier("$first:other", "@first:other", [create_id])
+
+        self.assertEqual(self._get_indexed_chain("$first:other"), {create_id})
+        self.assertEqual(self._get_indexed_chain(create_id), set())
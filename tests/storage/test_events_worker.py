@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+
+from mock import Mock
+
+from synapse.api.errors import NotFoundError
+from synapse.rest.client.v1 import room
+
+from tests.unittest import HomeserverTestCase
+
+
+class EventFetchTestCase(HomeserverTestCase):
+
+    user_id = "@red:server"
+    servlets = [room.register_servlets]
+
+    def make_homeserver(self, reactor, clock):
+        hs = self.setup_test_homeserver("server", http_client=None)
+        return hs
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.room_id = self.helper.create_room_as(self.user_id)
+
+        self.event_ids = [
+            self.helper.send(self.room_id, body="test%i" % (i,))["event_id"]
+            for i in range(3)
+        ]
+
+        # Make sure that everything has to come out of the database.
+        self.store._get_event_cache.invalidate_all()
+
+        self.fetch_event_rows = Mock(side_effect=self.store._fetch_event_rows)
+        self.store._fetch_event_rows = self.fetch_event_rows
+
+    def test_concurrent_requests_are_batched(self):
+        """Requests made before the fetch thread runs share one query, and events
+        which are already in flight are not requested twice.
+        """
+        d1 = self.store.get_event(self.event_ids[0])
+        d2 = self.store.get_events(self.event_ids)
+        self.pump()
+
+        event = self.successResultOf(d1)
+        self.assertEqual(event.event_id, self.event_ids[0])
+        self.assertEqual(set(self.successResultOf(d2)), set(self.event_ids))
+
+        self.assertEqual(self.fetch_event_rows.call_count, 1)
+        fetched_ids = self.fetch_event_rows.call_args[0][1]
+        self.assertEqual(sorted(fetched_ids), sorted(self.event_ids))
+
+        # the in-flight map should have been cleared out
+        self.assertEqual(self.store._event_fetch_in_flight, {})
+
+    def test_redacted_event_in_same_batch(self):
+        """A redacted event and its redaction can be fetched in the same batch.
+        """
+        request, channel = self.make_request(
+            "POST",
+            "/_matrix/client/r0/rooms/%s/redact/%s" % (
+                self.room_id, self.event_ids[0],
+            ),
+            {"reason": "spam"},
+        )
+        self.render(request)
+        self.assertEqual(channel.code, 200, channel.result)
+        redaction_id = channel.json_body["event_id"]
+
+        self.store._get_event_cache.invalidate_all()
+        self.fetch_event_rows.reset_mock()
+
+        d = self.store.get_events([self.event_ids[0], redaction_id])
+        self.pump()
+
+        events = self.successResultOf(d)
+        redacted = events[self.event_ids[0]]
+        self.assertEqual(redacted.content, {})
+        self.assertEqual(redacted.unsigned["redacted_by"], redaction_id)
+        self.assertEqual(
+            redacted.unsigned["redacted_because"].event_id, redaction_id,
+        )
+        self.assertEqual(self.fetch_event_rows.call_count, 1)
+
+
+class SharedEventCacheTestCase(HomeserverTestCase):
+
+    user_id = "@red:server"
+    servlets = [room.register_servlets]
+
+    def make_homeserver(self, reactor, clock):
+        self.dir = tempfile.mkdtemp(prefix="synapse-tests-")
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        config = self.default_config()
+        config.shared_event_cache_path = os.path.join(self.dir, "events")
+        config.shared_event_cache_size = 1024 * 1024
+
+        hs = self.setup_test_homeserver("server", config=config, http_client=None)
+        return hs
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.room_id = self.helper.create_room_as(self.user_id)
+        self.event_id = self.helper.send(self.room_id, body="test")["event_id"]
+
+        # load the event from the database, which should add it to the shared
+        # cache.
+        self.store._get_event_cache.invalidate_all()
+        self.get_success(self.store.get_event(self.event_id))
+
+        self.store._get_event_cache.invalidate_all()
+        self.fetch_event_rows = Mock(side_effect=self.store._fetch_event_rows)
+        self.store._fetch_event_rows = self.fetch_event_rows
+
+    def test_get_from_shared_cache(self):
+        event = self.get_success(self.store.get_event(self.event_id))
+        self.assertEqual(event.event_id, self.event_id)
+        self.assertEqual(event.content["body"], "test")
+        self.assertFalse(self.fetch_event_rows.called)
+
+    def test_invalidate(self):
+        self.store._invalidate_get_event_cache(self.event_id)
+
+        event = self.get_success(self.store.get_event(self.event_id))
+        self.assertEqual(event.event_id, self.event_id)
+        self.assertTrue(self.fetch_event_rows.called)
+
+    def test_stale_row_not_stored(self):
+        """If an event is invalidated while its row is being fetched, the row
+        isn't put in the shared cache.
+        """
+        self.store._invalidate_get_event_cache(self.event_id)
+
+        versions = self.store._get_shared_cache_versions([self.event_id])
+        rows = self.get_success(self.store.runInteraction(
+            "fetch", self.store._fetch_event_rows, [self.event_id],
+        ))
+
+        # eg, the event is redacted on another process
+        self.store._shared_event_cache.invalidate(self.event_id.encode("utf8"))
+
+        self.get_success(self.store._get_events_from_rows(
+            {row["event_id"]: row for row in rows}, versions,
+        ))
+        self.assertIsNone(
+            self.store._shared_event_cache.get(self.event_id.encode("utf8")),
+        )
+
+    def test_purge(self):
+        later_event_id = self.helper.send(self.room_id, body="later")["event_id"]
+        token = self.get_success(
+            self.store.get_topological_token_for_event(later_event_id),
+        )
+        self.get_success(self.store.purge_history(self.room_id, token, True))
+
+        self.assertIsNone(
+            self.store._shared_event_cache.get(self.event_id.encode("utf8")),
+        )
+        self.get_failure(self.store.get_event(self.event_id), NotFoundError)
@@ -14,11 +14,12 @@
 # limitations under the License.
 
 
-from mock import Mock
+from mock import Mock, patch
 
 from twisted.internet import defer
 
 from synapse.api.constants import EventTypes, Membership, RoomVersions
+from synapse.rest.client.v1 import room
 from synapse.types import RoomID, UserID
 
 from tests import unittest
@@ -83,3 +84,144 @@ class RoomMemberStoreTestCase(unittest.TestCase):
                 )
             ],
         )
+
+
+class JoinedHostCountsTestCase(unittest.HomeserverTestCase):
+
+    user_id = "@alice:test"
+    servlets = [room.register_servlets]
+
+    def make_homeserver(self, reactor, clock):
+        return self.setup_test_homeserver("test", http_client=None)
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+        self.event_builder_factory = hs.get_event_builder_factory()
+        self.event_creation_handler = hs.get_event_creation_handler()
+
+        self.room_id = self.helper.create_room_as(self.user_id)
+
+    def _inject_membership(self, user_id, membership):
+        builder = self.event_builder_factory.new(
+            RoomVersions.V1,
+            {
+                "type": EventTypes.Member,
+                "sender": user_id,
+                "state_key": user_id,
+                "room_id": self.room_id,
+                "content": {"membership": membership},
+            }
+        )
+        event, context = self.get_success(
+            self.event_creation_handler.create_new_client_event(builder)
+        )
+        self.get_success(self.store.persist_event(event, context))
+
+    def _get_counts(self):
+        return self.get_success(self.store.get_joined_host_counts(self.room_id))
+
+    def test_counts_follow_current_state(self):
+        self.assertEqual(self._get_counts(), {"test": 1})
+
+        self._inject_membership("@charlie:elsewhere", Membership.JOIN)
+        self._inject_membership("@bob:test", Membership.JOIN)
+        self.assertEqual(self._get_counts(), {"test": 2, "elsewhere": 1})
+
+        # changing profile doesn't change the count
+        self._inject_membership("@bob:test", Membership.JOIN)
+        self.assertEqual(self._get_counts(), {"test": 2, "elsewhere": 1})
+
+        # the last member on a server leaving removes the server
+        self._inject_membership("@charlie:elsewhere", Membership.LEAVE)
+        self._inject_membership("@bob:test", Membership.LEAVE)
+        self.assertEqual(self._get_counts(), {"test": 1})
+
+        # the index matches what we'd get by counting the members
+        self.assertEqual(
+            self._get_counts(),
+            self.get_success(self.store.runInteraction(
+                "count", self.store._count_joined_hosts_txn, self.room_id,
+            )),
+        )
+
+    def test_counts_before_event(self):
+        self._inject_membership("@charlie:elsewhere", Membership.JOIN)
+        ordering = self.get_success(self.store.get_room_max_stream_ordering())
+
+        def get_counts_before(stream_ordering):
+            return self.get_success(self.store.get_joined_host_counts_before(
+                self.room_id, stream_ordering,
+            ))
+
+        # the join is the latest change, so we don't know who was there before
+        self.assertIsNone(get_counts_before(ordering))
+
+        # but we do know for any event after it
+        self.assertEqual(
+            get_counts_before(ordering + 1), {"test": 1, "elsewhere": 1},
+        )
+
+        # until the state changes again
+        self._inject_membership("@charlie:elsewhere", Membership.LEAVE)
+        self.assertIsNone(get_counts_before(ordering + 1))
+
+    def test_background_update(self):
+        """The background update fills in the counts for existing rooms, and
+        until it has we count the members instead
+        """
+        self._inject_membership("@charlie:elsewhere", Membership.JOIN)
+
+        self.get_success(self.store.runInteraction(
+            "delete_counts",
+            lambda txn: txn.execute("DELETE FROM room_joined_host_counts"),
+        ))
+        self.get_success(self.store._simple_insert(
+            "background_updates",
+            {
+                "update_name": "room_joined_host_counts_populate",
+                "progress_json": "{}",
+            },
+        ))
+        self.store._joined_host_counts_populated = False
+        self.store.get_joined_host_counts.invalidate_all()
+
+        self.assertEqual(self._get_counts(), {"test": 1, "elsewhere": 1})
+
+        self.store._all_done = False
+        while not self.get_success(self.store.has_completed_background_updates()):
+            self.get_success(self.store.do_next_background_update(100), by=0.1)
+
+        self.store.get_joined_host_counts.invalidate_all()
+        self.assertEqual(self._get_counts(), {"test": 1, "elsewhere": 1})
+        self.assertTrue(self.store._joined_host_counts_populated)
+
+    def test_concurrently_inserted_count(self):
+        """If another transaction inserts the row for a host first (eg, the
+        background update), the change is added to it rather than failing
+        """
+        def add_and_get(change):
+            def f(txn):
+                self.store._add_to_joined_host_count_txn(
+                    txn, self.room_id, "elsewhere", change,
+                )
+                return self.store._simple_select_one_onecol_txn(
+                    txn,
+                    table="room_joined_host_counts",
+                    keyvalues={"room_id": self.room_id, "host": "elsewhere"},
+                    retcol="member_count",
+                )
+            return self.get_success(self.store.runInteraction("add", f))
+
+        self.assertEqual(add_and_get(2), 2)
+        self.assertEqual(add_and_get(1), 3)
+
+        # and the same without native upserts
+        engine_class = type(self.store.database_engine)
+        with patch.object(engine_class, "can_native_upsert", False):
+            self.assertEqual(add_and_get(-1), 2)
+            self.get_success(self.store._simple_delete(
+                "room_joined_host_counts",
+                {"room_id": self.room_id, "host": "elsewhere"},
+                "delete_count",
+            ))
+            self.assertEqual(add_and_get(1), 1)
@@ -14,6 +14,11 @@
 # limitations under the License.
 
 import logging
+import os
+import shutil
+import tempfile
+
+from mock import Mock, PropertyMock, patch
 
 from twisted.internet import defer
 
@@ -489,3 +494,154 @@ class StateStoreTestCase(tests.unittest.TestCase):
 
         self.assertEqual(is_all, True)
         self.assertDictEqual({(e5.type, e5.state_key): e5.event_id}, state_dict)
+
+
+class StateGroupChainTestCase(tests.unittest.HomeserverTestCase):
+
+    room_id = "!room:test"
+
+    def make_homeserver(self, reactor, clock):
+        config = self.default_config()
+        config.max_state_delta_hops = 3
+
+        hs = self.setup_test_homeserver(config=config)
+        return hs
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+        # build a chain longer than we now allow, as if it was created before
+        # max_state_delta_hops was lowered.
+        self.store._max_state_delta_hops = 100
+
+        self.state_groups = []
+        self.states = []
+        prev_group = None
+        state = {}
+        for i in range(8):
+            delta = {("test.type", "key%d" % (i,)): "$event%d:test" % (i,)}
+            state = dict(state)
+            state.update(delta)
+            prev_group = self.get_success(self.store.store_state_group(
+                "$event%d:test" % (i,), self.room_id, prev_group, delta, state,
+            ))
+            self.state_groups.append(prev_group)
+            self.states.append(state)
+
+        self.store._max_state_delta_hops = 3
+
+    def get_hops(self, state_group):
+        return self.get_success(self.store.runInteraction(
+            "test_count_hops",
+            self.store._count_state_group_hops_txn, state_group,
+        ))
+
+    def get_state(self, state_group):
+        return self.get_success(self.store._get_state_groups_from_groups(
+            [state_group], StateFilter.all(),
+        ))[state_group]
+
+    def test_get_state_without_recursive_cte(self):
+        """The fallback for old versions of sqlite gives the same results.
+        """
+        engine = self.store.database_engine
+        with patch.object(
+            type(engine), "supports_recursive_cte", new_callable=PropertyMock,
+        ) as supports_recursive_cte:
+            supports_recursive_cte.return_value = False
+            states = [self.get_state(group) for group in self.state_groups]
+            hops = [self.get_hops(group) for group in self.state_groups]
+
+        self.assertEqual(states, [self.get_state(g) for g in self.state_groups])
+        self.assertEqual(hops, [self.get_hops(g) for g in self.state_groups])
+        self.assertEqual(states, self.states)
+
+    def run_background_updates(self):
+        self.store._all_done = False
+        while not self.get_success(self.store.has_completed_background_updates()):
+            self.get_success(self.store.do_next_background_update(100), by=0.1)
+
+    def test_compaction(self):
+        """Lowering max_state_delta_hops schedules a background update which
+        shortens the existing chains.
+        """
+        self.assertGreater(self.get_hops(self.state_groups[-1]), 3)
+
+        self.get_success(self.store.runWithConnection(
+            self.store._schedule_state_group_chain_compaction,
+        ))
+        self.run_background_updates()
+
+        for state_group, state in zip(self.state_groups, self.states):
+            self.assertLessEqual(self.get_hops(state_group), 3)
+            self.assertEqual(self.get_state(state_group), state)
+
+        max_hops = self.get_success(self.store._simple_select_one_onecol(
+            "state_group_max_delta_hops", {}, "max_hops",
+        ))
+        self.assertEqual(max_hops, 3)
+
+
+class StateSnapshotCacheTestCase(tests.unittest.HomeserverTestCase):
+
+    room_id = "!room:test"
+
+    def make_homeserver(self, reactor, clock):
+        self.dir = tempfile.mkdtemp(prefix="synapse-tests-")
+        self.addCleanup(shutil.rmtree, self.dir)
+
+        config = self.default_config()
+        config.state_snapshot_cache_path = os.path.join(self.dir, "state")
+        config.state_snapshot_cache_size = 1024 * 1024
+
+        hs = self.setup_test_homeserver(config=config)
+        return hs
+
+    def prepare(self, reactor, clock, hs):
+        self.store = hs.get_datastore()
+
+        self.state = {
+            (EventTypes.Create, ""): "$create:test",
+            (EventTypes.Member, "@alice:test"): "$alice:test",
+            (EventTypes.Member, "@bob:test"): "$bob:test",
+        }
+        self.state_group = self.get_success(self.store.store_state_group(
+            "$bob:test", self.room_id, None, None, self.state,
+        ))
+
+        self.store._state_group_cache.invalidate_all()
+        self.store._state_group_members_cache.invalidate_all()
+
+        self.get_state_groups_from_groups = Mock(
+            side_effect=self.store._get_state_groups_from_groups,
+        )
+        self.store._get_state_groups_from_groups = (
+            self.get_state_groups_from_groups
+        )
+
+    def test_get_from_snapshot(self):
+        state = self.get_success(self.store._get_state_for_groups(
+            [self.state_group],
+        ))
+        self.assertEqual(state, {self.state_group: self.state})
+
+        state = self.get_success(self.store._get_state_for_groups(
+            [self.state_group],
+            StateFilter.from_types([(EventTypes.Member, "@bob:test")]),
+        ))
+        self.assertEqual(state, {
+            self.state_group: {(EventTypes.Member, "@bob:test"): "$bob:test"},
+        })
+
+        self.assertFalse(self.get_state_groups_from_groups.called)
+
+    def test_filled_from_database(self):
+        self.store._state_snapshot_cache.invalidate(self.state_group)
+
+        state = self.get_success(self.store._get_state_for_groups(
+            [self.state_group],
+        ))
+        self.assertEqual(state, {self.state_group: self.state})
+        self.assertTrue(self.get_state_groups_from_groups.called)
+
+        self.assertIsNotNone(self.store._state_snapshot_cache.get(self.state_group))
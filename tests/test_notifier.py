@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.internet import defer
+
+from synapse.api.constants import EventTypes, Membership
+from synapse.events import FrozenEvent
+
+from tests import unittest
+
+USER_ID = "@user:test"
+ROOM_ID = "!room:test"
+
+
+class NotifierTestCase(unittest.HomeserverTestCase):
+    def prepare(self, reactor, clock, hs):
+        self.notifier = hs.get_notifier()
+        self.event_sources = hs.get_event_sources()
+
+    def _wait_for_events(self, results):
+        """Start waiting for events for the user, recording the tokens each
+        time we're woken up.
+        """
+        from_token = self.get_success(self.event_sources.get_current_token())
+
+        def callback(before_token, after_token):
+            results.append(after_token)
+            return defer.succeed(None)
+
+        d = self.notifier.wait_for_events(
+            USER_ID, 10000, callback, room_ids=[ROOM_ID], from_token=from_token,
+        )
+        self.pump()
+        return d
+
+    def test_wakeups_coalesced(self):
+        results = []
+        self._wait_for_events(results)
+        self.assertEqual(results, [])
+
+        self.notifier.on_new_event("typing_key", 5, rooms=[ROOM_ID])
+        self.notifier.on_new_event("typing_key", 6, rooms=[ROOM_ID])
+        self.notifier.on_new_event("receipt_key", 3, users=[USER_ID])
+
+        # The listener isn't woken up until the end of the reactor tick, and
+        # then only once.
+        self.assertEqual(results, [])
+        self.reactor.advance(0)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0].typing_key, 6)
+        self.assertEqual(results[0].receipt_key, 3)
+
+        self.notifier.on_new_event("typing_key", 7, rooms=[ROOM_ID])
+        self.reactor.advance(0)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[1].typing_key, 7)
+
+    def test_other_rooms_not_woken(self):
+        results = []
+        self._wait_for_events(results)
+
+        self.notifier.on_new_event("typing_key", 5, rooms=["!other:test"])
+        self.reactor.advance(0)
+        self.assertEqual(results, [])
+
+    def test_leave_room(self):
+        results = []
+        self._wait_for_events(results)
+        self.assertIn(ROOM_ID, self.notifier.room_to_user_streams)
+
+        leave = FrozenEvent({
+            "event_id": "$leave:test",
+            "room_id": ROOM_ID,
+            "type": EventTypes.Member,
+            "state_key": USER_ID,
+            "sender": USER_ID,
+            "content": {"membership": Membership.LEAVE},
+        })
+        max_stream_id = self.hs.get_datastore().get_room_max_stream_ordering()
+        self.notifier.on_new_room_event(leave, max_stream_id, max_stream_id)
+
+        # The user is told about their leave, but then stops listening to
+        # the room.
+        self.reactor.advance(0)
+        self.assertEqual(len(results), 1)
+        self.assertNotIn(ROOM_ID, self.notifier.room_to_user_streams)
+
+        self.notifier.on_new_event("typing_key", 5, rooms=[ROOM_ID])
+        self.reactor.advance(0)
+        self.assertEqual(len(results), 1)
+
+    def test_expired_streams_removed_from_index(self):
+        # Wait for the listener to time out, and then for the stream to expire
+        self._wait_for_events([])
+        self.reactor.advance(20)
+        self.reactor.advance(self.notifier.UNUSED_STREAM_EXPIRY_MS / 1000. * 2)
+
+        self.assertEqual(self.notifier.user_to_user_stream, {})
+        self.assertEqual(self.notifier.room_to_user_streams, {})
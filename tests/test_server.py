@@ -15,6 +15,7 @@
 import logging
 import re
 
+from mock import patch
 from six import StringIO
 
 from twisted.internet.defer import Deferred
@@ -24,7 +25,7 @@ from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
 
 from synapse.api.errors import Codes, SynapseError
-from synapse.http.server import JsonResource
+from synapse.http.server import JsonResource, LazyJsonObject
 from synapse.http.site import SynapseSite, logger
 from synapse.util import Clock
 from synapse.util.logcontext import make_deferred_yieldable
@@ -36,6 +37,7 @@ from tests.server import (
     make_request,
     render,
     setup_test_homeserver,
+    wait_until_result,
 )
 
 
@@ -152,6 +154,49 @@ class JsonResourceTests(unittest.TestCase):
         self.assertEqual(channel.json_body["error"], "Unrecognized request")
         self.assertEqual(channel.json_body["errcode"], "M_UNRECOGNIZED")
 
+    def test_lazy_json_object(self):
+        """
+        A LazyJsonObject is encoded as it is written out, a buffer's worth at a
+        time.
+        """
+        generated = []
+
+        def _rooms():
+            for i in range(100):
+                generated.append(i)
+                yield "room%d" % (i,), {"events": ["event"] * 10}
+
+        def _callback(request, **kwargs):
+            return 200, LazyJsonObject([
+                ("rooms", LazyJsonObject(_rooms())),
+                ("empty", LazyJsonObject([])),
+                ("next_batch", "s1"),
+            ])
+
+        res = JsonResource(self.homeserver)
+        res.register_paths("GET", [re.compile("^/_matrix/foo$")], _callback)
+
+        request, channel = make_request(self.reactor, b"GET", b"/_matrix/foo")
+        with patch("synapse.http.server.JSON_STREAM_BUFFER_SIZE", 1000):
+            request.render(res)
+            self.reactor.advance(0)
+
+            # only the first buffer's worth has been generated so far
+            self.assertLess(len(generated), 100)
+            self.assertGreater(len(generated), 0)
+
+            wait_until_result(self.reactor, request)
+
+        self.assertEqual(channel.result["code"], b'200')
+        self.assertEqual(channel.headers.getRawHeaders(b"Content-Length"), None)
+        self.assertEqual(channel.json_body, {
+            "rooms": {
+                "room%d" % (i,): {"events": ["event"] * 10} for i in range(100)
+            },
+            "empty": {},
+            "next_batch": "s1",
+        })
+
 
 class SiteTestCase(unittest.HomeserverTestCase):
     def test_lose_connection(self):
@@ -241,6 +241,16 @@ class StateTestCase(unittest.TestCase):
             {"START", "A", "C"}, {e_id for e_id in prev_state_ids.values()}
         )
 
+        # the resolution should have been recorded against the room, until
+        # the next report
+        handler = self.state._state_resolution_handler
+        metrics = handler._state_res_metrics.get("!room_id:example.com")
+        self.assertIsNotNone(metrics)
+        self.assertEqual(metrics.count, 1)
+
+        handler._report_metrics()
+        self.assertEqual(len(handler._state_res_metrics), 0)
+
     @defer.inlineCallbacks
     def test_branch_have_banned_conflict(self):
         graph = Graph(
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import shutil
+import tempfile
+
+from mock import patch
+
+from synapse.util.caches.shared_memory_cache import _SLOTS_OFFSET, SharedMemoryCache
+
+from tests import unittest
+
+
+class SharedMemoryCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="synapse-tests-")
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "cache")
+
+    def _make_cache(self, max_size=64 * 1024, slot_size=256):
+        cache = SharedMemoryCache("test", self.path, max_size, slot_size=slot_size)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_get_set(self):
+        cache = self._make_cache()
+
+        self.assertIsNone(cache.get(b"key"))
+        self.assertTrue(cache.set(b"key", b"value"))
+        self.assertEquals(cache.get(b"key"), b"value")
+        self.assertEquals(len(cache), 1)
+
+    def test_invalidate(self):
+        cache = self._make_cache()
+
+        cache.set(b"key", b"value")
+        cache.invalidate(b"key")
+        self.assertIsNone(cache.get(b"key"))
+        self.assertEquals(len(cache), 0)
+
+    def test_len(self):
+        cache = self._make_cache()
+
+        cache.set(b"key1", b"value")
+        cache.set(b"key1", b"value2")
+        cache.set(b"key2", b"value")
+        self.assertEquals(len(cache), 2)
+
+        cache.invalidate(b"key1")
+        cache.invalidate(b"key1")
+        self.assertEquals(len(cache), 1)
+
+    def test_stale_set(self):
+        """A value loaded before the key was invalidated is not stored"""
+        cache = self._make_cache()
+
+        version = cache.get_version(b"key")
+        cache.invalidate(b"key")
+        self.assertFalse(cache.set(b"key", b"stale", version=version))
+        self.assertIsNone(cache.get(b"key"))
+
+        version = cache.get_version(b"key")
+        self.assertTrue(cache.set(b"key", b"value", version=version))
+        self.assertEquals(cache.get(b"key"), b"value")
+
+    def test_too_big(self):
+        cache = self._make_cache(slot_size=64)
+
+        self.assertFalse(cache.set(b"key", b"x" * 64))
+        self.assertIsNone(cache.get(b"key"))
+
+    def test_eviction(self):
+        # a cache with a single slot
+        cache = self._make_cache(max_size=256 + _SLOTS_OFFSET)
+
+        cache.set(b"key1", b"value1")
+        cache.set(b"key2", b"value2")
+        self.assertIsNone(cache.get(b"key1"))
+        self.assertEquals(cache.get(b"key2"), b"value2")
+
+    def test_shared(self):
+        """Entries written through one cache object are visible through another
+        mapping of the same file.
+        """
+        cache1 = self._make_cache()
+        cache2 = self._make_cache()
+
+        cache1.set(b"key", b"value")
+        self.assertEquals(cache2.get(b"key"), b"value")
+
+        cache2.invalidate(b"key")
+        self.assertIsNone(cache1.get(b"key"))
+
+    def test_half_written_slot(self):
+        """A slot left half-written by a dead process is treated as empty, and
+        can be written to again.
+        """
+        cache = self._make_cache(max_size=256 + _SLOTS_OFFSET)
+
+        cache.set(b"key", b"value")
+        cache._start_write(_SLOTS_OFFSET)
+        self.assertIsNone(cache.get(b"key"))
+
+        cache.set(b"key", b"value2")
+        self.assertEquals(cache.get(b"key"), b"value2")
+
+    def test_mismatched_settings(self):
+        self._make_cache(slot_size=256)
+
+        with self.assertRaises(ValueError):
+            self._make_cache(slot_size=512)
+
+    def test_out_of_space(self):
+        """If there isn't room for the file, we fail when creating the cache
+        rather than when we first write to it, and leave the file empty
+        """
+        with patch(
+            "os.posix_fallocate",
+            side_effect=OSError(errno.ENOSPC, "No space left on device"),
+            create=True,
+        ):
+            with self.assertRaises(OSError):
+                self._make_cache()
+
+        self.assertEquals(os.stat(self.path).st_size, 0)
+
+        # and we can create it once there is space
+        cache = self._make_cache()
+        cache.set(b"key", b"value")
+        self.assertEquals(cache.get(b"key"), b"value")
+
+    def test_fallocate_not_supported(self):
+        """We fall back to a sparse file if the filesystem can't allocate it"""
+        with patch(
+            "os.posix_fallocate",
+            side_effect=OSError(errno.EOPNOTSUPP, "Operation not supported"),
+            create=True,
+        ):
+            cache = self._make_cache()
+
+        cache.set(b"key", b"value")
+        self.assertEquals(cache.get(b"key"), b"value")
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+# Copyright 2019 New Vector Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import shutil
+import tempfile
+
+from mock import patch
+
+from synapse.api.constants import EventTypes
+from synapse.storage.state import StateFilter
+from synapse.util.caches.state_snapshot_cache import (
+    StateSnapshot,
+    StateSnapshotCache,
+    encode_state_snapshot,
+)
+
+from tests import unittest
+
+STATE = {
+    (EventTypes.Create, ""): "$create:test",
+    (EventTypes.Name, ""): "$name:test",
+    (EventTypes.Member, "@alice:test"): "$alice:test",
+    (EventTypes.Member, "@bob:test"): "$bob:test",
+    (EventTypes.Member, u"@éve:test"): u"$éve:test",
+}
+
+
+class StateSnapshotCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="synapse-tests-")
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "cache")
+
+    def _make_cache(self, max_size=256 * 1024, server_name="test", max_state_group=0):
+        cache = StateSnapshotCache(
+            "test", self.path, max_size,
+            server_name=server_name, max_state_group=max_state_group,
+        )
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_get_set(self):
+        cache = self._make_cache()
+
+        self.assertIsNone(cache.get(1))
+        self.assertTrue(cache.set(1, b"value"))
+        self.assertEquals(cache.get(1), b"value")
+        self.assertIsNone(cache.get(2))
+        self.assertEquals(len(cache), 1)
+
+    def test_invalidate(self):
+        cache = self._make_cache()
+
+        cache.set(1, b"value1")
+        cache.set(1 + cache._num_slots, b"value2")
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+
+        # entries in later slots can still be found
+        self.assertEquals(cache.get(1 + cache._num_slots), b"value2")
+        self.assertEquals(len(cache), 1)
+
+    def test_reset_when_full(self):
+        cache = self._make_cache()
+        value = b"x" * (cache._data_size // 3)
+
+        cache.set(1, value)
+        cache.set(2, value)
+        cache.set(3, value)
+        self.assertIsNone(cache.get(1))
+        self.assertIsNone(cache.get(2))
+        self.assertEquals(cache.get(3), value)
+
+    def test_shared(self):
+        """Entries written through one cache object are visible through another
+        mapping of the same file, such as one in a restarted process.
+        """
+        cache1 = self._make_cache()
+        cache1.set(1, b"value")
+
+        cache2 = self._make_cache(max_state_group=1)
+        self.assertEquals(cache2.get(1), b"value")
+
+        cache2.invalidate(1)
+        self.assertIsNone(cache1.get(1))
+
+    def test_mismatched_settings(self):
+        self._make_cache(max_size=256 * 1024)
+
+        with self.assertRaises(ValueError):
+            self._make_cache(max_size=512 * 1024)
+
+    def test_other_server(self):
+        """A file written by another server is reset"""
+        cache = self._make_cache()
+        cache.set(1, b"value")
+
+        cache = self._make_cache(server_name="other")
+        self.assertIsNone(cache.get(1))
+        self.assertEquals(len(cache), 0)
+
+    def test_database_restored(self):
+        """A file holding state groups beyond the database's latest is reset,
+        as their ids will be reused
+        """
+        cache = self._make_cache(max_state_group=1)
+        cache.set(1, b"value1")
+        cache.set(5, b"value5")
+
+        cache = self._make_cache(max_state_group=5)
+        self.assertEquals(cache.get(5), b"value5")
+
+        cache = self._make_cache(max_state_group=3)
+        self.assertIsNone(cache.get(1))
+        self.assertIsNone(cache.get(5))
+
+        # the file is now for the restored database
+        cache.set(4, b"value4")
+        cache = self._make_cache(max_state_group=4)
+        self.assertEquals(cache.get(4), b"value4")
+
+    def test_out_of_space(self):
+        """If there isn't room for the file, we fail when creating the cache"""
+        with patch(
+            "os.posix_fallocate",
+            side_effect=OSError(errno.ENOSPC, "No space left on device"),
+            create=True,
+        ):
+            with self.assertRaises(OSError):
+                self._make_cache()
+
+        self.assertEquals(os.stat(self.path).st_size, 0)
+
+
+class StateSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = StateSnapshot(encode_state_snapshot(STATE))
+
+    def test_full(self):
+        self.assertEquals(self.snapshot.filter_state(StateFilter.all()), STATE)
+
+    def test_empty(self):
+        snapshot = StateSnapshot(encode_state_snapshot({}))
+        self.assertEquals(snapshot.filter_state(StateFilter.all()), {})
+        self.assertEquals(
+            snapshot.filter_state(StateFilter.from_types([(EventTypes.Name, "")])),
+            {},
+        )
+
+    def test_filter(self):
+        state_filter = StateFilter.from_types([
+            (EventTypes.Member, "@bob:test"),
+            (EventTypes.Member, "@carol:test"),
+            (EventTypes.Name, None),
+            (EventTypes.Topic, ""),
+        ])
+
+        self.assertEquals(self.snapshot.filter_state(state_filter), {
+            (EventTypes.Member, "@bob:test"): "$bob:test",
+            (EventTypes.Name, ""): "$name:test",
+        })
+
+    def test_filter_with_others(self):
+        state_filter = StateFilter(
+            types={EventTypes.Member: frozenset([u"@éve:test"])},
+            include_others=True,
+        )
+
+        self.assertEquals(
+            self.snapshot.filter_state(state_filter),
+            state_filter.filter_state(STATE),
+        )
@@ -13,8 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from mock import patch
 
 from synapse.util.caches.dictionary_cache import DictionaryCache
+from synapse.util.caches.memory_budget import MemoryBudget, estimate_size
 
 from tests import unittest
 
@@ -89,3 +91,30 @@ class DictCacheTestCase(unittest.TestCase):
             },
             c.value,
         )
+
+    def test_update_memory_size(self):
+        """Partial updates to an entry in a cache with a memory budget are
+        charged by the size of what they add.
+        """
+        budget = MemoryBudget(100000)
+        with patch(
+            "synapse.util.caches.dictionary_cache.get_global_memory_budget",
+            return_value=budget,
+        ):
+            cache = DictionaryCache("budgeted")
+
+        key = "test_update_memory_size"
+        cache.update(cache.sequence, key, {"a": "x" * 10}, fetched_keys={"a"})
+        size = cache.cache.get_memory_size(key)
+
+        cache.update(
+            cache.sequence, key, {"b": "x" * 100}, fetched_keys={"b", "c"},
+        )
+        self.assertEqual(
+            cache.cache.get_memory_size(key),
+            # the fetched keys are all added to known_absent
+            size + estimate_size("b") + estimate_size("x" * 100)
+            + estimate_size("b") + estimate_size("c"),
+        )
+        self.assertEqual(budget.used_bytes, cache.cache.memory_usage())
+        self.assertEqual(cache.get(key).value, {"a": "x" * 10, "b": "x" * 100})
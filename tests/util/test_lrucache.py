@@ -13,13 +13,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gc
+import weakref
 
 from mock import Mock
 
 from synapse.util.caches.lrucache import LruCache
+from synapse.util.caches.memory_budget import MemoryBudget, estimate_size
 from synapse.util.caches.treecache import TreeCache
 
 from .. import unittest
+from ..utils import MockClock
 
 
 class LruCacheTestCase(unittest.TestCase):
@@ -43,6 +47,19 @@ class LruCacheTestCase(unittest.TestCase):
         self.assertEquals(cache.get(2), 2)
         self.assertEquals(cache.get(3), 3)
 
+    def test_items(self):
+        cache = LruCache(3)
+        cache[1] = "a"
+        cache[2] = "b"
+        cache[3] = "c"
+        cache.get(1)
+
+        self.assertEquals(cache.items(), [(1, "a"), (3, "c"), (2, "b")])
+
+        # listing the items doesn't count as using them
+        cache[4] = "d"
+        self.assertEquals(cache.items(), [(4, "d"), (1, "a"), (3, "c")])
+
     def test_setdefault(self):
         cache = LruCache(1)
         self.assertEquals(cache.setdefault("key", 1), 1)
@@ -255,3 +272,217 @@ class LruCacheSizedTestCase(unittest.TestCase):
         self.assertEquals(cache["key3"], [3])
         self.assertEquals(cache["key4"], [4])
         self.assertEquals(cache["key5"], [5, 6])
+
+
+class LruCacheMemoryBudgetTestCase(unittest.TestCase):
+    def test_evict_across_caches(self):
+        entry_size = estimate_size("key1") + estimate_size("x" * 100)
+        budget = MemoryBudget(entry_size * 3)
+
+        cache1 = LruCache(1000, memory_budget=budget)
+        cache2 = LruCache(1000, memory_budget=budget)
+
+        cache1["key1"] = "x" * 100
+        cache2["key2"] = "x" * 100
+        cache1["key3"] = "x" * 100
+        self.assertEquals(budget.used_bytes, entry_size * 3)
+        self.assertEquals(cache1.memory_usage(), entry_size * 2)
+        self.assertEquals(cache2.memory_usage(), entry_size)
+
+        # touching key1 makes key2, in the other cache, the oldest entry
+        cache1.get("key1")
+        cache1["key4"] = "x" * 100
+
+        self.assertEquals(cache2.get("key2"), None)
+        self.assertEquals(len(cache2), 0)
+        self.assertEquals(cache2.memory_usage(), 0)
+        self.assertEquals(len(cache1), 3)
+        self.assertEquals(budget.used_bytes, entry_size * 3)
+
+    def test_evicts_by_size(self):
+        budget = MemoryBudget(estimate_size("big") + estimate_size("x" * 1000))
+        cache = LruCache(1000, memory_budget=budget)
+
+        cache["a"] = True
+        cache["b"] = True
+        self.assertEquals(len(cache), 2)
+
+        cache["big"] = "x" * 1000
+        self.assertEquals(len(cache), 1)
+        self.assertEquals(cache["big"], "x" * 1000)
+
+    def test_max_size(self):
+        """The cache's own limit on its number of entries still applies"""
+        budget = MemoryBudget(10000)
+        cache = LruCache(2, memory_budget=budget)
+
+        cache["a"] = True
+        cache["b"] = True
+        cache["c"] = True
+        self.assertEquals(len(cache), 2)
+        self.assertEquals(cache.get("a"), None)
+        self.assertEquals(budget.used_bytes, cache.memory_usage())
+
+    def test_given_memory_size(self):
+        budget = MemoryBudget(10000)
+        cache = LruCache(1000, memory_budget=budget)
+
+        cache.set("key", "value", memory_size=100)
+        self.assertEquals(cache.get_memory_size("key"), 100)
+        self.assertEquals(budget.used_bytes, estimate_size("key") + 100)
+
+        cache.set("key", "value", memory_size=200)
+        self.assertEquals(budget.used_bytes, estimate_size("key") + 200)
+
+    def test_eviction_callbacks(self):
+        m = Mock()
+        budget = MemoryBudget(estimate_size("key1") + estimate_size("value"))
+        cache = LruCache(1000, memory_budget=budget)
+
+        cache.set("key1", "value", callbacks=[m])
+        self.assertEquals(m.call_count, 0)
+
+        cache.set("key2", "value")
+        self.assertEquals(m.call_count, 1)
+
+    def test_pop_and_clear(self):
+        budget = MemoryBudget(10000)
+        cache = LruCache(1000, memory_budget=budget)
+
+        cache["key1"] = "value"
+        cache["key2"] = "value"
+        cache.pop("key1")
+        self.assertEquals(budget.used_bytes, cache.memory_usage())
+
+        cache.clear()
+        self.assertEquals(budget.used_bytes, 0)
+        self.assertEquals(cache.memory_usage(), 0)
+
+    def test_resize(self):
+        budget = MemoryBudget(10000)
+        cache = LruCache(1000, memory_budget=budget)
+
+        cache["key"] = "x"
+        small = budget.used_bytes
+        cache["key"] = "x" * 100
+        self.assertEquals(budget.used_bytes, small + 99)
+
+
+class LruCacheExpiryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = MockClock()
+
+    def test_expiry(self):
+        m = Mock()
+        cache = LruCache(1000, expiry_ms=60 * 1000, clock=self.clock)
+
+        cache.set("key1", "value", callbacks=[m])
+        self.clock.advance_time(30)
+        cache.set("key2", "value")
+
+        # looking an entry up doesn't stop it expiring
+        self.clock.advance_time(25)
+        self.assertEquals(cache.get("key1"), "value")
+
+        self.clock.advance_time(10)
+        cache.expire()
+        self.assertEquals(cache.get("key1"), None)
+        self.assertEquals(cache.get("key2"), "value")
+        self.assertEquals(m.call_count, 1)
+
+        self.clock.advance_time(30)
+        cache.expire()
+        self.assertEquals(len(cache), 0)
+
+    def test_replace_resets_expiry(self):
+        cache = LruCache(1000, expiry_ms=60 * 1000, clock=self.clock)
+
+        cache["key"] = "value1"
+        self.clock.advance_time(50)
+        cache["key"] = "value2"
+
+        self.clock.advance_time(20)
+        cache.expire()
+        self.assertEquals(cache.get("key"), "value2")
+
+        self.clock.advance_time(50)
+        cache.expire()
+        self.assertEquals(cache.get("key"), None)
+
+    def test_idle_expiry(self):
+        evicted = Mock()
+        cache = LruCache(
+            1000, idle_expiry_ms=60 * 1000, clock=self.clock,
+            evicted_callback=evicted,
+        )
+
+        cache["key1"] = "value"
+        cache["key2"] = "value"
+
+        # keep key1 alive by looking it up
+        for _ in range(3):
+            self.clock.advance_time(40)
+            self.assertEquals(cache.get("key1"), "value")
+            cache.expire()
+
+        self.assertEquals(cache.get("key2"), None)
+        self.assertEquals(evicted.call_count, 1)
+
+        self.clock.advance_time(70)
+        cache.expire()
+        self.assertEquals(len(cache), 0)
+
+    def test_removed_entries(self):
+        cache = LruCache(
+            1000, keylen=2, cache_type=TreeCache, idle_expiry_ms=60 * 1000,
+            clock=self.clock,
+        )
+
+        cache[("a", "b")] = "value"
+        cache.del_multi(("a",))
+        cache[("a", "b")] = "value2"
+
+        self.clock.advance_time(40)
+        cache.expire()
+        self.assertEquals(cache.get(("a", "b")), "value2")
+
+        self.clock.advance_time(70)
+        cache.expire()
+        self.assertEquals(len(cache), 0)
+
+    def test_removed_entries_freed(self):
+        """The timer doesn't keep entries alive once they have been removed"""
+        class Value(object):
+            pass
+
+        cache = LruCache(1000, idle_expiry_ms=60 * 1000, clock=self.clock)
+
+        cache["key1"] = Value()
+        cache["key2"] = Value()
+        refs = [weakref.ref(cache["key1"]), weakref.ref(cache["key2"])]
+
+        cache.pop("key1")
+        cache.clear()
+        gc.collect()
+        self.assertEquals([ref() for ref in refs], [None, None])
+
+    def test_clear(self):
+        cache = LruCache(1000, idle_expiry_ms=60 * 1000, clock=self.clock)
+
+        cache["key"] = "value1"
+        cache.clear()
+        self.clock.advance_time(50)
+        cache["key"] = "value2"
+
+        # the entry from before the clear doesn't make the new one expire early
+        self.clock.advance_time(30)
+        cache.expire()
+        self.assertEquals(cache.get("key"), "value2")
+
+        self.clock.advance_time(70)
+        cache.expire()
+        self.assertEquals(len(cache), 0)
+
+    def test_clock_required(self):
+        with self.assertRaises(ValueError):
+            LruCache(1000, expiry_ms=60 * 1000)